@@ -58,6 +58,7 @@ from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
 from Bio.Alphabet import IUPAC
 from Bio.Nexus.Nexus import NexusError
+import numpy as np
 
 # ##################################################### WISH LIST #################################################### #
 # - Map features from a sequence file over to the alignment
@@ -188,6 +189,21 @@ class AlignBuddy(object):
         if len(self.alignments) == 0:
             return "AlignBuddy object contains no alignments.\n"
 
+        output = StringIO()
+        self._write_handle(output)
+        output = output.getvalue()
+        if self.out_format == "clustal":
+            return "%s\n\n" % output.rstrip()
+        else:
+            return "%s\n" % output.rstrip()
+
+    def _write_handle(self, handle):
+        """
+        Serialize alignments straight into a seekable text handle, without an intermediate temp file or string.
+        If AlignIO has to fall back on a different format, anything already written by this call is discarded first.
+        :param handle: Writable and seekable text handle (e.g., open file or StringIO)
+        :return: None
+        """
         # There is a weird bug in genbank write() that concatenates dots to the organism name (if set).
         # The following is a work around...
         if self.out_format in ["gb", "genbank"]:
@@ -204,34 +220,31 @@ class AlignBuddy(object):
             raise ValueError("%s format does not support multiple alignments in one file.\n" % self.out_format)
 
         if self.out_format == "phylipsr":
-            output = br.phylip_sequential_out(self)
+            handle.write(br.phylip_sequential_out(self))
 
         elif self.out_format == "phylipss":
-            output = br.phylip_sequential_out(self, relaxed=False)
-
-        else:
-            tmp_file = br.TempFile()
-            with open(tmp_file.path, "w", encoding="utf-8") as ofile:
-                try:
-                    AlignIO.write(self.alignments, ofile, self.out_format)
-                except ValueError as e:
-                    if "Sequences must all be the same length" in str(e):
-                        br._stderr("Warning: Alignment format detected but sequences are different lengths. "
-                                   "Format changed to fasta to accommodate proper printing of records.\n\n")
-                        AlignIO.write(self.alignments, ofile, "fasta")
-                    elif "Repeated name" in str(e) and self.out_format == "phylip":
-                        br._stderr("Warning: Phylip format returned a 'repeat name' error, probably due to truncation. "
-                                   "Format changed to phylip-relaxed.\n")
-                        AlignIO.write(self.alignments, ofile, "phylip-relaxed")
-                    else:
-                        raise e
+            handle.write(br.phylip_sequential_out(self, relaxed=False))
 
-            with open(tmp_file.path, "r", encoding="utf-8") as ifile:
-                output = ifile.read()
-        if self.out_format == "clustal":
-            return "%s\n\n" % output.rstrip()
         else:
-            return "%s\n" % output.rstrip()
+            start = handle.tell()
+            try:
+                AlignIO.write(self.alignments, handle, self.out_format)
+            except ValueError as e:
+                if "Sequences must all be the same length" in str(e):
+                    br._stderr("Warning: Alignment format detected but sequences are different lengths. "
+                               "Format changed to fasta to accommodate proper printing of records.\n\n")
+                    handle.seek(start)
+                    handle.truncate()
+                    AlignIO.write(self.alignments, handle, "fasta")
+                elif "Repeated name" in str(e) and self.out_format == "phylip":
+                    br._stderr("Warning: Phylip format returned a 'repeat name' error, probably due to truncation. "
+                               "Format changed to phylip-relaxed.\n")
+                    handle.seek(start)
+                    handle.truncate()
+                    AlignIO.write(self.alignments, handle, "phylip-relaxed")
+                else:
+                    raise e
+        return
 
     def set_format(self, in_format):
         self.out_format = br.parse_format(in_format)
@@ -260,14 +273,30 @@ class AlignBuddy(object):
         return lengths
 
     def write(self, file_path, out_format=None):
-        with open(file_path, "w", encoding="utf-8") as ofile:
-            if out_format:
-                out_format_save = str(self.out_format)
-                self.set_format(out_format)
-                ofile.write(str(self))
-                self.set_format(out_format_save)
-            else:
-                ofile.write(str(self))
+        """
+        Stream alignments to disk. The file contents are identical to str(self), but the full output string is never
+        built.
+        :param file_path: Path to the output file
+        :param out_format: Optionally write in a format other than self.out_format
+        :return: None
+        """
+        out_format_save = str(self.out_format)
+        if out_format:
+            self.set_format(out_format)
+        try:
+            with open(file_path, "w", encoding="utf-8") as ofile:
+                # Empty alignments are dropped by __str__(), so let it deal with them (and with empty objects)
+                if not self.alignments or not all([len(alignment) for alignment in self.alignments]):
+                    ofile.write(str(self))
+                    return
+                self._write_handle(ofile)
+
+            br.rstrip_file(file_path)
+            if self.out_format == "clustal":
+                with open(file_path, "a", encoding="utf-8") as ofile:
+                    ofile.write("\n")
+        finally:
+            self.out_format = out_format_save
         return
 
 
@@ -288,15 +317,15 @@ def guess_alphabet(alignments):
         seq_list += [str(x.seq) for x in alignment]
 
     sequence = "".join(seq_list).upper()
-    sequence = re.sub("[NX\-?]", "", sequence)
+    seq_len = len(sequence) - sum([sequence.count(char) for char in "NX-?"])
 
-    if len(sequence) == 0:
+    if seq_len == 0:
         return None
 
     if 'U' in sequence:  # U is unique to RNA
         return IUPAC.ambiguous_rna
 
-    percent_dna = len(re.findall("[ATCG]", sequence)) / float(len(sequence))
+    percent_dna = sum([sequence.count(char) for char in "ATCG"]) / float(seq_len)
     if percent_dna > 0.85:  # odds that a sequence with no Us and such a high ATCG count be anything but DNA is low
         return IUPAC.ambiguous_dna
     else:
@@ -312,20 +341,20 @@ def guess_format(_input):  # _input can be list, SeqBuddy object, file handle, o
     if _input.__class__.__name__ == 'AlignBuddy':
         return _input.in_format
 
-    # If input is a handle or path, try to read the file in each format, and assume success if not error and # seqs > 0
+    # If input is a handle or path, sniff the header and assume success if the first alignment parses without error
     if os.path.isfile(str(_input)):
         _input = open(_input, "r", encoding="utf-8")
 
     if str(type(_input)) == "<class '_io.TextIOWrapper'>" or isinstance(_input, StringIO):
         if not _input.seekable():  # Deal with input streams (e.g., stdout pipes)
             _input = StringIO(_input.read().decode("utf-8"))
-        if _input.read() == "":
+        if _input.read(1) == "":
             return "empty file"
         _input.seek(0)
 
         possible_formats = ["gb", "phylipss", "phylipsr", "phylip", "phylip-relaxed",
                             "stockholm", "fasta", "nexus", "clustal"]
-        for next_format in possible_formats:
+        for next_format in br.sniff_format(_input, possible_formats):
             try:
                 _input.seek(0)
                 if next_format in ["phylip", "phylipsr", "phylipss"]:
@@ -335,11 +364,13 @@ def guess_format(_input):  # _input can be list, SeqBuddy object, file handle, o
                     else:
                         continue
 
-                if list(AlignIO.parse(_input, next_format)):
+                if next(AlignIO.parse(_input, next_format)):
                     _input.seek(0)
                     return br.parse_format(next_format)
                 else:
                     continue
+            except StopIteration:
+                continue
             except br.PhylipError:
                 continue
             except NexusError:
@@ -354,14 +385,105 @@ def guess_format(_input):  # _input can be list, SeqBuddy object, file handle, o
 
 
 def make_copy(alignbuddy):
-    alphabet_list = [rec.seq.alphabet for rec in alignbuddy.records()]
-    _copy = deepcopy(alignbuddy)
-    _copy.alpha = alignbuddy.alpha
-    for indx, rec in enumerate(_copy.records()):
-        rec.seq.alphabet = alphabet_list[indx]
+    """
+    Copy an AlignBuddy object. Records are copied with br.copy_record(), so the (immutable) sequence strings are
+    shared with the original instead of being duplicated, while everything mutable is deep copied.
+    :param alignbuddy: AlignBuddy object
+    :return: AlignBuddy object
+    """
+    memo = {id(alignbuddy.alpha): alignbuddy.alpha}
+    _copy = alignbuddy.__class__.__new__(alignbuddy.__class__)
+    for key, value in alignbuddy.__dict__.items():
+        if key == "alignments":
+            alignments = []
+            for alignment in value:
+                new_alignment = alignment.__class__.__new__(alignment.__class__)
+                for aln_key, aln_value in alignment.__dict__.items():
+                    if aln_key == "_records":
+                        aln_value = [br.copy_record(rec, memo) for rec in aln_value]
+                    elif aln_key == "_alphabet":
+                        pass
+                    else:
+                        aln_value = deepcopy(aln_value, memo)
+                    new_alignment.__dict__[aln_key] = aln_value
+                alignments.append(new_alignment)
+            value = alignments
+        else:
+            value = deepcopy(value, memo)
+        _copy.__dict__[key] = value
     return _copy
 
 
+def _alignment_matrix(alignment):
+    """
+    View an alignment as a 2D numpy array, with one row per record and one column per alignment column, so column
+    operations can be vectorized. Residues are stored as single bytes, or as 32-bit code points if any sequence holds
+    characters outside of latin-1. Convert selected columns back into an alignment with _select_columns().
+    :param alignment: MultipleSeqAlignment object
+    :return: Read-only numpy array of shape (num records, alignment length)
+    """
+    seqs = [str(rec.seq) for rec in alignment]
+    length = len(seqs[0]) if seqs else 0
+    if any([len(seq) != length for seq in seqs]):
+        raise ValueError("Sequences must all be the same length")
+    seqs = "".join(seqs)
+    try:
+        matrix = np.frombuffer(seqs.encode("latin-1"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        matrix = np.frombuffer(seqs.encode("utf-32-le"), dtype=np.uint32)
+    return matrix.reshape(len(alignment), length)
+
+
+def _matrix2str(row):
+    """
+    Convert one row (or any 1D slice) of an alignment matrix back into a string
+    :param row: numpy array from _alignment_matrix()
+    :return: str
+    """
+    return row.tobytes().decode("latin-1" if row.dtype == np.uint8 else "utf-32-le")
+
+
+def _select_columns(alignment, columns, matrix=None):
+    """
+    Build a new alignment from a selection of columns (in any order, and repeats are allowed). Records keep their ids,
+    names, descriptions and per-letter annotations, and the alignment keeps its per-column annotations. Features,
+    annotations and dbxrefs are not carried over (see FeatureReMapper).
+    :param alignment: MultipleSeqAlignment object
+    :param columns: Column indices (list or numpy array)
+    :param matrix: The alignment as returned by _alignment_matrix(), if it has already been built
+    :return: MultipleSeqAlignment object
+    """
+    matrix = _alignment_matrix(alignment) if matrix is None else matrix
+    columns = np.asarray(columns, dtype=np.intp)
+    return _rows2alignment(alignment, columns, [_matrix2str(row) for row in matrix[:, columns]])
+
+
+def _rows2alignment(alignment, columns, rows):
+    """
+    Assemble the output of _select_columns() from sequence strings that have already been gathered
+    :param alignment: The MultipleSeqAlignment object that the columns were selected from
+    :param columns: numpy array of the selected column indices
+    :param rows: One sequence string per record, in the same order as the alignment
+    :return: MultipleSeqAlignment object
+    """
+    def take(value):
+        selected = [value[col] for col in columns.tolist()]
+        return "".join(selected) if isinstance(value, str) else selected
+
+    records = []
+    for rec, row in zip(alignment, rows):
+        new_rec = SeqRecord(Seq(row, alphabet=rec.seq.alphabet),
+                            id=rec.id, name=rec.name, description=rec.description)
+        for key, value in rec.letter_annotations.items():
+            new_rec.letter_annotations[key] = take(value)
+        records.append(new_rec)
+
+    new_alignment = MultipleSeqAlignment(records, alphabet=alignment._alphabet)
+    for key, value in alignment.column_annotations.items():
+        new_alignment.column_annotations[key] = take(value)
+    return new_alignment
+
+
 class FeatureReMapper(object):
     """
     Build a list that maps original alignment columns to new positions if columns have been removed
@@ -394,6 +516,23 @@ class FeatureReMapper(object):
                 self.position_map.append((self.position_map[-1][0], False))
         return
 
+    def extend_many(self, exists):
+        """
+        Same as calling extend() once for each column, for a whole run of columns at a time
+        :param exists: Sequence of bools (e.g., numpy array), specifying whether each column exists or not
+        """
+        exists = np.asarray(exists, dtype=bool)
+        if not len(exists):
+            return
+        new_positions = np.cumsum(exists)
+        if self.starting_position_filled:
+            new_positions += self.position_map[-1][0]
+        else:
+            new_positions = np.maximum(new_positions - 1, 0)
+            self.starting_position_filled = bool(exists.any())
+        self.position_map += list(zip(new_positions.tolist(), exists.tolist()))
+        return
+
     def remap_features(self, old_alignment, new_alignment):
         """
         Add all the features from old_alignment that still exist onto new_alignment
@@ -401,6 +540,12 @@ class FeatureReMapper(object):
         :param old_alignment: AlignRecord
         :param new_alignment: AlignRecord
         """
+        # For each column, the index of the first retained column at or after it
+        next_present = [len(self.position_map)] * (len(self.position_map) + 1)
+        for indx in range(len(self.position_map) - 1, -1, -1):
+            next_present[indx] = indx if self.position_map[indx][1] else next_present[indx + 1]
+        self._next_present = next_present
+
         new_records = list(new_alignment)
         for indx, rec in enumerate(old_alignment):
             new_features = []
@@ -419,13 +564,13 @@ class FeatureReMapper(object):
         :param feature: A feature from the old alignment
         """
         if type(feature.location) == FeatureLocation:
-            for pos, present in self.position_map[feature.location.start:feature.location.end]:
-                if present:
-                    start = pos
-                    end = self.position_map[feature.location.end - 1][0] + 1
-                    location = FeatureLocation(start, end, strand=feature.location.strand)
-                    feature.location = location
-                    return feature
+            first_present = self._next_present[min(max(int(feature.location.start), 0), len(self.position_map))]
+            if first_present < min(int(feature.location.end), len(self.position_map)):
+                start = self.position_map[first_present][0]
+                end = self.position_map[feature.location.end - 1][0] + 1
+                location = FeatureLocation(start, end, strand=feature.location.strand)
+                feature.location = location
+                return feature
             else:
                 return None
 
@@ -463,46 +608,68 @@ def alignment_lengths(alignbuddy):
     return output
 
 
-def bootstrap(alignbuddy, num_bootstraps=1, r_seed=None):
+def bootstrap(alignbuddy, num_bootstraps=1, r_seed=None, max_processes=1):
     """
     Sample len(alignbuddy) columns with replacement, and make new alignment(s)
     :param alignbuddy: The AlignBuddy object to be bootstrapped
     :type alignbuddy: AlignBuddy
     :param num_bootstraps: The number of new alignments to be generated
     :param r_seed: Set a seed value so 'random' numbers are reproducible
+    :param max_processes: Number of worker processes (0 for br.usable_cpu_count()). Output does not depend on this.
     :rtype: AlignBuddy
     """
-    rand_gen = random.Random() if not r_seed else random.Random(r_seed)
-
-    new_alignments = []
-    for align_indx, alignment in enumerate(alignbuddy.alignments):
-        alignment = [[res for res in str(seq.seq)] for seq in alignment]
-        align_length = len(alignment[0])
-        num_seqs = len(alignment)
-        for _ in range(num_bootstraps):
-            # Instantiate an empty list of lists
-            align_as_lists = [['' for _ in range(align_length)] for _ in range(num_seqs)]
-            for res_indx in range(align_length):
-                column = rand_gen.randint(0, align_length - 1)
-                for seq_indx in range(num_seqs):
-                    align_as_lists[seq_indx][res_indx] = alignment[seq_indx][column]
-
-            align_as_lists = ["".join(seq) for seq in align_as_lists]
-            alb_copy = make_copy(alignbuddy)
-            for copy_indx, seq in enumerate(alb_copy.alignments[align_indx]):
-                seq.seq = Seq(align_as_lists[copy_indx], alphabet=seq.seq.alphabet)
-                seq.features = []
-                align_as_lists[copy_indx] = seq
-
-            new_alignment = MultipleSeqAlignment(align_as_lists, alphabet=alignbuddy.alpha)
-            new_alignments.append(new_alignment)
-
+    new_alignments = list(bootstrap_replicates(alignbuddy, num_bootstraps, r_seed, max_processes))
     alignbuddy = AlignBuddy(new_alignments, out_format=alignbuddy.out_format)
     if alignbuddy.out_format == "nexus":
         alignbuddy.out_format = "phylip-relaxed"
     return alignbuddy
 
 
+def bootstrap_replicates(alignbuddy, num_bootstraps=1, r_seed=None, max_processes=1):
+    """
+    Lazily generate bootstrap replicates, one MultipleSeqAlignment at a time (all replicates of the first alignment,
+    then all replicates of the second, etc.). Every replicate draws its columns from its own random stream spawned
+    from r_seed, so the output is the same no matter how many processes are used.
+    Features are dropped, because they no longer mean anything after resampling.
+    :param alignbuddy: The AlignBuddy object to be bootstrapped
+    :type alignbuddy: AlignBuddy
+    :param num_bootstraps: The number of new alignments to be generated from each alignment
+    :param r_seed: Set a seed value so 'random' numbers are reproducible
+    :param max_processes: Number of worker processes (0 for br.usable_cpu_count())
+    :return: Generator of MultipleSeqAlignment objects
+    """
+    seed_seq = np.random.SeedSequence(r_seed) if r_seed else np.random.SeedSequence()
+    for alignment, align_seed in zip(alignbuddy.alignments, seed_seq.spawn(len(alignbuddy.alignments))):
+        matrix = _alignment_matrix(alignment)
+        replicate_seeds = align_seed.spawn(num_bootstraps)
+        if max_processes == 1:
+            replicates = (_bootstrap_replicate(seed, [matrix]) for seed in replicate_seeds)
+        else:
+            replicates = _mc_bootstrap_replicates(matrix, replicate_seeds, max_processes)
+
+        for columns, rows in replicates:
+            new_alignment = _rows2alignment(alignment, columns, rows)
+            for rec, new_rec in zip(alignment, new_alignment):
+                new_rec.annotations = dict(rec.annotations)
+                new_rec.dbxrefs = list(rec.dbxrefs)
+            yield new_alignment
+
+
+def _bootstrap_replicate(seed, args):
+    matrix = args[0]
+    columns = np.random.default_rng(seed).integers(0, matrix.shape[1], matrix.shape[1])
+    return columns, [_matrix2str(row) for row in matrix[:, columns]]
+
+
+def _mc_bootstrap_replicates(matrix, replicate_seeds, max_processes):
+    # Replicates are generated in batches, so only a few of them are ever held in memory at once
+    with br.MultiCoreExecutor(_bootstrap_replicate, [matrix], max_processes=max_processes) as executor:
+        batch_size = executor.max_processes * 2
+        for indx in range(0, len(replicate_seeds), batch_size):
+            for replicate in executor.map(replicate_seeds[indx:indx + batch_size]):
+                yield replicate
+
+
 def clean_seq(alignbuddy, ambiguous=True, rep_char="N", skip_list=None):
     """
     Remove all non-sequence charcters from sequence strings (wraps SeqBuddy function)
@@ -644,18 +811,17 @@ def consensus_sequence(alignbuddy):
     for alignment in alignbuddy.alignments:
         alpha = guess_alphabet(alignment)
         ambig_char = "X" if alpha == IUPAC.protein else "N"
+        matrix = _alignment_matrix(alignment)
         new_seq = ""
-        for indx in range(alignment.get_alignment_length()):
-            residues = {}
-            for rec in alignment:
-                residue = rec.seq[indx]
-                residues.setdefault(residue, 0)
-                residues[residue] += 1
-            residues = sorted(residues.items(), key=lambda x: x[1], reverse=True)
-            if len(residues) == 1 or residues[0][1] != residues[1][1]:
-                new_seq += residues[0][0]
-            else:
-                new_seq += ambig_char
+        if matrix.size:
+            # Count each residue in every column, then find the most common one and check it for ties
+            residues = np.unique(matrix)
+            counts = np.stack([(matrix == residue).sum(axis=0) for residue in residues])
+            top = counts.argmax(axis=0)
+            top_counts = counts.max(axis=0)
+            tied = (counts == top_counts).sum(axis=0) > 1
+            consensus = np.where(tied, ord(ambig_char), residues[top]).astype(matrix.dtype)
+            new_seq = _matrix2str(consensus)
         new_seq = Seq(new_seq, alphabet=alpha)
         description = "Original sequences: %s" % ", ".join([rec.id for rec in alignment])
         new_seq = SeqRecord(new_seq, id="consensus", name="consensus",
@@ -796,12 +962,13 @@ def extract_feature_sequences(alignbuddy, patterns):
     new_alignments = []
     for alignment in alignbuddy.alignments:
         keep_ranges = []
+        feature_indices = [br.FeatureIndex(rec.features) for rec in alignment]
         for pat in single_patterns:
             matches = []
-            for rec in alignment:
-                for feat in rec.features:
-                    if re.search(pat, feat.type):
-                        matches.append([int(feat.location.start), int(feat.location.end)])
+            for feature_index in feature_indices:
+                for indx in feature_index.match_type(pat):
+                    feat = feature_index.features[indx]
+                    matches.append([int(feat.location.start), int(feat.location.end)])
             if matches:
                 matches = sorted(matches, key=lambda x: x[0])
                 start, end = matches[0]
@@ -816,16 +983,12 @@ def extract_feature_sequences(alignbuddy, patterns):
         for pat in range_patterns:
             start, end = len(alignment[0]), 0
             pat1, pat2 = False, False
-            for rec in alignment:
-                for feat in rec.features:
-                    if re.search(pat[0], feat.type):
-                        start = int(feat.location.start) if int(feat.location.start) < start else start
-                        end = int(feat.location.end) if int(feat.location.end) > end else end
-                        pat1 = True
-                    if re.search(pat[1], feat.type):
-                        start = int(feat.location.start) if int(feat.location.start) < start else start
-                        end = int(feat.location.end) if int(feat.location.end) > end else end
-                        pat2 = True
+            for feature_index in feature_indices:
+                first, second = feature_index.match_type(pat[0]), feature_index.match_type(pat[1])
+                if first or second:
+                    rec_start, rec_end = feature_index.span(first + second)
+                    start, end = min(start, rec_start), max(end, rec_end)
+                    pat1, pat2 = pat1 or bool(first), pat2 or bool(second)
             if pat1 and pat2:
                 keep_ranges.append([start, end])
 
@@ -1059,20 +1222,21 @@ def generate_msa(seqbuddy, alias, params=None, keep_temp=None, quiet=False):
                     output = contents
                 alignbuddy = AlignBuddy(output, out_format=seqbuddy.out_format)
 
+                sb_recs = OrderedDict()
+                for sb_rec in seqbuddy.records:
+                    sb_recs.setdefault(sb_rec.id, []).append(sb_rec)
                 seqbuddy_recs = []
                 for alb_rec in alignbuddy.records():
-                    for indx, sb_rec in enumerate(seqbuddy.records):
-                        if sb_rec.id == alb_rec.id:
-                            seqbuddy_recs.append(sb_rec)
-                            del seqbuddy.records[indx]
-                            break
+                    if sb_recs.get(alb_rec.id):
+                        seqbuddy_recs.append(sb_recs[alb_rec.id].pop(0))
 
                 seqbuddy.records = seqbuddy_recs
                 # ToDo: Change remap_gapped_features to multicore
                 br.remap_gapped_features(seqbuddy_recs, alignbuddy.records())
 
-                for _hash, sb_rec in seqbuddy.hash_map.items():
-                    rename(alignbuddy, _hash, sb_rec)
+                hashed_seqbuddy = Sb.SeqBuddy(alignbuddy.records())
+                hashed_seqbuddy.hash_map = seqbuddy.hash_map
+                hashed_seqbuddy.reverse_hashmap()
 
                 if keep_temp:
                     # Loop through each saved file and rename any hashes that have been carried over
@@ -1080,8 +1244,7 @@ def generate_msa(seqbuddy, alias, params=None, keep_temp=None, quiet=False):
                         for next_file in files:
                             with open("%s%s%s" % (root, os.path.sep, next_file), "r", encoding="utf-8") as ifile:
                                 contents = ifile.read()
-                            for _hash, sb_rec in seqbuddy.hash_map.items():
-                                contents = re.sub(_hash, sb_rec, contents)
+                            contents = br.Unhasher(seqbuddy.hash_map).sub(contents)
                             with open("%s%s%s" % (root, os.path.sep, next_file), "w", encoding="utf-8") as ofile:
                                 ofile.write(contents)
 
@@ -1121,15 +1284,16 @@ def hash_ids(alignbuddy, hash_length=10, r_seed=None):
         alignbuddy_copy = make_copy(alignbuddy)
         re_apply_hash_map = True
         records = alignbuddy_copy.records_dict()
-        reverse_hashmap_ids = [rec_id for _hash, rec_id in alignbuddy.hash_map.items()]
-        reverse_hashmap_hashes = [_hash for _hash, rec_id in alignbuddy.hash_map.items()]
+        reverse_hashmap = {}
+        for _hash, rec_id in alignbuddy.hash_map.items():
+            reverse_hashmap.setdefault(rec_id, _hash)
 
         for rec_id, rec_list in records.items():
-            if rec_id not in reverse_hashmap_ids:
+            if rec_id not in reverse_hashmap:
                 re_apply_hash_map = False
                 break
             for rec in rec_list:
-                _hash = reverse_hashmap_hashes[reverse_hashmap_ids.index(rec_id)]
+                _hash = reverse_hashmap[rec_id]
                 rec.id = _hash
                 rec.name = _hash
 
@@ -1167,30 +1331,21 @@ def map_features2alignment(seqbuddy, alignbuddy):
     :return: The modified AlignBuddy object
     :rtype: AlignBuddy
     """
-    def feat_map(feat, _sb_rec, _alb_rec):
+    def feat_map(feat, _columns):
         new_location = feat.location
         if type(feat.location) == FeatureLocation:
-            chars = 0
-            start = None
-            end = None
-            for indx, residue in enumerate(str(alb_rec.seq)):
-                if residue not in GAP_CHARS:
-                    chars += 1
-
-                if start is None and chars - 1 == feat.location.start:
-                    start = int(indx)
-
-                if chars == feat.location.end:
-                    end = int(indx) + 1
-
-                if None not in [start, end]:
-                    new_location = FeatureLocation(start, end)
-                    break
+            # _columns holds the alignment column of each residue, so residue positions are converted by lookup
+            start, end = int(feat.location.start), int(feat.location.end)
+            if 0 <= start < len(_columns) and 0 <= end <= len(_columns):
+                if start < end:
+                    new_location = FeatureLocation(int(_columns[start]), int(_columns[end - 1]) + 1)
+                elif end or _columns[0]:
+                    new_location = FeatureLocation(int(_columns[start]), int(_columns[end]))
 
         else:  # CompoundLocation
             parts = []
             for sub_feature in feat.location.parts:
-                parts.append(feat_map(SeqFeature(sub_feature), _sb_rec, _alb_rec).location)
+                parts.append(feat_map(SeqFeature(sub_feature), _columns).location)
             new_location = CompoundLocation(parts, operator='order')
         feat.location = new_location
         return feat
@@ -1201,8 +1356,9 @@ def map_features2alignment(seqbuddy, alignbuddy):
         sb_rec.features = br.shift_features(sb_rec.features, 0, len(sb_rec.seq))  # Cleans weird start/end positions
         if sb_rec.id in alb_recs:
             for alb_rec in alb_recs[sb_rec.id]:
+                columns = br.residue_columns(alb_rec.seq, GAP_CHARS)
                 for feature in sb_rec.features:
-                    alb_rec.features.append(feat_map(feature, sb_rec, alb_rec))
+                    alb_rec.features.append(feat_map(feature, columns))
     return alignbuddy
 
 
@@ -1314,7 +1470,7 @@ def trimal(alignbuddy, threshold):
     :return: The trimmed AlignBuddy object
     :rtype: AlignBuddy
     """
-    def gappyout(_gap_distr, _position_map):
+    def gappyout(_gap_distr):
         _max_gaps = 0
         # If there are no columns with zero gaps, scan through the distribution to find where the columns start
         for i in _gap_distr:
@@ -1369,85 +1525,49 @@ def trimal(alignbuddy, threshold):
 
             active_pointer = prev_pointer2
 
-        cuts = []
-        for col, gaps in enumerate(each_column):
-            if gaps <= _max_gaps:
-                cuts.append(col)
-                _position_map.extend(True)
-            else:
-                _position_map.extend(False)
-
-        _new_alignment = alignment[:, 0:0]
-        for _col in cuts:
-            _new_alignment += alignment[:, _col:_col + 1]
-
-        return _new_alignment
+        return _max_gaps
 
     for alignment_index, alignment in enumerate(alignbuddy.alignments):
         if not alignment:
             continue  # Prevent crash if the alignment doesn't have any records in it
+        matrix = _alignment_matrix(alignment)
+        num_columns = matrix.shape[1]
+        each_column = (matrix == ord("-")).sum(axis=0)
         # gap_distr is the number of columns w/ each possible number of gaps; the index is == to number of gaps
-        gap_distr = [0 for _ in range(len(alignment) + 1)]
-        num_columns = alignment.get_alignment_length()
-        each_column = [0 for _ in range(num_columns)]
-
-        # Each position_map index corresponds to the original column position, values are tuples of the new position
-        # and whether the column still exists (True) or has been deleted (False)
-        position_map = FeatureReMapper()
+        gap_distr = np.bincount(each_column, minlength=len(alignment) + 1).tolist()
 
         max_gaps = 0
-        for indx in range(num_columns):
-            num_gaps = len(re.findall("-", str(alignment[:, indx])))
-            gap_distr[num_gaps] += 1
-            each_column[indx] = num_gaps
-
         # Remove any columns with any gaps
         if threshold in ["no_gaps", "all"]:
             threshold = 0
-            new_alignment = alignment[:, 0:0]
-            for next_col, num_gaps in enumerate(each_column):
-                if num_gaps <= max_gaps:
-                    new_alignment += alignment[:, next_col:next_col + 1]
-                    position_map.extend(True)
-                else:
-                    position_map.extend(False)
 
         # Remove any columns that contain nothing but gaps
         elif threshold == "clean":
             max_gaps = len(alignment) - 1
-            new_alignment = alignment[:, 0:0]
-            for next_col, num_gaps in enumerate(each_column):
-                if num_gaps <= max_gaps:
-                    new_alignment += alignment[:, next_col:next_col + 1]
-                    position_map.extend(True)
-                else:
-                    position_map.extend(False)
 
         # trimAl algorithm for removing gaps, depending on size of alignment and distribution of seqs
         elif threshold == "gappyout":
-            new_alignment = gappyout(gap_distr, position_map)
+            max_gaps = gappyout(gap_distr)
+
+        elif threshold in ["strict", "strictplus"]:  # ToDo: Implement
+            raise NotImplementedError("%s not an implemented trimal method" % threshold)
 
-        elif threshold == "strict":  # ToDo: Implement
-            new_alignment = False
-        elif threshold == "strictplus":  # ToDo: Implement
-            new_alignment = False
         elif type(threshold) in [int, float]:
             if threshold >= 1:
                 max_gaps = round(threshold)
             else:
                 threshold = 0.0001 if threshold == 0 else threshold
                 max_gaps = round(len(alignment) * threshold)
-
-            new_alignment = alignment[:, 0:0]
-            for next_col, num_gaps in enumerate(each_column):
-                if num_gaps <= max_gaps:
-                    new_alignment += alignment[:, next_col:next_col + 1]
-                    position_map.extend(True)
-                else:
-                    position_map.extend(False)
         else:
             raise NotImplementedError("%s not an implemented trimal method" % threshold)
 
+        # Each position_map index corresponds to the original column position, values are tuples of the new position
+        # and whether the column still exists (True) or has been deleted (False)
+        position_map = FeatureReMapper()
+        keep = each_column <= max_gaps
+        position_map.extend_many(keep)
+        new_alignment = _select_columns(alignment, np.flatnonzero(keep), matrix)
+
         position_map.remap_features(alignbuddy.alignments[alignment_index], new_alignment)
         position_map.append_pos_map(new_alignment)
         alignbuddy.alignments[alignment_index] = new_alignment
@@ -1630,7 +1750,22 @@ def command_line_ui(in_args, alignbuddy, skip_exit=False, pass_through=False):
     # Bootstrap
     if in_args.bootstrap:
         num_bootstraps = in_args.bootstrap[0] if in_args.bootstrap[0] else 1
-        _print_aligments(bootstrap(alignbuddy, num_bootstraps))
+        out_format = "phylip-relaxed" if alignbuddy.out_format == "nexus" else alignbuddy.out_format
+        if in_args.test or in_args.in_place or (out_format in ["fasta", "gb", "genbank"] and
+                                                 len(alignbuddy.alignments) * num_bootstraps > 1):
+            _print_aligments(bootstrap(alignbuddy, num_bootstraps))
+        else:
+            # Write each replicate as soon as it is generated, instead of holding all of them in memory.
+            # Only the last replicate is trimmed by str(), which leaves the same separators as the batched output.
+            previous = None
+            for replicate in bootstrap_replicates(alignbuddy, num_bootstraps):
+                if previous is not None:
+                    handle = StringIO()
+                    previous._write_handle(handle)
+                    br._stdout(handle.getvalue())
+                previous = AlignBuddy([replicate], out_format=out_format)
+            if previous is not None:
+                br._stdout(str(previous))
         _exit("bootstrap")
 
     # Clean Seq
@@ -42,18 +42,28 @@ import sys
 import os
 import re
 from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
-from time import sleep
+from urllib.parse import urlsplit, urljoin
+import http.client
+import socket
+from time import sleep, monotonic, time
 import json
-from multiprocessing import Lock
-from collections import OrderedDict
+from threading import Lock, Thread, local
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+from weakref import WeakKeyDictionary, finalize
+import operator
 from hashlib import md5
 import cmd
 from subprocess import Popen, PIPE
-from io import TextIOWrapper, StringIO
+from io import TextIOWrapper, StringIO, BytesIO
 import warnings
 import readline
 import dill
+import pickle
+import sqlite3
 import glob
 
 # Third party
@@ -80,6 +90,15 @@ FORMATS = ["ids", "accessions", "summary", "full-summary", "clustal", "embl", "f
            "fastq-solexa", "fastq-illumina", "genbank", "gb", "imgt", "nexus", "phd", "phylip", "seqxml",
            "stockholm", "tab", "qual"]
 CONFIG = br.config_values()
+RATE_LIMITS = {"eutils.ncbi.nlm.nih.gov": 3, "rest.ensembl.org": 15, "www.uniprot.org": 10}  # Requests per second
+RETRY_CODES = [429, 500, 502, 503, 504]
+CACHE_TTL = 60 * 60 * 24 * 30  # Seconds that downloaded records are trusted for
+CACHE_SIZE = 2 ** 30  # Bytes
+JOURNAL_COMPACT_SIZE = 2 ** 26  # Bytes
+ENSEMBL_SPECIES_TTL = 60 * 60 * 24 * 7  # Seconds before the Ensembl species table is downloaded again
+ENSEMBL_MAX_SYMBOLS = 1000  # Symbols per POST lookup/symbol request
+JOURNAL_GROUPS = ["records", "trash_bin"]
+JOURNAL_ATTRS = ["search_terms", "out_format", "failures", "databases", "memory_footprint", "cache"]
 VERSION = br.Version("DatabaseBuddy", 1, "2.5", br.contributors, {"year": 2017, "month": 2, "day": 3})
 
 GREY = "\033[90m"
@@ -107,6 +126,7 @@ class DbBuddy(object):  # Open a file or read a handle and parse, or convert raw
         self.databases = check_database(_databases)
         self.server_clients = {"ncbi": False, "ensembl": False, "uniprot": False}
         self.memory_footprint = 0
+        self.cache = RecordCache()  # Summaries and sequences that have been downloaded before
 
         # Empty DbBuddy object
         if not _input:
@@ -194,22 +214,13 @@ class DbBuddy(object):  # Open a file or read a handle and parse, or convert raw
             raise ValueError("The 'mode' argument in filter() must be 'keep', 'remove', or 'restore', not %s." % mode)
 
         column_errors = {"KeyError": [], "ValueError": []}
-        for _id, _rec in self.trash_bin.items() if mode == 'restore' else self.records.items():
-            # try:
-            if mode == "keep" and not _rec.search(regex):
-                self.trash_bin[_id] = _rec
-            elif mode == "remove" and _rec.search(regex):
-                self.trash_bin[_id] = _rec
-            elif mode == "restore" and _rec.search(regex):
-                self.records[_id] = _rec
-        if mode == "restore":
-            for _id in self.records:
-                if _id in self.trash_bin:
-                    del self.trash_bin[_id]
-        else:
-            for _id in self.trash_bin:
-                if _id in self.records:
-                    del self.records[_id]
+        group = self.trash_bin if mode == 'restore' else self.records
+        hits = _column_index(self).search(compile_query(regex)) if group else set()
+        keep = mode == "keep"
+        moved = [(_id, _rec) for _id, _rec in group.items() if (id(_rec) in hits) is not keep]
+        (self.records if mode == "restore" else self.trash_bin).update(moved)
+        for _id, _rec in moved:
+            del group[_id]
 
         return column_errors
 
@@ -404,6 +415,10 @@ class DbBuddy(object):  # Open a file or read a handle and parse, or convert raw
 
 
 # ################################################# SUPPORT CLASSES ################################################## #
+_RECORD_EDITS = 0  # Counts every Record attribute assignment, so ColumnIndex objects know when they are out of date
+_RECORD_TEXT = WeakKeyDictionary()  # {Record: (SeqRecord, embl text)}
+
+
 class Record(object):
     def __init__(self, _accession, gi=None, _version=None, _record=None, summary=None, _size=None,
                  _database=None, _type=None, _search_term=None):
@@ -482,7 +497,57 @@ class Record(object):
         return
 
     def search(self, regex):
-        import re  # This is to allow the objects to be loaded again later
+        return compile_query(regex).match(self)
+
+    def __setattr__(self, key, value):
+        global _RECORD_EDITS
+        _RECORD_EDITS += 1
+        self.__dict__[key] = value
+
+    def update(self, new_rec):
+        self.accession = new_rec.accession if new_rec.accession else self.accession
+        self.gi = int(new_rec.gi) if new_rec.gi else self.gi
+        self.version = new_rec.version if new_rec.version else self.version
+        self.record = new_rec.record if new_rec.record else self.record
+        self.summary = new_rec.summary if new_rec.summary else self.summary
+        self.size = new_rec.size if new_rec.size else self.size
+        self.database = new_rec.database if new_rec.database else self.database
+        self.type = new_rec.type if new_rec.type else self.type
+        self.search_term = new_rec.search_term if new_rec.search_term else self.search_term
+
+    def __str__(self):
+        return "Accession:\t{0}\nDatabase:\t{1}\nRecord:\t{2}\nType:\t{3}\n".format(self.accession, self.database,
+                                                                                    self.record, self.type)
+
+
+def _record_text(_rec):
+    """
+    The embl text that global searches run against when a full record is present. Serializing a SeqRecord is slow, so
+    the text is kept for as long as the Record holds on to the same SeqRecord.
+    :param _rec: Record object
+    :return: str, or None if there is no full record
+    """
+    if not _rec.record:
+        return None
+    cached = _RECORD_TEXT.get(_rec)
+    if cached and cached[0] is _rec.record:
+        return cached[1]
+    text = _rec.record.format("embl")
+    _RECORD_TEXT[_rec] = (_rec.record, text)
+    return text
+
+
+LENGTH_OPERATORS = {"=": operator.eq, ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+
+class RecordQuery(object):
+    def __init__(self, regex):
+        """
+        Filter expression used by Record.search() and DbBuddy.filter_records(), parsed once so it can be tested
+        against any number of records.
+        :param regex: Regular expression, optionally prefixed with 'i?' (case-insensitive) and/or '(column)'. The
+        special '(length <operator> <int>)' column compares sequence lengths.
+        """
         regex = ".*" if regex == "*" else regex  # This prevents a crash
         # Default is case-senstive, so check if the user desires otherwise
         if regex[:2] in ["i?", "?i"]:
@@ -491,89 +556,208 @@ class Record(object):
         else:
             flags = 0
 
+        self.column = None
+        self.length = None  # (operator function, limit)
+        self.length_error = None  # Only raised once a record with a length is tested, as Record.search() always did
+        self.regex = regex
+        self.pattern = None
+
         column = re.match("\((.*?)\)", regex)
         if column:
-            column = column.group(1)
+            self.column = column.group(1)
             # Special case, if user is searching sequence length
-            if re.match("length.+", column.strip(), flags=re.IGNORECASE):
-                if not re.match("^length[ =<>]+[0-9]+$", column, flags=re.IGNORECASE):
-                    raise ValueError("Invalid syntax for seaching 'length': %s" % column)
-
-                limit = re.search("length *([ =<>]+)([0-9]+)", column, flags=re.IGNORECASE)
-                operator = limit.group(1).strip()
-                limit = int(limit.group(2))
-                if "length" not in self.summary:
-                    return False
-
-                length = int(self.summary["length"])
-                if operator not in ["=", ">", ">=", "<", "<="]:
-                    raise ValueError("Invalid operator: %s" % operator)
-
-                if operator == "=" and length == limit:
-                    return True
-                elif operator == ">" and length > limit:
-                    return True
-                elif operator == ">=" and length >= limit:
-                    return True
-                elif operator == "<" and length < limit:
-                    return True
-                elif operator == "<=" and length <= limit:
-                    return True
-                else:
-                    return False
+            if re.match("length.+", self.column.strip(), flags=re.IGNORECASE):
+                if not re.match("^length[ =<>]+[0-9]+$", self.column, flags=re.IGNORECASE):
+                    raise ValueError("Invalid syntax for seaching 'length': %s" % self.column)
+
+                limit = re.search("length *([ =<>]+)([0-9]+)", self.column, flags=re.IGNORECASE)
+                _operator = limit.group(1).strip()
+                if _operator not in LENGTH_OPERATORS:
+                    self.length_error = "Invalid operator: %s" % _operator
+                self.length = (LENGTH_OPERATORS.get(_operator), int(limit.group(2)))
+                return
 
             # Strip off column syntax
-            regex = re.search("^\(.*?\)(.*)", regex, flags=flags)
-            regex = None if not regex else regex.group(1).strip()
+            self.regex = re.search("^\(.*?\)(.*)", regex, flags=flags).group(1).strip()
 
-            if column.lower() == "accn":
-                if re.search(regex, str(self.accession), flags=flags):
-                    return True
+        self.pattern = re.compile(self.regex, flags)
 
-            if column.lower() == "type":
-                if re.search(regex, str(self.type), flags=flags):
-                    return True
+    def test_length(self, length):
+        """
+        :param length: Value of a record's 'length' summary field
+        :return: bool
+        """
+        length = int(length)
+        if self.length_error:
+            raise ValueError(self.length_error)
+        return self.length[0](length, self.length[1])
 
-            if column.lower() == "db":
-                if re.search(regex, str(self.database), flags=flags):
-                    return True
+    def match(self, _rec):
+        """
+        :param _rec: Record object
+        :return: bool
+        """
+        if self.length:
+            return "length" in _rec.summary and self.test_length(_rec.summary["length"])
 
-            if column in self.summary and not regex:  # This will return everything with the given column
+        search = self.pattern.search
+        if self.column is not None:
+            column = self.column.lower()
+            if column == "accn" and search(str(_rec.accession)):
                 return True
-
-            if column in self.summary and re.search(regex, str(self.summary[column]), flags=flags):
+            if column == "type" and search(str(_rec.type)):
                 return True
-            else:
-                return False
-
-        for param in [self.accession, self.database, self.type, self.search_term]:
-            if re.search(regex, str(param), flags=flags):
+            if column == "db" and search(str(_rec.database)):
                 return True
+            if self.column in _rec.summary:
+                # An empty regex will return everything with the given column
+                return not self.regex or bool(search(str(_rec.summary[self.column])))
+            return False
 
-        for _key, _value in self.summary.items():
-            if re.search(regex, _key, flags=flags) or re.search(regex, str(_value), flags=flags):
+        for param in [_rec.accession, _rec.database, _rec.type, _rec.search_term]:
+            if search(str(param)):
                 return True
 
-        if self.record:
-            if re.search(regex, self.record.format("embl"), flags=flags):
+        for _key, _value in _rec.summary.items():
+            if search(_key) or search(str(_value)):
                 return True
+
+        text = _record_text(_rec)
         # If nothing hits, default to False
-        return False
+        return bool(text and search(text))
 
-    def update(self, new_rec):
-        self.accession = new_rec.accession if new_rec.accession else self.accession
-        self.gi = int(new_rec.gi) if new_rec.gi else self.gi
-        self.version = new_rec.version if new_rec.version else self.version
-        self.record = new_rec.record if new_rec.record else self.record
-        self.summary = new_rec.summary if new_rec.summary else self.summary
-        self.size = new_rec.size if new_rec.size else self.size
-        self.database = new_rec.database if new_rec.database else self.database
-        self.type = new_rec.type if new_rec.type else self.type
-        self.search_term = new_rec.search_term if new_rec.search_term else self.search_term
 
-    def __str__(self):
-        return "Accession:\t{0}\nDatabase:\t{1}\nRecord:\t{2}\nType:\t{3}\n".format(self.accession, self.database,
-                                                                                    self.record, self.type)
+@lru_cache(maxsize=128)
+def compile_query(regex):
+    """
+    :param regex: Filter expression (see RecordQuery)
+    :return: RecordQuery object, shared by every call with the same expression
+    """
+    return RecordQuery(regex)
+
+
+class ColumnIndex(object):
+    def __init__(self, records):
+        """
+        Inverted index over the searchable fields of a group of records. Every column maps the string form of each
+        distinct value to the ids of the records holding it, so a query only needs to be tested once per distinct
+        value instead of once per record. Columns are only built the first time a query needs them.
+        :param records: List of Record objects
+        """
+        self.edits = _RECORD_EDITS
+        self.records = records
+        self.ids = set(map(id, records))
+        self.columns = {}  # {"accn"|"db"|"type"|"search_term": column}
+        self.summary = {}  # {summary key: column}
+        self.summary_complete = False
+
+    def current(self, records):
+        """
+        :param records: Iterable of Record objects
+        :return: True if nothing has been modified since the index was built, and every record is in it
+        """
+        return self.edits == _RECORD_EDITS and self.ids.issuperset(map(id, records))
+
+    def column(self, name):
+        """
+        :param name: One of 'accn', 'db', 'type', or 'search_term'
+        :return: {str(value): [record ids]}
+        """
+        if name not in self.columns:
+            attr = {"accn": "accession", "db": "database"}.get(name, name)
+            column = self.columns[name] = defaultdict(list)
+            for _rec in self.records:
+                column[str(getattr(_rec, attr))].append(id(_rec))
+        return self.columns[name]
+
+    def summary_column(self, key):
+        """
+        :param key: Summary field
+        :return: {str(value): [record ids]}, which is empty if no record has the field
+        """
+        if key not in self.summary and not self.summary_complete:
+            column = self.summary[key] = defaultdict(list)
+            for _rec in self.records:
+                if key in _rec.summary:
+                    column[str(_rec.summary[key])].append(id(_rec))
+        return self.summary.get(key, {})
+
+    def summary_columns(self):
+        """
+        :return: {summary key: column} for every summary field
+        """
+        if not self.summary_complete:
+            self.summary = {}
+            for _rec in self.records:
+                for _key, _value in _rec.summary.items():
+                    column = self.summary.get(_key)
+                    if column is None:
+                        column = self.summary[_key] = defaultdict(list)
+                    column[str(_value)].append(id(_rec))
+            self.summary_complete = True
+        return self.summary
+
+    @staticmethod
+    def _every(value):
+        return True
+
+    @staticmethod
+    def _hits(column, test):
+        return chain.from_iterable(ids for value, ids in column.items() if test(value))
+
+    def search(self, query):
+        """
+        :param query: RecordQuery object
+        :return: Set of the ids of every matching record
+        """
+        hits = set()
+        if query.length:
+            hits.update(self._hits(self.summary_column("length"), query.test_length))
+            return hits
+
+        search = query.pattern.search
+        if query.column is not None:
+            column = query.column.lower()
+            if column in ["accn", "type", "db"]:
+                hits.update(self._hits(self.column(column), search))
+            hits.update(self._hits(self.summary_column(query.column), search if query.regex else self._every))
+            return hits
+
+        # Fields are checked in the same order as Record.search(), and later columns aren't even built once
+        # everything has matched
+        for name in ["accn", "db", "type", "search_term"]:
+            hits.update(self._hits(self.column(name), search))
+            if len(hits) == len(self.ids):
+                return hits
+        for _key, column in self.summary_columns().items():
+            hits.update(self._hits(column, self._every if search(_key) else search))
+            if len(hits) == len(self.ids):
+                return hits
+        # Full records are searched last, and only if nothing else hit
+        hits.update([id(_rec) for _rec in self.records
+                     if _rec.record and id(_rec) not in hits and search(_record_text(_rec))])
+        return hits
+
+
+# {id(DbBuddy): ColumnIndex}, kept out of the DbBuddy so it is never pickled. DbBuddy objects hash by content, so they
+# can't be used as weak keys; entries are dropped by a finalizer instead.
+_COLUMN_INDICES = {}
+
+
+def _column_index(_dbbuddy):
+    """
+    Return the ColumnIndex covering every record and trashed record, only rebuilding it if something has changed
+    :param _dbbuddy: DbBuddy object
+    :return: ColumnIndex object
+    """
+    index = _COLUMN_INDICES.get(id(_dbbuddy))
+    if index and index.current(chain(_dbbuddy.records.values(), _dbbuddy.trash_bin.values())):
+        return index
+    if not index:
+        finalize(_dbbuddy, _COLUMN_INDICES.pop, id(_dbbuddy), None)
+    index = ColumnIndex(list(_dbbuddy.records.values()) + list(_dbbuddy.trash_bin.values()))
+    _COLUMN_INDICES[id(_dbbuddy)] = index
+    return index
 
 
 class Failure(object):
@@ -598,6 +782,620 @@ class Failure(object):
         return _output
 
 
+class RateLimiter(object):
+    def __init__(self, rate, burst=1):
+        """
+        Token bucket that spaces out requests to a server. Callers reserve the next free slot and then sleep until it
+        comes up, so a burst of threads is served in order instead of spinning on the lock.
+        :param rate: Sustained requests per second
+        :param burst: Number of requests allowed to go out back to back after a quiet period
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.blocked_until = 0.
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = max(0., (1 - self.tokens) / self.rate, self.blocked_until - now)
+            self.tokens -= 1
+        if wait:
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Hold back every request to the server, e.g., when it answers with a Retry-After header
+        :param seconds: How long to wait from now
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+        return
+
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = Lock()
+
+
+def rate_limiter(host, rate=None):
+    """
+    Every client talking to the same server shares one RateLimiter
+    :param host: Server name (e.g., 'rest.ensembl.org')
+    :param rate: Requests per second. Defaults to RATE_LIMITS, or 10/s for unlisted servers
+    :return: RateLimiter object
+    """
+    with _RATE_LIMITERS_LOCK:
+        if host not in _RATE_LIMITERS or (rate and _RATE_LIMITERS[host].rate != rate):
+            _RATE_LIMITERS[host] = RateLimiter(rate if rate else RATE_LIMITS.get(host, 10))
+        return _RATE_LIMITERS[host]
+
+
+class HTTPEngine(object):
+    def __init__(self, max_workers=4, max_attempts=5, backoff=1., timeout=60):
+        """
+        Send HTTP requests from a pool of threads over keep-alive connections. Requests are throttled with a per-server
+        RateLimiter, and busy or failing servers (RETRY_CODES, dropped connections) are retried with exponential backoff
+        or after the delay in their Retry-After header.
+        :param max_workers: Number of threads used by run()
+        :param max_attempts: How many times a request is tried before giving up
+        :param backoff: Seconds to wait after the first failure, doubled after every subsequent one
+        :param timeout: Socket timeout in seconds
+        """
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cancelled = False  # Set by _fan_out() to stop a client that has been abandoned
+        self._connections = local()
+
+    def __getstate__(self):  # Open connections can't be pickled (e.g., by LiveShell.dump_session())
+        state = dict(self.__dict__)
+        del state["_connections"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connections = local()
+
+    def _pool(self):
+        if not hasattr(self._connections, "pool"):
+            self._connections.pool = {}
+        return self._connections.pool
+
+    def close(self):
+        """
+        Close the keep-alive connections opened by the calling thread
+        """
+        pool = self._pool()
+        for conn in pool.values():
+            conn.close()
+        pool.clear()
+        return
+
+    def _send(self, method, url, data=None, headers=None):
+        """
+        Make a single request, reusing this thread's open connection to the server if there is one
+        :return: (status, reason, headers, body) tuple
+        """
+        parts = urlsplit(url)
+        path = "%s?%s" % (parts.path or "/", parts.query) if parts.query else parts.path or "/"
+        key = (parts.scheme, parts.netloc)
+        pool = self._pool()
+        for fresh in [key not in pool, True]:
+            if key not in pool:
+                conn_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+                pool[key] = conn_class(parts.netloc, timeout=self.timeout)
+            conn = pool[key]
+            try:
+                conn.request(method, path, body=data, headers=headers if headers else {})
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError) as err:
+                # Servers are free to close idle keep-alive connections, so try once more on a new one
+                conn.close()
+                del pool[key]
+                if fresh:
+                    raise URLError(err)
+                continue
+            except OSError as err:
+                conn.close()
+                del pool[key]
+                raise URLError(err)
+            if response.will_close:
+                conn.close()
+                del pool[key]
+            return response.status, response.reason, response.msg, body
+
+    def request(self, url, data=None, headers=None):
+        """
+        :param url: Full URL, including any query string
+        :param data: Request body (bytes). Requests with data are POSTed
+        :param headers: Dictionary of request headers
+        :return: Response body (bytes)
+        :raises HTTPError: Server responded with an error, or was still busy after max_attempts
+        :raises URLError: The server couldn't be reached, or the engine has been cancelled
+        """
+        method = "POST" if data is not None else "GET"
+        for attempt in range(self.max_attempts):
+            if getattr(self, "cancelled", False):  # Engines pickled before the flag existed won't have it
+                raise URLError("Request cancelled")
+            rate_limiter(urlsplit(url).hostname).acquire()
+            try:
+                status, reason, resp_headers, body = self._send(method, url, data, headers)
+            except URLError as err:
+                # Unresolvable host names mean no internet connection (or a typo), and waiting won't fix either
+                if attempt == self.max_attempts - 1 or isinstance(err.reason, socket.gaierror):
+                    raise
+                sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if status in [301, 302, 303, 307, 308] and resp_headers.get("Location"):
+                url = urljoin(url, resp_headers["Location"])
+                if status == 303:
+                    method, data = "GET", None
+                continue
+
+            if status < 400:
+                return body
+
+            if status in RETRY_CODES and attempt < self.max_attempts - 1:
+                retry_after = resp_headers.get("Retry-After")
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = self.backoff * 2 ** attempt
+                if status == 429:
+                    rate_limiter(urlsplit(url).hostname).pause(wait)
+                else:
+                    sleep(wait)
+                continue
+            raise HTTPError(url, status, reason, resp_headers, BytesIO(body))
+        raise HTTPError(url, 310, "Too many redirects", None, BytesIO(b""))
+
+    def run(self, iterable, function, func_args=None, max_workers=None):
+        """
+        Call function(next_iter, func_args) (or function(next_iter) if no func_args) on every item from a pool of
+        threads. Results are collected in memory.
+        :param iterable: The items to process
+        :param function: Usually a client method that makes one request and stores the result
+        :param func_args: List of extra arguments passed in as the second argument of function
+        :param max_workers: Override self.max_workers
+        :return: List of return values, in the same order as the input
+        """
+        iterable = list(iterable)
+        if not iterable:
+            return []
+        max_workers = max_workers if max_workers else self.max_workers
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(iterable)))
+        futures = [executor.submit(function, next_iter, func_args) if func_args else
+                   executor.submit(function, next_iter) for next_iter in iterable]
+        try:
+            results = [future.result() for future in futures]
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+        return results
+
+
+class ResultsBuffer(object):
+    def __init__(self):
+        """
+        In-memory stand-in for br.TempFile, where client threads collect their results
+        """
+        self.contents = []
+
+    def write(self, content, mode="a"):
+        if mode == "w":
+            self.contents = []
+        self.contents.append(content)
+        return
+
+    def read(self):
+        return "".join(self.contents)
+
+    def clear(self):
+        self.contents = []
+        return
+
+    def get_handle(self, mode="r"):
+        return StringIO(self.read())
+
+
+class RecordCache(object):
+    def __init__(self, path=None, ttl=CACHE_TTL, max_size=CACHE_SIZE, offline=False):
+        """
+        Local SQLite store of record summaries and full SeqRecords, keyed by database, accession, and version, so the
+        same accessions are not requested from the servers over and over again.
+        :param path: Location of the SQLite file. Defaults to the BuddySuite data directory, and caching is switched off
+        if that directory doesn't exist (or if path is False).
+        :param ttl: Seconds before a cached entry goes stale (None to keep entries forever)
+        :param max_size: Approximate limit (in bytes) of cached data. Least recently used entries are evicted first.
+        :param offline: Only serve records from the cache, and never send requests to the servers
+        """
+        if path is None and CONFIG["data_dir"]:
+            path = "%s%sdb_cache.sqlite" % (CONFIG["data_dir"], os.sep)
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS records (db TEXT, accession TEXT, version TEXT, "
+                                 "full_accn TEXT, gi INTEGER, type TEXT, size INTEGER, summary TEXT, record BLOB, "
+                                 "bytes INTEGER, stored REAL, accessed REAL, PRIMARY KEY (db, accession, version))")
+                    conn.execute("CREATE INDEX IF NOT EXISTS accession_index ON records (accession)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS gi_index ON records (gi)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS accessed_index ON records (accessed)")
+            except sqlite3.Error as err:
+                br._stderr("Warning: Unable to open the record cache at %s (%s). Caching is disabled.\n"
+                           % (self.path, err))
+                self.path = None
+
+    @contextmanager
+    def _connect(self):
+        # Connections are opened per operation so the cache can be pickled along with its DbBuddy object
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _disable(self, err):
+        # The cache is optional, so a locked, corrupted, read-only, or full file mustn't stop records being downloaded
+        br._stderr("Warning: The record cache at %s failed (%s). Caching is disabled.\n" % (self.path, err))
+        self.path = None
+
+    @staticmethod
+    def _split_version(_rec):
+        version = re.search("^(.*?)\.([0-9]+)$", str(_rec.accession))
+        accn = version.group(1) if version else str(_rec.accession)
+        if _rec.version not in [None, ""]:
+            version = str(_rec.version)
+        else:
+            version = version.group(2) if version else ""
+        return accn, version
+
+    @staticmethod
+    def _to_record(row):
+        summary = None if row["summary"] is None else json.loads(row["summary"], object_pairs_hook=OrderedDict)
+        _rec = Record(row["full_accn"], gi=row["gi"], _version=row["version"] or None, summary=summary,
+                      _size=row["size"], _database=row["db"], _type=row["type"])
+        if row["record"] is not None:
+            _rec.record = pickle.loads(row["record"])
+        return _rec
+
+    def get_many(self, records, full=False):
+        """
+        :param records: List of Record objects to look up. Unversioned accessions match the newest cached version, and
+        bare GI numbers are matched against the GIs of cached NCBI records.
+        :param full: Only accept entries that include the full SeqRecord
+        :return: List of cached Record objects (or None for misses), in the same order as the input
+        """
+        if not self.path or not records:
+            return [None for _ in records]
+
+        oldest = time() - self.ttl if self.ttl else 0
+        sql = "SELECT rowid, * FROM records WHERE {0} IN ({1}) AND stored >= ?{2} ORDER BY stored DESC"
+        sql_full = " AND record IS NOT NULL" if full else ""
+        gi_nums = sorted(set([_rec.gi for _rec in records if _rec.type == "gi_num" and _rec.gi]))
+        accns = sorted(set([self._split_version(_rec)[0] for _rec in records]))
+        by_accn = {}
+        by_gi = {}
+        try:
+            with self._connect() as conn:
+                for column, values in [("accession", accns), ("gi", gi_nums)]:
+                    for i in range(0, len(values), 500):  # Stay well under SQLite's limit on bound parameters
+                        group = values[i:i + 500]
+                        for row in conn.execute(sql.format(column, ",".join("?" * len(group)), sql_full),
+                                                group + [oldest]):
+                            if column == "gi":
+                                by_gi.setdefault(row["gi"], row)
+                            else:
+                                by_accn.setdefault((row["db"], row["accession"]), []).append(row)
+
+                hits = []
+                for _rec in records:
+                    row = None
+                    if _rec.type == "gi_num" and _rec.gi:
+                        row = by_gi.get(_rec.gi)
+                    else:
+                        accn, version = self._split_version(_rec)
+                        for candidate in by_accn.get((_rec.database, accn), []):
+                            if not version or candidate["version"] == version:
+                                row = candidate
+                                break
+                    hits.append(row)
+
+                accessed = time()
+                conn.executemany("UPDATE records SET accessed = ? WHERE rowid = ?",
+                                 [(accessed, row["rowid"]) for row in hits if row is not None])
+        except sqlite3.Error as err:
+            self._disable(err)
+            return [None for _ in records]
+
+        found = [None if row is None else self._to_record(row) for row in hits]
+        self.misses += found.count(None)
+        self.hits += len(found) - found.count(None)
+        return found
+
+    def put_many(self, records):
+        """
+        Store summaries and SeqRecords. Anything already cached for an accession is only replaced by new data, so
+        storing a summary-only Record does not throw away a previously cached sequence.
+        :param records: List of Record objects
+        :return: None
+        """
+        if not self.path:
+            return
+        rows = []
+        stored = time()
+        for _rec in records:
+            if _rec.database not in DATABASES or _rec.type == "gi_num" or not (_rec.summary or _rec.record):
+                continue
+            accn, version = self._split_version(_rec)
+            summary = json.dumps(_rec.summary, default=str) if _rec.summary else None
+            record = None
+            if _rec.record:
+                try:
+                    record = pickle.dumps(_rec.record, protocol=-1)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    pass
+            _bytes = len(summary or "") + len(record or b"")
+            rows.append((_rec.database, accn, version, _rec.accession, _rec.gi, _rec.type, _rec.size, summary, record,
+                         _bytes, stored, stored))
+        if not rows:
+            return
+
+        try:
+            with self._connect() as conn:
+                conn.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                                 "ON CONFLICT (db, accession, version) DO UPDATE SET "
+                                 "full_accn = excluded.full_accn, gi = IFNULL(excluded.gi, gi), "
+                                 "type = IFNULL(excluded.type, type), size = IFNULL(excluded.size, size), "
+                                 "summary = IFNULL(excluded.summary, summary), "
+                                 "record = IFNULL(excluded.record, record), "
+                                 "bytes = IFNULL(LENGTH(IFNULL(excluded.summary, summary)), 0) + "
+                                 "IFNULL(LENGTH(IFNULL(excluded.record, record)), 0), "
+                                 "stored = excluded.stored, accessed = excluded.accessed", rows)
+        except sqlite3.Error as err:
+            self._disable(err)
+        self.evict()
+        return
+
+    def evict(self):
+        """
+        Drop stale entries, and then the least recently used entries until the cache fits inside max_size
+        :return: None
+        """
+        if not self.path:
+            return
+        try:
+            with self._connect() as conn:
+                if self.ttl:
+                    conn.execute("DELETE FROM records WHERE stored < ?", (time() - self.ttl,))
+                if self.max_size:
+                    excess = conn.execute("SELECT IFNULL(SUM(bytes), 0) FROM records").fetchone()[0] - self.max_size
+                    doomed = []
+                    if excess > 0:
+                        for row in conn.execute("SELECT rowid, bytes FROM records ORDER BY accessed"):
+                            doomed.append((row["rowid"],))
+                            excess -= row["bytes"]
+                            if excess <= 0:
+                                break
+                    conn.executemany("DELETE FROM records WHERE rowid = ?", doomed)
+        except sqlite3.Error as err:
+            self._disable(err)
+        return
+
+    def clear(self):
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    conn.execute("DELETE FROM records")
+            except sqlite3.Error as err:
+                self._disable(err)
+        return
+
+    def stats(self):
+        _output = OrderedDict([("path", self.path), ("offline", self.offline), ("hits", self.hits),
+                               ("misses", self.misses), ("entries", 0), ("full_records", 0), ("bytes", 0)])
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    row = conn.execute("SELECT COUNT(*), COUNT(record), IFNULL(SUM(bytes), 0) "
+                                       "FROM records").fetchone()
+                    _output["entries"], _output["full_records"], _output["bytes"] = tuple(row)
+            except sqlite3.Error as err:
+                self._disable(err)
+                _output["path"] = None
+        return _output
+
+
+class SessionJournal(object):
+    def __init__(self, path, compact_size=JOURNAL_COMPACT_SIZE):
+        """
+        Append-only log of a live session. The first entry is a checkpoint holding the whole DbBuddy object, and every
+        entry after that only holds what changed since the entry before it: new or modified Records, the order of the
+        records and the trash bin, and any other attributes that changed. Records moving between the main list and
+        the trash bin are never written out again. Any earlier state can be rebuilt by replaying the log up to it.
+        :param path: Location of the journal file (usually the LiveShell crash file)
+        :param compact_size: Once the journal passes this many bytes (and is more than four times the size of its
+        checkpoint), it is rewritten as a single fresh checkpoint
+        """
+        self.path = path
+        self.compact_size = compact_size
+        self.entries = 0
+        self.checkpoint_size = 0
+        self.next_uid = 0
+        self.known = {}  # id(Record) -> (Record, uid, signature, SeqRecord)
+        self.orders = {}  # Group -> [(key, uid), ...]
+        self.attrs = {}  # Attribute name -> pickled value
+
+    @staticmethod
+    def _signature(_rec):
+        if not isinstance(_rec, Record):
+            return None
+        summary = list(_rec.summary.items()) if isinstance(_rec.summary, dict) else _rec.summary
+        return (_rec.accession, _rec.gi, _rec.version, _rec.size, _rec.database, _rec.type, _rec.search_term,
+                summary)
+
+    def _diff(self, _dbbuddy, full=False):
+        known = {}
+        pool = {}
+        orders = {}
+        for group in JOURNAL_GROUPS:
+            order = []
+            for key, _rec in getattr(_dbbuddy, group).items():
+                tracked = known.get(id(_rec), self.known.get(id(_rec)))
+                signature = self._signature(_rec)
+                # SeqRecords don't support comparison, so they are only checked for identity
+                if full or not tracked or tracked[0] is not _rec or tracked[2] != signature \
+                        or tracked[3] is not getattr(_rec, "record", None):
+                    tracked = (_rec, self.next_uid, signature, getattr(_rec, "record", None))
+                    pool[tracked[1]] = _rec
+                    self.next_uid += 1
+                known[id(_rec)] = tracked
+                order.append((key, tracked[1]))
+            if full or order != self.orders.get(group):
+                orders[group] = order
+
+        attrs = {}
+        for attr in JOURNAL_ATTRS:
+            value = pickle.dumps(getattr(_dbbuddy, attr, None), protocol=-1)
+            if full or value != self.attrs.get(attr):
+                attrs[attr] = value
+        return known, {"pool": pool, "orders": orders, "attrs": attrs}
+
+    def _write(self, kind, known, entry, mode="ab"):
+        path = self.path if mode == "ab" else "%s.tmp" % self.path
+        with open(path, mode) as ofile:
+            pickle.dump((kind, entry), ofile, protocol=-1)
+        if mode != "ab":
+            os.replace(path, self.path)  # A crash half way through a checkpoint leaves the old journal intact
+        self.known = known
+        self.orders.update(entry["orders"])
+        self.attrs.update(entry["attrs"])
+
+    def checkpoint(self, _dbbuddy):
+        """
+        Start the journal over with a snapshot of the entire session
+        :param _dbbuddy: DbBuddy object
+        :return: Index of the new entry (always 0)
+        """
+        self.next_uid = 0
+        self.orders = {}
+        self.attrs = {}
+        known, entry = self._diff(_dbbuddy, full=True)
+        self._write("checkpoint", known, entry, mode="wb")
+        self.entries = 1
+        self.checkpoint_size = os.path.getsize(self.path)
+        return 0
+
+    def record(self, _dbbuddy):
+        """
+        Append whatever changed in the session since the last entry
+        :param _dbbuddy: DbBuddy object
+        :return: Index of the new entry, 0 if the journal was compacted into a new checkpoint, or None if nothing changed
+        """
+        if not self.entries:
+            return self.checkpoint(_dbbuddy)
+
+        known, entry = self._diff(_dbbuddy)
+        if not entry["pool"] and not entry["orders"] and not entry["attrs"]:
+            self.known = known
+            return None
+
+        if os.path.getsize(self.path) > max(self.compact_size, self.checkpoint_size * 4):
+            return self.checkpoint(_dbbuddy)
+
+        self._write("update", known, entry)
+        self.entries += 1
+        return self.entries - 1
+
+    def replay(self, index=None):
+        """
+        Rebuild the session as it was after a given entry
+        :param index: Entry to stop at (defaults to the end of the journal)
+        :return: Dictionary with the records and trash bin (as OrderedDicts), plus any other attributes that were logged
+        """
+        pool = {}
+        orders = {}
+        attrs = {}
+        uids = {}
+        with open(self.path, "rb") as ifile:
+            indx = 0
+            while index is None or indx <= index:
+                try:
+                    kind, entry = pickle.load(ifile)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError):  # Partially written entry, if the session crashed
+                    break
+                if kind == "checkpoint":
+                    pool, orders, attrs = {}, {}, {}
+                pool.update(entry["pool"])
+                orders.update(entry["orders"])
+                attrs.update(entry["attrs"])
+                indx += 1
+
+        state = {attr: pickle.loads(value) for attr, value in attrs.items()}
+        for group in JOURNAL_GROUPS:
+            state[group] = OrderedDict([(key, pool[uid]) for key, uid in orders.get(group, [])])
+            uids.update({id(pool[uid]): uid for key, uid in orders.get(group, [])})
+        state["_uids"] = uids
+        return state
+
+    def restore(self, _dbbuddy, index):
+        """
+        Rewind the session to an earlier entry, and log the rewind so crash recovery ends up in the same place
+        :param _dbbuddy: DbBuddy object
+        :param index: Entry to return to
+        :return: Index of the entry logging the rewind (see record())
+        """
+        state = self.replay(index)
+        for attr in JOURNAL_ATTRS + JOURNAL_GROUPS:
+            if attr in state:
+                setattr(_dbbuddy, attr, state[attr])
+
+        # Records that came back out of the journal are already in it, so don't write them out again
+        for group in JOURNAL_GROUPS:
+            for _rec in getattr(_dbbuddy, group).values():
+                self.known[id(_rec)] = (_rec, state["_uids"][id(_rec)], self._signature(_rec),
+                                        getattr(_rec, "record", None))
+        return self.record(_dbbuddy)
+
+    @staticmethod
+    def load(path):
+        """
+        Read a saved session, either as a single pickled DbBuddy object or as a journal (e.g., from a crash)
+        :param path: Location of the file
+        :return: DbBuddy object
+        """
+        with open(path, "rb") as ifile:
+            first = dill.load(ifile)
+        if isinstance(first, tuple) and first and first[0] == "checkpoint":
+            state = SessionJournal(path).replay()
+            _dbbuddy = DbBuddy()
+            for attr in JOURNAL_ATTRS + JOURNAL_GROUPS:
+                if attr in state:
+                    setattr(_dbbuddy, attr, state[attr])
+            return _dbbuddy
+        return first
+
+
 # ################################################# HELPER FUNCTIONS ################################################# #
 class DatabaseError(Exception):
     def __init__(self, _value):
@@ -678,59 +1476,286 @@ def check_type(_type):
     return _type
 
 
-def retrieve_summary(_dbbuddy):
-    check_all = False if _dbbuddy.databases else True
-    if "uniprot" in _dbbuddy.databases or check_all:
-        uniprot = _dbbuddy.server("uniprot")
-        uniprot.search_proteins()
+def _checkout_cached(_dbbuddy, full=False):
+    """
+    Fill in records from the local cache, and pull them out of the DbBuddy object so the clients don't request them
+    from the servers again
+    :param _dbbuddy: DbBuddy object
+    :param full: Look for full sequence records instead of summaries
+    :return: Dict of the state needed by _checkin_cached()
+    """
+    checkout = {"order": list(_dbbuddy.records), "found": OrderedDict(), "missing": 0,
+                "before": {id(_rec): (id(_rec.summary), id(_rec.record)) for _rec in _dbbuddy.records.values()}}
+    cache = getattr(_dbbuddy, "cache", None)  # Sessions saved before the cache existed won't have one
+    if not cache or not cache.path:
+        return checkout
+
+    databases = _dbbuddy.databases if _dbbuddy.databases else DATABASES
+    wanted = [(accn, _rec) for accn, _rec in _dbbuddy.records.items()
+              if _rec.database in databases and not (_rec.record if full else _rec.summary)]
+    cached_recs = cache.get_many([_rec for accn, _rec in wanted], full=full)
+    for (accn, _rec), cached_rec in zip(wanted, cached_recs):
+        if cached_rec:
+            _rec.update(cached_rec)
+            checkout["found"][accn] = _dbbuddy.records.pop(accn)
+        else:
+            checkout["missing"] += 1
 
-    if "ncbi_nuc" in _dbbuddy.databases or check_all:
-        refseq = _dbbuddy.server("ncbi")
-        refseq.search_ncbi("nucleotide")
-        refseq.fetch_summaries("ncbi_nuc")
+    if checkout["found"]:
+        br._stderr("%s %s retrieved from the local cache\n" % (len(checkout["found"]),
+                                                                 "records" if full else "summaries"))
+    return checkout
 
-    if "ncbi_prot" in _dbbuddy.databases or check_all:
-        refseq = _dbbuddy.server("ncbi")
-        refseq.search_ncbi("protein")
-        refseq.fetch_summaries("ncbi_prot")
 
-    if "ensembl" in _dbbuddy.databases or check_all:
-        ensembl = _dbbuddy.server("ensembl")
-        ensembl.search_ensembl()
-        ensembl.fetch_summaries()
+def _checkin_cached(_dbbuddy, checkout):
+    """
+    Put cached records back into the DbBuddy object in their original order, and store anything new from the servers
+    :param _dbbuddy: DbBuddy object
+    :param checkout: Dict returned by _checkout_cached()
+    :return: None
+    """
+    fetched = OrderedDict(_dbbuddy.records)
+    merged = OrderedDict()
 
-    return _dbbuddy
+    def add(_accn, _rec):
+        if _accn in merged:
+            merged[_accn].update(_rec)
+        else:
+            merged[_accn] = _rec
+
+    for accn in checkout["order"]:
+        if accn in checkout["found"]:
+            add(checkout["found"][accn].accession, checkout["found"][accn])
+        elif accn in fetched:
+            add(accn, fetched.pop(accn))
+    for accn, _rec in fetched.items():
+        add(accn, _rec)
+
+    _dbbuddy.records.clear()
+    _dbbuddy.records.update(merged)
+
+    cache = getattr(_dbbuddy, "cache", None)
+    if cache:
+        # Only store what the servers sent back, so stale entries don't get a fresh time stamp
+        before = checkout["before"]
+        from_cache = {id(_rec) for _rec in checkout["found"].values()}
+        cache.put_many([_rec for _rec in merged.values() if id(_rec) not in from_cache and
+                        before.get(id(_rec)) != (id(_rec.summary), id(_rec.record))])
+    return
 
 
-def retrieve_sequences(_dbbuddy):
-    check_all = False if _dbbuddy.databases else True
-    if "uniprot" in _dbbuddy.databases or check_all:
-        uniprot = _dbbuddy.server("uniprot")
-        uniprot.fetch_proteins()
+class _ServerView(object):
+    def __init__(self, _dbbuddy, databases):
+        """
+        Stand-in for the DbBuddy object that is handed to a single server's client while all of the servers are being
+        queried at the same time. Each client only sees (and changes) the records from its own databases, so threads
+        never touch the same dictionaries, and the results are merged back in by _fan_out() once they finish.
+        :param _dbbuddy: DbBuddy object
+        :param databases: The databases served by this client
+        """
+        self.search_terms = list(_dbbuddy.search_terms)
+        self.databases = list(_dbbuddy.databases)
+        self.out_format = _dbbuddy.out_format
+        self.records = OrderedDict([(accn, _rec) for accn, _rec in _dbbuddy.records.items()
+                                    if _rec.database in databases])
+        self.original = list(self.records)
+        self.failures = OrderedDict()
+        self.trash_bin = OrderedDict()
+
+
+def _fan_out(_dbbuddy, jobs, timeout=None):
+    """
+    Query several servers at the same time. Every server gets a single thread (the client's own HTTPEngine and the
+    shared RateLimiters keep each server within its budget), so the total wait is set by the slowest server instead of
+    the sum of all of them.
+    :param _dbbuddy: DbBuddy object
+    :param jobs: List of (server name, databases, function) tuples. Functions are called with the server's client.
+    :param timeout: Seconds to wait for the servers. Anything still running after that (or when the user hits Ctrl-C)
+    is cancelled and left out of the results.
+    :return: List of the server names that didn't finish in time
+    """
+    label = {"uniprot": "UniProt", "ncbi": "NCBI", "ensembl": "Ensembl"}
+    branches = []
+    for server, databases, func in jobs:
+        view = _ServerView(_dbbuddy, databases)
+        client = _dbbuddy.server(server)
+        client.engine.cancelled = False
+        branch = {"server": server, "client": client, "view": view, "done": False, "error": None}
+
+        def run(_client=client, _func=func, _branch=branch):
+            start = monotonic()
+            _client.dbbuddy = _branch["view"]
+            try:
+                _func(_client)
+            except Exception as err:
+                _branch["error"] = err
+            finally:
+                # Abandoned clients keep their own view, so they can't write into a later run's records
+                if not _client.engine.cancelled:
+                    _client.dbbuddy = _dbbuddy
+            if _client.engine.cancelled:
+                return
+            _branch["done"] = True
+            if len(branches) > 1:
+                br._stderr("%s finished (%s records, %s)\n" % (label[_branch["server"]], len(_branch["view"].records),
+                                                               br.pretty_time(round(monotonic() - start))))
+
+        branch["thread"] = Thread(target=run, daemon=True)  # Daemon, so a hung server can't block the exit
+        branches.append(branch)
+
+    interrupted = False
+    try:
+        if len(branches) == 1:
+            branches[0]["thread"].run()  # No need to spin up a thread for a single server
+        else:
+            for branch in branches:
+                branch["thread"].start()
+        deadline = None if timeout is None else monotonic() + timeout
+        for branch in branches:
+            while branch["thread"].is_alive():
+                # Short joins keep the main thread responsive to KeyboardInterrupt
+                wait = 0.1 if deadline is None else min(0.1, deadline - monotonic())
+                if wait <= 0:
+                    break
+                branch["thread"].join(wait)
+    except KeyboardInterrupt:
+        # Ctrl-C only reaches the main thread, so the clients' own interrupt handlers never see it
+        interrupted = True
+        br._stderr("\n\tQuery interrupted by user\n")
+
+    # Anything still running is told to stop, and its client is replaced on the next call to DbBuddy.server()
+    for branch in branches:
+        if not branch["done"]:
+            branch["client"].engine.cancelled = True
+            if _dbbuddy.server_clients.get(branch["server"]) is branch["client"]:
+                _dbbuddy.server_clients[branch["server"]] = False
+
+    # Merge everything back in, keeping the original record order and appending new records server by server
+    finished = [branch for branch in branches if branch["done"]]
+    slow = [branch["server"] for branch in branches if not branch["done"]]
+    for branch in finished:
+        if branch["error"]:
+            raise branch["error"]
+    results = {}
+    for branch in finished:
+        for accn in branch["view"].original:
+            results[accn] = branch["view"].records.pop(accn, None)
+    merged = OrderedDict()
+    for accn, _rec in _dbbuddy.records.items():
+        _rec = results.get(accn, _rec)
+        if _rec:
+            merged[accn] = _rec
+    for branch in finished:
+        for accn, _rec in branch["view"].records.items():
+            if accn in merged:
+                merged[accn].update(_rec)
+            else:
+                merged[accn] = _rec
+        for key, failure in branch["view"].failures.items():
+            _dbbuddy.failures[key] = failure
+    _dbbuddy.records.clear()
+    _dbbuddy.records.update(merged)
+
+    for server in slow:
+        if interrupted:
+            br._stderr("%s was interrupted; its results are not included\n" % label[server])
+        else:
+            br._stderr("%s did not respond within %s; its results are not included\n"
+                       % (label[server], br.pretty_time(timeout)))
+    return slow
 
-    if "ncbi_nuc" in _dbbuddy.databases or check_all:
-        refseq = _dbbuddy.server("ncbi")
-        refseq.fetch_sequences("nucleotide")
 
-    if "ncbi_prot" in _dbbuddy.databases or check_all:
-        refseq = _dbbuddy.server("ncbi")
-        refseq.fetch_sequences("protein")
+def retrieve_summary(_dbbuddy, timeout=None):
+    """
+    Search for, and download summaries of, records from all of the selected databases at the same time
+    :param _dbbuddy: DbBuddy object
+    :param timeout: Seconds to wait for the slowest server. Partial results are kept if a server runs over.
+    :return: The DbBuddy object
+    """
+    check_all = False if _dbbuddy.databases else True
+    checkout = _checkout_cached(_dbbuddy)
+    if getattr(_dbbuddy, "cache", None) and _dbbuddy.cache.offline:
+        _offline_warning(_dbbuddy, checkout)
+        _checkin_cached(_dbbuddy, checkout)
+        return _dbbuddy
+
+    def uniprot(client):
+        client.search_proteins()
+
+    def ncbi(client):
+        for database, _type in [("ncbi_nuc", "nucleotide"), ("ncbi_prot", "protein")]:
+            if database in _dbbuddy.databases or check_all:
+                client.search_ncbi(_type)
+                client.fetch_summaries(database)
+
+    def ensembl(client):
+        client.search_ensembl()
+        client.fetch_summaries()
+
+    jobs = [(server, databases, func) for server, databases, func in
+            [("uniprot", ["uniprot"], uniprot), ("ncbi", ["ncbi_nuc", "ncbi_prot"], ncbi),
+             ("ensembl", ["ensembl"], ensembl)]
+            if check_all or [db for db in databases if db in _dbbuddy.databases]]
+    try:
+        _fan_out(_dbbuddy, jobs, timeout)
+    finally:
+        _checkin_cached(_dbbuddy, checkout)
+    return _dbbuddy
 
-    if "ensembl" in _dbbuddy.databases or check_all:
-        ensembl = _dbbuddy.server("ensembl")
-        ensembl.fetch_nucleotide()
 
+def retrieve_sequences(_dbbuddy, timeout=None):
+    """
+    Download full sequence records from all of the selected databases at the same time
+    :param _dbbuddy: DbBuddy object
+    :param timeout: Seconds to wait for the slowest server. Partial results are kept if a server runs over.
+    :return: The DbBuddy object
+    """
+    check_all = False if _dbbuddy.databases else True
+    checkout = _checkout_cached(_dbbuddy, full=True)
+    if getattr(_dbbuddy, "cache", None) and _dbbuddy.cache.offline:
+        _offline_warning(_dbbuddy, checkout)
+        _checkin_cached(_dbbuddy, checkout)
+        return _dbbuddy
+
+    def uniprot(client):
+        client.fetch_proteins()
+
+    def ncbi(client):
+        for database, _type in [("ncbi_nuc", "nucleotide"), ("ncbi_prot", "protein")]:
+            if database in _dbbuddy.databases or check_all:
+                client.fetch_sequences(_type)
+
+    def ensembl(client):
+        client.fetch_nucleotide()
+
+    jobs = [(server, databases, func) for server, databases, func in
+            [("uniprot", ["uniprot"], uniprot), ("ncbi", ["ncbi_nuc", "ncbi_prot"], ncbi),
+             ("ensembl", ["ensembl"], ensembl)]
+            if check_all or [db for db in databases if db in _dbbuddy.databases]]
+    try:
+        _fan_out(_dbbuddy, jobs, timeout)
+    finally:
+        _checkin_cached(_dbbuddy, checkout)
     return _dbbuddy
 
 
+def _offline_warning(_dbbuddy, checkout):
+    if checkout["missing"]:
+        br._stderr("Offline mode: %s records are not in the local cache\n" % checkout["missing"])
+    if _dbbuddy.search_terms:
+        br._stderr("Offline mode: search terms were not sent to the servers\n")
+    return
+
+
 # ################################################# Database Clients ################################################# #
 class GenericClient(object):
     def __init__(self, _dbbuddy, max_url=1000):
         self.dbbuddy = _dbbuddy
-        self.http_errors_file = br.TempFile()
-        self.results_file = br.TempFile()
+        self.http_errors_file = ResultsBuffer()
+        self.results_file = ResultsBuffer()
         self.max_url = max_url
         self.lock = Lock()
+        self.engine = HTTPEngine()
 
     def parse_error_file(self):
         http_errors_file = self.http_errors_file.read().strip("//\n")
@@ -780,18 +1805,27 @@ class UniProtRestClient(GenericClient):
         if type(request_params) == list:  # In case it's coming in from multicore run
             request_params = request_params[0]
         search_term = re.sub(" ", "+", search_term)
+        response = self._request(search_term, request_params)
+        if response is not None:
+            response = re.sub("^Entry.*\n", "", response, count=1)
+            with self.lock:
+                self.results_file.write("# Search: %s\n%s//\n" % (search_term, response))
+        return
+
+    def _request(self, search_term, request_params):
+        """
+        :param search_term: UniProt query (with spaces already converted to '+')
+        :param request_params: Dictionary of extra URL parameters (format, columns, etc.)
+        :return: The decoded response, or None if the request failed
+        """
         request_string = ""
         for _param, _value in request_params.items():
             _value = re.sub(" ", "+", _value)
             request_string += "&{0}={1}".format(_param, _value)
 
         try:
-            request = Request("{0}?query={1}{2}".format(self.server, search_term, request_string))
-            response = urlopen(request)
-            response = response.read().decode("utf-8")
-            response = re.sub("^Entry.*\n", "", response, count=1)
-            with self.lock:
-                self.results_file.write("# Search: %s\n%s//\n" % (search_term, response))
+            response = self.engine.request("{0}?query={1}{2}".format(self.server, search_term, request_string))
+            return response.decode("utf-8")
 
         except HTTPError as err:
             self.write_error("Uniprot search failed for '%s'" % search_term, err)
@@ -803,7 +1837,28 @@ class UniProtRestClient(GenericClient):
                 self.write_error("Uniprot request failed", err)
         except KeyboardInterrupt:
             br._stderr("\n\tUniProt query interrupted by user\n")
-        return
+        return None
+
+    def _fetch_page(self, accessions):
+        """
+        Download one batch of full records, and attach each one to its Record as soon as it is parsed. Only a single
+        response is ever held in memory, instead of the whole download.
+        :param accessions: Comma separated string of accessions
+        :return: Number of records attached
+        """
+        response = self._request(accessions, {"format": "txt"})
+        if not response or not response.strip():
+            return 0
+        received = 0
+        for _rec in SeqIO.parse(StringIO(response), "swiss"):
+            # Merged entries come back under a new primary accession, so check the secondary accessions too
+            for accn in [_rec.id] + _rec.annotations.get("accessions", []):
+                with self.lock:
+                    if accn in self.dbbuddy.records:
+                        self.dbbuddy.records[accn].record = _rec
+                        received += 1
+                        break
+        return received
 
     def count_hits(self):
         # Limit URLs to 2,083 characters
@@ -852,8 +1907,7 @@ class UniProtRestClient(GenericClient):
         runtime.start()
         if len(self.dbbuddy.search_terms) > 1:
             br._stderr("Querying UniProt with %s search terms (Ctrl+c to abort)\n" % len(self.dbbuddy.search_terms))
-            br.run_multicore_function(self.dbbuddy.search_terms, self.query_uniprot, max_processes=10, quiet=True,
-                                      func_args=[params])
+            self.engine.run(self.dbbuddy.search_terms, self.query_uniprot, func_args=[params], max_workers=10)
         else:
             br._stderr("Querying UniProt with the search term '%s'...\n" % self.dbbuddy.search_terms[0])
             self.query_uniprot(self.dbbuddy.search_terms[0], params)
@@ -891,11 +1945,10 @@ class UniProtRestClient(GenericClient):
         accessions = self.group_terms_for_url([_rec.accession for _rec in _records])
         runtime = br.RunTime(prefix="\t")
         runtime.start()
-        params = {"format": "txt"}
         if len(accessions) > 1:
-            br.run_multicore_function(accessions, self.query_uniprot, max_processes=10, quiet=True, func_args=[params])
+            received = sum(self.engine.run(accessions, self._fetch_page, max_workers=10))
         else:
-            self.query_uniprot(accessions[0], params)
+            received = self._fetch_page(accessions[0])
 
         runtime.end()
         errors = self.parse_error_file()
@@ -903,20 +1956,8 @@ class UniProtRestClient(GenericClient):
             br._stderr("{0}{1}The following errors were encountered while querying UniProt with "
                        "fetch_proteins():{2}\n{3}{4}".format(RED, UNDERLINE, NO_UNDERLINE, errors, DEF_FONT))
 
-        data = self.results_file.read().strip()
-        data = re.sub("# Search.*?\n", "", data)
-        data = re.sub("//(\n//)+", "//\n", data)
-        data = re.sub("^//\n*", "", data)
-        data = re.sub("//\n\n+", "//\n", data)
-        if data in ["", "//\n"]:
+        if not received:
             br._stderr("No sequences returned\n\n")
-            return
-
-        self.results_file.write(data, "w")
-
-        _records = SeqIO.parse(self.results_file.get_handle("r"), "swiss")
-        for _rec in _records:
-            self.dbbuddy.records[_rec.id].record = _rec
         return
 
 
@@ -927,300 +1968,397 @@ class NCBIClient(GenericClient):
         self.Entrez.email = CONFIG["email"]
         self.Entrez.tool = "buddysuite"
         self.max_attempts = 5  # NCBI throws a lot of 503 errors, so keep trying until we get through...
-        self.tries = 0
+        self.rate_limit = 10 if getattr(Entrez, "api_key", None) else 3  # Requests per second allowed by NCBI
+        self.summary_page = 1000  # Records per esummary request
+        self.sequence_page = 200  # Records per efetch request
+        self.post_size = 10000  # IDs per epost request
+        self.taxa = {}  # TaxId: organism name, so each taxon is only looked up once
 
-    def _mc_query(self, query, func_args):
+    def _entrez(self, tool, **params):
         """
-        Make a request to Entrez for some data
-        :param query: Appropriately sized/formatted request string
-        :param func_args: tool = "esummary_taxa", "efetch_gi", "esummary_seq", or "efetch_seq"
-        :return:
+        Make a single E-utilities request (through Biopython), respecting NCBI's rate limit and retrying busy servers
+        :param tool: "esearch", "epost", "esummary", or "efetch"
+        :param params: Passed on to the Entrez function (db, term, id, WebEnv, query_key, retstart, retmax, etc.)
+        :return: The raw response as bytes, or None if the request failed
         """
-        tool = func_args[0]
-        _type = None if len(func_args) == 1 else func_args[1]
-        if _type and _type not in ["nucleotide", "protein"]:
-            raise ValueError("Unknown type '%s', choose between 'nucleotide' and 'protein" % _type)
-        handle = None
-        timer = br.time()
-        counter = int(self.max_attempts)
-        while counter > 0:
-            counter -= 1
-            try:
-                if tool == "esummary_taxa":
-                    # Example query of taxa ids: "649,734,1009,2302"
-                    handle = Entrez.esummary(db="taxonomy", id=query, retmax=10000)
-                elif tool == "efetch_gi":
-                    # Example query of accn nums: "XP_010103297.1,XP_010103298.1,XP_010103299.1"
-                    handle = Entrez.efetch(db="nucleotide", id=query, rettype="gi", retmax=10000)
-                elif tool == "esummary_seq":
-                    # Example query of GI nums: "703125407,703125412,703125420"
-                    handle = Entrez.esummary(db="nucleotide", id=query, retmax=10000)
-                elif tool == "efetch_seq":
-                    # Example query of GI nums: "703125407,703125412,703125420"
-                    # Note that the database passed in doesn't matter. GIs will pull dna or prot regardless.
-                    handle = Entrez.efetch(db="nucleotide", id=query, rettype="gb", retmode="text", retmax=10000)
-                elif tool == "esearch":
-                    count = Entrez.read(Entrez.esearch(db=_type, term=re.sub('[\'"]', '', query), rettype="count"))["Count"]
-                    handle = Entrez.esearch(db=_type, term=re.sub('[\'"]', '', query), retmax=count)
-                else:
-                    raise ValueError("_mc_query() 'tool' argument must be in 'esummary_taxa', "
-                                     "'efetch_gi', 'esummary_seq', or 'efetch_seq'")
-
-                # This is a throttle so the NCBI server isn't spammed too rapidly
-                timer = br.time() - timer
-                if timer < 1:
-                    sleep(1 - timer)
+        if tool not in ["esearch", "epost", "esummary", "efetch"]:
+            raise ValueError("_entrez() 'tool' argument must be in 'esearch', 'epost', 'esummary', or 'efetch'")
+        query = params.get("term", params.get("id", "%s %s-%s" % (params.get("db"), params.get("retstart", 0),
+                                                                  params.get("retstart", 0) + params.get("retmax", 0))))
+        for attempt in range(self.max_attempts):
+            if getattr(self.engine, "cancelled", False):
                 break
+            # This is a throttle, shared by all threads, so the NCBI server isn't spammed too rapidly
+            rate_limiter("eutils.ncbi.nlm.nih.gov", self.rate_limit).acquire()
+            try:
+                handle = getattr(Entrez, tool)(**params)
+                result = handle.read()
+                handle.close()
+                return result if isinstance(result, bytes) else result.encode("utf-8")
             except HTTPError as err:
-                if err.getcode() != 503 or counter == 0:
+                if err.getcode() not in RETRY_CODES or attempt == self.max_attempts - 1:
                     self.write_error("NCBI request failed: %s" % query, err)
                     break
-                sleep(1)
+                sleep(self.engine.backoff * 2 ** attempt)
             except ConnectionResetError as err:
-                if "[Errno 54] Connection reset by peer" not in str(err) or counter == 0:
+                if "[Errno 54] Connection reset by peer" not in str(err) or attempt == self.max_attempts - 1:
                     self.write_error("NCBI request failed: %s" % query, err)
                     break
-                sleep(1)
+                sleep(self.engine.backoff * 2 ** attempt)
             except URLError as err:
                 if "Errno 8" in str(err):
                     self.write_error("NCBI request failed, are you connected to the internet?", err)
                 else:
                     self.write_error("NCBI request failed", err)
                 break
-            except KeyboardInterrupt:
-                return
-        if handle:
-            if tool == "efetch_seq":
-                result = "%s\n" % handle.read().strip()
-            else:
-                result = "%s\n### END ###\n" % handle.read().strip()
+        return None
 
+    @staticmethod
+    def _history(result):
+        """
+        Pull the history server keys out of an esearch or epost response. Regular expressions are used instead of
+        Entrez.read(), because that needs to download DTDs from NCBI.
+        :param result: Raw XML response
+        :return: (WebEnv, query_key, count) tuple, or None if the server didn't send them back
+        """
+        result = result.decode("utf-8") if result else ""
+        webenv = re.search("<WebEnv>(.*?)</WebEnv>", result)
+        query_key = re.search("<QueryKey>(.*?)</QueryKey>", result)
+        count = re.search("<Count>([0-9]+)</Count>", result)
+        if not webenv or not query_key:
+            return None
+        return webenv.group(1), query_key.group(1), None if not count else int(count.group(1))
+
+    def _post(self, _type, ids):
+        """
+        Upload IDs to the Entrez history server, in batches of self.post_size
+        :param _type: "nucleotide" or "protein"
+        :param ids: List of GI numbers or accessions
+        :return: List of (WebEnv, query_key, count) tuples
+        """
+        histories = []
+        webenv = None
+        for i in range(0, len(ids), self.post_size):
+            group = ids[i:i + self.post_size]
+            params = {"db": _type, "id": ",".join([str(_id) for _id in group])}
+            if webenv:
+                params["WebEnv"] = webenv  # Keep all of the batches in the same session
+            history = self._history(self._entrez("epost", **params))
+            if history:
+                webenv = history[0]
+                histories.append((history[0], history[1], len(group)))
+        return histories
+
+    def _stream_pages(self, page_starts, fetch_page, process_page):
+        """
+        Download pages from the history server concurrently, but hand them on in order, as soon as every earlier page
+        is in. This keeps the record order predictable without waiting for the whole download.
+        :param page_starts: List of retstart values
+        :param fetch_page: Function that takes a retstart value and returns the page, ready to be merged. It runs outside
+        of self.lock, so any downloading and parsing happens in parallel.
+        :param process_page: Function that merges a page returned by fetch_page. It is called in page order while
+        holding self.lock, so it must not make requests or call write_error().
+        :return: None
+        """
+        finished = {}
+        next_page = [0]
+
+        def get_page(indx):
+            page = fetch_page(page_starts[indx])
             with self.lock:
-                self.results_file.write(result)
+                finished[indx] = page
+                while next_page[0] in finished:
+                    page = finished.pop(next_page[0])
+                    if page:
+                        process_page(page)
+                    next_page[0] += 1
+
+        self.engine.run(range(len(page_starts)), get_page, max_workers=3)
+        return
+
+    def _taxa_names(self, taxa_ids):
+        """
+        Look up scientific names for any TaxIds that haven't been seen before
+        :param taxa_ids: Iterable of TaxIds
+        :return: None (names are stored in self.taxa)
+        """
+        taxa_ids = sorted(set([str(int(taxa_id)) for taxa_id in taxa_ids]) - set(self.taxa) - {"0"})
+        for i in range(0, len(taxa_ids), self.summary_page):
+            group = taxa_ids[i:i + self.summary_page]
+            result = self._entrez("esummary", db="taxonomy", id=",".join(group))
+            if not result:
+                continue
+            for summary in Entrez.parse(BytesIO(result)):
+                self.taxa[str(int(summary["TaxId"]))] = "Unclassified" if "ScientificName" not in summary \
+                    else summary["ScientificName"]
         return
 
+    def _parse_summaries(self, result):
+        """
+        Parse a page of esummary results, and look up the organism names of any new TaxIds
+        :param result: Raw esummary XML (None if the request failed)
+        :return: List of summary dictionaries
+        """
+        if not result:
+            return []
+        try:
+            summaries = [dict(x) for x in Entrez.parse(BytesIO(result))]
+        except RuntimeError as err:  # The server sometimes sends back an error message instead of results
+            self.write_error("NCBI esummary failed", err)
+            return []
+
+        self._taxa_names([summary["TaxId"] for summary in summaries])
+        return summaries
+
+    def _add_summaries(self, summaries, _type, database):
+        """
+        Turn parsed esummary results into Records, and merge them into the DbBuddy object
+        :param summaries: List of summary dictionaries from _parse_summaries()
+        :param _type: "nucleotide" or "protein"
+        :param database: "ncbi_nuc" or "ncbi_prot"
+        :return: Number of records added or updated
+        """
+        records = self.dbbuddy.records
+        for summary in summaries:
+            # status can be 'live', 'dead', 'withdrawn', 'replaced'
+            status = summary["Status"] if summary["ReplacedBy"] == '' else \
+                "%s->%s" % (summary["Status"], summary["ReplacedBy"])
+
+            keys = ["gi_num",
+                    "TaxId",
+                    "organism",
+                    "length",
+                    "comments",
+                    "status"]
+            values = [str(summary["Gi"]),
+                      summary["TaxId"],
+                      self.taxa.get(str(int(summary["TaxId"])), "Unclassified"),
+                      summary["Length"],
+                      summary["Title"],
+                      status]
+            rec_summary = OrderedDict([(key, value) for key, value in zip(keys, values)])
+
+            accn = summary["Caption"]
+            version = re.search("%s\.([0-9]+)" % accn, summary["Extra"])
+            if version:
+                accn = "%s.%s" % (accn, version.group(1))
+            rec = Record(accn, gi=int(summary["Gi"]), summary=rec_summary, _type=_type,
+                         _size=rec_summary["length"], _database=database)
+
+            # Replace GI-only and un-versioned placeholders with the full record
+            if str(rec.gi) in records and str(rec.gi) != rec.accession:
+                del records[str(rec.gi)]
+            if rec.accession.split(".")[0] in records and rec.accession.split(".")[0] != rec.accession:
+                del records[rec.accession.split(".")[0]]
+            if rec.accession in records:
+                records[rec.accession].update(rec)
+            else:
+                records[rec.accession] = rec
+        return len(summaries)
+
+    def _page_summaries(self, _type, database, history):
+        webenv, query_key, count = history
+        received = [0]
+
+        def fetch_page(retstart):
+            return self._parse_summaries(self._entrez("esummary", db=_type, WebEnv=webenv, query_key=query_key,
+                                                      retstart=retstart, retmax=self.summary_page))
+
+        def process_page(page):
+            received[0] += self._add_summaries(page, _type, database)
+
+        self._stream_pages(list(range(0, count, self.summary_page)), fetch_page, process_page)
+        return received[0]
+
     def search_ncbi(self, _type):
         """
-        Query NCBI with search terms (not accns or GI nums)
+        Query NCBI with search terms (not accns or GI nums). Hits are kept on the history server and their summaries
+        are paged straight into the DbBuddy object.
         :param _type: "nucleotide" or "protein"
         :return:
         """
         if not self.dbbuddy.search_terms:
             return
+        if _type not in ["nucleotide", "protein"]:
+            raise ValueError("Unknown type '%s', choose between 'nucleotide' and 'protein" % _type)
+        database = 'ncbi_nuc' if _type == 'nucleotide' else 'ncbi_prot'
         self.results_file.clear()
-        if len(self.dbbuddy.search_terms) > 1:
-            br.run_multicore_function(self.dbbuddy.search_terms, self._mc_query, func_args=["esearch", _type],
-                                      max_processes=3, quiet=True)
-        else:
-            self._mc_query(self.dbbuddy.search_terms[0], func_args=["esearch", _type])
-
+        received = 0
+        try:
+            for search_term in self.dbbuddy.search_terms:
+                history = self._history(self._entrez("esearch", db=_type, term=re.sub('[\'"]', '', search_term),
+                                                     usehistory="y", retmax=0))
+                if not history or not history[2]:
+                    continue
+                br._stderr("Retrieving %s %s record summaries from NCBI for '%s'...\n"
+                           % (history[2], _type, search_term))
+                received += self._page_summaries(_type, database, history)
+        except KeyboardInterrupt:
+            br._stderr("\n\tNCBI query interrupted by user\n")
         self.parse_error_file()
 
-        results = self.results_file.read().split("\n### END ###\n")
-        results = [x for x in results if x != ""]
-        gi_nums = []
-        for result in results:
-            result = Entrez.read(StringIO(result))
-            gi_nums += result["IdList"]
-        if not gi_nums:
+        if not received:
             br._stderr("NCBI returned no %s results\n\n" % _type)
-            return
-        for accn, rec in self.dbbuddy.records.items():
-            if str(rec.gi) in gi_nums:
-                del gi_nums[gi_nums.index(str(rec.gi))]
-        database = 'ncbi_nuc' if _type == 'nucleotide' else 'ncbi_prot'
-        for gi in gi_nums:
-            self.dbbuddy.records[gi] = Record(gi, gi=int(gi), _database=database, _type="gi_num")
+        else:
+            br._stderr("\t%s records received.\n" % received)
         return
 
     def fetch_summaries(self, database):
         """
-        Fetch metadata for all records
+        Fetch metadata for all records that don't have it yet
         :param database: in "ncbi_prot" and "ncbi_nuc"
         :return:
         """
-        # EUtils esummary will only take gi numbers
-        # Start by grabbing GI numbers for any records with accns but no GI
         _type = "protein" if database == "ncbi_prot" else "nucleotide"
         self.results_file.clear()
-        accns = [accn for accn, rec in self.dbbuddy.records.items()
-                 if rec.database == database and not rec.gi]
-        if accns:
-            accn_searches = self.group_terms_for_url(accns)
-            if len(accn_searches) > 1:
-                br.run_multicore_function(accn_searches, self._mc_query,
-                                          func_args=["efetch_gi"], max_processes=3, quiet=True)
-            else:
-                self._mc_query(accn_searches[0], func_args=["efetch_gi"])
-
-        gi_nums = self.results_file.read().split("\n### END ###\n")
-        gi_nums = [x.split("\n") for x in gi_nums]
-        gi_nums = [x for sublist in gi_nums for x in sublist if x]
-
-        # Append any records that were not grabbed in the previous step
-        gi_nums += [rec.gi for accn, rec in self.dbbuddy.records.items()
-                    if rec.database == database and rec.gi and rec.gi not in gi_nums]
-
-        # That's it if no GIs present
-        if not gi_nums:
+        ids = OrderedDict()  # Used as an ordered set
+        for accn, rec in self.dbbuddy.records.items():
+            if rec.database == database and not rec.summary:
+                ids[str(rec.gi) if rec.gi else accn] = None
+        if not ids:
             return
 
-        # Download all of the summaries
-        self.results_file.clear()
-        gi_groups = self.group_terms_for_url(gi_nums)
-        br._stderr("Retrieving %s %s record summaries from NCBI...\n" % (len(gi_nums), _type))
+        br._stderr("Retrieving %s %s record summaries from NCBI...\n" % (len(ids), _type))
         runtime = br.RunTime(prefix="\t")
         runtime.start()
-        if len(gi_groups) > 1:
-            br.run_multicore_function(gi_groups, self._mc_query, func_args=["esummary_seq"],
-                                      max_processes=3, quiet=True)
-        else:
-            self._mc_query(gi_groups[0], func_args=["esummary_seq"])
+        received = 0
+        try:
+            for history in self._post(_type, list(ids)):
+                received += self._page_summaries(_type, database, history)
+        except KeyboardInterrupt:
+            br._stderr("\n\tNCBI query interrupted by user\n")
         runtime.end()
-        results = self.results_file.read().split("\n### END ###\n")
-        results = [x for x in results if x != ""]
-
-        # Sift through all the results and grab summary information
-        gi_nums = {}
-        taxa = []
-        for result in results:
-            try:  # This will catch and retry when the server fails on us
-                summaries = [x for x in Entrez.parse(StringIO(result))]
-                self.tries = 0
-            except RuntimeError:
-                if self.tries >= self.max_attempts:
-                    self.tries = 0
-                    break
-                else:
-                    br._stderr("Problem talking to NCBI, retrying...\n")
-                    self.tries += 1
-                    self.fetch_summaries(database)
-                break
-
-            for summary in [dict(x) for x in summaries]:
-                # status can be 'live', 'dead', 'withdrawn', 'replaced'
-                status = summary["Status"] if summary["ReplacedBy"] == '' else \
-                    "%s->%s" % (summary["Status"], summary["ReplacedBy"])
-
-                keys = ["gi_num",
-                        "TaxId",
-                        "organism",
-                        "length",
-                        "comments",
-                        "status"]
-                values = [str(summary["Gi"]),
-                          summary["TaxId"],
-                          "",
-                          summary["Length"],
-                          summary["Title"],
-                          status]
-                rec_summary = OrderedDict([(key, value) for key, value in zip(keys, values)])
-
-                if summary["TaxId"] not in taxa:
-                    taxa.append(summary["TaxId"])
-
-                accn = summary["Caption"]
-                version = re.search("%s\.([0-9])+" % accn, summary["Extra"])
-                if version:
-                    accn = "%s.%s" % (accn, version.group(1))
-                gi_nums[summary["Gi"]] = Record(accn, gi=int(summary["Gi"]), summary=rec_summary, _type=_type,
-                                                _size=rec_summary["length"], _database=database)
-
-        # Get taxa names for all of the records retrieved
-        self.results_file.clear()
-        _taxa_ids = self.group_terms_for_url(taxa)
-        if len(_taxa_ids) > 1:
-            br.run_multicore_function(_taxa_ids, self._mc_query, func_args=["esummary_taxa"],
-                                      max_processes=3, quiet=True)
-        else:
-            self._mc_query(_taxa_ids[0], func_args=["esummary_taxa"])
         self.parse_error_file()
-
-        results = self.results_file.read().split("\n### END ###\n")
-        results = [x for x in results if x]
-
-        taxa = {}
-        for result in results:
-            for summary in Entrez.parse(StringIO(result)):
-                taxa[summary["TaxId"]] = "Unclassified" if "ScientificName" not in summary \
-                    else summary["ScientificName"]
-
-        # Apply the taxa names that were downloaded
-        for gi, rec in gi_nums.items():
-            if rec.summary["TaxId"] in taxa:
-                rec.summary["organism"] = taxa[rec.summary["TaxId"]]
-            else:
-                rec.summary["organism"] = "Unclassified"
-        br._stderr("\t%s records received.\n" % len(gi_nums))
-
-        # Update the dbbuddy object with all the new info
-        for gi, rec in gi_nums.items():
-            if str(gi) in self.dbbuddy.records:  # GI only records
-                del self.dbbuddy.records[str(gi)]
-            if rec.accession.split(".")[0] in self.dbbuddy.records:  # Un-versioned accns
-                del self.dbbuddy.records[rec.accession.split(".")[0]]
-            if rec.accession in self.dbbuddy.records:
-                self.dbbuddy.records[rec.accession].update(rec)
-            else:
-                self.dbbuddy.records[rec.accession] = rec
+        br._stderr("\t%s records received.\n" % received)
         return
 
     def fetch_sequences(self, database):  # database in ["nucleotide", "protein"]
         db = "ncbi_nuc" if database == "nucleotide" else "ncbi_prot"
-        gi_nums = [_rec.gi for accn, _rec in self.dbbuddy.records.items() if _rec.database == db]
-        if not gi_nums:
+        # Look records back up by accession, un-versioned accession, or GI
+        lookup = {}
+        ids = OrderedDict()  # Used as an ordered set
+        for accn, _rec in self.dbbuddy.records.items():
+            if _rec.database == db and not _rec.record:
+                ids[str(_rec.gi) if _rec.gi else accn] = None
+                for _id in [str(_rec.gi), accn.split(".")[0], accn]:
+                    lookup[_id] = accn
+        if not ids:
             return
+
+        def fetch_page(retstart):
+            page = self._entrez("efetch", db=database, WebEnv=webenv, query_key=query_key, retstart=retstart,
+                                retmax=self.sequence_page, rettype="gb", retmode="text")
+            return list(SeqIO.parse(TextIOWrapper(BytesIO(page), encoding="utf-8"), "gb")) if page else None
+
+        def process_page(page):
+            for rec in page:
+                gi = rec.annotations.get("gi")
+                accn = lookup.get(rec.id, lookup.get(rec.id.split(".")[0], lookup.get(str(gi))))
+                if not accn or self.dbbuddy.records[accn].record:
+                    continue
+                self.dbbuddy.records[accn].record = rec
+                version = re.search("^.*?\.([0-9]+)$", rec.id)
+                if version:
+                    self.dbbuddy.records[accn].version = version.group(1)
+
         try:
             self.results_file.clear()
-            gi_nums = self.group_terms_for_url(gi_nums)
             runtime = br.RunTime(prefix="\t")
             br._stderr("Fetching full %s sequence records from NCBI...\n" % database)
             runtime.start()
-            if len(gi_nums) > 1:
-                br.run_multicore_function(gi_nums, self._mc_query, func_args=["efetch_seq"],
-                                          max_processes=3, quiet=True)
-            else:
-                self._mc_query(gi_nums[0], func_args=["efetch_seq"])
+            for webenv, query_key, count in self._post(database, list(ids)):
+                self._stream_pages(list(range(0, count, self.sequence_page)), fetch_page, process_page)
             self.parse_error_file()
-
             runtime.end()
-            records = {}
-            for rec in SeqIO.parse(self.results_file.get_handle("r"), "gb"):
-                if rec.id not in records:
-                    records[rec.id] = rec
             br._stderr("\tDone\n")
-            for accn, rec in records.items():
-                self.dbbuddy.records[accn].record = rec
-                version = re.search("^.*?\.([0-9]+)$", accn)
-                if version:
-                    self.dbbuddy.records[accn].version = version.group(1)
         except KeyboardInterrupt:
             br._stderr("\n\tNCBI query interrupted by user\n")
 
         return
 
 
+_ENSEMBL_SPECIES = {}  # server: (time stamp, species table), shared by every EnsemblRestClient
+_ENSEMBL_SPECIES_LOCK = Lock()
+
+
 class EnsemblRestClient(GenericClient):
-    def __init__(self, _dbbuddy, server='http://rest.ensembl.org/'):
+    def __init__(self, _dbbuddy, server='http://rest.ensembl.org/', species_file=None):
+        """
+        :param _dbbuddy: DbBuddy object
+        :param server: Ensembl REST server
+        :param species_file: JSON file where the species table is kept between sessions. Defaults to the BuddySuite
+        data directory (set to False to only keep it in memory).
+        """
         GenericClient.__init__(self, _dbbuddy)
         self.server = server
-        self.species = self.perform_rest_action("info/species", headers={"Content-type": "application/json",
-                                                                         "Accept": "application/json"})
-        self.parse_error_file()
-        if self.species:
-            self.species = self.species["species"]
-            self.species = {x["display_name"]: x for x in self.species if x["display_name"]}
-        else:
-            self.species = {}
-        self.max_attempts = 5
+        if species_file is None and CONFIG["data_dir"]:
+            species_file = "%s%sensembl_species.json" % (CONFIG["data_dir"], os.sep)
+        self.species_file = species_file
+        self.species = self._load_species()
 
-    def _mc_search(self, species, args):
-        identifier = args[0]
-        self.dbbuddy.failures = {}
-        data = self.perform_rest_action("lookup/symbol/%s/%s" % (species, identifier),
-                                        headers={"Content-type": "application/json", "Accept": "application/json"})
-        with self.lock:
-            self.results_file.write("%s\n### END ###\n" % data)
+    def _load_species(self):
+        """
+        The species table rarely changes, so it is only downloaded once every ENSEMBL_SPECIES_TTL seconds
+        :return: {display_name: info} dictionary
+        """
+        with _ENSEMBL_SPECIES_LOCK:
+            cached = _ENSEMBL_SPECIES.get(self.server)
+            if not cached and self.species_file and os.path.isfile(self.species_file):
+                try:
+                    with open(self.species_file, "r", encoding="utf-8") as ifile:
+                        cached = json.load(ifile).get(self.server)
+                    cached = None if not cached else (cached["stored"], cached["species"])
+                except (ValueError, KeyError, OSError):
+                    cached = None
+            if cached and time() - cached[0] < ENSEMBL_SPECIES_TTL:
+                _ENSEMBL_SPECIES[self.server] = cached
+                return cached[1]
+
+            species = self.perform_rest_action("info/species", headers={"Content-type": "application/json",
+                                                                        "Accept": "application/json"})
+            self.parse_error_file()
+            if not species:
+                return {} if not cached else cached[1]  # Stale is better than nothing if the server is down
+
+            species = {x["display_name"]: x for x in species["species"] if x["display_name"]}
+            _ENSEMBL_SPECIES[self.server] = (time(), species)
+            if self.species_file:
+                try:
+                    tables = {}
+                    if os.path.isfile(self.species_file):
+                        with open(self.species_file, "r", encoding="utf-8") as ifile:
+                            tables = json.load(ifile)
+                    tables[self.server] = {"stored": time(), "species": species}
+                    with open(self.species_file, "w", encoding="utf-8") as ofile:
+                        json.dump(tables, ofile)
+                except (ValueError, OSError):
+                    pass
+            return species
+
+    def _summary2record(self, summary, species):
+        """
+        :param summary: Dictionary returned by lookup/symbol
+        :param species: Display name of the species that was searched
+        :return: Record object
+        """
+        accn = summary['id']
+        size = abs(summary["start"] - summary["end"])
+        _version = None if 'version' not in summary else summary['version']
+
+        required_keys = ['display_name', 'biotype', 'object_type', 'strand', 'assembly_name', 'description',
+                         'version']
+        for key in required_keys:
+            if key not in summary:
+                summary[key] = ''
+
+        summary = OrderedDict([('name', summary['display_name']), ('length', size),
+                               ('organism', species),
+                               ('TaxId', self.species[species]['taxon_id']),
+                               ('biotype', summary['biotype']), ('object_type', summary['object_type']),
+                               ('strand', summary['strand']), ('assembly_name', summary['assembly_name']),
+                               ('comments', summary['description'])])
+
+        return Record(accn, summary=summary, _version=_version, _size=size, _database="ensembl", _type="nucleotide")
 
     def perform_rest_action(self, endpoint, **kwargs):
         """
@@ -1230,41 +2368,27 @@ class EnsemblRestClient(GenericClient):
         :return:
         """
         endpoint = endpoint.strip("/")
-        kwargs_backup = dict(kwargs)
+        headers = kwargs.get("headers", {})
         try:
+            data = None
             if "data" in kwargs:
-                data = '{'
-                for key, value in kwargs["data"].items():
-                    data += '"%s": %s, ' % (key, value)
-                data = "%s}" % data.strip(", ")
-                data = re.sub("'", '"', data)
-                kwargs["data"] = data.encode('utf-8')
-
-            request = Request(self.server + endpoint, **kwargs)
-            response = urlopen(request)
-            self.max_attempts = 5  # Reset max_attempts, which may have been reduced if there were some 429 errors
-            if request.get_header("Content-type") == "application/json":
-                content = response.read().decode()
-                data = json.loads(content)
-            elif request.get_header("Content-type") == "text/x-seqxml+xml":
-                data = SeqIO.parse(response, "seqxml")
+                data = json.dumps(kwargs["data"]).encode('utf-8')
+
+            if headers.get("Content-type") not in ["application/json", "text/x-seqxml+xml"]:
+                raise ValueError("Unknown request headers '%s'" % headers)
+
+            # Rate limits, and 429 responses with their Retry-After header, are dealt with by the engine
+            response = self.engine.request(self.server + endpoint, data=data, headers=headers)
+            if headers["Content-type"] == "application/json":
+                data = json.loads(response.decode())
             else:
-                raise ValueError("Unknown request headers '%s'" % request.headers)
+                data = SeqIO.parse(BytesIO(response), "seqxml")
             return data
 
         except HTTPError as err:
-            # check if we are being rate limited by the server
             err_code = err.getcode()
             if err_code == 429:
-                if self.max_attempts == 0:
-                    self.max_attempts = 5
-                    self.write_error("Server Busy", err)
-                    pass
-                elif 'Retry-After' in err.headers:
-                    self.max_attempts -= 1
-                    retry = err.headers['Retry-After']
-                    sleep(float(retry) + 1)
-                    self.perform_rest_action(endpoint, **kwargs_backup)
+                self.write_error("Server Busy", err)
             elif err_code == 400:
                 pass
             else:
@@ -1280,52 +2404,49 @@ class EnsemblRestClient(GenericClient):
             pass
         return
 
+    def _bulk_search(self, job):
+        """
+        Look up a batch of gene symbols in one species with a single POST request
+        :param job: (species display name, [symbols]) tuple
+        :return: {symbol: Record} dictionary of the hits
+        """
+        species, symbols = job
+        data = self.perform_rest_action("lookup/symbol/%s" % self.species[species]["name"],
+                                        data={"symbols": symbols},
+                                        headers={"Content-type": "application/json", "Accept": "application/json"})
+        if not data:
+            return {}
+        return OrderedDict([(symbol, self._summary2record(summary, species)) for symbol, summary in data.items()
+                            if summary])
+
     def search_ensembl(self):
+        """
+        Every search term is looked up in every species, but all of the terms go to each species in one request
+        :return:
+        """
         self.results_file.clear()
-        species = [name for name, info in self.species.items()]
-        for search_term in self.dbbuddy.search_terms:
-            br._stderr("Searching Ensembl for %s...\n" % search_term)
-            br.run_multicore_function(species, self._mc_search, [search_term], quiet=True)
-            self.parse_error_file()
-            results = self.results_file.read().split("\n### END ###")
-            counter = 0
-            for rec in results:
-                rec = rec.strip()
-                if not rec or rec in ["None", ""]:
-                    continue
-                counter += 1
-                rec = re.sub("'", '"', rec)
-                summary = json.loads(rec)
-                accn = summary['id']
-                size = abs(summary["start"] - summary["end"])
-                _version = None if 'version' not in summary else summary['version']
-
-                required_keys = ['display_name', 'species', 'biotype', 'object_type',
-                                 'strand', 'assembly_name', 'description', 'version']
-
-                for key in required_keys:
-                    if key not in summary:
-                        summary[key] = ''
-
-                summary = OrderedDict([('name', summary['display_name']), ('length', size),
-                                       ('organism', summary['species']),
-                                       ('TaxId', self.species[summary['species']]['taxon_id']),
-                                       ('biotype', summary['biotype']), ('object_type', summary['object_type']),
-                                       ('strand', summary['strand']), ('assembly_name', summary['assembly_name']),
-                                       ('comments', summary['description'])])
-
-                rec = Record(accn, summary=summary, _version=_version,
-                             _size=size, _database="ensembl", _type="nucleotide")
+        search_terms = list(OrderedDict([(term, None) for term in self.dbbuddy.search_terms]))
+        if not search_terms:
+            return
+        jobs = [(species, search_terms[i:i + ENSEMBL_MAX_SYMBOLS]) for species in self.species
+                for i in range(0, len(search_terms), ENSEMBL_MAX_SYMBOLS)]
+        br._stderr("Searching Ensembl for %s...\n" % ", ".join(search_terms))
+        results = self.engine.run(jobs, self._bulk_search)
+        self.parse_error_file()
 
+        counter = 0
+        for hits in results:
+            for symbol, rec in hits.items():
+                counter += 1
                 if rec.accession in self.dbbuddy.records:
                     self.dbbuddy.records[rec.accession].update(rec)
                 else:
                     self.dbbuddy.records[rec.accession] = rec
 
-            if counter > 0:
-                br._stderr("\t%s records received\n" % counter)
-            else:
-                br._stderr("Ensembl returned no results\n")
+        if counter > 0:
+            br._stderr("\t%s records received\n" % counter)
+        else:
+            br._stderr("Ensembl returned no results\n")
 
     def fetch_summaries(self):
         accns = [accn for accn, rec in self.dbbuddy.records.items() if rec.database == "ensembl"]
@@ -1432,6 +2553,10 @@ Further details about each command can be accessed by typing 'help <command>'
         self.doc_header = "Available commands:                                                         "
         self.dbbuddy = _dbbuddy
         self.crash_file = crash_file
+        self.journal = SessionJournal(crash_file.path)
+        # Journal entries that can be rewound by 'undo', most recent last
+        self.undo = []
+        self.timeout = None  # Seconds that 'search' and 'fetch' wait for the slowest server
         self.dump_session()
 
         if CONFIG["data_dir"]:
@@ -1450,10 +2575,6 @@ Further details about each command can be accessed by typing 'help <command>'
         readline.read_history_file(self.history_path)
         readline.set_history_length(1000)
 
-        # As implemented, one UnDo is possible (reload the most recent dump). Set self.undo to true every time a dump
-        # occurs, and back to False if undo is used.
-        self.undo = False
-
         br._stderr(self.terminal_default)  # This needs to be called here if stderr is going to format correctly
         if self.dbbuddy.records or self.dbbuddy.search_terms:
             retrieve_summary(_dbbuddy)
@@ -1485,16 +2606,11 @@ Further details about each command can be accessed by typing 'help <command>'
         return stop
 
     def dump_session(self):
-        # Need to remove Lock()s to pickle
-        for client in [client for db, client in self.dbbuddy.server_clients.items() if client]:
-            client.lock = False
-        self.crash_file.save("%s_undo" % self.crash_file.path)
-        self.crash_file.open()
-        dill.dump(self.dbbuddy, self.crash_file.handle, protocol=-1)
-        self.crash_file.close()
-        self.undo = True
-        for client in [client for db, client in self.dbbuddy.server_clients.items() if client]:
-            client.lock = Lock()
+        # Only the changes since the last dump are appended to the crash file
+        entry = self.journal.record(self.dbbuddy)
+        if entry is None:
+            return
+        self.undo = self.undo + [entry] if entry else []  # Compacting the journal clears the undo history
 
     def default(self, line):
         if line == "exit":
@@ -1594,6 +2710,40 @@ Further details about each command can be accessed by typing 'help <command>'
             Popen(line, shell=True).wait()
         _stdout("\n", format_out=self.terminal_default)
 
+    def do_cache(self, line=None):
+        line = "" if not line else line.strip().lower()
+        if not getattr(self.dbbuddy, "cache", None):  # Sessions loaded from before the cache existed
+            self.dbbuddy.cache = RecordCache()
+
+        cache = self.dbbuddy.cache
+        if not cache.path:
+            _stdout("The record cache is disabled, because there is no BuddySuite data directory.\n\n", format_in=RED,
+                    format_out=self.terminal_default)
+            return
+
+        if line in ["offline", "online"]:
+            cache.offline = True if line == "offline" else False
+            _stdout("Records will %s.\n\n" % ("only be read from the local cache" if cache.offline
+                                               else "be requested from the servers if they are not cached"),
+                    format_in=GREEN, format_out=self.terminal_default)
+            self.dump_session()
+        elif line == "clear":
+            cache.clear()
+            _stdout("Local cache cleared.\n\n", format_in=GREEN, format_out=self.terminal_default)
+        elif line:
+            _stdout("Unknown cache command '%s'. Choose from 'offline', 'online', or 'clear'.\n\n" % line,
+                    format_in=RED, format_out=self.terminal_default)
+        else:
+            stats = cache.stats()
+            _stdout("Local cache: {0}{path}{1}\n"
+                    "Mode:        {0}{mode}{1}\n"
+                    "Entries:     {0}{entries}{1} ({0}{full_records}{1} with sequence, {0}{size}B{1})\n"
+                    "Hits:        {0}{hits}{1}\n"
+                    "Misses:      {0}{misses}{1}\n\n".format(YELLOW, GREEN, mode="offline" if stats["offline"] else
+                                                             "online", size=br.pretty_number(stats["bytes"]),
+                                                             **stats),
+                    format_in=GREEN, format_out=self.terminal_default)
+
     def do_database(self, line):
         if not line:
             line = input("%sSpecify database:%s " % (RED, self.terminal_default))
@@ -1719,7 +2869,7 @@ Further details about each command can be accessed by typing 'help <command>'
         if accn_only:
             search_terms = list(self.dbbuddy.search_terms)
             self.dbbuddy.search_terms = []
-            retrieve_summary(self.dbbuddy)
+            retrieve_summary(self.dbbuddy, timeout=self.timeout)
             self.dbbuddy.search_terms = search_terms
 
         amount_seq_requested = 0
@@ -1737,7 +2887,7 @@ Further details about each command can be accessed by typing 'help <command>'
                 _stdout("Aborted...\n\n", format_in=RED, format_out=self.terminal_default)
                 return
 
-        retrieve_sequences(self.dbbuddy)
+        retrieve_sequences(self.dbbuddy, timeout=self.timeout)
         seq_retrieved = 0
         for _accn in new_records_fetched:
             if self.dbbuddy.records[_accn].record:
@@ -1766,20 +2916,19 @@ Further details about each command can be accessed by typing 'help <command>'
         if not line:
             line = input("%sWhere is the dump_file?%s " % (RED, self.terminal_default))
         try:
-            with open(os.path.abspath(line), "rb") as ifile:
-                dbbuddy = dill.load(ifile)
-                self.dbbuddy.search_terms = dbbuddy.search_terms
-                self.dbbuddy.records = dbbuddy.records
-                self.dbbuddy.trash_bin = dbbuddy.trash_bin
-                self.dbbuddy.out_format = dbbuddy.out_format
-                self.dbbuddy.failures = dbbuddy.failures
-                self.dbbuddy.databases = dbbuddy.databases
-                self.dbbuddy.memory_footprint = dbbuddy.memory_footprint
+            dbbuddy = SessionJournal.load(os.path.abspath(line))
+            self.dbbuddy.search_terms = dbbuddy.search_terms
+            self.dbbuddy.records = dbbuddy.records
+            self.dbbuddy.trash_bin = dbbuddy.trash_bin
+            self.dbbuddy.out_format = dbbuddy.out_format
+            self.dbbuddy.failures = dbbuddy.failures
+            self.dbbuddy.databases = dbbuddy.databases
+            self.dbbuddy.memory_footprint = dbbuddy.memory_footprint
 
             for _db, client in self.dbbuddy.server_clients.items():
                 if client:
-                    client.http_errors_file = br.TempFile()
-                    client.results_file = br.TempFile()
+                    client.http_errors_file = ResultsBuffer()
+                    client.results_file = ResultsBuffer()
 
             _stdout("Session loaded from file.\n\n", format_in=GREEN, format_out=self.terminal_default, quiet=quiet)
             self.dump_session()
@@ -1840,7 +2989,15 @@ Further details about each command can be accessed by typing 'help <command>'
                     format_in=RED, format_out=self.terminal_default)
             return
 
-        self.crash_file.save(line)
+        # Need to remove Lock()s to pickle
+        for client in [client for db, client in self.dbbuddy.server_clients.items() if client]:
+            client.lock = False
+        try:
+            with open(line, "wb") as ofile:
+                dill.dump(self.dbbuddy, ofile, protocol=-1)
+        finally:
+            for client in [client for db, client in self.dbbuddy.server_clients.items() if client]:
+                client.lock = Lock()
         self.hash = hash(self.dbbuddy)
         _stdout("Live session saved\n\n", format_in=GREEN, format_out=self.terminal_default)
 
@@ -1851,7 +3008,7 @@ Further details about each command can be accessed by typing 'help <command>'
         # Do this on a temp dbbuddy obj so searches are not repeated
         temp_buddy = DbBuddy(line)
         temp_buddy.databases = self.dbbuddy.databases
-        retrieve_summary(temp_buddy)
+        retrieve_summary(temp_buddy, timeout=self.timeout)
         for _term in temp_buddy.search_terms:
             if _term not in self.dbbuddy.search_terms:
                 self.dbbuddy.search_terms.append(_term)
@@ -2047,14 +3204,36 @@ NOTE: There are %s summary records in the Live Session, and only full records ca
                     format_in=RED, format_out=self.terminal_default)
         return
 
+    def do_timeout(self, line=None):
+        line = "" if not line else line.strip().lower()
+        if line in ["off", "none"]:
+            self.timeout = None
+        elif line:
+            try:
+                timeout = float(line)
+                if timeout <= 0:
+                    raise ValueError
+            except ValueError:
+                _stdout("Timeout must be a positive number of seconds, or 'off', not '%s'.\n\n" % line, format_in=RED,
+                        format_out=self.terminal_default)
+                return
+            self.timeout = int(timeout) if timeout.is_integer() else timeout
+
+        if self.timeout is None:
+            _stdout("Searches and fetches wait for every server to finish.\n\n", format_in=GREEN,
+                    format_out=self.terminal_default)
+        else:
+            _stdout("Servers that take longer than %s%s%s are left out of searches and fetches.\n\n"
+                    % (YELLOW, br.pretty_time(self.timeout), GREEN), format_in=GREEN, format_out=self.terminal_default)
+
     def do_undo(self, *_):
         if not self.undo:
-            _stdout("There is currently no undo history (only a single undo is possible).\n\n",
-                    format_in=RED, format_out=self.terminal_default)
+            _stdout("There is currently no undo history.\n\n", format_in=RED, format_out=self.terminal_default)
             return
 
-        self.do_load("%s_undo" % self.crash_file.path, quiet=True)
-        self.undo = False
+        self.undo.pop()
+        if self.journal.restore(self.dbbuddy, self.undo[-1] if self.undo else 0) == 0:
+            self.undo = []
         _stdout("Most recent state reloaded\n\n", format_in=GREEN, format_out=self.terminal_default)
 
     def complete_bash(self, *args):
@@ -2072,6 +3251,11 @@ NOTE: There are %s summary records in the Live Session, and only full records ca
                         self.shell_execs.append(_file.strip())
         return ["%s " % x for x in self.shell_execs if x.startswith(text)]
 
+    @staticmethod
+    def complete_cache(*args):
+        text = args[0]
+        return [x for x in ["offline", "online", "clear"] if x.startswith(text)]
+
     @staticmethod
     def complete_database(*args):
         text = args[0]
@@ -2166,6 +3350,15 @@ Be careful!! This is not sand-boxed in any way, so give the 'bash' command
 all the respect you would normally give the terminal window.\n
 ''', format_in=GREEN, format_out=self.terminal_default)
 
+    def help_cache(self):
+        _stdout('''\
+Show what is stored in the local record cache, along with the cache hits and misses for this session.
+Summaries and sequences are saved locally as they are downloaded, and are reused instead of asking the servers again.
+    {0}offline{1}: Only use cached records (nothing is sent to the servers)
+    {0}online{1}:  Request anything that isn't cached from the servers (default)
+    {0}clear{1}:   Delete everything from the cache\n
+'''.format(YELLOW, GREEN), format_in=GREEN, format_out=self.terminal_default)
+
     def help_database(self):
         _stdout('''\
 Reset the database(s) to be searched. Separate multiple databases with spaces.
@@ -2294,6 +3487,14 @@ To reverse the sort order include the keyword 'rev' or 'reverse'.\n
         _stdout("Display the current state of your Live Session, including how many accessions and full records "
                 "have been downloaded.\n\n", format_in=GREEN, format_out=self.terminal_default)
 
+    def help_timeout(self):
+        _stdout('''\
+Stop waiting for slow servers during 'search' and 'fetch'. Records from the servers that finished in
+time are kept, and the others are left out (run the command again later to fill them in).
+Supply the number of seconds to wait, or {0}off{1} to always wait for every server (default).
+Hitting Ctrl-C while records are downloading does the same thing for any server that hasn't finished.\n
+'''.format(YELLOW, GREEN), format_in=GREEN, format_out=self.terminal_default)
+
     def help_undo(self):
         _stdout('''\
 Revert the most recent change to your live session.
@@ -2305,8 +3506,11 @@ The commands that can be undone are: - keep
                                      - format
                                      - database
                                      - load
+                                     - cache
+                                     - delete
+                                     - sort
 
-Caution: Undo can only restore a sinlge previous step. All other history is lost.\n
+Repeat 'undo' to keep stepping back. History is cleared when the session journal is compacted.\n
 ''', format_in=GREEN, format_out=self.terminal_default)
 
     def help_write(self):
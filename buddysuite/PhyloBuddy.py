@@ -269,6 +269,18 @@ class PhyloBuddy(object):
         if len(self.trees) == 0:
             return "Error: No trees in object.\n"
 
+        _output = StringIO()
+        self._write_handle(_output)
+        _output = '{0}\n'.format(_output.getvalue().rstrip())
+
+        return _output
+
+    def _write_handle(self, _handle):
+        """
+        Serialize trees straight into a text handle, without building an intermediate string
+        :param _handle: Writable text handle (e.g., open file or StringIO)
+        :return: None
+        """
         tree_list = TreeList()
 
         if self.out_format in OUTPUT_FORMATS:
@@ -279,17 +291,23 @@ class PhyloBuddy(object):
             raise TypeError("Error: Unsupported output format.")
 
         if self.out_format != 'nexml':
-            _output = tree_list.as_string(schema=self.out_format, annotations_as_nhx=False, suppress_annotations=False)
+            tree_list.write(file=_handle, schema=self.out_format, annotations_as_nhx=False, suppress_annotations=False)
         else:
-            _output = tree_list.as_string(schema='nexml')
-
-        _output = '{0}\n'.format(_output.rstrip())
-
-        return _output
+            tree_list.write(file=_handle, schema='nexml')
+        return
 
     def write(self, _file_path):
+        """
+        Stream trees to disk. The file contents are identical to str(self).
+        :param _file_path: Path to the output file
+        :return: None
+        """
         with open(_file_path, "w", encoding="utf-8") as _ofile:
-            _ofile.write(str(self))
+            if len(self.trees) == 0:
+                _ofile.write(str(self))
+                return
+            self._write_handle(_ofile)
+        br.rstrip_file(_file_path)
         return
 
 
@@ -368,26 +386,19 @@ def _guess_format(_input):
     if _input.__class__.__name__ == "PhyloBuddy":
         return _input.in_format
 
-    # If input is a handle or path, try to read the file in each format, and assume success if not error and # trees > 0
+    # If input is a handle or path, sniff the header for tree format markers
     if os.path.isfile(str(_input)):
         _input = open(_input, "r", encoding='utf-8')
 
     if str(type(_input)) == "<class '_io.TextIOWrapper'>" or isinstance(_input, StringIO):
         # Die if file is empty
-        contents = _input.read()
-        if contents == "":
+        if _input.read(1) == "":
             sys.exit("Input file is empty.")
         _input.seek(0)
 
-        if re.search('<nex:nexml', contents, re.IGNORECASE):
-            return 'nexml'
-        # Maddison, Swofford, and Maddison, 1997 DOI: 10.1093/sysbio/46.4.590
-        elif re.search('#nexus', contents, re.IGNORECASE):
-            return 'nexus'
-        elif re.search('\(', contents):
-            return 'newick'
-        else:
-            return None  # Unable to determine format from file handle
+        # Maddison, Swofford, and Maddison, 1997 DOI: 10.1093/sysbio/46.4.590 for the NEXUS header
+        candidates = br.sniff_format(_input, ["nexml", "nexus", "newick"])
+        return candidates[0] if candidates else None  # None if unable to determine format from file handle
 
     else:
         raise br.GuessError("Unsupported _input argument in guess_format(). %s" % _input)
@@ -701,16 +712,20 @@ def generate_tree(alignbuddy, alias, params=None, keep_temp=None, quiet=False):
 
             phylobuddy = PhyloBuddy(output)
 
-            for _hash, _id in sub_alignbuddy.hash_map.items():
-                rename(phylobuddy, _hash, _id)
+            unhasher = br.Unhasher(sub_alignbuddy.hash_map)
+            for tree in phylobuddy.trees:
+                for node in tree:
+                    if node.label:
+                        node.label = unhasher.sub(node.label)
+                    if node.taxon and node.taxon.label:
+                        node.taxon.label = unhasher.sub(node.taxon.label)
 
             if keep_temp:
                 _root, dirs, files = next(br.walklevel(keep_temp))
                 for file in files:
                     with open("%s/%s" % (_root, file), "r", encoding="utf-8") as ifile:
                         contents = ifile.read()
-                    for _hash, _id in sub_alignbuddy.hash_map.items():
-                        contents = re.sub(_hash, _id, contents)
+                    contents = unhasher.sub(contents)
                     with open("%s/%s" % (_root, file), "w", encoding="utf-8") as ofile:
                         ofile.write(contents)
             phylo_objs += phylobuddy.trees
@@ -49,6 +49,7 @@ import string
 import zipfile
 import shutil
 import time
+import mmap
 import urllib.parse
 import urllib.request
 import urllib.error
@@ -56,11 +57,11 @@ from copy import deepcopy
 from random import sample, randint, random, Random
 from math import floor, ceil, log
 from subprocess import Popen, PIPE
-from multiprocessing import Lock
 from shutil import which
 from hashlib import md5
 from io import StringIO, TextIOWrapper
 from collections import OrderedDict
+from itertools import chain
 from xml.sax import SAXParseException
 
 # Third party
@@ -73,6 +74,7 @@ from Bio.Seq import Seq
 from Bio.Alphabet import IUPAC
 from Bio.Data import CodonTable
 from Bio.Nexus.Trees import TreeError
+import numpy as np
 
 # ##################################################### WISH LIST #################################################### #
 '''
@@ -84,14 +86,6 @@ def sim_ident(matrix):  # Return the pairwise similarity and identity scores amo
     return x
 
 
-def cd_hit(seqbuddy, threshold):
-    """
-    :param seqbuddy: SeqBuddy object
-    :param threshold: Maximum sequence identity
-    """
-    return seqbuddy
-
-
 def auto_annotate():
     """
     Find common plasmid features in sequences
@@ -162,6 +156,15 @@ OUTPUT_FORMATS = ["ids", "accessions", "summary", "full-summary", "clustal", "em
                   "fastq-solexa", "fastq-illumina", "genbank", "gb", "imgt", "nexus", "phd", "phylip", "phylip-relaxed",
                   "phylipss", "phylipsr", "raw", "seqxml", "sff", "stockholm", "tab", "qual"]
 
+# Formats where records are written one after another with no file-level header, so they can be streamed in chunks
+STREAM_FORMATS = ["embl", "fasta", "fastq", "fastq-sanger", "fastq-solexa", "fastq-illumina", "genbank", "gb",
+                  "qual", "raw", "swiss", "tab"]
+
+# Command line tools that only look at one record at a time, and are therefore safe to run with --stream
+STREAM_TOOLS = ["clean_seq", "complement", "delete_features", "delete_large", "delete_metadata", "delete_small",
+                "lowercase", "pull_records", "pull_records_with_feature", "rename_ids", "reverse_complement",
+                "reverse_transcribe", "transcribe", "translate", "uppercase"]
+
 
 # ##################################################### SEQBUDDY ##################################################### #
 class SeqBuddy(object):
@@ -312,6 +315,17 @@ class SeqBuddy(object):
         if len(self.records) == 0:
             return "Error: No sequences in object.\n"
 
+        output = StringIO()
+        self._write_handle(output)
+        return "%s\n" % output.getvalue().rstrip()
+
+    def _write_handle(self, handle):
+        """
+        Serialize records straight into a seekable text handle, without an intermediate temp file or string.
+        If SeqIO has to fall back on a different format, anything already written by this call is discarded first.
+        :param handle: Writable and seekable text handle (e.g., open file or StringIO)
+        :return: None
+        """
         # There is a weird bug in genbank write() that concatenates dots to the organism name (if set).
         # The following is a work around...
         self.out_format = self.out_format.lower()
@@ -324,63 +338,82 @@ class SeqBuddy(object):
                     pass
 
         if self.out_format == "phylipsr":
-            output = br.phylip_sequential_out(self, _type="seqbuddy")
+            handle.write(br.phylip_sequential_out(self, _type="seqbuddy"))
 
         elif self.out_format == "phylipss":
-            output = br.phylip_sequential_out(self, relaxed=False, _type="seqbuddy")
+            handle.write(br.phylip_sequential_out(self, relaxed=False, _type="seqbuddy"))
 
         elif self.out_format == "raw":
-            output = "\n\n".join([str(rec.seq) for rec in self.records])
+            for indx, rec in enumerate(self.records):
+                handle.write("%s%s" % ("\n\n" if indx else "", str(rec.seq)))
         else:
-            tmp_dir = br.TempDir()
-            with open("%s%sseqs.tmp" % (tmp_dir.path, os.path.sep), "w", encoding="utf-8") as _ofile:
-                try:
-                    SeqIO.write(self.records, _ofile, self.out_format)
-                except ValueError as e:
-                    if "Sequences must all be the same length" in str(e):
-                        br._stderr("Warning: Alignment format detected but sequences are different lengths. "
-                                   "Format changed to fasta to accommodate proper printing of records.\n\n")
-                        SeqIO.write(self.records, _ofile, "fasta")
-                    elif "Repeated name" in str(e) and self.out_format == "phylip":
-                        br._stderr("Warning: Phylip format returned a 'repeat name' error, probably due to truncation. "
-                                   "Attempting phylip-relaxed.\n")
-                        SeqIO.write(self.records, _ofile, "phylip-relaxed")
-                    elif "Locus identifier" in str(e) and "is too long" in str(e) \
-                            and self.out_format in ["gb", "genbank"]:
-                        br._stderr("Warning: Genbank format returned an 'ID too long' error. "
-                                   "Format changed to EMBL.\n\n")
-                        SeqIO.write(self.records, _ofile, "embl")
-                    else:
-                        raise e
+            start = handle.tell()
 
-            with open("%s%sseqs.tmp" % (tmp_dir.path, os.path.sep), "r", encoding="utf-8") as ifile:
-                output = ifile.read()
+            def rewind():
+                handle.seek(start)
+                handle.truncate()
 
-        return "%s\n" % output.rstrip()
+            try:
+                SeqIO.write(self.records, handle, self.out_format)
+            except ValueError as e:
+                if "Sequences must all be the same length" in str(e):
+                    br._stderr("Warning: Alignment format detected but sequences are different lengths. "
+                               "Format changed to fasta to accommodate proper printing of records.\n\n")
+                    rewind()
+                    SeqIO.write(self.records, handle, "fasta")
+                elif "Repeated name" in str(e) and self.out_format == "phylip":
+                    br._stderr("Warning: Phylip format returned a 'repeat name' error, probably due to truncation. "
+                               "Attempting phylip-relaxed.\n")
+                    rewind()
+                    SeqIO.write(self.records, handle, "phylip-relaxed")
+                elif "Locus identifier" in str(e) and "is too long" in str(e) \
+                        and self.out_format in ["gb", "genbank"]:
+                    br._stderr("Warning: Genbank format returned an 'ID too long' error. "
+                               "Format changed to EMBL.\n\n")
+                    rewind()
+                    SeqIO.write(self.records, handle, "embl")
+                else:
+                    raise e
+        return
 
     def __len__(self):
         return len(self.records)
 
+    def records_dict(self):  # Note that multiple records can have the same ID. Each item in the dict is a list of recs
+        seq_recs = OrderedDict()
+        for rec in self.records:
+            seq_recs.setdefault(rec.id, [])
+            seq_recs[rec.id].append(rec)
+        return seq_recs
+
     def to_dict(self):
-        sb_copy = find_repeats(make_copy(self))
-        if len(sb_copy.repeat_ids) > 0:
-            raise RuntimeError("There are repeat IDs in self.records\n%s" %
-                               ", ".join([key for key, recs in sb_copy.repeat_ids.items()]))
+        records_dict = self.records_dict()
+        repeat_ids = [rec_id for rec_id, recs in records_dict.items() if len(recs) > 1]
+        if repeat_ids:
+            raise RuntimeError("There are repeat IDs in self.records\n%s" % ", ".join(repeat_ids))
 
-        records_dict = OrderedDict()
-        for rec in self.records:
-            records_dict[rec.id] = rec
+        for rec_id, recs in records_dict.items():
+            records_dict[rec_id] = recs[0]
         return records_dict
 
     def write(self, file_path, out_format=None):
-        with open(file_path, "w", encoding="utf-8") as ofile:
-            if out_format:
-                out_format_save = str(self.out_format)
-                self.out_format = out_format
-                ofile.write(str(self))
-                self.out_format = out_format_save
-            else:
-                ofile.write(str(self))
+        """
+        Stream records to disk. The file contents are identical to str(self), but the full output string is never built.
+        :param file_path: Path to the output file
+        :param out_format: Optionally write in a format other than self.out_format
+        :return: None
+        """
+        out_format_save = str(self.out_format)
+        self.out_format = out_format if out_format else self.out_format
+        try:
+            with open(file_path, "w", encoding="utf-8") as ofile:
+                if len(self.records) == 0:
+                    ofile.write(str(self))
+                else:
+                    self._write_handle(ofile)
+        finally:
+            self.out_format = out_format_save
+        br.rstrip_file(file_path)
         return
 
     def print_hashmap(self):
@@ -392,8 +425,12 @@ class SeqBuddy(object):
 
     def reverse_hashmap(self):
         if self.hash_map:
-            for _hash, seq_id in self.hash_map.items():
-                rename(self, _hash, seq_id)
+            unhasher = br.Unhasher(self.hash_map)
+            for rec in self.records:
+                if rec.description.startswith(rec.id):
+                    rec.description = rec.description[len(rec.id) + 1:]
+                rec.id = unhasher.sub(rec.id)
+                rec.name = rec.id
         return
 
 
@@ -418,6 +455,121 @@ def _add_buddy_data(rec, key=None, data=None):
     return rec
 
 
+def _ambig_regex(pattern, alpha):
+    """
+    Convert any ambiguous letter codes in a search pattern into regex character classes
+    :param pattern: regex pattern
+    :param alpha: IUPAC alphabet of the sequences being searched
+    :return: regex pattern
+    """
+    pattern_backup = str(pattern)
+    if alpha == IUPAC.protein:
+        pattern = re.sub("[xX]", "[ARNDCQEGHILKMFPSTWYVX]", pattern)
+        pattern = re.sub("[bB]", "[NDB]", pattern)
+        pattern = re.sub("[zZ]", "[QEZ]", pattern)
+
+    elif alpha in [IUPAC.ambiguous_dna, IUPAC.unambiguous_dna]:
+        pattern = re.sub("[kK]", "[GT]", pattern)
+        pattern = re.sub("[mM]", "[AC]", pattern)
+        pattern = re.sub("[rR]", "[AG]", pattern)
+        pattern = re.sub("[yY]", "[CT]", pattern)
+        pattern = re.sub("[sS]", "[CG]", pattern)
+        pattern = re.sub("[wW]", "[AT]", pattern)
+        pattern = re.sub("[bB]", "[CGT]", pattern)
+        pattern = re.sub("[vV]", "[CGA]", pattern)
+        pattern = re.sub("[hH]", "[ACT]", pattern)
+        pattern = re.sub("[dD]", "[AGT]", pattern)
+        pattern = re.sub("[xnXN]", "[ATCG]", pattern)
+
+    elif alpha in [IUPAC.ambiguous_rna, IUPAC.unambiguous_rna]:
+        pattern = re.sub("[kK]", "[GU]", pattern)
+        pattern = re.sub("[mM]", "[AC]", pattern)
+        pattern = re.sub("[rR]", "[AG]", pattern)
+        pattern = re.sub("[yY]", "[CU]", pattern)
+        pattern = re.sub("[sS]", "[CG]", pattern)
+        pattern = re.sub("[wW]", "[AU]", pattern)
+        pattern = re.sub("[bB]", "[CGU]", pattern)
+        pattern = re.sub("[vV]", "[CGA]", pattern)
+        pattern = re.sub("[hH]", "[ACU]", pattern)
+        pattern = re.sub("[dD]", "[AGU]", pattern)
+        pattern = re.sub("[xnXN]", "[AUCG]", pattern)
+
+    safety_valve = br.SafetyValve()
+    # Strip out any double square brackets
+    while re.search("\[[^[\]]*?\[[^]]*\]", pattern):
+        safety_valve.step("Ambiguous %s regular expression '%s' failed compile." % (alpha, pattern_backup))
+        pattern = re.sub("(\[[^[\]]*?)\[([^]]*)\]", r"\1\2", pattern, count=1)
+    return pattern
+
+
+def _banded_identities(query, subjects, diagonals, band_width, min_identities=0):
+    """
+    Count the identical residues in banded alignments of one query against several subjects at once. The whole query
+    is aligned, but overhanging ends of the subjects are free. Scoring is +1 per match, 0 per mismatch and -1 per gap
+    position, with ties broken in favour of more identities.
+    :param query: numpy uint8 array
+    :param subjects: List of numpy uint8 arrays
+    :param diagonals: Offset (subject position - query position) that each band is centered on
+    :param band_width: Number of diagonals included on either side of the center
+    :param min_identities: Stop aligning subjects as soon as they can no longer reach this many identities (their
+    partial count is returned instead)
+    :return: numpy array with the number of identical residues for each subject
+    """
+    query_len = len(query)
+    # Scores are stored as (score * scale) + identities, so a single max() also takes care of the tie break
+    scale = query_len + 1
+    neg_inf = -(2 ** 62)
+    cells = np.arange(2 * band_width + 1)
+    gaps = cells * scale
+
+    lengths = np.array([len(subj) for subj in subjects])[:, None]
+    # Subjects are concatenated, and reads that run past the end of a subject only ever land in cells that are masked
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[:, None] - 1
+    flat_subjects = np.concatenate(list(subjects))
+    remaining = np.arange(len(subjects))
+    identities = np.zeros(len(subjects), dtype=np.int64)
+
+    # Subject position of every cell in the band, before adding the row number
+    band_pos = (np.array(diagonals) - band_width)[:, None] + cells[None, :]
+    row = np.where((band_pos >= 0) & (band_pos <= lengths), 0, neg_inf)
+    up = np.empty_like(row)
+    for indx in range(1, query_len + 1):
+        subj_pos = band_pos + indx
+        matches = np.take(flat_subjects, starts + subj_pos, mode="clip") == query[indx - 1]
+        up[:, :-1] = row[:, 1:]
+        up[:, -1] = neg_inf
+        up -= scale
+        row += matches * (scale + 1)
+        np.maximum(row, up, out=row)
+        # Gaps in the query run along the row, so they are resolved with a running max
+        row += gaps
+        np.maximum.accumulate(row, axis=1, out=row)
+        row -= gaps
+        in_bounds = (subj_pos >= 0) & (subj_pos <= lengths)
+        row[~in_bounds] = neg_inf
+
+        if min_identities and indx % 16 == 0 and indx < query_len:
+            partial = np.where(in_bounds, row % scale, 0).max(axis=1)
+            alive = partial + query_len - indx >= min_identities
+            identities[remaining[~alive]] = partial[~alive]
+            if not alive.any():
+                return identities
+            if not alive.all():
+                remaining, row, band_pos = remaining[alive], row[alive], band_pos[alive]
+                lengths, starts, up = lengths[alive], starts[alive], up[alive]
+
+    best = row.max(axis=1)
+    identities[remaining] = np.where(best < neg_inf // 2, 0, best % scale)
+    return identities
+
+
+def _cd_hit_identities(block, args):
+    # Worker for cd_hit(); sequences are inherited by forked processes, so only record indices are passed around
+    seqs = args[0]
+    query, subjects, diagonals, band_width, min_identities = block
+    return _banded_identities(seqs[query], [seqs[subj] for subj in subjects], diagonals, band_width, min_identities)
+
+
 def _check_for_blast_bin(blast_bin):
     """
     Check the user's system for the blast bin in $PATH, try to download if not.
@@ -431,6 +583,81 @@ def _check_for_blast_bin(blast_bin):
         return False
 
 
+def _codon_codes(residues):
+    """
+    Pack every complete codon of a sequence into a single integer, three bytes wide. Trailing bases that do not make up
+    a full codon are dropped.
+    :param residues: numpy uint8 array, as returned by _residue_array()
+    :return: numpy int32 array with one code per codon
+    """
+    codons = residues[:len(residues) - len(residues) % 3].reshape(-1, 3).astype(np.int32)
+    return (codons[:, 0] << 16) | (codons[:, 1] << 8) | codons[:, 2]
+
+
+def _cpg_islands(sequence, window_size=200, min_gc=0.5, min_oe=0.6, block_size=1000000):
+    """
+    Stream the CpG islands of a DNA sequence. Every window gets a G+C fraction and an observed/expected CpG ratio, and
+    each position is scored with the average of the windows that cover it. Islands are the runs of positions where both
+    averages pass the thresholds. Window values come from prefix sums, and the sequence is processed in blocks so memory
+    use does not grow with the length of the sequence.
+    :param sequence: DNA sequence (str or Seq)
+    :param window_size: Length of the sliding window (shortened to the sequence length for short sequences)
+    :param min_gc: G+C fraction that positions must exceed
+    :param min_oe: Observed/expected CpG ratio that positions must exceed
+    :param block_size: Number of positions scored at a time
+    :return: Generator of (start, end) tuples, with end pointing at the first position after the island
+    """
+    seq_len = len(sequence)
+    window_size = min(window_size, seq_len)
+    num_windows = seq_len - window_size + 1
+    island_start = None
+    for block_start in range(0, seq_len, block_size):
+        block_end = min(block_start + block_size, seq_len)
+        positions = np.arange(block_start, block_end)
+
+        # Score every window that covers a position in this block
+        first_window = max(0, block_start - window_size + 1)
+        last_window = min(block_end - 1, num_windows - 1)
+        residues = _residue_array(sequence[first_window:last_window + window_size])
+        is_c, is_g = residues == ord("C"), residues == ord("G")
+        gc_sums = np.concatenate(([0], np.cumsum(is_c | is_g)))
+        cpg_sums = np.concatenate(([0], np.cumsum(is_c[:-1] & is_g[1:])))
+        windows = np.arange(last_window - first_window + 1)
+        gc_counts = gc_sums[windows + window_size] - gc_sums[windows]
+        expected = (gc_counts / 2) ** 2
+        expected[expected == 0] = 1
+        oe_values = (cpg_sums[windows + window_size - 1] - cpg_sums[windows]) * window_size / expected
+
+        # Sum the windows covering each position
+        low = np.maximum(positions - window_size + 1, 0) - first_window
+        high = np.minimum(positions, num_windows - 1) - first_window + 1
+        gc_totals = np.concatenate(([0], np.cumsum(gc_counts)))
+        gc_totals = gc_totals[high] - gc_totals[low]
+        oe_totals = np.concatenate(([0], np.cumsum(oe_values)))
+        oe_totals = oe_totals[high] - oe_totals[low]
+
+        # Positions near the ends of the sequence are covered by fewer windows
+        divisors = np.where(positions + 1 <= window_size, positions + 1,
+                            np.where(positions >= seq_len - window_size, seq_len - positions, window_size))
+        in_island = (gc_totals > min_gc * window_size * divisors) & (oe_totals / divisors > min_oe)
+
+        if island_start is not None and not in_island[0]:
+            yield island_start, block_start
+            island_start = None
+        elif island_start is None and in_island[0]:
+            island_start = block_start
+
+        for edge in (np.flatnonzero(np.diff(in_island.astype(np.int8))) + 1).tolist():
+            if in_island[edge]:
+                island_start = block_start + edge
+            else:
+                yield island_start, block_start + edge
+                island_start = None
+
+    if island_start is not None:
+        yield island_start, seq_len
+
+
 def _feature_rc(feature, seq_len):
     """
     BioPython does not properly handle reverse complement of features, so implement it...
@@ -494,6 +721,25 @@ class FeatureReMapper(object):
                 self.position_map.append((self.position_map[-1][0], False))
         return
 
+    def extend_many(self, exists):
+        """
+        Same as calling extend() once for each residue, for a whole run of residues at a time
+        :param exists: Sequence of bools (e.g., numpy array), specifying whether each residue exists or not
+        """
+        exists = np.asarray(exists, dtype=bool)
+        if len(self.old_seq.seq) < len(self.position_map) + len(exists):
+            raise AttributeError("The position map has already been fully populated.")
+        if not len(exists):
+            return
+        new_positions = np.cumsum(exists)
+        if self.starting_position_filled:
+            new_positions += self.position_map[-1][0]
+        else:
+            new_positions = np.maximum(new_positions - 1, 0)
+            self.starting_position_filled = bool(exists.any())
+        self.position_map += list(zip(new_positions.tolist(), exists.tolist()))
+        return
+
     def remap_features(self, new_seq):
         """
         Add all the features from self.old_seq that still exist onto new_seq
@@ -502,9 +748,18 @@ class FeatureReMapper(object):
         if len(self.old_seq.seq) != len(self.position_map):
             raise AttributeError("The position map has not been fully populated.")
 
+        # For each position, the index of the first retained residue at or after it
+        next_present = [len(self.position_map)] * (len(self.position_map) + 1)
+        for indx in range(len(self.position_map) - 1, -1, -1):
+            next_present[indx] = indx if self.position_map[indx][1] else next_present[indx + 1]
+        self._next_present = next_present
+
+        # Features that don't overlap anything between the first and last retained residues are gone
+        first = next_present[0]
+        last = next((indx for indx in range(len(self.position_map) - 1, -1, -1) if self.position_map[indx][1]), -1)
         new_features = []
-        for feature in self.old_seq.features:
-            feature = self._remap(feature)
+        for indx in br.FeatureIndex(self.old_seq.features).overlapping(first, last + 1):
+            feature = self._remap(self.old_seq.features[indx])
             if feature:
                 new_features.append(feature)
         new_seq.features = new_features
@@ -516,13 +771,13 @@ class FeatureReMapper(object):
         :param feature: A feature from self.old_seq
         """
         if type(feature.location) == FeatureLocation:
-            for pos, present in self.position_map[feature.location.start:feature.location.end]:
-                if present:
-                    start = pos
-                    end = self.position_map[feature.location.end - 1][0] + 1
-                    location = FeatureLocation(start, end, strand=feature.location.strand)
-                    feature.location = location
-                    return feature
+            first_present = self._next_present[min(max(int(feature.location.start), 0), len(self.position_map))]
+            if first_present < min(int(feature.location.end), len(self.position_map)):
+                start = self.position_map[first_present][0]
+                end = self.position_map[feature.location.end - 1][0] + 1
+                location = FeatureLocation(start, end, strand=feature.location.strand)
+                feature.location = location
+                return feature
             else:
                 return None
 
@@ -541,6 +796,319 @@ class FeatureReMapper(object):
             return feature
 
 
+def _pattern_hits(items, patterns, fields):
+    """
+    Find the items matched by each search pattern, with the same results as running re.search() over every field of
+    every item. Plain strings are looked up in hash sets instead; '^string$' matches a whole field, and anything else
+    without regex syntax is a substring match. Only genuine regular expressions are run against every field.
+    :param items: List of objects to search (e.g., SeqRecords)
+    :param patterns: List of regular expressions or plain strings ('*' matches everything)
+    :param fields: Function that returns the list of strings to search for a given item
+    :return: One list per pattern, holding the indices of the items that it matched (in order)
+    """
+    literal = r"((?:[^.^$*+?{}\[\]\\|()]|\\[^0-9A-Za-z])+)"
+    exact_strs, sub_strs, regexes = {}, {}, []
+    for pat_indx, pattern in enumerate(patterns):
+        pattern = ".*" if pattern == "*" else pattern
+        exact = re.fullmatch(r"\^%s\$" % literal, pattern)
+        sub_str = re.fullmatch(literal, pattern)
+        if exact:
+            exact_strs.setdefault(re.sub(r"\\(.)", r"\1", exact.group(1)), []).append(pat_indx)
+        elif sub_str:
+            sub_strs.setdefault(re.sub(r"\\(.)", r"\1", sub_str.group(1)), []).append(pat_indx)
+        else:
+            regexes.append((pat_indx, re.compile(pattern)))
+    lengths = sorted({len(sub_str) for sub_str in sub_strs})
+    sub_str_set = set(sub_strs)
+
+    hits = [[] for _ in patterns]
+    for item_indx, item in enumerate(items):
+        matched = set()
+        for text in fields(item):
+            matched.update(exact_strs.get(text, []))
+            for length in lengths:
+                for window in {text[i:i + length] for i in range(len(text) - length + 1)} & sub_str_set:
+                    matched.update(sub_strs[window])
+            matched.update([pat_indx for pat_indx, regex in regexes if pat_indx not in matched and regex.search(text)])
+        for pat_indx in matched:
+            hits[pat_indx].append(item_indx)
+    return hits
+
+
+class PatternScanner(object):
+    """
+    Search sequences for several patterns at once.
+    Patterns that boil down to a fixed run of single residues or character classes (literal motifs, IUPAC ambiguity
+    codes, '.', '[...]', 'x{n}') are compiled into per-position residue tables. For each sequence, the start position
+    of every residue triplet is sorted into a shared index a single time, and each table pattern only checks the
+    positions whose first three residues it accepts. Everything else falls back to a compiled regular expression.
+    Matching is case insensitive, and matches of any one pattern do not overlap (the same as re.finditer()).
+    :usage: Instantiate with a list of patterns, then call scan() on each sequence
+    """
+    index_size = 3  # Length of the residue prefix used to index sequence positions
+    max_prefixes = 4096  # Table patterns with more prefix combinations than this are checked position by position
+    _token = re.compile(r"(?:\[(\^?)((?:[A-Za-z0-9*]|\\\*)+)\]|\\([*.-])|(\.)|([A-Za-z0-9-]))(?:\{([0-9]+)\})?")
+
+    def __init__(self, patterns, alpha=None, ambig=False):
+        """
+        :param patterns: regex patterns
+        :param alpha: IUPAC alphabet of the sequences to be searched (only used with ambig)
+        :param ambig: Convert any ambiguous letter codes in the patterns into regex
+        """
+        self.patterns = [str(pattern) for pattern in patterns]
+        self.tables = OrderedDict()  # {pattern index: 2D numpy bool array, [position in pattern][residue byte]}
+        self.regexes = OrderedDict()  # {pattern index: compiled regex}
+        for indx, pattern in enumerate(self.patterns):
+            pattern = _ambig_regex(pattern, alpha) if ambig else pattern
+            table = self._compile_table(pattern)
+            if table is None:
+                self.regexes[indx] = re.compile(pattern, flags=re.IGNORECASE)
+            else:
+                self.tables[indx] = table
+
+    def _compile_table(self, pattern):
+        """
+        Convert a pattern into a table of the residues accepted at each position
+        :param pattern: regex pattern
+        :return: numpy bool array with shape (len(match), 256), or None if the pattern is not a fixed run of residues
+        """
+        rows = []
+        position = 0
+        for token in self._token.finditer(pattern):
+            if token.start() != position:
+                return None
+            position = token.end()
+            negate, char_class, escaped, wildcard, literal, repeat = token.groups()
+            row = np.zeros(256, dtype=bool)
+            if wildcard:
+                row[:] = True
+                row[ord("\n")] = False
+            else:
+                chars = char_class.replace("\\", "") if char_class else escaped or literal
+                row[list(chars.upper().encode())] = True
+                if negate:
+                    row = ~row
+            rows += [row] * (1 if repeat is None else int(repeat))
+        if position != len(pattern) or not rows:
+            return None
+        return np.array(rows)
+
+    def _table_matches(self, table, residues, index):
+        """
+        Find every position where a table pattern matches
+        :param table: Table from _compile_table()
+        :param residues: Sequence from _residue_array()
+        :param index: Tuple of (sorted prefix codes, positions), or None if the sequence is too short to be indexed
+        :return: numpy array of start positions
+        """
+        length = len(table)
+        if len(residues) < length:
+            return np.zeros(0, dtype=np.int64)
+
+        if index is not None and length >= self.index_size:
+            present = [np.flatnonzero(row[index[2]]) for row in table[:self.index_size]]
+            num_prefixes = np.prod([len(codes) for codes in present])
+        if index is None or length < self.index_size or num_prefixes > self.max_prefixes:
+            starts = np.flatnonzero(table[0][residues[:len(residues) - length + 1]])
+            first_unchecked = 1
+        else:
+            sorted_codes, positions, alphabet = index
+            prefixes = np.zeros(1, dtype=np.int64)
+            for codes in present:
+                prefixes = (prefixes[:, None] * len(alphabet) + codes[None, :]).ravel()
+            bounds = np.searchsorted(sorted_codes, np.stack([prefixes, prefixes + 1]))
+            starts = np.sort(np.concatenate([positions[low:high] for low, high in bounds.T] + [positions[:0]]))
+            starts = starts[starts <= len(residues) - length]
+            first_unchecked = self.index_size
+
+        for offset in range(first_unchecked, length):
+            starts = starts[table[offset][residues[starts + offset]]]
+        return starts
+
+    @staticmethod
+    def _non_overlapping(starts, length):
+        """
+        Keep the leftmost matches that do not overlap, as re.finditer() would
+        :param starts: Sorted numpy array of start positions
+        :param length: Length of each match
+        :return: list of (start, end) tuples
+        """
+        starts = starts.tolist()
+        if len(starts) < 2 or min(np.diff(starts)) >= length:
+            return [(start, start + length) for start in starts]
+        matches = []
+        for start in starts:
+            if not matches or start >= matches[-1][1]:
+                matches.append((start, start + length))
+        return matches
+
+    def scan(self, sequence):
+        """
+        Search a sequence for all patterns
+        :param sequence: str or Seq object
+        :return: list containing a list of (start, end) tuples for each pattern, in the same order as self.patterns
+        """
+        sequence = str(sequence)
+        results = [[] for _ in self.patterns]
+        if self.tables:
+            residues = _residue_array(sequence)
+            index = None
+            if len(self.tables) > 1 and len(residues) >= self.index_size:
+                # Rank the residues actually present, then sort every position by the residue triplet that starts there
+                alphabet, ranks = np.unique(residues, return_inverse=True)
+                codes = np.zeros(len(residues) - self.index_size + 1, dtype=np.int64)
+                for offset in range(self.index_size):
+                    codes = codes * len(alphabet) + ranks[offset:len(codes) + offset]
+                positions = np.argsort(codes, kind="stable")
+                index = (codes[positions], positions, alphabet)
+            for indx, table in self.tables.items():
+                results[indx] = self._non_overlapping(self._table_matches(table, residues, index), len(table))
+        for indx, regex in self.regexes.items():
+            results[indx] = [(match.start(), match.end()) for match in regex.finditer(sequence)]
+        return results
+
+
+def _residue_array(sequence):
+    """
+    Convert a sequence into an upper case numpy byte array, so it can be counted and compared without Python loops.
+    Non-ASCII characters are replaced by '?'.
+    :param sequence: str or Seq object
+    :return: numpy uint8 array
+    """
+    return np.frombuffer(str(sequence).upper().encode("ascii", "replace"), dtype=np.uint8)
+
+
+class SeqIndex(object):
+    def __init__(self, file_path):
+        """
+        Random access to the records of a FASTA or GenBank file through its sidecar index (see index_file()). Only the
+        bytes of the requested records are read, from a memory map of the file.
+        FASTA files use a samtools style '.fai' index (name, length, offset, line bases, line width), so indices made
+        by 'samtools faidx' work too. Records with irregular line lengths are stored with 0 line bases/width.
+        GenBank files use a '.gbi' index (id, name, offset, bytes, length).
+        :param file_path: Path to the indexed sequence file (not the index itself)
+        """
+        self.file_path = os.path.abspath(file_path)
+        if os.path.isfile("%s.fai" % self.file_path):
+            self.index_path, self.in_format = "%s.fai" % self.file_path, "fasta"
+        elif os.path.isfile("%s.gbi" % self.file_path):
+            self.index_path, self.in_format = "%s.gbi" % self.file_path, "gb"
+        else:
+            raise FileNotFoundError("No index found for '%s'. Create one with index_file()." % file_path)
+
+        if os.path.getmtime(self.index_path) < os.path.getmtime(self.file_path):
+            raise RuntimeError("The index '%s' is older than its sequence file. Rebuild it with index_file()."
+                               % self.index_path)
+
+        # Each entry is (id, name, offset, length, line bases, line width) for FASTA or (id, name, offset, bytes,
+        # length) for GenBank
+        self.entries = []
+        with open(self.index_path, "r", encoding="utf-8") as ifile:
+            for line in ifile:
+                line = line.rstrip("\n").split("\t")
+                if self.in_format == "fasta":
+                    self.entries.append((line[0], line[0], int(line[2]), int(line[1]), int(line[3]), int(line[4])))
+                else:
+                    self.entries.append((line[0], line[1], int(line[2]), int(line[3]), int(line[4])))
+        self._id_indices = {}
+        for indx, entry in enumerate(self.entries):
+            self._id_indices.setdefault(entry[0], indx)
+
+        self._handle = open(self.file_path, "rb")
+        if os.path.getsize(self.file_path):
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._handle.close()
+        return
+
+    def ids(self):
+        return [entry[0] for entry in self.entries]
+
+    def _record_bytes(self, indx):
+        entry = self.entries[indx]
+        if self.in_format == "fasta":
+            start = self._mmap.rfind(b"\n", 0, entry[2] - 1) + 1
+            end = self._mmap.find(b"\n>", entry[2] - 1) + 1
+            end = len(self._mmap) if not end else end
+        else:
+            start, end = entry[2], entry[2] + entry[3]
+        return self._mmap[start:end]
+
+    def records(self, indices=None):
+        """
+        Parse records straight out of the file
+        :param indices: Positions of the records in the index (all records if not set)
+        :return: List of SeqRecord objects
+        """
+        indices = range(len(self.entries)) if indices is None else indices
+        return [SeqIO.read(StringIO(self._record_bytes(indx).decode("utf-8")), self.in_format) for indx in indices]
+
+    def pull_recs(self, regex, out_format=None, alpha=None):
+        """
+        Only parse the records with IDs/names matching a search pattern. The result is the same as running
+        pull_recs() on the whole file, but the other records are never read.
+        :param regex: List of regex expressions or single regex
+        :param out_format: Output format of the new SeqBuddy object
+        :param alpha: Alphabet of the new SeqBuddy object
+        :return: SeqBuddy object
+        """
+        if type(regex) == str:
+            regex = [regex]
+        hits = _pattern_hits(self.entries, regex, lambda entry: [entry[0], entry[1]])
+        matched = sorted({indx for pat_hits in hits for indx in pat_hits})
+        return SeqBuddy(self.records(matched), self.in_format, out_format, alpha)
+
+    def subsequence(self, rec_id, start=0, end=None):
+        """
+        Read a slice of a sequence without parsing the rest of the record (for regularly wrapped FASTA records)
+        :param rec_id: ID of the record (the first record is used if the ID is repeated)
+        :param start: Zero-indexed start position
+        :param end: End position (exclusive). Defaults to the end of the sequence.
+        :return: Sequence string
+        """
+        if rec_id not in self._id_indices:
+            raise KeyError("'%s' is not in the index" % rec_id)
+        indx = self._id_indices[rec_id]
+        entry = self.entries[indx]
+        if self.in_format != "fasta" or not entry[4]:
+            return str(self.records([indx])[0].seq[start:end])
+
+        start, end, step = slice(start, end).indices(entry[3])
+        if start >= end:
+            return ""
+
+        def position(residue):
+            return entry[2] + (residue // entry[4]) * entry[5] + residue % entry[4]
+
+        return self._mmap[position(start):position(end)].decode("utf-8").replace("\n", "").replace("\r", "")
+
+
+def _load_index(file_path):
+    """
+    Open the sidecar index of a sequence file, if there is an up-to-date one
+    :param file_path: Path to the sequence file
+    :return: SeqIndex object, or None
+    """
+    try:
+        return SeqIndex(file_path)
+    except (FileNotFoundError, RuntimeError, ValueError, IndexError):
+        return None
+
+
 def _guess_alphabet(seqbuddy):
     """
     Looks through the characters in the SeqBuddy records to determine the most likely alphabet
@@ -572,8 +1140,8 @@ def _guess_alphabet(seqbuddy):
 
 def _guess_format(_input):
     """
-    Loop through many possible formats that BioPython has a parser for, and return the format that is
-    actually able to return records.
+    Sniff the first few KB of input for format markers, then confirm the best candidates by parsing a single record.
+    Only phylip candidates need to be trial-parsed in full, because nothing in their header distinguishes the variants.
     :param _input: Duck-typed; can be list, SeqBuddy object, file handle, or file path.
     :return: str or None
     """
@@ -585,20 +1153,20 @@ def _guess_format(_input):
     if _input.__class__.__name__ == "SeqBuddy":
         return _input.in_format
 
-    # If input is a handle or path, try to read the file in each format, and assume success if not error and # seqs > 0
+    # If input is a handle or path, sniff the header and assume success if the first record parses without error
     if os.path.isfile(str(_input)):
         _input = open(_input, "r", encoding="utf-8")
 
     if str(type(_input)) == "<class '_io.TextIOWrapper'>" or isinstance(_input, StringIO):
         if not _input.seekable():  # Deal with input streams (e.g., stdout pipes)
             _input = StringIO(_input.read())
-        if _input.read() == "":
+        if _input.read(1) == "":
             return "empty file"
         _input.seek(0)
 
         possible_formats = ["stockholm", "fasta", "gb", "phylipss", "phylipsr", "phylip", "phylip-relaxed",
                             "fastq", "embl", "nexus", "seqxml", "clustal", "swiss"]
-        for next_format in possible_formats:
+        for next_format in br.sniff_format(_input, possible_formats):
             try:
                 _input.seek(0)
                 if next_format in ["phylip", "phylipsr", "phylipss"]:
@@ -637,19 +1205,99 @@ def _guess_format(_input):
 
 def make_copy(seqbuddy):
     """
-    Deepcopy a SeqBuddy object. The alphabet objects are not handled properly when deepcopy is called,
-    so need to wrap it.
+    Copy a SeqBuddy object. Records are copied with br.copy_record(), so the (immutable) sequence strings are shared
+    with the original instead of being duplicated, while everything mutable is deep copied. Alphabet objects are
+    never copied, because Biopython compares them by identity.
     :param seqbuddy: SeqBuddy object
     :return: SeqBuddy object
     """
-    alphabet_list = [rec.seq.alphabet for rec in seqbuddy.records]
-    _copy = deepcopy(seqbuddy)
-    _copy.alpha = seqbuddy.alpha
-    for indx, rec in enumerate(_copy.records):
-        rec.seq.alphabet = alphabet_list[indx]
+    memo = {id(seqbuddy.alpha): seqbuddy.alpha}
+    _copy = seqbuddy.__class__.__new__(seqbuddy.__class__)
+    for key, value in seqbuddy.__dict__.items():
+        if key == "records":
+            value = [br.copy_record(rec, memo) for rec in value]
+        else:
+            value = deepcopy(value, memo)
+        _copy.__dict__[key] = value
     return _copy
 
 
+def stream(sb_input, in_format=None, out_format=None, alpha=None, chunk_size=1000):
+    """
+    Lazily parse sequences, yielding SeqBuddy objects that each hold at most chunk_size records. Memory use is bounded
+    by the chunk size instead of the input file, but only record-local tools (e.g., clean_seq, uppercase,
+    translate_cds, rename, pull_recs, delete_small) give the same result as they would on a full SeqBuddy object.
+    Input and output formats must be sequential (see STREAM_FORMATS), so that chunks can be written one after another.
+    :param sb_input: File path, file handle, or a string of sequence data
+    :param in_format: Explicitly set the input format. Non-seekable input streams are only processed lazily if set.
+    :param out_format: Output format of the yielded SeqBuddy objects
+    :param alpha: Alphabet. If not set, it is guessed from the first chunk and applied to every subsequent chunk
+    :param chunk_size: Maximum number of records in each SeqBuddy object
+    :return: Generator of SeqBuddy objects
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer, not %s" % chunk_size)
+
+    in_file = None
+    close_handle = False
+    if type(sb_input) == str and os.path.isfile(sb_input):
+        in_file = sb_input
+        sb_input = open(sb_input, "r", encoding="utf-8")
+        close_handle = True
+    elif type(sb_input) == str:
+        sb_input = StringIO(br.utf_encode(sb_input))
+    elif not hasattr(sb_input, "read"):
+        raise br.GuessError("Unable to stream input type %s. Please provide a file path or file handle." %
+                            type(sb_input))
+
+    if not in_format:
+        if not sb_input.seekable():
+            sb_input = StringIO(sb_input.read())  # The format can't be sniffed and rewound without buffering
+        in_format = _guess_format(sb_input)
+        sb_input.seek(0)
+        if in_format == "empty file":
+            in_format = "fasta"
+        elif not in_format:
+            if close_handle:
+                sb_input.close()
+            raise br.GuessError("Could not determine format from sb_input%s.\n"
+                                "Try explicitly setting with -f flag." % (" file '%s'" % in_file if in_file else ""))
+
+    if not out_format:
+        out_format = "fasta" if in_format == "raw" else in_format
+    for _format in [in_format, out_format]:
+        if _format.lower() not in STREAM_FORMATS:
+            if close_handle:
+                sb_input.close()
+            raise ValueError("Format '%s' can not be streamed. Supported formats: %s" %
+                             (_format, ", ".join(STREAM_FORMATS)))
+
+    def chunk_generator(handle, _alpha):
+        try:
+            if in_format == "raw":
+                records = iter([SeqRecord(Seq(br.utf_encode(handle.read())), id="raw_input", description="")])
+                parse_format = "fasta"
+            else:
+                records = SeqIO.parse(handle, in_format)
+                parse_format = in_format
+
+            chunk = []
+            for rec in records:
+                chunk.append(rec)
+                if len(chunk) == chunk_size:
+                    seqbuddy = SeqBuddy(chunk, parse_format, out_format, _alpha)
+                    _alpha = seqbuddy.alpha if _alpha is None else _alpha
+                    chunk = []
+                    yield seqbuddy
+            if chunk:
+                yield SeqBuddy(chunk, parse_format, out_format, _alpha)
+        finally:
+            if close_handle:
+                handle.close()
+
+    return chunk_generator(sb_input, alpha)
+
+
 # ################################################ MAIN API FUNCTIONS ################################################ #
 def annotate(seqbuddy, _type, location, strand=None, qualifiers=None, pattern=None):
     """
@@ -983,39 +1631,14 @@ def back_translate(seqbuddy, mode='random', species=None, r_seed=None):
 
 def bl2seq(seqbuddy):
     """
-    Does an all-by-all analysis of the sequences
+    Does an all-by-all analysis of the sequences. A single BLAST database is built from all of the records, and then
+    every record is searched against it in one multi-threaded blastp/blastn call.
     :param seqbuddy: SeqBuddy object
     :return: OrderedDict of results dict[key][matches]
     """
-    # Note on blast2seq: Expect (E) values are calculated on an assumed database size of (the rather large) nr, so the
-    # threshold may need to be increased quite a bit to return short alignments
-    def mc_blast(_query, _args):
-        _subject_file = _args[0]
-        _query_file = br.TempFile()
-        with open(_query_file.path, "w", encoding="utf-8") as ofile:
-            ofile.write(_query.format("fasta"))
-
-        if subject.id == _query.id:
-            return
-
-        _blast_res = Popen("%s -query %s -subject %s -outfmt 6" %
-                           (blast_bin, _query_file.path, _subject_file), stdout=PIPE, shell=True).communicate()
-        _blast_res = _blast_res[0].decode().split("\n")[0].split("\t")
-
-        if len(_blast_res) == 1:
-            _result = "%s\t%s\t0\t0\t0\t0\n" % (subject.id, _query.id)
-        else:
-            # values are: query, subject, %_ident, length, evalue, bit_score
-            if _blast_res[10] == '0.0':
-                _blast_res[10] = '1e-180'
-            _result = "%s\t%s\t%s\t%s\t%s\t%s\n" % (_blast_res[0], _blast_res[1], _blast_res[2],
-                                                    _blast_res[3], _blast_res[10], _blast_res[11].strip())
-
-        with lock:
-            with open("%s%sblast_results.txt" % (tmp_dir.path, os.path.sep), "a", encoding="utf-8") as _ofile:
-                _ofile.write(_result)
-        return
-
+    # Note on bl2seq: BLAST calculates Expect (E) values against the size of the whole all-by-all database, so they are
+    # rescaled to the length of each subject to approximate pairwise 'blast -subject' searches (the effective length
+    # corrections are not redone). Bit scores and percent identities are unaffected.
     if seqbuddy.alpha == IUPAC.protein and not _check_for_blast_bin("blastp"):
         raise RuntimeError("Blastp not present in $PATH or working directory.")
 
@@ -1023,40 +1646,67 @@ def bl2seq(seqbuddy):
             and not _check_for_blast_bin("blastn"):
         raise RuntimeError("Blastn not present in $PATH or working directory.")
 
-    blast_bin = "blastp" if seqbuddy.alpha == IUPAC.protein else "blastn"
+    if not _check_for_blast_bin("makeblastdb"):
+        raise RuntimeError("makeblastdb not present in $PATH or working directory.")
 
-    from multiprocessing import Lock
-    lock = Lock()
+    blast_bin = "blastp" if seqbuddy.alpha == IUPAC.protein else "blastn"
+    dbtype = "prot" if seqbuddy.alpha == IUPAC.protein else "nucl"
     tmp_dir = br.TempDir()
 
     # Remove any gaps
     seqbuddy = clean_seq(seqbuddy, skip_list=["*"])
-
-    # Copy the seqbuddy records into new list, so they can be iteratively deleted below
     make_ids_unique(seqbuddy, sep="-")
-    seqs_copy = seqbuddy.records[:]
-    subject_file = "%s%ssubject.fa" % (tmp_dir.path, os.path.sep)
-    for subject in seqbuddy.records:
-        with open(subject_file, "w", encoding="utf-8") as ifile:
-            SeqIO.write(subject, ifile, "fasta")
 
-        br.run_multicore_function(seqs_copy, mc_blast, [subject_file], out_type=sys.stderr, quiet=True)
-        seqs_copy = seqs_copy[1:]
+    # BLAST is picky about sequence IDs, so search with hashes and map back afterwards
+    hashed = hash_ids(make_copy(seqbuddy), r_seed=12345)
+    hashed.write("%s%sall.fa" % (tmp_dir.path, os.path.sep), out_format="fasta")
+    makeblastdb = Popen("makeblastdb -dbtype {0} -in {1}{2}all.fa -out {1}{2}all_db "
+                        "-parse_seqids".format(dbtype, tmp_dir.path, os.path.sep), shell=True, stdout=PIPE, stderr=PIPE)
+    makeblastdb_output = makeblastdb.communicate()[1].decode("utf-8")
+    if makeblastdb.returncode or "Error" in makeblastdb_output:
+        raise RuntimeError("makeblastdb failed: %s" % makeblastdb_output.strip())
+
+    # The database size is set explicitly so E-values can be rescaled exactly, and the E-value cutoff is raised by the
+    # same factor as the shortest subject, so pairs that would pass the default cutoff (10) on their own are not lost
+    lengths = {rec.id: len(rec.seq) for rec in hashed.records}
+    db_size = max(sum(lengths.values()), 1)
+    min_length = max(min(lengths.values(), default=1), 1)
+    blast_command = "{0} -db {1}all_db -query {1}all.fa -out {1}out.txt -outfmt 6 -num_threads {2} " \
+                    "-max_target_seqs {3} -dbsize {4} -evalue {5}".format(blast_bin, tmp_dir.path + os.path.sep,
+                                                                         br.usable_cpu_count(), max(len(hashed), 5),
+                                                                         db_size, 10 * db_size / min_length)
+    blast_output = Popen(blast_command, shell=True, stdout=PIPE, stderr=PIPE).communicate()
+    blast_output = blast_output[1].decode("utf-8")
+    if "Error" in blast_output:
+        raise RuntimeError(blast_output)
 
-    with open("%s%sblast_results.txt" % (tmp_dir.path, os.path.sep), "r", encoding="utf-8") as _ifile:
-        output_list = _ifile.read().strip().split("\n")
+    # Each pair is reported with the later record as query and the earlier record as subject, and hits are sorted
+    # by score, so the first line seen for a pair is the best HSP.
+    order = {rec.id: indx for indx, rec in enumerate(hashed.records)}
+    hits = {}
+    with open("%s%sout.txt" % (tmp_dir.path, os.path.sep), "r", encoding="utf-8") as ifile:
+        for line in ifile:
+            line = line.strip().split("\t")
+            if len(line) < 12 or line[0] not in order or line[1] not in order or order[line[0]] <= order[line[1]] \
+                    or (line[0], line[1]) in hits:
+                continue
+            evalue = float(line[10]) * lengths[line[1]] / db_size
+            if evalue > 10:
+                continue
+            # values are: %_ident, length, evalue, bit_score
+            hits[(line[0], line[1])] = [line[2], line[3], "1e-180" if line[10] == "0.0" else evalue, line[11]]
 
     # Push output into a dictionary of dictionaries, for more flexible use outside of this function
-    output_list = [x.split("\t") for x in output_list]
-    output_list = sorted(output_list, key=lambda l: l[0])
     output_dict = {}
-    for match in output_list:
-        query, subj, ident, length, evalue, bit_score = match
-        output_dict.setdefault(query, {})
-        output_dict[query][subj] = [float(ident), int(length), float(evalue), float(bit_score)]
+    for indx, subj in enumerate(hashed.records):
+        for query in hashed.records[indx + 1:]:
+            ident, length, evalue, bit_score = hits.get((query.id, subj.id), ["0", "0", "0", "0"])
+            query_id, subj_id = hashed.hash_map[query.id], hashed.hash_map[subj.id]
+            output_dict.setdefault(query_id, {})
+            output_dict[query_id][subj_id] = [float(ident), int(length), float(evalue), float(bit_score)]
 
-        output_dict.setdefault(subj, {})
-        output_dict[subj][query] = [float(ident), int(length), float(evalue), float(bit_score)]
+            output_dict.setdefault(subj_id, {})
+            output_dict[subj_id][query_id] = [float(ident), int(length), float(evalue), float(bit_score)]
 
     for key, value in output_dict.items():
         output_dict[key] = [(x, y) for x, y in output_dict[key].items()]
@@ -1207,9 +1857,7 @@ def blast(subject, query, **kwargs):
     if query_sb:
         new_seqs.hash_map = query_sb.hash_map
         new_seqs.reverse_hashmap()
-
-        for key, value in new_seqs.hash_map.items():
-            blast_results = re.sub(key, value, blast_results)
+        blast_results = br.Unhasher(new_seqs.hash_map).sub(blast_results)
 
     br._stderr("# ######################## BLAST results ######################## #\n%s"
                "# ############################################################### #\n\n" % blast_results,
@@ -1217,6 +1865,135 @@ def blast(subject, query, **kwargs):
     return new_seqs
 
 
+def cd_hit(seqbuddy, threshold, word_size=None, band_width=20, max_processes=0):
+    """
+    Greedy incremental clustering in the spirit of CD-HIT (Li and Godzik, 2006). Records are sorted by length, and each
+    one either joins the first cluster whose representative it matches at or above the identity threshold, or it
+    becomes the representative of a new cluster. Only representatives that share enough short words (k-mers) to
+    possibly reach the threshold are aligned, and alignments are restricted to a band around the diagonal that shares
+    the most words. Identity is the number of identical aligned residues divided by the length of the shorter sequence.
+    Sequences shorter than word_size have no words to filter on, so they are aligned against every representative.
+    :param seqbuddy: SeqBuddy object
+    :param threshold: Sequence identity threshold, as a fraction (e.g., 0.9) or a percentage (e.g., 90)
+    :param word_size: Length of the short words used as a filter (1-8). Chosen from the threshold if not set.
+    :param band_width: Number of diagonals on either side of the best diagonal included in the alignment
+    :param max_processes: Number of worker processes used to align candidates (0 for br.usable_cpu_count()). Output
+    does not depend on this.
+    :return: The SeqBuddy object with only cluster representatives remaining, in their original order. The IDs of the
+    records in each cluster are stored in rec.buddy_data["cluster"]
+    """
+    threshold = float(threshold)
+    threshold = threshold / 100 if threshold > 1 else threshold
+    if not 0 < threshold <= 1:
+        raise ValueError("The cd_hit threshold must be between 0 and 1 (or 0 and 100%%), not %s" % threshold)
+
+    if not word_size:
+        if seqbuddy.alpha == IUPAC.protein:
+            cutoffs = [(0.7, 5), (0.6, 4), (0.5, 3), (0, 2)]
+        else:
+            cutoffs = [(0.9, 8), (0.88, 7), (0.85, 6), (0.8, 5), (0, 4)]
+        word_size = [size for cutoff, size in cutoffs if threshold >= cutoff][0]
+    elif not 0 < word_size <= 8:
+        raise ValueError("The cd_hit word_size must be between 1 and 8, not %s" % word_size)
+
+    seqs = []
+    for rec in seqbuddy.records:
+        seq = re.sub("[-.]", "", str(rec.seq).upper()).encode("ascii", "replace")
+        seqs.append(np.frombuffer(seq, dtype=np.uint8))
+
+    # Words are packed into integers, one byte per residue
+    words = []
+    for seq in seqs:
+        codes = np.zeros(max(len(seq) - word_size + 1, 0), dtype=np.uint64)
+        for pos in range(word_size):
+            codes = (codes << np.uint64(8)) | seq[pos:len(codes) + pos].astype(np.uint64)
+        words.append(codes)
+
+    max_processes = br.usable_cpu_count() if not max_processes else max_processes
+    block_size = 256
+    executor = None  # Only started once a query has more candidates than fit in a single block
+    reps = []  # Record indices of cluster representatives, in the order they were created (longest first)
+    word_index = {}  # word: [(position in reps << 32) | position of the word in the representative]
+    clusters = OrderedDict()
+    try:
+        for indx in sorted(range(len(seqs)), key=lambda i: -len(seqs[i])):
+            query, query_words = seqs[indx], words[indx]
+            min_identities = ceil(len(query) * threshold)
+            query_band = band_width
+            if not len(query):
+                candidates, diagonals = [], []
+            elif not len(query_words):
+                # Too short for the word filter, so align against all of every representative
+                candidates, diagonals = list(range(len(reps))), [0] * len(reps)
+                query_band = max([len(seqs[rep]) for rep in reps], default=0)
+            else:
+                unique_words, first_pos = np.unique(query_words, return_index=True)
+                postings = [word_index.get(word, ()) for word in unique_words.tolist()]
+                counts = np.fromiter(map(len, postings), dtype=np.int64, count=len(postings))
+                hits = np.fromiter(chain.from_iterable(postings), dtype=np.int64, count=int(counts.sum()))
+                hit_reps = hits >> 32
+                hit_words = np.repeat(np.arange(len(unique_words)), counts)
+                hit_diags = (hits & 0xFFFFFFFF) - first_pos[hit_words]
+
+                # Each non-identical residue can destroy at most word_size words, which bounds how few words a match
+                # can share
+                min_shared = max(len(unique_words) - (len(query) - min_identities) * word_size, 1)
+                shared = np.unique(hit_reps * len(unique_words) + hit_words) // len(unique_words)
+                candidates = np.flatnonzero(np.bincount(shared, minlength=len(reps)) >= min_shared)
+
+                # Center each band on the diagonal (rep position - query position) with the most shared words, taking
+                # the smallest diagonal on ties
+                shift = len(query)
+                width = int(hit_diags.max()) + shift + 1 if len(hits) else 1
+                keys, key_counts = np.unique(hit_reps * width + hit_diags + shift, return_counts=True)
+                key_reps, key_diags = keys // width, keys % width - shift
+                order = np.lexsort((key_diags, -key_counts, key_reps))
+                key_reps, key_diags = key_reps[order], key_diags[order]
+                firsts = np.flatnonzero(np.diff(key_reps, prepend=-1))
+                best_diags = np.zeros(len(reps), dtype=np.int64)
+                best_diags[key_reps[firsts]] = key_diags[firsts]
+                candidates, diagonals = candidates.tolist(), best_diags[candidates].tolist()
+
+            cluster = None
+            if max_processes > 1 and len(candidates) > block_size:
+                if executor is None:
+                    executor = br.MultiCoreExecutor(_cd_hit_identities, [seqs], max_processes=max_processes)
+                # Split the candidates evenly over the workers, and take the first match in candidate order
+                size = max(ceil(len(candidates) / executor.max_processes), 32)
+                blocks = [(indx, [reps[rep] for rep in candidates[pos:pos + size]], diagonals[pos:pos + size],
+                           query_band, min_identities) for pos in range(0, len(candidates), size)]
+                matches = np.flatnonzero(np.concatenate(executor.map(blocks)) >= min_identities)
+                cluster = candidates[matches[0]] if len(matches) else None
+            else:
+                for pos in range(0, len(candidates), block_size):
+                    block = (indx, [reps[rep] for rep in candidates[pos:pos + block_size]],
+                             diagonals[pos:pos + block_size], query_band, min_identities)
+                    matches = np.flatnonzero(_cd_hit_identities(block, [seqs]) >= min_identities)
+                    if len(matches):
+                        cluster = candidates[pos + matches[0]]
+                        break
+
+            if cluster is None:
+                for pos, word in enumerate(query_words.tolist()):
+                    word_index.setdefault(word, []).append((len(reps) << 32) | pos)
+                clusters[indx] = []
+                reps.append(indx)
+            else:
+                clusters[reps[cluster]].append(seqbuddy.records[indx].id)
+    finally:
+        if executor is not None:
+            executor.close()
+
+    new_records = []
+    for indx, rec in enumerate(seqbuddy.records):
+        if indx in clusters:
+            _add_buddy_data(rec, "cluster")
+            rec.buddy_data["cluster"] = clusters[indx]
+            new_records.append(rec)
+    seqbuddy.records = new_records
+    return seqbuddy
+
+
 def clean_seq(seqbuddy, ambiguous=True, rep_char="N", skip_list=None):
     """
     Removes all non-sequence characters, and converts ambiguous characters to 'X' if ambiguous=False
@@ -1295,11 +2072,13 @@ def concat_seqs(seqbuddy, clean=False):
     return seqbuddy
 
 
-def count_codons(seqbuddy):
+def count_codons(seqbuddy, aggregate=False):
     """
     Generate frequency statistics for codon composition
     :param seqbuddy: SeqBuddy object
+    :param aggregate: Pool the codons from every record into a single table for the whole file
     :return: A tuple containing the original SeqBuddy object and a dictionary - dict[id][codon] = (Amino acid, num, %)
+             If aggregate is True, the dictionary holds a single table instead - dict[codon] = (Amino acid, num, %)
     """
     if seqbuddy.alpha not in [IUPAC.ambiguous_dna, IUPAC.unambiguous_dna, IUPAC.ambiguous_rna, IUPAC.unambiguous_rna]:
         raise TypeError("Nucleic acid sequence required, not protein or other.")
@@ -1307,88 +2086,75 @@ def count_codons(seqbuddy):
         codontable = CodonTable.ambiguous_dna_by_name['Standard'].forward_table
     else:
         codontable = CodonTable.ambiguous_rna_by_name['Standard'].forward_table
-    output = OrderedDict()
-    sb_copy = make_copy(seqbuddy)
-    replace_subsequence(sb_copy, "[-.]")
-    uppercase(sb_copy)
-    for rec in sb_copy.records:
-        sequence = str(rec.seq)
-        if len(sequence) % 3 != 0:
-            while len(sequence) % 3 != 0:
-                sequence = sequence[:-1]
-        data_table = {}
-        num_codons = len(sequence) / 3
-        while len(sequence) > 0:
-            codon = str(sequence[:3])
-            if codon in data_table:
-                data_table[codon][1] += 1
+
+    def codon_frequencies(codes):
+        codes, counts = np.unique(codes, return_counts=True)
+        num_codons = float(counts.sum())
+        data_table = OrderedDict()
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            codon = "".join([chr(code >> 16), chr(code >> 8 & 255), chr(code & 255)])
+            if codon in ['ATG', 'AUG']:
+                amino_acid = 'M'
+            elif codon == 'NNN':
+                amino_acid = 'X'
+            elif codon in ['TAA', 'TAG', 'TGA', 'UAA', 'UAG', 'UGA']:
+                amino_acid = '*'
+            elif codon in codontable:
+                amino_acid = codontable[codon]
             else:
-                if codon in ['ATG', 'AUG']:
-                    data_table[codon] = ['M', 1, 0.0]
-                elif codon == 'NNN':
-                    data_table[codon] = ['X', 1, 0.0]
-                elif codon in ['TAA', 'TAG', 'TGA', 'UAA', 'UAG', 'UGA']:
-                    data_table[codon] = ['*', 1, 0.0]
-                else:
-                    try:
-                        data_table[codon] = [codontable[codon], 1, 0.0]
-                    except KeyError:
-                        br._stderr("Warning: Codon '{0}' is invalid. Codon will be skipped.\n".format(codon))
-            sequence = sequence[3:]
-        for codon in data_table:
-            data_table[codon][2] = round(data_table[codon][1] / float(num_codons) * 100, 3)
-        output[rec.id] = OrderedDict(sorted(data_table.items(), key=lambda x: x[0]))
+                br._stderr("Warning: Codon '{0}' is invalid. Codon will be skipped.\n".format(codon))
+                continue
+            data_table[codon] = [amino_acid, count, round(count / num_codons * 100, 3)]
+        return data_table
+
+    gaps = _residue_array("-.")
+    record_codes = []
     for rec in seqbuddy.records:
-        try:
-            rec.buddy_data['Codon_frequency'] = output[rec.id]
-        except AttributeError:
-            rec.buddy_data = OrderedDict({'Codon_frequency': output[rec.id]})
+        residues = _residue_array(rec.seq)
+        record_codes.append(_codon_codes(residues[~np.isin(residues, gaps)]))
+
+    if aggregate:
+        return seqbuddy, codon_frequencies(np.concatenate(record_codes + [np.zeros(0, dtype=np.int32)]))
+
+    output = OrderedDict()
+    for rec, codes in zip(seqbuddy.records, record_codes):
+        output[rec.id] = codon_frequencies(codes)
+        _add_buddy_data(rec)
+        rec.buddy_data['Codon_frequency'] = output[rec.id]
     return seqbuddy, output
 
 
-def count_residues(seqbuddy):
+def count_residues(seqbuddy, aggregate=False):
     """
     Generate frequency statistics for residue composition
     :param seqbuddy: SeqBuddy object
+    :param aggregate: Pool the residues from every record into a single table for the whole file
     :return: annotated SeqBuddy object. Residue counts are appended to buddy_data in the SeqRecord obects
+             If aggregate is True, the residue count table for the whole file is returned instead
     """
-    for rec in seqbuddy.records:
-        resid_count = {}
-        seq = str(rec.seq).upper()
-        for char in seq:
-            resid_count.setdefault(char, 0)
-            resid_count[char] += 1
+    def percent(residues, counts, seq_len):
+        return round(100 * int(counts[_residue_array(residues)].sum()) / seq_len, 2)
 
-        seq_len = len(rec)
-        for residue, count in resid_count.items():
-            resid_count[residue] = [count, count / seq_len]
+    def residue_frequencies(counts, seq_len):
+        resid_count = {}
+        for residue in np.flatnonzero(counts).tolist():
+            resid_count[chr(residue)] = [int(counts[residue]), int(counts[residue]) / seq_len]
 
         if seqbuddy.alpha is IUPAC.protein:
-            ambig = len(re.findall("X", seq))
-            if ambig > 0:
-                resid_count['% Ambiguous'] = round(100 * ambig / seq_len, 2)
-
-            pos = len(re.findall("[HKR]", seq))
-            resid_count['% Positive'] = round(100 * pos / seq_len, 2)
-
-            neg = len(re.findall("[DEC]", seq))
-            resid_count['% Negative'] = round(100 * neg / seq_len, 2)
-
-            neut = len(re.findall("[GAVLIPFYWSTNQM]", seq))
-            resid_count['% Uncharged'] = round(100 * neut / seq_len, 2)
-
-            hydrophobic = len(re.findall("[AVLIPYFWMC]", seq))
-            resid_count['% Hydrophobic'] = round(100 * hydrophobic / seq_len, 2)
-
-            hydrophilic = len(re.findall("[NQSTKRHDE]", seq))
-            resid_count['% Hydrophilic'] = round(100 * hydrophilic / seq_len, 2)
+            if counts[ord("X")] > 0:
+                resid_count['% Ambiguous'] = percent("X", counts, seq_len)
+            resid_count['% Positive'] = percent("HKR", counts, seq_len)
+            resid_count['% Negative'] = percent("DEC", counts, seq_len)
+            resid_count['% Uncharged'] = percent("GAVLIPFYWSTNQM", counts, seq_len)
+            resid_count['% Hydrophobic'] = percent("AVLIPYFWMC", counts, seq_len)
+            resid_count['% Hydrophilic'] = percent("NQSTKRHDE", counts, seq_len)
 
             for residue in ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L", "M",
                             "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]:
                 resid_count.setdefault(residue, [0, 0])
 
         else:
-            ambig = len(re.findall("[^ATCGU]", seq))
+            ambig = seq_len - int(counts[_residue_array("ATCGU")].sum())
             if ambig > 0:
                 resid_count['% Ambiguous'] = round(100 * ambig / seq_len, 2)
 
@@ -1397,8 +2163,21 @@ def count_residues(seqbuddy):
 
             if "T" not in resid_count and "U" not in resid_count:
                 resid_count["T"] = [0, 0]
+        return OrderedDict(sorted(resid_count.items()))
 
-        _add_buddy_data(rec, "res_count", OrderedDict(sorted(resid_count.items())))
+    total_counts = np.zeros(256, dtype=np.int64)
+    total_len = 0
+    for rec in seqbuddy.records:
+        residues = _residue_array(rec.seq)
+        counts = np.bincount(residues, minlength=256)
+        if aggregate:
+            total_counts += counts
+            total_len += len(residues)
+        else:
+            _add_buddy_data(rec, "res_count", residue_frequencies(counts, max(len(residues), 1)))
+
+    if aggregate:
+        return residue_frequencies(total_counts, max(total_len, 1))
     return seqbuddy
 
 
@@ -1562,11 +2341,8 @@ def delete_features(seqbuddy, pattern):
     :return: The modified SeqBuddy object
     """
     for rec in seqbuddy.records:
-        retained_features = []
-        for _feature in rec.features:
-            if not re.search(pattern, _feature.type):
-                retained_features.append(_feature)
-        rec.features = retained_features
+        deleted = set(br.FeatureIndex(rec.features).match_type(pattern))
+        rec.features = [_feature for indx, _feature in enumerate(rec.features) if indx not in deleted]
     return seqbuddy
 
 
@@ -1613,19 +2389,9 @@ def delete_records(seqbuddy, patterns):
     if type(patterns) != list:
         raise ValueError("'patterns' must be a list or a string.")
 
-    for indx, pattern in enumerate(patterns):
-        patterns[indx] = ".*" if pattern == "*" else pattern
-
-    patterns = "|".join(patterns)
-
-    retained_records = []
-    deleted = [rec.id for rec in pull_recs(make_copy(seqbuddy), patterns).records]
-    for rec in seqbuddy.records:
-        if rec.id in deleted:
-            continue
-        else:
-            retained_records.append(rec)
-    seqbuddy.records = retained_records
+    hits = _pattern_hits(seqbuddy.records, patterns, lambda rec: [rec.id, rec.name])
+    deleted = {seqbuddy.records[indx].id for pat_hits in hits for indx in pat_hits}
+    seqbuddy.records = [rec for rec in seqbuddy.records if rec.id not in deleted]
     return seqbuddy
 
 
@@ -1640,10 +2406,10 @@ def delete_repeats(seqbuddy, scope='all'):  # scope in ['all', 'ids', 'seqs']
     if scope in ['all', 'ids']:
         find_repeats(seqbuddy)
         if len(seqbuddy.repeat_ids) > 0:
-            for rep_id in seqbuddy.repeat_ids:
-                store_one_copy = pull_recs(make_copy(seqbuddy), ["^%s$" % rep_id]).records[0]
-                delete_records(seqbuddy, "^%s$" % rep_id)
-                seqbuddy.records.append(store_one_copy)
+            # The first copy of each repeated ID is kept, and moved to the end of the file
+            records_dict = seqbuddy.records_dict()
+            seqbuddy.records = [rec for rec in seqbuddy.records if rec.id not in seqbuddy.repeat_ids]
+            seqbuddy.records += [records_dict[rep_id][0] for rep_id in seqbuddy.repeat_ids]
 
     # Then remove duplicate sequences
     if scope in ['all', 'seqs']:
@@ -1655,14 +2421,13 @@ def delete_repeats(seqbuddy, scope='all'):  # scope in ['all', 'ids', 'seqs']
                 for rep_seq_id in seqbuddy.repeat_seqs[seq]:
                     rep_seq_ids[-1].append(rep_seq_id)
 
-            repeat_regex = ""
+            repeat_regex = []
 
             for repeat_seqs in rep_seq_ids:
                 for rep_seq in repeat_seqs[1:]:
                     rep_seq = re.sub("([|.*?^\[\]()])", r"\\\1", rep_seq)
-                    repeat_regex += "^%s$|" % rep_seq
+                    repeat_regex.append("^%s$" % rep_seq)
 
-            repeat_regex = repeat_regex[:-1]
             delete_records(seqbuddy, repeat_regex)
 
     seqbuddy.repeat_seqs = OrderedDict()
@@ -1710,12 +2475,6 @@ def extract_feature_sequences(seqbuddy, patterns):
     :return: Modified SeqBuddy object
     :rtype: SeqBuddy
     """
-    def check_single_patterns(_feature):
-        for pat in single_patterns:
-            if re.search(pat, _feature.type):
-                return True
-        return False
-
     if type(patterns) == str:
         patterns = [patterns]
 
@@ -1730,26 +2489,19 @@ def extract_feature_sequences(seqbuddy, patterns):
     new_recs = []
     for rec in seqbuddy.records:
         keep_ranges = []
-        for feature in rec.features:
-            if check_single_patterns(feature):
-                if type(feature.location) == CompoundLocation:
-                    keep_ranges += [[int(x.start), int(x.end)] for x in feature.location.parts]
-                else:
-                    keep_ranges.append([int(feature.location.start), int(feature.location.end)])
+        feature_index = br.FeatureIndex(rec.features)
+        single_matches = {indx for pat in single_patterns for indx in feature_index.match_type(pat)}
+        for indx in sorted(single_matches):
+            feature = rec.features[indx]
+            if type(feature.location) == CompoundLocation:
+                keep_ranges += [[int(x.start), int(x.end)] for x in feature.location.parts]
+            else:
+                keep_ranges.append([int(feature.location.start), int(feature.location.end)])
         for rang_pat in range_patterns:
-            start, end = len(rec.seq), 0
-            pat1, pat2 = False, False
-            for feature in rec.features:
-                if re.search(rang_pat[0], feature.type):
-                    start = int(feature.location.start) if int(feature.location.start) < start else start
-                    end = int(feature.location.end) if int(feature.location.end) > end else end
-                    pat1 = True
-                if re.search(rang_pat[1], feature.type):
-                    start = int(feature.location.start) if int(feature.location.start) < start else start
-                    end = int(feature.location.end) if int(feature.location.end) > end else end
-                    pat2 = True
+            pat1, pat2 = feature_index.match_type(rang_pat[0]), feature_index.match_type(rang_pat[1])
             if pat1 and pat2:
-                keep_ranges.append([start, end])
+                start, end = feature_index.span(pat1 + pat2)
+                keep_ranges.append([min(start, len(rec.seq)), max(end, 0)])
 
         if not keep_ranges:
             rec.seq = Seq("", alphabet=rec.seq.alphabet)
@@ -1859,15 +2611,13 @@ def extract_regions(seqbuddy, positions):
     for rec in seqbuddy.records:
         new_rec_positions = create_residue_list(rec, positions)
         new_seq = []
-        if rec.features:  # This is super slow for large records...
+        if rec.features:
             remapper = FeatureReMapper(rec)
-            for indx, residue in enumerate(str(rec.seq)):
-                if indx in new_rec_positions:
-                    remapper.extend(True)
-                    new_seq.append(residue)
-                else:
-                    remapper.extend(False)
-            new_seq = ''.join(new_seq)
+            exists = np.zeros(len(rec.seq), dtype=bool)
+            exists[new_rec_positions] = True
+            remapper.extend_many(exists)
+            seq = str(rec.seq)
+            new_seq = ''.join([seq[indx] for indx in new_rec_positions])
             new_seq = Seq(new_seq, alphabet=rec.seq.alphabet)
             new_seq = SeqRecord(new_seq, id=rec.id, name=rec.name, description=rec.description, dbxrefs=rec.dbxrefs,
                                 annotations=rec.annotations)
@@ -1887,83 +2637,41 @@ def extract_regions(seqbuddy, positions):
     return seqbuddy
 
 
-def find_cpg(seqbuddy):
+def find_cpg(seqbuddy, window_size=200, min_gc=0.5, min_oe=0.6):
     """
     Predicts locations of CpG islands in DNA sequences
     :param seqbuddy: SeqBuddy object
+    :param window_size: Length of the sliding window (shortened to the sequence length for short sequences)
+    :param min_gc: Minimum average G+C fraction of the windows covering a position
+    :param min_oe: Minimum average observed/expected CpG ratio of the windows covering a position
     :return: Modified SeqBuddy object (buddy_data["cpgs"] appended to all records)
     """
     seqbuddy = clean_seq(seqbuddy)
     if seqbuddy.alpha not in [IUPAC.ambiguous_dna, IUPAC.unambiguous_dna]:
         raise TypeError("DNA sequence required, not protein or RNA.")
+    if int(window_size) < 1:
+        raise ValueError("The CpG window size must be a positive integer, not %s" % window_size)
 
     records = []
-
-    def cpg_calc(in_seq):  # Returns observed/expected value of a sequence
-        in_seq = in_seq.upper()
-        observed_cpg = len(re.findall("CG", in_seq)) * len(in_seq)
-        expected = (len(re.findall("[CG]", in_seq)) / 2) ** 2
-        expected = 1 if not expected else expected  # Prevent DivByZero
-        return observed_cpg / expected
-
-    def cg_percent(in_seq):  # Returns the CG % of a sequence
-        in_seq = in_seq.upper()
-        return len(re.findall("[CG]", in_seq)) / len(in_seq)
-
-    def find_islands(cg_percents, oe_values):  # Returns a list of tuples containing the start and end of an island
-        _indx = 0
-        out_list = []
-        while _indx < len(cg_percents):
-            if cg_percents[_indx] > .5 and oe_values[_indx] > .6:
-                start = _indx
-                while _indx < len(cg_percents) and cg_percents[_indx] > .5 and oe_values[_indx] > .6:
-                    _indx += 1
-                end = _indx
-                out_list.append((start, end))
-            _indx += 1
-        return out_list
-
-    def map_cpg(in_seq, island_ranges):  # Maps CpG islands onto a sequence as capital letters
-        cpg_seq = in_seq.lower()
-        for pair in island_ranges:
-            cpg_seq = cpg_seq[:pair[0]] + cpg_seq[pair[0]:pair[1] + 1].upper() + cpg_seq[pair[1] + 1:]
-        return cpg_seq
-
     for rec in seqbuddy.records:
-        seq = rec.seq
-
-        oe_vals_list = [0 for _ in range(len(seq))]
-        cg_percent_list = [0 for _ in range(len(seq))]
-        window_size = len(seq) if len(seq) < 200 else 200
-
-        for indx, window in enumerate([seq[i:i + window_size] for i in range(len(seq) - window_size + 1)]):
-            cpg = cpg_calc(str(window))
-            for i in range(window_size):
-                oe_vals_list[indx + i] += cpg
+        seq = str(rec.seq)
+        indices = list(_cpg_islands(seq, int(window_size), min_gc, min_oe))
+
+        # Map the islands onto the sequence as capital letters
+        upper_case = np.zeros(len(seq) + 1, dtype=np.int32)
+        for start, end in indices:
+            upper_case[start] += 1
+            upper_case[min(end + 1, len(seq))] -= 1
+        upper_case = np.cumsum(upper_case[:-1]) > 0
+        cpg_seq = np.where(upper_case, np.frombuffer(seq.upper().encode(), dtype=np.uint8),
+                           np.frombuffer(seq.lower().encode(), dtype=np.uint8))
+        cpg_seq = Seq(cpg_seq.tobytes().decode(), alphabet=rec.seq.alphabet)
 
-            cg_perc = cg_percent(str(window))
-            for i in range(window_size):
-                cg_percent_list[indx + i] += cg_perc
-
-        for indx in range(len(oe_vals_list)):
-            if indx + 1 <= window_size:
-                oe_vals_list[indx] /= (indx + 1)
-                cg_percent_list[indx] /= (indx + 1)
-
-            elif (len(oe_vals_list) - window_size) - (indx + 1) < 0:
-                oe_vals_list[indx] /= (len(oe_vals_list) - indx)
-                cg_percent_list[indx] /= (len(cg_percent_list) - indx)
-
-            else:
-                oe_vals_list[indx] /= window_size
-                cg_percent_list[indx] /= window_size
-
-        indices = find_islands(cg_percent_list, oe_vals_list)
         cpg_features = [SeqFeature(location=FeatureLocation(start, end), type="CpG_island",
                                    qualifiers={'created_by': 'SeqBuddy'}) for (start, end) in indices]
         for feature in rec.features:
             cpg_features.append(feature)
-        rec = SeqRecord(map_cpg(seq, indices), id=rec.id, name=rec.name, description=rec.description,
+        rec = SeqRecord(cpg_seq, id=rec.id, name=rec.name, description=rec.description,
                         dbxrefs=rec.dbxrefs, features=cpg_features, annotations=rec.annotations,
                         letter_annotations=rec.letter_annotations)
 
@@ -1985,33 +2693,24 @@ def find_orfs(seqbuddy, include_feature=True, include_buddy_data=True):
         raise TypeError("Nucleic acid sequence required, not protein.")
 
     pattern = "a[tu]g(?:...)*?(?:[tu]aa|[tu]ag|[tu]ga)"
+    scanner = PatternScanner([pattern], seqbuddy.alpha, ambig=True)
 
     clean_seq(seqbuddy)
     lowercase(seqbuddy)
 
-    find_pattern(seqbuddy, pattern, ambig=True, include_feature=True, include_buddy_data=False)
-    lowercase(seqbuddy)
-
-    reverse_complement(seqbuddy)
-    find_pattern(seqbuddy, pattern, ambig=True, include_feature=True, include_buddy_data=False)
-    lowercase(seqbuddy)
-
-    reverse_complement(seqbuddy)
-
     for rec in seqbuddy.records:
+        seq_len = len(rec.seq)
         buddy_data = {'+': [], '-': []}
-        feature_indicies = []
-        for indx, feature in enumerate(rec.features):
-            if 'regex' in feature.qualifiers.keys() and feature.qualifiers['regex'] == pattern:
-                if include_feature:
-                    feature.type = "orf"
-                    strand = "+" if feature.strand == +1 else "-"
-                    feature.qualifiers.pop("regex")
-                    buddy_data[strand].append((int(feature.location.start), int(feature.location.end)))
-                else:
-                    feature_indicies.append(indx)
-        for indx in sorted(feature_indicies, reverse=True):
-            del rec.features[indx]
+        for start, end in scanner.scan(rec.seq)[0]:
+            buddy_data['+'].append((start, end))
+        for start, end in scanner.scan(rec.seq.reverse_complement())[0]:
+            buddy_data['-'].append((seq_len - end, seq_len - start))
+
+        if include_feature:
+            for strand, indices in [(+1, buddy_data['+']), (-1, buddy_data['-'])]:
+                for start, end in indices:
+                    rec.features.append(SeqFeature(location=FeatureLocation(start=start, end=end), type="orf",
+                                                   strand=strand, qualifiers={'added_by': 'SeqBuddy'}))
 
         if include_buddy_data:
             _add_buddy_data(rec, 'find_orfs')
@@ -2019,84 +2718,59 @@ def find_orfs(seqbuddy, include_feature=True, include_buddy_data=True):
     return seqbuddy
 
 
-def find_pattern(seqbuddy, *patterns, ambig=False, include_feature=True, include_buddy_data=True):
+def find_pattern(seqbuddy, *patterns, ambig=False, reverse=False, include_feature=True, include_buddy_data=True):
     """
     Finds ﻿occurrences of a sequence pattern
     :param seqbuddy: SeqBuddy object
     :param patterns: regex patterns
     :param ambig: Convert any ambiguous letter codes in the search pattern into regex
+    :param reverse: Also search the reverse complement of nucleotide sequences
     :param include_feature: Add a new 'match' feature to records
     :param include_buddy_data: Append information directly to records
-    :return: Annotated SeqBuddy object. The match indices are also stored in rec.buddy_data["find_patterns"].
+    :return: Annotated SeqBuddy object. The match indices are also stored in rec.buddy_data["find_patterns"]. Reverse
+    strand matches are stored in rec.buddy_data["find_patterns_reverse"], as the start of the match on the forward
+    strand.
     """
+    if reverse and seqbuddy.alpha == IUPAC.protein:
+        raise TypeError("SeqBuddy object is protein. Nucleic acid sequences required.")
+
     # search through sequences for regex matches. For example, to find micro-RNAs
+    scanner = PatternScanner(patterns, seqbuddy.alpha, ambig)
     lowercase(seqbuddy)
-    for pattern in patterns:
-        pattern_backup = str(pattern)
-        if ambig and seqbuddy.alpha == IUPAC.protein:
-            pattern = re.sub("[xX]", "[ARNDCQEGHILKMFPSTWYVX]", pattern)
-            pattern = re.sub("[bB]", "[NDB]", pattern)
-            pattern = re.sub("[zZ]", "[QEZ]", pattern)
-
-        elif ambig and seqbuddy.alpha in [IUPAC.ambiguous_dna or IUPAC.unambiguous_dna]:
-            pattern = re.sub("[kK]", "[GT]", pattern)
-            pattern = re.sub("[mM]", "[AC]", pattern)
-            pattern = re.sub("[rR]", "[AG]", pattern)
-            pattern = re.sub("[yY]", "[CT]", pattern)
-            pattern = re.sub("[sS]", "[CG]", pattern)
-            pattern = re.sub("[wW]", "[AT]", pattern)
-            pattern = re.sub("[bB]", "[CGT]", pattern)
-            pattern = re.sub("[vV]", "[CGA]", pattern)
-            pattern = re.sub("[hH]", "[ACT]", pattern)
-            pattern = re.sub("[dD]", "[AGT]", pattern)
-            pattern = re.sub("[xnXN]", "[ATCG]", pattern)
-
-        elif ambig and seqbuddy.alpha in [IUPAC.ambiguous_rna or IUPAC.unambiguous_rna]:
-            pattern = re.sub("[kK]", "[GU]", pattern)
-            pattern = re.sub("[mM]", "[AC]", pattern)
-            pattern = re.sub("[rR]", "[AG]", pattern)
-            pattern = re.sub("[yY]", "[CU]", pattern)
-            pattern = re.sub("[sS]", "[CG]", pattern)
-            pattern = re.sub("[wW]", "[AU]", pattern)
-            pattern = re.sub("[bB]", "[CGU]", pattern)
-            pattern = re.sub("[vV]", "[CGA]", pattern)
-            pattern = re.sub("[hH]", "[ACU]", pattern)
-            pattern = re.sub("[dD]", "[AGU]", pattern)
-            pattern = re.sub("[xnXN]", "[AUCG]", pattern)
-
-        if ambig:
-            safety_valve = br.SafetyValve()
-            # Strip out any double square brackets
-            while re.search("\[[^[\]]*?\[[^]]*\]", pattern):
-                safety_valve.step("Ambiguous %s regular expression '%s' failed compile." %
-                                  (seqbuddy.alpha, pattern_backup))
-                pattern = re.sub("(\[[^[\]]*?)\[([^]]*)\]", r"\1\2", pattern, count=1)
-
-        for rec in seqbuddy.records:
+    strands = [(+1, 'find_patterns'), (-1, 'find_patterns_reverse')] if reverse else [(+1, 'find_patterns')]
+    for rec in seqbuddy.records:
+        seq = str(rec.seq)
+        upper_case = np.zeros(len(seq) + 1, dtype=np.int32)
+        for strand, key in strands:
             if include_buddy_data:
-                _add_buddy_data(rec, 'find_patterns')
-            indices = []
-            matches = re.finditer(pattern, str(rec.seq), flags=re.IGNORECASE)
-            new_seq = ""
-            last_match = 0
-            for match in matches:
-                indices.append(match.start())
-                if include_feature:
-                    rec.features.append(SeqFeature(location=FeatureLocation(start=match.start(), end=match.end()),
-                                                   type='match', strand=+1,
-                                                   qualifiers={'regex': pattern_backup, 'added_by': 'SeqBuddy'}))
-                if match.start() > 0:
-                    new_seq += str(rec.seq[last_match:match.start()])
-                new_seq += str(rec.seq[match.start():match.end()]).upper()
-                last_match = match.end()
-            new_seq += str(rec.seq[last_match:])
-            rec.seq = Seq(new_seq, alphabet=rec.seq.alphabet)
+                _add_buddy_data(rec, key)
+                if not rec.buddy_data[key]:
+                    rec.buddy_data[key] = OrderedDict()
 
-            if include_buddy_data:
-                if not rec.buddy_data['find_patterns']:
-                    rec.buddy_data['find_patterns'] = OrderedDict({pattern_backup: indices})
-                else:
-                    rec.buddy_data['find_patterns'][pattern_backup] = indices
+            if strand == +1:
+                all_matches = scanner.scan(seq)
+            else:
+                # Reverse strand matches are converted into forward strand coordinates
+                all_matches = [sorted((len(seq) - end, len(seq) - start) for start, end in matches)
+                               for matches in scanner.scan(str(rec.seq.reverse_complement()))]
+
+            for pattern, matches in zip(scanner.patterns, all_matches):
+                for start, end in matches:
+                    upper_case[start] += 1
+                    upper_case[end] -= 1
+                    if include_feature:
+                        rec.features.append(SeqFeature(location=FeatureLocation(start=start, end=end),
+                                                       type='match', strand=strand,
+                                                       qualifiers={'regex': pattern, 'added_by': 'SeqBuddy'}))
+                if include_buddy_data:
+                    rec.buddy_data[key][pattern] = [start for start, end in matches]
+
+        # Matched residues are shown in upper case
+        upper_case = np.cumsum(upper_case[:-1]) > 0
+        if upper_case.any():
+            seq = np.where(upper_case, np.frombuffer(seq.upper().encode(), dtype=np.uint8),
+                           np.frombuffer(seq.encode(), dtype=np.uint8))
+            rec.seq = Seq(seq.tobytes().decode(), alphabet=rec.seq.alphabet)
     return seqbuddy
 
 
@@ -2248,9 +2922,6 @@ def hash_ids(seqbuddy, hash_length=10, r_seed=None):
     :param r_seed: Set the random generator seed value
     :return: The modified SeqBuddy object, with a new attribute `hash_map` added
     """
-    hash_list = []
-    seq_ids = []
-
     try:
         hash_length = int(hash_length)
     except ValueError:
@@ -2280,30 +2951,91 @@ def hash_ids(seqbuddy, hash_length=10, r_seed=None):
                          "Hash length must be increased.")
 
     rand_gen = Random() if not r_seed else Random(r_seed)
-    for i in range(len(seqbuddy)):
-        new_hash = ""
-        seq_ids.append(seqbuddy.records[i].id)
-        while True:
-            chars = string.ascii_letters + string.digits
+    chars = string.ascii_letters + string.digits
+    hash_map = OrderedDict()
+    for rec in seqbuddy.records:
+        new_hash = "".join([rand_gen.choice(chars) for _ in range(hash_length)])
+        while new_hash in hash_map:
             new_hash = "".join([rand_gen.choice(chars) for _ in range(hash_length)])
-            if new_hash in hash_list:
-                continue
-            else:
-                hash_list.append(new_hash)
-                break
-        if re.match(seqbuddy.records[i].id, seqbuddy.records[i].description):
-            seqbuddy.records[i].description = seqbuddy.records[i].description[len(seqbuddy.records[i].id) + 1:]
+        hash_map[new_hash] = rec.id
 
-        seqbuddy.records[i].id = new_hash
-        seqbuddy.records[i].name = new_hash
+        if re.match(rec.id, rec.description):
+            rec.description = rec.description[len(rec.id) + 1:]
+        rec.id = new_hash
+        rec.name = new_hash
 
-    hash_map = OrderedDict()
-    for indx, _hash in enumerate(hash_list):
-        hash_map[hash_list[indx]] = seq_ids[indx]
     seqbuddy.hash_map = hash_map
     return seqbuddy
 
 
+def index_file(file_path, in_format=None):
+    """
+    Write a sidecar index next to a FASTA ('.fai') or GenBank ('.gbi') file, so records can be read without parsing the
+    whole file (see SeqIndex). The index is ignored once the sequence file is modified, so rebuild it after changes.
+    :param file_path: Path to the sequence file
+    :param in_format: 'fasta' or 'gb'/'genbank'. Guessed from the file if not set.
+    :return: SeqIndex object
+    """
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError("Only files can be indexed, '%s' was not found." % file_path)
+    if not in_format:
+        with open(file_path, "r", encoding="utf-8") as ifile:
+            in_format = _guess_format(ifile)
+    in_format = "gb" if str(in_format).lower() in ["gb", "genbank"] else str(in_format).lower()
+    if in_format not in ["fasta", "gb"]:
+        raise ValueError("Only FASTA and GenBank files can be indexed, not '%s'." % in_format)
+
+    entries = []
+    offset = 0
+    with open(file_path, "rb") as ifile:
+        if in_format == "fasta":
+            for line in ifile:
+                if line.startswith(b">"):
+                    header = line[1:].decode("utf-8").split(None, 1)
+                    # [name, length, offset, line bases, line width, regular wrapping, short/blank line seen]
+                    entries.append([header[0] if header else "", 0, offset + len(line), 0, 0, True, False])
+                elif entries:
+                    entry = entries[-1]
+                    residues = line.strip()
+                    if residues:
+                        bases = len(line.rstrip(b"\r\n"))
+                        if entry[6] or b" " in residues or bases != len(residues):
+                            entry[5] = False
+                        elif not entry[3]:
+                            entry[3], entry[4] = bases, len(line)
+                        elif bases > entry[3] or (line.endswith(b"\n") and len(line) - bases != entry[4] - entry[3]):
+                            entry[5] = False
+                        elif bases < entry[3]:
+                            entry[6] = True
+                        entry[1] += len(residues.replace(b" ", b""))
+                    else:
+                        entry[6] = True
+                offset += len(line)
+        else:
+            start = None
+            for line in ifile:
+                if line.startswith(b"LOCUS"):
+                    start = offset
+                offset += len(line)
+                if line.startswith(b"//") and start is not None:
+                    ifile.seek(start)
+                    rec = SeqIO.read(StringIO(ifile.read(offset - start).decode("utf-8")), "genbank")
+                    ifile.seek(offset)
+                    entries.append([rec.id, rec.name, start, offset - start, len(rec.seq)])
+                    start = None
+
+    with open("%s.%s" % (file_path, "fai" if in_format == "fasta" else "gbi"), "w", encoding="utf-8") as ofile:
+        for entry in entries:
+            if in_format == "fasta":
+                name, length, seq_offset, line_bases, line_width, regular = entry[:6]
+                if not regular:
+                    line_bases, line_width = 0, 0
+                ofile.write("%s\t%s\t%s\t%s\t%s\n" % (name, length, seq_offset, line_bases, line_width))
+            else:
+                ofile.write("%s\n" % "\t".join([str(value) for value in entry]))
+    return SeqIndex(file_path)
+
+
 def insert_sequence(seqbuddy, sequence, location=0, regexes=None):
     """
     Add a specific sequence at a defined location in all records. E.g., adding a barcode (zero-indexed)
@@ -2520,9 +3252,7 @@ def map_features_nucl2prot(nuclseqbuddy, protseqbuddy, mode="key", quiet=False):
             br._stderr("Warning: size mismatch between aa and nucl seqs for %s --> %s, %s\n" %
                        (nucl_rec.id, len(nucl_rec.seq), len(prot_rec.seq)), quiet)
 
-        prot_feature_hashes = []
-        for feat in prot_rec.features:
-            prot_feature_hashes.append(md5(str(feat).encode()).hexdigest())
+        prot_feature_hashes = {md5(str(feat).encode()).hexdigest() for feat in prot_rec.features}
 
         for feat in nucl_rec.features:
             feat = _feature_map(feat)
@@ -2607,9 +3337,7 @@ def map_features_prot2nucl(protseqbuddy, nuclseqbuddy, mode="key", quiet=False):
             br._stderr("Warning: size mismatch between aa and nucl seqs for %s --> %s, %s\n" %
                        (prot_rec.id, len(prot_rec.seq), len(nucl_rec.seq)), quiet)
 
-        dna_feature_hashes = []
-        for feat in nucl_rec.features:
-            dna_feature_hashes.append(md5(str(feat).encode()).hexdigest())
+        dna_feature_hashes = {md5(str(feat).encode()).hexdigest() for feat in nucl_rec.features}
 
         for feat in prot_rec.features:
             feat = _feature_map(feat)
@@ -2619,7 +3347,7 @@ def map_features_prot2nucl(protseqbuddy, nuclseqbuddy, mode="key", quiet=False):
             prot_feature_hashes.append(md5(str(feat).encode()).hexdigest())
             feat.strand = 1
             prot_feature_hashes.append(md5(str(feat).encode()).hexdigest())
-            if not set(prot_feature_hashes) & set(dna_feature_hashes):
+            if dna_feature_hashes.isdisjoint(prot_feature_hashes):
                 nucl_rec.features.append(feat)
 
     nuclseqbuddy.records = br.remap_gapped_features(nucl_copy.records, nuclseqbuddy.records)
@@ -2898,8 +3626,7 @@ class PrositeScan(object):
         req_h.close()
         return result
 
-    def _mc_run_prosite(self, _rec, args):
-        out_file_path, lock = args
+    def _mc_run_prosite(self, _rec):
         if not self.user_deets["email"] or not re.search(r".+@.+\..+", self.user_deets["email"]):
             email = "buddysuite@nih.gov"
         else:
@@ -2933,16 +3660,11 @@ class PrositeScan(object):
         temp_seq = SeqBuddy([_rec], out_format="gb")
         temp_seq.records[0].features = feature_list
         temp_seq = order_features_by_position(temp_seq)
-
-        with lock:
-            with open(out_file_path, "a", encoding="utf-8") as out_file:
-                out_file.write("%s\n" % str(temp_seq))
-        return
+        return str(temp_seq)
 
     def run(self):
         self._rest_request(self.base_url)  # Confirm internet connection prior to multi-core loop
 
-        temp_file = br.TempFile()
         hash_ids(self.seqbuddy)
         clean_seq(self.seqbuddy, skip_list="*")  # Clean once to make sure no wonky characters (no alignments)
         seqbuddy_copy = make_copy(self.seqbuddy)
@@ -2950,18 +3672,13 @@ class PrositeScan(object):
         if self.seqbuddy.alpha != IUPAC.protein:
             translate_cds(self.seqbuddy)
 
-        br.run_multicore_function(self.seqbuddy.records, self._mc_run_prosite,
-                                  [temp_file.path, Lock()], out_type=sys.stderr, quiet=self.quiet)
-        self.seqbuddy = SeqBuddy(temp_file.path)
-        new_records = []
-        for rec in seqbuddy_copy.records:
-            for indx, rec2 in enumerate(self.seqbuddy.records):
-                if rec.id == rec2.id:
-                    new_records.append(rec2)
-                    del self.seqbuddy.records[indx]
-                    break
-
-        self.seqbuddy.records = new_records
+        results = br.run_multicore_function(self.seqbuddy.records, self._mc_run_prosite,
+                                            out_type=sys.stderr, quiet=self.quiet)
+        self.seqbuddy = SeqBuddy("\n".join(results))
+        scanned_recs = OrderedDict()
+        for rec in self.seqbuddy.records:
+            scanned_recs.setdefault(rec.id, rec)
+        self.seqbuddy.records = [scanned_recs[rec.id] for rec in seqbuddy_copy.records if rec.id in scanned_recs]
 
         find_pattern(seqbuddy_copy, "\*", include_feature=False)
         for indx, rec in enumerate(seqbuddy_copy.records):
@@ -3034,18 +3751,14 @@ def pull_recs(seqbuddy, regex, description=False):
     """
     if type(regex) == str:
         regex = [regex]
-    for indx, pattern in enumerate(regex):
-        regex[indx] = ".*" if pattern == "*" else pattern
 
-    regex = "|".join(regex)
-    matched_records = []
-    for rec in seqbuddy.records:
-        if re.search(regex, rec.id) or re.search(regex, rec.name):
-            matched_records.append(rec)
-            continue
-        if description and (re.search(regex, rec.description) or re.search(regex, str(rec.annotations))):
-            matched_records.append(rec)
-    seqbuddy.records = matched_records
+    if description:
+        hits = _pattern_hits(seqbuddy.records, regex,
+                             lambda rec: [rec.id, rec.name, rec.description, str(rec.annotations)])
+    else:
+        hits = _pattern_hits(seqbuddy.records, regex, lambda rec: [rec.id, rec.name])
+    matched = sorted({indx for pat_hits in hits for indx in pat_hits})
+    seqbuddy.records = [seqbuddy.records[indx] for indx in matched]
     return seqbuddy
 
 
@@ -3059,29 +3772,32 @@ def pull_recs_with_feature(seqbuddy, regex):
     """
     if type(regex) == str:
         regex = [regex]
-    for indx, pattern in enumerate(regex):
-        regex[indx] = ".*" if pattern == "*" else pattern
 
-    regex = "|".join(regex)
-    matched_records = []
-    for rec in seqbuddy.records:
-        for feat in rec.features:
-            if re.search(regex, feat.type) or re.search(regex, feat.id):
-                matched_records.append(rec)
-                break
-    seqbuddy.records = matched_records
+    hits = _pattern_hits(seqbuddy.records, regex,
+                         lambda rec: list(br.FeatureIndex(rec.features).types()) + [feat.id for feat in rec.features])
+    matched = sorted({indx for pat_hits in hits for indx in pat_hits})
+    seqbuddy.records = [seqbuddy.records[indx] for indx in matched]
     return seqbuddy
 
 
-def purge(seqbuddy, threshold):
+def purge(seqbuddy, threshold, method="bl2seq"):
     """
     Deletes highly similar sequences
     ToDo: Implement a way to return a certain # of seqs (i.e. auto-determine threshold)
         - This would probably be a different flag in the UI
     :param seqbuddy: SeqBuddy object
-    :param threshold: Sets the similarity threshold
+    :param threshold: Sets the similarity threshold (BLAST bit score for 'bl2seq', sequence identity for 'cd_hit')
+    :param method: How similarity is assessed; all-by-all BLAST ('bl2seq') or the built-in clustering ('cd_hit')
     :return: The purged SeqBuddy object
     """
+    if method == "cd_hit":
+        cd_hit(seqbuddy, threshold)
+        for rec in seqbuddy.records:
+            _add_buddy_data(rec, "purge_set", rec.buddy_data["cluster"])
+        return seqbuddy
+    elif method != "bl2seq":
+        raise ValueError("Unknown purge method '%s'. Choose between 'bl2seq' and 'cd_hit'." % method)
+
     keep_dict = {}
     purged = []
     for query_id, match_list in bl2seq(seqbuddy).items():
@@ -3476,15 +4192,15 @@ def transmembrane_domains(seqbuddy, job_ids=None, quiet=False, keep_temp=None):
                     raise ConnectionError("Failed to submit TOPCONS job. Are you connected to the internet?")
 
     # Need to match up all hashed ids in seqbuddy_copy for downstream stuff
-    records = []
+    records = OrderedDict()
+    for rec in seqbuddy_copy.records:
+        records.setdefault(rec.id, rec)
+    seqbuddy_copy.records = []
     for _hash, rec_id in hash_map.items():
-        for indx, rec in enumerate(seqbuddy_copy.records):
-            if rec.id == rec_id:
-                rec.id = _hash
-                records.append(rec)
-                del seqbuddy_copy.records[indx]
-                break
-    seqbuddy_copy.records = records
+        if rec_id in records:
+            rec = records.pop(rec_id)
+            rec.id = _hash
+            seqbuddy_copy.records.append(rec)
 
     # Stops are converted to Xs by TOPCONS, so find them now for later replacement
     stop_positions = {}
@@ -3613,8 +4329,7 @@ def transmembrane_domains(seqbuddy, job_ids=None, quiet=False, keep_temp=None):
             for file in files:
                 with open("%s%s%s" % (_root, os.path.sep, file), "r", encoding="utf-8") as ifile:
                     contents = ifile.read()
-                for _hash, _id in hash_map.items():
-                    contents = re.sub(_hash, _id, contents)
+                contents = br.Unhasher(hash_map).sub(contents)
                 with open("%s%s%s" % (_root, os.path.sep, file), "w", encoding="utf-8") as ofile:
                     ofile.write(contents)
 
@@ -3638,8 +4353,12 @@ def transmembrane_domains(seqbuddy, job_ids=None, quiet=False, keep_temp=None):
 
         seqbuddy = merge(seqbuddy_copy, seqbuddy)
 
-    for _hash, seq_id in hash_map.items():
-        rename(seqbuddy, _hash, seq_id)
+    unhasher = br.Unhasher(hash_map)
+    for rec in seqbuddy.records:
+        if rec.description.startswith(rec.id):
+            rec.description = rec.description[len(rec.id) + 1:]
+        rec.id = unhasher.sub(rec.id)
+        rec.name = rec.id
 
     printer.write("************** Complete **************")
     printer.new_line(2)
@@ -3714,6 +4433,24 @@ def argparse_init():
     if in_args.guess_alphabet or in_args.guess_format:
         return in_args, SeqBuddy
 
+    if in_args.stream:
+        try:
+            streams = [stream(seq_set, in_args.in_format, in_args.out_format, in_args.alpha)
+                       for seq_set in in_args.sequence]
+        except (br.GuessError, ValueError) as e:
+            br._stderr("%s: %s\n" % (e.__class__.__name__, e), in_args.quiet)
+            sys.exit()
+        return in_args, (seqbuddy for _stream in streams for seqbuddy in _stream)
+
+    # Seek straight to the requested records if the input file has an up-to-date index (see index_file())
+    tools = [flag for flag in br.sb_flags if getattr(in_args, flag, None)]
+    if tools == ["pull_records"] and "full" not in in_args.pull_records and len(in_args.sequence) == 1 \
+            and type(in_args.sequence[0]) == str and os.path.isfile(in_args.sequence[0]):
+        seq_index = _load_index(in_args.sequence[0])
+        if seq_index and (not in_args.in_format or in_args.in_format.lower() in
+                          (["fasta"] if seq_index.in_format == "fasta" else ["gb", "genbank"])):
+            return in_args, seq_index
+
     try:
         for seq_set in in_args.sequence:
             if isinstance(seq_set, TextIOWrapper) and seq_set.buffer.raw.isatty():
@@ -3738,6 +4475,9 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
             br._stderr("*** Test passed ***\n", in_args.quiet)
             pass
 
+        elif in_args.stream and not len(_seqbuddy):
+            pass  # Don't print an error message for every chunk that was emptied
+
         elif in_args.in_place:
             _in_place(str(_seqbuddy), in_args.sequence[0])
 
@@ -3780,6 +4520,23 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
         sys.exit()
 
     # ############################################## COMMAND LINE LOGIC ############################################## #
+    # Stream records through a record-local tool, one chunk at a time
+    if in_args.stream and type(seqbuddy) != SeqBuddy:
+        tool = [flag for flag in br.sb_flags if getattr(in_args, flag, None)]
+        tool = tool[0] if tool else "stream"
+        if tool not in STREAM_TOOLS:
+            _raise_error(ValueError("The --stream flag can only be used with the following tools: %s" %
+                                    ", ".join(STREAM_TOOLS)), tool)
+        if in_args.in_place:
+            _raise_error(ValueError("The --stream flag can not be combined with --in_place"), tool)
+        try:
+            for chunk in seqbuddy:
+                command_line_ui(in_args, chunk, skip_exit=True, pass_through=True)
+        except (AttributeError, TypeError, ValueError) as e:
+            _raise_error(e, tool)
+        _exit(tool)
+        return
+
     # Add feature
     if in_args.annotate:
         # _type, location, strand=None, qualifiers=None, pattern=None
@@ -3912,7 +4669,7 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
 
     # Clean Seq
     if in_args.clean_seq:
-        args = in_args.clean_seq[0]
+        args = list(in_args.clean_seq[0])
         ambig = True
         rep_char = "N"
         lower_args = [str(x).lower() for x in args]
@@ -3945,8 +4702,9 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
     if in_args.count_codons:
         try:
             if in_args.count_codons[0] and str(in_args.count_codons[0].lower()) in "concatenate":
-                seqbuddy = concat_seqs(seqbuddy)
-            codon_table = count_codons(seqbuddy)[1]
+                codon_table = OrderedDict([("All sequences", count_codons(seqbuddy, aggregate=True)[1])])
+            else:
+                codon_table = count_codons(seqbuddy)[1]
             for sequence_id in codon_table:
                 br._stdout('#### {0} ####\n'.format(sequence_id))
                 br._stdout('Codon\tAA\tNum\tPercent\n')
@@ -3962,11 +4720,12 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
     if in_args.count_residues:
         seqbuddy = replace_subsequence(seqbuddy, "[-.]", "")
         if in_args.count_residues[0] and str(in_args.count_residues[0].lower()) in "concatenate":
-            seqbuddy = concat_seqs(seqbuddy)
-        count_residues(seqbuddy)
-        for rec in seqbuddy.records:
-            br._stdout("%s\n" % str(rec.id))
-            for residue, counts in rec.buddy_data["res_count"].items():
+            residue_tables = [("All sequences", count_residues(seqbuddy, aggregate=True))]
+        else:
+            residue_tables = [(rec.id, rec.buddy_data["res_count"]) for rec in count_residues(seqbuddy).records]
+        for seq_id, res_count in residue_tables:
+            br._stdout("%s\n" % str(seq_id))
+            for residue, counts in res_count.items():
                 try:
                     br._stdout("{0}:\t{1}\t{2} %\n".format(residue, counts[0], round(counts[1] * 100, 2)))
                 except TypeError:
@@ -4011,10 +4770,8 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
             else:
                 search_terms.append(arg)
 
-        deleted_seqs = []
-        for next_pattern in search_terms:
-            deleted_seqs += pull_recs(make_copy(seqbuddy), next_pattern).records
-
+        hits = _pattern_hits(seqbuddy.records, search_terms, lambda rec: [rec.id, rec.name])
+        deleted_seqs = [seqbuddy.records[indx] for pat_hits in hits for indx in pat_hits]
         seqbuddy = delete_records(seqbuddy, search_terms)
 
         if len(deleted_seqs) > 0 and not in_args.quiet:
@@ -4151,7 +4908,9 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
     # Find CpG
     if in_args.find_CpG:
         try:
-            find_cpg(seqbuddy)
+            cpg_args = in_args.find_CpG[0]
+            cpg_args = [int(cpg_args[0])] + [float(arg) for arg in cpg_args[1:3]] if cpg_args else []
+            find_cpg(seqbuddy, *cpg_args)
             islands = False
             for rec in seqbuddy.records:
                 if rec.buddy_data["cpgs"]:
@@ -4175,6 +4934,8 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
 
         except TypeError as e:
             _raise_error(e, "find_CpG", "DNA sequence required, not protein or RNA.")
+        except ValueError as e:
+            _raise_error(e, "find_CpG", ["invalid literal", "could not convert string to float", "CpG window size"])
 
     # Find orfs
     if in_args.find_orfs:
@@ -4205,25 +4966,34 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
         ambig = True if 'ambig' in in_args.find_pattern else False
         if ambig:
             del in_args.find_pattern[in_args.find_pattern.index("ambig")]
+        reverse = True if 'rc' in in_args.find_pattern else False
+        if reverse:
+            del in_args.find_pattern[in_args.find_pattern.index("rc")]
 
-        find_pattern(seqbuddy, *in_args.find_pattern, ambig=ambig)
-        for pattern in in_args.find_pattern:
-            num_matches = 0
-            for rec in seqbuddy.records:
-                indices = rec.buddy_data['find_patterns'][pattern]
-                num_matches += len(indices)
-            br._stderr("#### {0} matches found across {1} sequences for "
-                       "pattern '{2}' ####\n".format(num_matches, len(seqbuddy), pattern), in_args.quiet)
-            for rec in seqbuddy.records:
-                indices = rec.buddy_data['find_patterns'][pattern]
-                if not len(indices):
-                    br._stderr("{0}: None\n".format(rec.id), in_args.quiet)
-                else:
-                    br._stderr("{0}: {1}\n".format(rec.id, ", ".join([str(x) for x in indices])), in_args.quiet)
-                    num_matches += len(indices)
+        try:
+            find_pattern(seqbuddy, *in_args.find_pattern, ambig=ambig, reverse=reverse)
+            strands = [('find_patterns', ""), ('find_patterns_reverse', "reverse strand ")] if reverse \
+                else [('find_patterns', "")]
+            for pattern in in_args.find_pattern:
+                for key, label in strands:
+                    num_matches = 0
+                    for rec in seqbuddy.records:
+                        indices = rec.buddy_data[key][pattern]
+                        num_matches += len(indices)
+                    br._stderr("#### {0} {1}matches found across {2} sequences for pattern '{3}' "
+                               "####\n".format(num_matches, label, len(seqbuddy), pattern), in_args.quiet)
+                    for rec in seqbuddy.records:
+                        indices = rec.buddy_data[key][pattern]
+                        if not len(indices):
+                            br._stderr("{0}: None\n".format(rec.id), in_args.quiet)
+                        else:
+                            br._stderr("{0}: {1}\n".format(rec.id, ", ".join([str(x) for x in indices])),
+                                       in_args.quiet)
 
-            br._stderr("\n", in_args.quiet)
-        _print_recs(seqbuddy)
+                    br._stderr("\n", in_args.quiet)
+            _print_recs(seqbuddy)
+        except TypeError as e:
+            _raise_error(e, "find_pattern", "Nucleic acid sequences required.")
         _exit("find_pattern")
 
     # Find repeat sequences or ids
@@ -4466,6 +5236,19 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
         _print_recs(seqbuddy)
         _exit("hash_seq_ids")
 
+    # Index file
+    if in_args.index_file:
+        in_file = in_args.sequence[0] if len(in_args.sequence) == 1 else None
+        if type(in_file) != str or not os.path.isfile(in_file):
+            _raise_error(ValueError("The index_file tool requires the path to a single sequence file."), "index_file")
+        else:
+            try:
+                with index_file(in_file, seqbuddy.in_format) as seq_index:
+                    br._stderr("Indexed %s records in %s\n" % (len(seq_index), seq_index.index_path), in_args.quiet)
+            except ValueError as e:
+                _raise_error(e, "index_file", "Only FASTA and GenBank files can be indexed")
+        _exit("index_file")
+
     # Insert Seq
     if in_args.insert_seq:
         args = in_args.insert_seq[0]
@@ -4714,14 +5497,9 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
 
     # Pull records
     if in_args.pull_records:
-        if "full" in in_args.pull_records:
-            description = True
-            del in_args.pull_records[in_args.pull_records.index("full")]
-        else:
-            description = False
-
+        description = True if "full" in in_args.pull_records else False
         search_terms = []
-        for arg in in_args.pull_records:
+        for arg in [arg for arg in in_args.pull_records if arg != "full"]:
             if os.path.isfile(arg):
                 with open(arg, "r", encoding="utf-8") as ifile:
                     for line in ifile:
@@ -4729,6 +5507,9 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
             else:
                 search_terms.append(arg)
 
+        if type(seqbuddy) == SeqIndex:
+            with seqbuddy:
+                seqbuddy = seqbuddy.pull_recs(search_terms, in_args.out_format, in_args.alpha)
         _print_recs(pull_recs(seqbuddy, search_terms, description))
         _exit("pull_records")
 
@@ -4748,7 +5529,12 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False, pass_through=False):  #
 
     # Purge
     if in_args.purge:
-        purge(seqbuddy, in_args.purge)
+        args = in_args.purge[0]
+        try:
+            purge(seqbuddy, float(args[0]), "bl2seq" if len(args) == 1 else args[1])
+        except ValueError as e:
+            _raise_error(e, "purge", ["Unknown purge method", "could not convert string to float",
+                                      "cd_hit threshold must be"])
         br._stderr("### Deleted record mapping ###\n", in_args.quiet)
         for indx1, rec in enumerate(seqbuddy.records):
             br._stderr("%s\n" % rec.id, in_args.quiet)
@@ -28,7 +28,8 @@ if int(sys.version_info[0]) < 3:
     sys.exit()
 import argparse
 import datetime
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from copy import copy, deepcopy
 import os
 from configparser import ConfigParser, NoOptionError
 import json
@@ -38,7 +39,10 @@ from ftplib import FTP, all_errors
 from hashlib import md5
 from urllib import request
 from urllib.error import URLError, HTTPError, ContentTooShortError
-from multiprocessing import Process, cpu_count
+from multiprocessing import Process, cpu_count, current_process, get_context
+from threading import Event
+from itertools import islice
+from bisect import bisect_left, bisect_right
 from time import time
 from math import floor
 from tempfile import TemporaryDirectory
@@ -47,8 +51,10 @@ import string
 from random import choice
 import signal
 from pkg_resources import Requirement, resource_filename, DistributionNotFound
+import numpy as np
 
 from Bio import AlignIO
+from Bio.Seq import Seq
 from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
 from Bio.Alphabet import IUPAC
 
@@ -216,15 +222,77 @@ def usable_cpu_count():
 
 
 def run_multicore_function(iterable, function, func_args=False, max_processes=0, quiet=False, out_type=sys.stdout):
-        # fun little piece of abstraction here... directly pass in a function that is going to be looped over, and
-        # fork those loops onto independent processes. Any arguments the function needs must be provided as a list.
+    """
+    Call function(next_iter, func_args) (or function(next_iter) if no func_args) on every item of an iterable, spread
+    across a pool of worker processes. Dictionaries are iterated over by value.
+    :param iterable: Sized iterable or dict
+    :param function: The function to be called on each item (closures and bound methods are fine, they are never pickled)
+    :param func_args: List of extra arguments passed in as the second argument of function
+    :param max_processes: Number of worker processes (0 for br.usable_cpu_count())
+    :param quiet: Suppress progress output
+    :param out_type: Where to print progress (sys.stdout or sys.stderr)
+    :return: List of return values, in the same order as the input
+    """
+    d_print = DynamicPrint(out_type, quiet=quiet)
+    start_time = round(time())
+    # Don't fork more workers than there are jobs (0 still means br.usable_cpu_count())
+    max_processes = usable_cpu_count() if max_processes == 0 else max_processes
+    executor = MultiCoreExecutor(function, func_args, max_processes=max(min(max_processes, len(iterable)), 1))
+    d_print.write("Running function %s() on %s cores\n" % (function.__name__, executor.max_processes))
+    d_print.write("\tJob 0 of %s" % len(iterable))
+
+    def progress(counter, total):
+        d_print.write("\tJob %s of %s (%s)" % (counter, total, pretty_time(round(time()) - start_time)))
+
+    with executor:
+        results = executor.map(iterable, progress=progress)
+    d_print.write("\tDONE: %s jobs in %s\n" % (len(iterable), pretty_time(round(time()) - start_time)))
+    return results
+
+
+_WORKER_FUNCTION = None
+
+
+def _init_worker(function, func_args):
+    # Runs once in each forked worker process of a MultiCoreExecutor. Ctrl+c is left to the parent, which cancels the
+    # whole pool, instead of every worker dumping its own traceback.
+    global _WORKER_FUNCTION
+    _WORKER_FUNCTION = (function, func_args)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return
+
+
+def _call_function(function, func_args, chunk):
+    if func_args:
+        return [function(next_iter, func_args) for next_iter in chunk]
+    return [function(next_iter) for next_iter in chunk]
+
+
+def _run_worker(chunk):
+    function, func_args = _WORKER_FUNCTION
+    return _call_function(function, func_args, chunk)
+
+
+class MultiCoreExecutor(object):
+    def __init__(self, function, func_args=False, max_processes=0, chunk_size=1, queue_size=0):
+        """
+        Persistent pool of worker processes that call a single function. The workers are forked the first time map() is
+        called and are reused by every subsequent call until close(), so the function and func_args are inherited
+        instead of pickled. Only the items and return values cross process boundaries. Note that workers see the
+        parent as it was when the pool started, so use a new executor if the function depends on state that changes.
+        :param function: Called as function(next_iter, func_args), or function(next_iter) if func_args is not set
+        :param func_args: List of extra arguments passed in as the second argument of function
+        :param max_processes: Number of worker processes (0 for br.usable_cpu_count())
+        :param chunk_size: Number of items sent to a worker at a time
+        :param queue_size: Maximum number of chunks in flight, which bounds memory use (0 for 2 * max_processes)
+        """
         if func_args and not isinstance(func_args, list):
             raise AttributeError("The arguments passed into the multi-thread function must be provided as a list")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer, not %s" % chunk_size)
 
-        d_print = DynamicPrint(out_type)
         if max_processes == 0:
             max_processes = usable_cpu_count()
-
         else:
             cpus = cpu_count()
             if max_processes > cpus:
@@ -232,83 +300,104 @@ def run_multicore_function(iterable, function, func_args=False, max_processes=0,
             elif max_processes < 1:
                 max_processes = 1
 
-        max_processes = max_processes if max_processes < len(iterable) else len(iterable)
+        self.function = function
+        self.func_args = func_args
+        self.max_processes = max_processes
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size if queue_size > 0 else max_processes * 2
+        self.pool = None
+        self._cancel = Event()
+        # Windows can't fork, and daemonic pool workers can't have children of their own, so run serial instead
+        self.serial = os.name == "nt" or current_process().daemon
 
-        running_processes = 0
-        child_list = []
-        start_time = round(time())
-        elapsed = 0
-        counter = 0
-        if not quiet:
-            d_print.write("Running function %s() on %s cores\n" % (function.__name__, max_processes))
-        # fire up the multi-core!!
-        if not quiet:
-            d_print.write("\tJob 0 of %s" % len(iterable))
-
-        for next_iter in iterable:
-            if type(iterable) is dict:
-                next_iter = iterable[next_iter]
-            if os.name == "nt":  # Multicore doesn't work well on Windows, so for now just run serial
-                function(next_iter, func_args)
-                continue
-            while 1:     # Only fork a new process when there is a free processor.
-                if running_processes < max_processes:
-                    # Start new process
-                    if not quiet:
-                        d_print.write("\tJob %s of %s (%s)" % (counter, len(iterable), pretty_time(elapsed)))
-
-                    if func_args:
-                        p = Process(target=function, args=(next_iter, func_args))
-                    else:
-                        p = Process(target=function, args=(next_iter,))
-                    p.start()
-                    child_list.append(p)
-                    running_processes += 1
-                    counter += 1
-                    break
-                else:
-                    # processor wait loop
-                    while 1:
-                        for i in range(len(child_list)):
-                            if child_list[i].is_alive():
-                                continue
-                            else:
-                                child_list.pop(i)
-                                running_processes -= 1
-                                break
-
-                        if not quiet:
-                            if (start_time + elapsed) < round(time()):
-                                elapsed = round(time()) - start_time
-                                d_print.write("\tJob %s of %s (%s)" % (counter, len(iterable), pretty_time(elapsed)))
-
-                        if running_processes < max_processes:
-                            break
-
-        # wait for remaining processes to complete --> this is the same code as the processor wait loop above
-        if not quiet:
-            d_print.write("\tJob %s of %s (%s)" % (counter, len(iterable), pretty_time(elapsed)))
-
-        while len(child_list) > 0:
-            for i in range(len(child_list)):
-                if child_list[i].is_alive():
-                    continue
-                else:
-                    child_list.pop(i)
-                    running_processes -= 1
-                    break  # need to break out of the for-loop, because the child_list index is changed by pop
+    def __enter__(self):
+        return self
 
-            if not quiet:
-                if (start_time + elapsed) < round(time()):
-                    elapsed = round(time()) - start_time
-                    d_print.write("\t%s total jobs (%s, %s jobs remaining)" % (len(iterable), pretty_time(elapsed),
-                                                                               len(child_list)))
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-        if not quiet:
-            d_print.write("\tDONE: %s jobs in %s\n" % (len(iterable), pretty_time(elapsed)))
-        # func_args = []  # This may be necessary because of weirdness in assignment of incoming arguments
+    def cancel(self):
+        """
+        Stop a running map() call. Chunks that have not been started are dropped, and running workers are terminated.
+        Safe to call from a progress callback or another thread.
+        :return: None
+        """
+        self._cancel.set()
         return
 
+    def close(self):
+        """
+        Shut down the worker processes
+        :return: None
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return
+
+    def _terminate(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        return
+
+    def map(self, iterable, progress=None):
+        """
+        Call the function on every item of an iterable (dicts are iterated over by value). Items are consumed lazily,
+        so no more than queue_size * chunk_size of them are held in memory at once.
+        :param iterable: Any iterable
+        :param progress: Callback, called as progress(completed_items, total_items) every time a chunk finishes.
+                         total_items is None if the iterable has no length.
+        :return: List of return values, in the same order as the input. If cancel() is called, only the values that
+                 were completed before cancellation are returned.
+        """
+        self._cancel.clear()
+        total = len(iterable) if hasattr(iterable, "__len__") else None
+        iterable = iter(iterable.values() if isinstance(iterable, dict) else iterable)
+        results = []
+        if self.serial:
+            for next_iter in iterable:
+                if self._cancel.is_set():
+                    break
+                results += _call_function(self.function, self.func_args, [next_iter])
+                if progress:
+                    progress(len(results), total)
+            return results
+
+        if not self.pool:
+            self.pool = get_context("fork").Pool(self.max_processes, initializer=_init_worker,
+                                                 initargs=(self.function, self.func_args))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < self.queue_size and not self._cancel.is_set():
+                    chunk = list(islice(iterable, self.chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(self.pool.apply_async(_run_worker, (chunk,)))
+
+                if not pending:
+                    break
+
+                while not pending[0].ready() and not self._cancel.is_set():
+                    pending[0].wait(0.1)
+
+                if self._cancel.is_set():
+                    break
+
+                results += pending.popleft().get()
+                if progress:
+                    progress(len(results), total)
+
+            if self._cancel.is_set():
+                self._terminate()
+        except BaseException:
+            self._terminate()
+            raise
+        return results
+
 
 class TempDir(object):
     def __init__(self):
@@ -610,6 +699,81 @@ class CustomHelpFormatter(argparse.RawDescriptionHelpFormatter):
         return ', '.join(action.option_strings) + ' ' + args_string
 
 
+class FeatureIndex(object):
+    def __init__(self, features):
+        """
+        Lookup tables over the features of a record, so tools can find features by type or by location without testing
+        every feature against every pattern. Each table is only built the first time it is needed. The index is a
+        snapshot, so build a new one if the features are modified.
+        :param features: List of SeqFeature objects (e.g., rec.features)
+        """
+        self.features = list(features)
+        self._types = None
+        self._type_matches = {}
+        self._intervals = None
+
+    def __len__(self):
+        return len(self.features)
+
+    def types(self):
+        """
+        :return: OrderedDict of {feature type: [feature indices]}
+        """
+        if self._types is None:
+            self._types = OrderedDict()
+            for indx, feature in enumerate(self.features):
+                self._types.setdefault(feature.type, []).append(indx)
+        return self._types
+
+    def match_type(self, regex):
+        """
+        Find features with a type matching a regex. The regex is only run once for each distinct feature type.
+        :param regex: Regular expression (str or compiled) searched against feature types
+        :return: Sorted list of feature indices
+        """
+        if regex not in self._type_matches:
+            indices = []
+            for _type, type_indices in self.types().items():
+                if re.search(regex, _type):
+                    indices += type_indices
+            self._type_matches[regex] = sorted(indices)
+        return self._type_matches[regex]
+
+    def span(self, indices):
+        """
+        :param indices: Feature indices
+        :return: (start, end) tuple covering all of the features, or None if indices is empty
+        """
+        if not indices:
+            return None
+        starts, ends = zip(*[(int(self.features[indx].location.start), int(self.features[indx].location.end))
+                             for indx in indices])
+        return min(starts), max(ends)
+
+    def overlapping(self, start, end):
+        """
+        Find features that overlap the half-open range start:end. Compound locations are treated as their outer bounds.
+        Features are kept sorted by start, along with the largest end position seen so far, so only features that can
+        possibly overlap the range are looked at.
+        :param start: First position of the range (zero based)
+        :param end: Position after the end of the range
+        :return: Sorted list of feature indices
+        """
+        if self._intervals is None:
+            order = sorted(range(len(self.features)), key=lambda indx: int(self.features[indx].location.start))
+            starts = [int(self.features[indx].location.start) for indx in order]
+            ends = [int(self.features[indx].location.end) for indx in order]
+            max_ends = []
+            for feat_end in ends:
+                max_ends.append(feat_end if not max_ends or feat_end > max_ends[-1] else max_ends[-1])
+            self._intervals = (order, starts, ends, max_ends)
+
+        order, starts, ends, max_ends = self._intervals
+        first = bisect_right(max_ends, start)
+        last = bisect_left(starts, end)
+        return sorted([indx for indx, feat_end in zip(order[first:last], ends[first:last]) if feat_end > start])
+
+
 class Usage(object):
     def __init__(self):
         self.tmpfile = TempFile()
@@ -778,6 +942,46 @@ def check_garbage_flags(in_args, tool):
     return True
 
 
+def copy_record(rec, memo=None):
+    """
+    Copy a SeqRecord without duplicating its sequence. Seq data are immutable strings, so the copy gets a new Seq
+    wrapper around the same string (and the same alphabet object). Features, annotations, and everything else that
+    is mutable are copied structurally (see _copy_value()), so modifying the copy never touches the original.
+    :param rec: SeqRecord object
+    :param memo: deepcopy() memo dictionary, used to keep shared references consistent across several records
+    :return: SeqRecord object
+    """
+    memo = {} if memo is None else memo
+    new_rec = rec.__class__.__new__(rec.__class__)
+    memo[id(rec)] = new_rec
+    for key, value in rec.__dict__.items():
+        if key == "_seq" and type(value) == Seq:
+            value = Seq(str(value), value.alphabet)
+        else:
+            value = _copy_value(value, memo)
+        new_rec.__dict__[key] = value
+    return new_rec
+
+
+def _copy_value(value, memo):
+    """
+    Faster deepcopy() for the handful of types that make up most of a SeqRecord (lists, dicts, features, and
+    locations). Immutable values are returned as is, and anything unrecognized is handed off to deepcopy().
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if type(value) == list:
+        return [_copy_value(item, memo) for item in value]
+    if type(value) in [dict, OrderedDict]:
+        return value.__class__((key, _copy_value(item, memo)) for key, item in value.items())
+    if type(value) in [SeqFeature, FeatureLocation, CompoundLocation]:
+        new_value = copy(value)
+        for key, item in value.__dict__.items():
+            new_value.__dict__[key] = _copy_value(item, memo)
+        return new_value
+    return deepcopy(value, memo)
+
+
 def error_report(trace_back, permission=False):
     message = ""
     error_hash = re.sub("^#.*?\n{2}", "", trace_back, flags=re.DOTALL)  # Remove error header information before hashing
@@ -1100,6 +1304,53 @@ def replacements(input_str, query, replace="", num=0):
     return input_str
 
 
+class Unhasher(object):
+    def __init__(self, hash_map):
+        """
+        Swap hashes (e.g., from hash_ids()) back to the original strings with a single compiled regex, instead of
+        running a regex substitution over the input for every hash in the map.
+        :param hash_map: Dictionary of {hash: original string}
+        """
+        self.hash_map = hash_map
+        # Alternatives are tried in order, so listing the longest hashes first makes them win where hashes overlap
+        hashes = sorted((_hash for _hash in hash_map if _hash), key=len, reverse=True)
+        self.regex = re.compile("|".join(re.escape(_hash) for _hash in hashes)) if hashes else None
+
+    def sub(self, input_str):
+        """
+        Replace every hash found in a string, scanning once from left to right. Where hashes of different lengths
+        overlap, the longest one wins.
+        :param input_str: Any string, from a single ID up to the contents of a whole file
+        :return: Modified string
+        """
+        if input_str in self.hash_map:
+            return self.hash_map[input_str]
+        if self.regex is None:
+            return input_str
+        return self.regex.sub(lambda match: self.hash_map[match.group(0)], input_str)
+
+
+def rstrip_file(file_path):
+    """
+    Strip trailing whitespace from a file and end it with a single newline, without reading the whole file. Files
+    streamed to disk then match the "%s\n" % output.rstrip() convention used by the Buddy __str__() methods.
+    :param file_path: Path to the file
+    :return: None
+    """
+    with open(file_path, "rb+") as ofile:
+        ofile.seek(0, os.SEEK_END)
+        position = ofile.tell()
+        while position > 0:
+            ofile.seek(position - 1)
+            if ofile.read(1) not in b" \t\r\n":
+                break
+            position -= 1
+        ofile.seek(position)
+        ofile.truncate()
+        ofile.write(b"\n")
+    return
+
+
 def send_traceback(tool, function, e, version):
     now = datetime.datetime.now()
     config = config_values()
@@ -1173,6 +1424,62 @@ def shift_features(features, shift, full_seq_len):
     return shifted_features
 
 
+# Header markers used by sniff_format(). Phylip variants all share the 'phylip' entry.
+SNIFF_SAMPLE_SIZE = 8192
+FORMAT_SIGNATURES = {"clustal": "CLUSTAL|MUSCLE|PROBCONS",
+                     "embl": "ID   ",
+                     "fasta": ">",
+                     "fastq": "@",
+                     "gb": "LOCUS ",
+                     "genbank": "LOCUS ",
+                     "newick": "(?:\\[[^\\]]*\\] *)*\\(",
+                     "nexml": "<(?:nex:)?nexml",
+                     "nexus": "#[Nn][Ee][Xx][Uu][Ss]",
+                     "phylip": " *[0-9]+[ \\t]+[0-9]+ *$",
+                     "seqxml": "<seqXML",
+                     "stockholm": "# STOCKHOLM",
+                     "swiss": "ID   "}
+
+
+def sniff_format(_input, possible_formats, sample_size=None):
+    """
+    Rank candidate file formats from header markers in the first few KB of a seekable handle, so format guessing
+    does not need to trial-parse the entire file in every format.
+    A marker on the first non-blank line scores 3 points, a marker at the start of any later line in the sample
+    scores 1. Ties fall back on the order of possible_formats. Formats without a distinctive marker are not returned.
+    :param _input: Seekable file handle. It is rewound to position 0 before returning.
+    :param possible_formats: Formats the calling Buddy is able to parse, in order of preference
+    :param sample_size: Number of characters to read from the start of the handle
+    :return: list of candidate formats, best first
+    """
+    sample_size = SNIFF_SAMPLE_SIZE if not sample_size else sample_size
+    sample = _input.read(sample_size)
+    _input.seek(0)
+
+    sample = re.sub("^\\s*<\\?xml[^>]*\\?>\\s*", "", sample)  # XML declarations don't tell us anything
+    lines = sample.lstrip().splitlines()
+    if not lines:
+        return []
+    header, body = lines[0], "\n".join(lines[1:])
+
+    scores = OrderedDict()
+    for _format in possible_formats:
+        signature = FORMAT_SIGNATURES.get("phylip" if _format.startswith("phylip") else _format)
+        if not signature:
+            continue
+        if re.match(signature, header):
+            scores[_format] = 3
+        elif re.search("^(?:%s)" % signature, body, flags=re.MULTILINE):
+            scores[_format] = 1
+
+    if "swiss" in scores and "embl" in scores:
+        id_line = re.search("^ID   .*$", sample, flags=re.MULTILINE).group(0)
+        scores["swiss" if re.search(" AA\\.$", id_line) else "embl"] += 1
+
+    # sorted() is stable, so formats with equal scores stay in the order they were provided
+    return [_format for _format, score in sorted(scores.items(), key=lambda x: x[1], reverse=True)]
+
+
 def ungap_feature_ends(feat, rec):
     """
     If a feature begins or ends on a gap, it makes it much harder to track changes, so force the feature onto actual
@@ -1223,11 +1530,80 @@ def ungap_feature_ends(feat, rec):
     return feat
 
 
-def _old2new(feat, old_rec, new_rec):
+def residue_columns(seq, gap_chars="-"):
+    """
+    Find the columns of a (gapped) sequence that hold residues, so that residue positions can be converted to columns
+    with array lookups (and columns back to residue counts with np.searchsorted()), instead of walking the sequence.
+    :param seq: Sequence string or Seq object
+    :param gap_chars: Characters that are treated as gaps
+    :return: numpy array of column indices, one for each residue
+    """
+    codes = np.frombuffer(str(seq).encode("utf-32-le"), dtype=np.uint32)
+    return np.flatnonzero(~np.isin(codes, [ord(char) for char in gap_chars]))
+
+
+class _GapIndex(object):
+    def __init__(self, old_rec, new_rec):
+        """
+        Residue positions of two differently gapped versions of the same sequence, built once per record pair so that
+        _old2new() can translate every feature coordinate with array lookups.
+        :param old_rec: SeqRecord that the features are currently mapped to
+        :param new_rec: SeqRecord that the features are being moved onto
+        """
+        old_seq, new_seq = str(old_rec.seq).lower(), str(new_rec.seq).lower()
+        self.old_len, self.new_len = len(old_seq), len(new_seq)
+        self.old_cols, self.new_cols = residue_columns(old_seq), residue_columns(new_seq)
+        self.old_residues, self.new_residues = old_seq.replace("-", ""), new_seq.replace("-", "")
+
+        # The residues of the two records are identical up to (but not including) this position
+        length = min(len(self.old_residues), len(self.new_residues))
+        old_codes = np.frombuffer(self.old_residues[:length].encode("utf-32-le"), dtype=np.uint32)
+        new_codes = np.frombuffer(self.new_residues[:length].encode("utf-32-le"), dtype=np.uint32)
+        mismatches = np.flatnonzero(old_codes != new_codes)
+        self.first_mismatch = int(mismatches[0]) if len(mismatches) else length
+
+    def translate(self, start, end):
+        """
+        Find the columns in the new record holding the same residues as start:end in the old record. If the residues
+        differ between the records, the feature is extended to the end of the new record.
+        :param start: Start position of the feature in the old record
+        :param end: End position of the feature in the old record
+        :return: (start, end) tuple, or None if the feature's starting residue can't be found in the new record
+        """
+        front_end = slice(None, start).indices(self.old_len)[1]
+        feat_start, feat_end = slice(start, end).indices(self.old_len)[:2]
+        front_len = int(np.searchsorted(self.old_cols, front_end))
+        feat_len = max(int(np.searchsorted(self.old_cols, feat_end)) - int(np.searchsorted(self.old_cols, feat_start)),
+                       0)
+
+        if front_len >= len(self.new_residues) or front_len > self.first_mismatch:
+            return None
+
+        new_start = int(self.new_cols[front_len])
+        last = front_len + feat_len
+        if feat_len and last <= len(self.new_residues) and \
+                (last <= self.first_mismatch or
+                 self.new_residues[front_len:last] == self.old_residues[front_len:last]):
+            new_end = int(self.new_cols[last - 1]) + 1
+        else:
+            new_end = self.new_len
+        return new_start, new_end
+
+
+def _old2new(feat, old_rec, new_rec, gap_index=None):
+    """
+    Move a feature from one record onto a differently gapped version of the same sequence
+    :param feat: SeqFeature object
+    :param old_rec: SeqRecord that the feature is currently mapped to
+    :param new_rec: SeqRecord that the feature is being moved onto
+    :param gap_index: _GapIndex for old_rec and new_rec, if one has already been built
+    :return: The modified feature, or None if it can't be placed on new_rec
+    """
     if type(feat.location) == CompoundLocation:
+        gap_index = gap_index if gap_index else _GapIndex(old_rec, new_rec)
         parts = []
         for part in feat.location.parts:
-            new_part = _old2new(SeqFeature(part), old_rec, new_rec)
+            new_part = _old2new(SeqFeature(part), old_rec, new_rec, gap_index)
             if new_part:
                 parts.append(new_part.location)
         if len(parts) == 1:
@@ -1243,37 +1619,11 @@ def _old2new(feat, old_rec, new_rec):
             start, end = feat.location.end, feat.location.start
         else:
             start, end = feat.location.start, feat.location.end
-        old_seq = str(old_rec.seq).lower()
-        new_seq = str(new_rec.seq).lower()
-        old_front_seq = old_seq[:start]
-        old_front_seq = re.sub("-", "", old_front_seq)
-        old_feat_seq = old_seq[start:end]
-        old_feat_seq = re.sub("-", "", old_feat_seq)
-        start, end = 0, 0
-        new_front_seq, new_feat_seq = "", ""
-        for indx, residue in enumerate(new_seq):
-            if residue == "-":
-                continue
-
-            if not start:
-                if old_front_seq in ["", new_front_seq]:
-                    start = indx + 1
-                    new_feat_seq += residue
-                    if new_feat_seq == old_feat_seq:
-                        end = indx + 1
-                        break
-                else:
-                    new_front_seq += residue
-            else:
-                new_feat_seq += residue
-                if new_feat_seq == old_feat_seq:
-                    end = indx + 1
-                    break
-        start -= 1
-        if start == -1:
+        gap_index = gap_index if gap_index else _GapIndex(old_rec, new_rec)
+        new_location = gap_index.translate(int(start), int(end))
+        if not new_location:
             return None  # I don't think this should ever be hit
-        end = end if end != 0 else len(new_seq)
-        feat.location = FeatureLocation(start, end, feat.location.strand)
+        feat.location = FeatureLocation(new_location[0], new_location[1], feat.location.strand)
     else:
         raise TypeError("FeatureLocation or CompoundLocation object required.")
     return feat
@@ -1294,8 +1644,9 @@ def remap_gapped_features(old_records, new_records):
             features.append(ungap_feature_ends(feat, old_rec))
         old_rec.features = features
         features = []
+        gap_index = _GapIndex(old_rec, new_rec)
         for feat in old_rec.features:
-            feat = _old2new(feat, old_rec, new_rec)
+            feat = _old2new(feat, old_rec, new_rec, gap_index)
             if feat:
                 features.append(feat)
         new_rec.features = features
@@ -1499,8 +1850,12 @@ sb_flags = {"annotate": {"flag": "ano",
                                 "metavar": "positions",
                                 "help": "Pull out specific residues"},
             "find_CpG": {"flag": "fcpg",
-                         "action": "store_true",
-                         "help": "Predict regions under strong purifying selection based on high CpG content"},
+                         "action": "append",
+                         "nargs": "*",
+                         "metavar": "args",
+                         "help": "Predict regions under strong purifying selection based on high CpG content. "
+                                 "Args: [window size (default=200)] [min G+C fraction (default=0.5)] "
+                                 "[min observed/expected CpG (default=0.6)]"},
             "find_orfs": {"flag": "orf",
                           "action": "store_true",
                           "help": "Finds all the open reading frames in the sequences and their reverse complements."},
@@ -1509,7 +1864,8 @@ sb_flags = {"annotate": {"flag": "ano",
                              "nargs": "+",
                              "metavar": "<regex>",
                              "help": "Search for subsequences, returning the start positions of all matches. Include "
-                                     "the word 'ambig' to search with ambiguous character codes."},
+                                     "the word 'ambig' to search with ambiguous character codes, or 'rc' to also search "
+                                     "the reverse strand of nucleotide sequences."},
             "find_repeats": {"flag": "frp",
                              "action": "append",
                              "nargs": "?",
@@ -1550,6 +1906,10 @@ sb_flags = {"annotate": {"flag": "ano",
                              "metavar": "hash length (int)",
                              "help": "Rename all sequence IDs to fixed length hashes. "
                                      "Default length is 10."},
+            "index_file": {"flag": "idx",
+                           "action": "store_true",
+                           "help": "Write a sidecar index (.fai/.gbi) for a FASTA or GenBank file, so later "
+                                   "--pull_records calls only read the records they need"},
             "insert_seq": {"flag": "is",
                            "action": "append",
                            "nargs": "*",
@@ -1644,10 +2004,11 @@ sb_flags = {"annotate": {"flag": "ano",
                                           "metavar": "<regex>",
                                           "help": "Get all the records with ids containing a given string"},
             "purge": {"flag": "prg",
-                      "action": "store",
-                      "metavar": "<Max BLAST score (int)>",
-                      "type": int,
-                      "help": "Delete sequences with high similarity"},
+                      "action": "append",
+                      "nargs": "+",
+                      "metavar": ("<threshold>", "[bl2seq|cd_hit]"),
+                      "help": "Delete sequences with high similarity. The threshold is a max BLAST bit score (bl2seq, "
+                              "default) or a max percent identity (cd_hit, no BLAST required)"},
             "rename_ids": {"flag": "ri",
                            "action": "append",
                            "metavar": "args",
@@ -1716,6 +2077,10 @@ sb_modifiers = {"alpha": {"flag": "a",
                 "quiet": {"flag": "q",
                           "action": "store_true",
                           "help": "Suppress stderr messages"},
+                "stream": {"flag": "s",
+                           "action": "store_true",
+                           "help": "Process records in chunks instead of loading the whole file (record-local "
+                                   "tools and sequential formats only)"},
                 "test": {"flag": "t",
                          "action": "store_true",
                          "help": "Run the function and return any stderr/stdout other than sequences"}}
@@ -44,10 +44,34 @@ def test_alignment_lengths(alb_resources):
 def test_bootstrap(alb_resources, hf):
     # Test an amino acid file
     tester = Alb.bootstrap(alb_resources.get_one("m p py"), r_seed=12345)
-    assert hf.buddy2hash(tester) == "ce9009b430ad0fe7f151477985e6f922"
+    assert hf.buddy2hash(tester) == "88986cd48959399227fc8ca88faabc08"
 
     tester = Alb.bootstrap(alb_resources.get_one("m p py"), 3, r_seed=12345)
-    assert hf.buddy2hash(tester) == "e6d5f30c3a7f53ec7899618a045b017d"
+    assert hf.buddy2hash(tester) == "220236c81d710a1ab8b7920633d1bf04"
+
+    # The number of processes must not change the replicates that are drawn
+    tester = Alb.bootstrap(alb_resources.get_one("m p py"), 3, r_seed=12345, max_processes=2)
+    assert hf.buddy2hash(tester) == "220236c81d710a1ab8b7920633d1bf04"
+
+    tester = Alb.bootstrap(alb_resources.get_one("o p n"), 2, r_seed=12345)
+    assert tester.out_format == "phylip-relaxed"
+    assert tester.lengths() == [683, 683]
+
+
+def test_bootstrap_replicates(alb_resources):
+    alignbuddy = alb_resources.get_one("m p s")
+    replicates = Alb.bootstrap_replicates(alignbuddy, 2, r_seed=12345)
+    assert not isinstance(replicates, list)
+    replicates = list(replicates)
+    assert [rep.get_alignment_length() for rep in replicates] == [481, 481, 683, 683]
+    assert [rec.id for rec in replicates[2]] == [rec.id for rec in alignbuddy.alignments[1]]
+    assert str(replicates[0][0].seq) != str(replicates[1][0].seq)
+
+    # Every column of a replicate is a column of the original alignment
+    original = {str(alignbuddy.alignments[0][:, indx]) for indx in range(481)}
+    for indx in range(481):
+        assert str(replicates[0][:, indx]) in original
+    assert all(not rec.features for rec in replicates[0])
 
 
 # ##############################################  '-cs', '--clean_seqs' ############################################## #
@@ -389,7 +413,7 @@ def test_clustalomega(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "bad3a345e769d32672d39ee51df295f5"
+    assert hf.string2hash(kept_output) == "eae2d917c462b70253cb83af98bfb60b"
 
 
 def test_clustalw2(sb_resources, hf, monkeypatch):
@@ -429,7 +453,7 @@ def test_clustalw2(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "7c03d671198d4e6c4bb56c8fb5619fff"
+    assert hf.string2hash(kept_output) == "eb9ff56e71021ce9237aa592d4c9d686"
 
 
 def test_pagan(sb_resources, hf, monkeypatch):
@@ -472,7 +496,7 @@ def test_pagan(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "864112dafb4896ba25ece7929ca0a818"
+    assert hf.string2hash(kept_output) == "e6e34b6cc0a2de62be9e94c8917ad2fc"
 
 
 def test_prank(sb_resources, hf, monkeypatch):
@@ -512,7 +536,7 @@ def test_prank(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "d0564931e20a61b441fc60549f5560a0"
+    assert hf.string2hash(kept_output) == "4928df3557f29312d7b55166829eb477"
 
 
 def test_muscle(sb_resources, hf, monkeypatch):
@@ -543,7 +567,7 @@ def test_muscle(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "bd85c34b11261aef2d38c7a6a9d20bf9"
+    assert hf.string2hash(kept_output) == "e2f32ea93255937069bc172fbf7c354f"
 
 
 def test_mafft(sb_resources, hf, monkeypatch):
@@ -576,7 +600,7 @@ def test_mafft(sb_resources, hf, monkeypatch):
     for file in sorted(files):
         with open("%s%s%s" % (root, os.path.sep, file), "r", encoding="utf-8") as ifile:
             kept_output += ifile.read()
-    assert hf.string2hash(kept_output) == "6eaa7e087dd42a8d3ffe86d216b917d8"
+    assert hf.string2hash(kept_output) == "1a45f520c0df3670c93db90907ca3978"
 
 
 def test_alignment_edges(monkeypatch, sb_resources):
@@ -2,15 +2,18 @@
 # coding=utf-8
 """ tests basic functionality of AlignBuddy class """
 import pytest
+import numpy as np
 import io
 import os
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio.Alphabet import IUPAC
 from Bio import AlignIO
+from Bio.Align import MultipleSeqAlignment
 
 import buddy_resources as br
-from AlignBuddy import AlignBuddy, guess_alphabet, guess_format, make_copy
+from AlignBuddy import AlignBuddy, guess_alphabet, guess_format, make_copy, FeatureReMapper, \
+    _alignment_matrix, _matrix2str, _select_columns
 from buddy_resources import GuessError, parse_format
 
 
@@ -312,6 +315,69 @@ def test_guess_format(alb_resources, alb_odd_resources):
 def test_make_copy(alb_resources, hf):
     for alb in alb_resources.get_list():
         tester = make_copy(alb)
-        hf.buddy2hash(tester) == hf.buddy2hash(alb)
+        assert hf.buddy2hash(tester) == hf.buddy2hash(alb)
+
+    # Sequence strings are shared, everything else is independent
+    alignbuddy = alb_resources.get_one("m d s")
+    before = hf.buddy2hash(alignbuddy)
+    tester = make_copy(alignbuddy)
+    assert tester.alpha is alignbuddy.alpha
+    assert str(tester.records()[0].seq) is str(alignbuddy.records()[0].seq)
+    tester.alignments[0][0].seq = Seq("A" * len(tester.alignments[0][0].seq), alignbuddy.alpha)
+    tester.alignments[1]._records.pop()
+    tester.alignments[0].annotations["foo"] = "bar"
+    assert hf.buddy2hash(alignbuddy) == before
+    assert "foo" not in alignbuddy.alignments[0].annotations
+
+
+def test_alignment_matrix(alb_resources):
+    alignment = alb_resources.get_one("o p g").alignments[0]
+    matrix = _alignment_matrix(alignment)
+    assert matrix.shape == (len(alignment), alignment.get_alignment_length())
+    assert matrix.dtype == np.uint8
+    assert _matrix2str(matrix[2]) == str(alignment[2].seq)
+    assert _matrix2str(matrix[:, 5]) == alignment[:, 5]
+
+    alignment = MultipleSeqAlignment([SeqRecord(Seq("AC-Ω"), id="a"), SeqRecord(Seq("ACGT"), id="b")])
+    matrix = _alignment_matrix(alignment)
+    assert matrix.dtype == np.uint32
+    assert _matrix2str(matrix[0]) == "AC-Ω"
+    assert _alignment_matrix(MultipleSeqAlignment([])).shape == (0, 0)
+
+    alignment[0].seq = Seq("AC-")
+    with pytest.raises(ValueError) as err:
+        _alignment_matrix(alignment)
+    assert "Sequences must all be the same length" in str(err)
+
+
+def test_select_columns(alb_resources):
+    alignment = alb_resources.get_one("o d s").alignments[0]
+    alignment[0].letter_annotations["foo"] = list(range(alignment.get_alignment_length()))
+    alignment.column_annotations["bar"] = "x" * 5 + "y" * (alignment.get_alignment_length() - 5)
+    tester = _select_columns(alignment, [4, 5, 5, 0])
+    assert [str(rec.seq) for rec in tester] == [str(rec.seq[4:6] + rec.seq[5] + rec.seq[0]) for rec in alignment]
+    assert [rec.id for rec in tester] == [rec.id for rec in alignment]
+    assert tester[0].description == alignment[0].description
+    assert tester[0].letter_annotations["foo"] == [4, 5, 5, 0]
+    assert tester.column_annotations["bar"] == "xyyx"
+    assert tester._alphabet == alignment._alphabet
+    assert not tester[0].features
+
+    tester = _select_columns(alignment, [], _alignment_matrix(alignment))
+    assert tester.get_alignment_length() == 0
+    assert tester.column_annotations["bar"] == ""
+
+
+def test_feature_remapper_extend_many():
+    for exists in [[False, False, True, False, True, True, False], [True, False, True], [False, False], []]:
+        for split in range(len(exists) + 1):
+            tester, control = FeatureReMapper(), FeatureReMapper()
+            tester.extend_many(exists[:split])
+            tester.extend_many(np.array(exists[split:], dtype=bool))
+            for next_col in exists:
+                control.extend(next_col)
+            assert tester.position_map == control.position_map
+            assert tester.starting_position_filled == control.starting_position_filled
+
 
 # ToDo: def test_feature_remapper()
@@ -163,6 +163,37 @@ def test_bootstrap_ui(capsys, alb_resources):
     tester = Alb.AlignBuddy(out)
     assert tester.lengths() == [481, 481, 481, 683, 683, 683]
 
+    test_in_args.bootstrap = [2]
+    Alb.command_line_ui(test_in_args, alb_resources.get_one("o p n"), skip_exit=True)
+    out, err = capsys.readouterr()
+    tester = Alb.AlignBuddy(out)
+    assert tester.out_format == "phylip-relaxed"
+    assert tester.lengths() == [683, 683]
+
+    Alb.command_line_ui(test_in_args, alb_resources.get_one("o d f"), skip_exit=True)
+    out, err = capsys.readouterr()
+    assert "fasta format does not support multiple alignments in one file." in err
+
+
+def test_bootstrap_ui_streamed_matches_batched(capsys, alb_resources, monkeypatch):
+    bootstrap_replicates = Alb.bootstrap_replicates
+
+    def seeded_replicates(alignbuddy, num_bootstraps=1, r_seed=None, max_processes=1):
+        return bootstrap_replicates(alignbuddy, num_bootstraps, 12345, max_processes)
+
+    monkeypatch.setattr(Alb, "bootstrap_replicates", seeded_replicates)
+    test_in_args = deepcopy(in_args)
+    for out_format in ["clustal", "embl", "fasta", "gb", "nexus", "phylip", "phylipr", "phylipss", "phylipsr",
+                       "stockholm"]:
+        multi = out_format not in ["fasta", "gb", "nexus"]
+        test_in_args.bootstrap = [3] if multi else [1]
+        tester = alb_resources.get_one("m p py" if multi else "o p py")
+        tester.set_format(out_format)
+        batched = str(Alb.bootstrap(deepcopy(tester), test_in_args.bootstrap[0]))
+        capsys.readouterr()
+        Alb.command_line_ui(test_in_args, tester, skip_exit=True)
+        out, err = capsys.readouterr()
+        assert out == batched, out_format
 
 # ##################### '-cs', '--clean_seqs' ###################### ##
 def test_clean_seqs_ui(capsys, alb_resources, alb_odd_resources, hf):
@@ -12,6 +12,7 @@ import urllib.request
 import argparse
 import json
 from hashlib import md5
+from collections import OrderedDict
 from time import sleep
 import datetime
 from unittest import mock
@@ -191,10 +192,7 @@ def test_usable_cpu_count(monkeypatch):
     monkeypatch.setattr(br, 'cpu_count', cpu_func)
     assert br.usable_cpu_count() == 1
 
-# skipping run_multicore function for now
-
-
-def test_run_multicore_function(monkeypatch, hf):
+def test_run_multicore_function(monkeypatch):
     temp_file = br.TempFile()
     temp_path = temp_file.path
     monkeypatch.setattr(br, "time", lambda: 1)
@@ -202,31 +200,47 @@ def test_run_multicore_function(monkeypatch, hf):
     monkeypatch.setattr(br, "cpu_count", mock.Mock(return_value=4))
     monkeypatch.setattr(br, "usable_cpu_count", mock.Mock(return_value=4))
 
-    testfunc = mock.Mock()
-    testfunc.configure_mock(**{"__name__": "testfunc"})
-
     nums = range(1, 5)
 
     with open(temp_path, "w") as output:
-        br.run_multicore_function(nums, lambda *_: True, func_args=False,
-                                  max_processes=0, quiet=False, out_type=output)
+        assert br.run_multicore_function(nums, lambda x: x * 2, func_args=False,
+                                         max_processes=0, quiet=False, out_type=output) == [2, 4, 6, 8]
     with open(temp_path, "r") as out:
         output = out.read()
-        assert hf.string2hash(output) in ["107696d60ee9b932ecaffad7c97a609f", "c2adacdaf0de6526c707564068a3460a"]
+    assert "Running function <lambda>() on 4 cores" in output
+    assert "Job 0 of 4\n" in output
+    assert "Job 4 of 4 (0 sec)" in output
+    assert "DONE: 4 jobs in 0 sec" in output
 
     with open(temp_path, "w") as output:
-        br.run_multicore_function(nums, lambda *_: True, func_args=["Foo"],
-                                  max_processes=5, quiet=False, out_type=output)
+        assert br.run_multicore_function(nums, lambda x, args: x * args[0], func_args=[3],
+                                         max_processes=5, quiet=False, out_type=output) == [3, 6, 9, 12]
     with open(temp_path, "r") as out:
-        output = out.read()
-        assert hf.string2hash(output) in ["107696d60ee9b932ecaffad7c97a609f", "c2adacdaf0de6526c707564068a3460a"]
+        assert "Running function <lambda>() on 4 cores" in out.read()
 
     with open(temp_path, "w") as output:
-        br.run_multicore_function({"a": 1, "b": 2, "c": 3, "d": 4}, lambda *_: True, func_args=False,
-                                  max_processes=-4, quiet=False, out_type=output)
+        assert br.run_multicore_function({"a": 1, "b": 2, "c": 3, "d": 4}, lambda x: x, func_args=False,
+                                         max_processes=-4, quiet=False, out_type=output) == [1, 2, 3, 4]
     with open(temp_path, "r") as out:
-        output = out.read()
-        assert hf.string2hash(output) in ["cf5afec941a4b854ed78f01d2753009d", "b9a2268fefae3786a611f5e699fd6200"]
+        assert "Running function <lambda>() on 1 cores" in out.read()
+
+    with open(temp_path, "w") as output:
+        br.run_multicore_function(nums, lambda x: x, quiet=True, out_type=output)
+    with open(temp_path, "r") as out:
+        assert out.read() == ""
+
+    # Small jobs don't start a full pool
+    pool_sizes = []
+
+    class SpyExecutor(br.MultiCoreExecutor):
+        def __init__(self, *args, **kwargs):
+            pool_sizes.append(kwargs["max_processes"])
+            super(SpyExecutor, self).__init__(*args, **kwargs)
+
+    monkeypatch.setattr(br, "MultiCoreExecutor", SpyExecutor)
+    assert br.run_multicore_function([1, 2], lambda x: x * 2, quiet=True) == [2, 4]
+    assert br.run_multicore_function([], lambda x: x * 2, max_processes=3, quiet=True) == []
+    assert pool_sizes == [2, 1]
 
     with pytest.raises(AttributeError) as err:
         br.run_multicore_function(nums, lambda *_: True, func_args="Foo", max_processes=4, quiet=False,
@@ -241,15 +255,6 @@ def test_run_multicore_function(monkeypatch, hf):
             self.timer += 1 if self.timer < 3 else 0
             return self.timer
 
-    timer = MockTime()
-    monkeypatch.setattr(br, "time", timer.time)
-    with open(temp_path, "w") as output:
-        br.run_multicore_function(nums, lambda *_: True, func_args=False,
-                                  max_processes=1, quiet=False, out_type=output)
-    with open(temp_path, "r") as out:
-        output = out.read()
-        assert hf.string2hash(output) in ["08f48aaa5d64ac48ea15a4aa63d75141", 'b9a2268fefae3786a611f5e699fd6200']
-
     timer = MockTime()
     monkeypatch.setattr(br, "time", timer.time)
     with open(temp_path, "w") as output:
@@ -262,6 +267,62 @@ def test_run_multicore_function(monkeypatch, hf):
     assert re.search("DONE: 4 jobs in [0-9]+ sec", output)
 
 
+def test_multicore_executor(monkeypatch):
+    def worker_pid(_):
+        sleep(0.01)
+        return os.getpid()
+
+    monkeypatch.setattr(br, "cpu_count", mock.Mock(return_value=4))
+    with br.MultiCoreExecutor(worker_pid, max_processes=2, chunk_size=3) as executor:
+        assert executor.queue_size == 4
+        first = executor.map(range(10))
+        assert len(first) == 10
+        assert os.getpid() not in first
+        # The same workers are reused
+        assert set(executor.map(range(10))).issubset(set(first))
+    assert executor.pool is None
+
+    # Generators are consumed lazily, and progress is reported per chunk
+    consumed = []
+
+    def generator():
+        for indx in range(10):
+            consumed.append(indx)
+            yield indx
+
+    progress = []
+    with br.MultiCoreExecutor(lambda x: x + 1, max_processes=1, chunk_size=2, queue_size=1) as executor:
+        assert executor.map(generator(), progress=lambda done, total: progress.append((done, total, len(consumed)))) \
+            == list(range(1, 11))
+    assert [x[:2] for x in progress] == [(2, None), (4, None), (6, None), (8, None), (10, None)]
+    assert progress[0][2] <= 4
+
+    # Cancellation from the progress callback
+    with br.MultiCoreExecutor(lambda x: x, max_processes=1, queue_size=1) as executor:
+        assert executor.map(range(100), progress=lambda done, total: executor.cancel() if done >= 3 else None) \
+            == [0, 1, 2]
+        assert executor.pool is None
+        assert executor.map(range(3)) == [0, 1, 2]
+
+    # Errors in workers are raised in the parent
+    def boom(x):
+        raise ValueError("Boom %s" % x)
+
+    with pytest.raises(ValueError) as err:
+        br.run_multicore_function([1, 2], boom, quiet=True)
+    assert "Boom 1" in str(err)
+
+    # Serial fallback
+    with br.MultiCoreExecutor(worker_pid, max_processes=2) as executor:
+        executor.serial = True
+        assert executor.map({"a": 1, "b": 2}) == [os.getpid(), os.getpid()]
+        assert executor.pool is None
+
+    with pytest.raises(ValueError) as err:
+        br.MultiCoreExecutor(worker_pid, chunk_size=0)
+    assert "chunk_size must be a positive integer" in str(err)
+
+
 # ######################################  TempDir  ###################################### #
 def test_tempdir_init():
     test_dir = br.TempDir()
@@ -538,6 +599,36 @@ def test_customhelpformatter(capsys, hf):
     assert err == "" and olderr == ""
 
 
+def test_feature_index():
+    from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
+    features = [SeqFeature(FeatureLocation(10, 20), type="TMD1"), SeqFeature(FeatureLocation(0, 100), type="CDS"),
+                SeqFeature(FeatureLocation(30, 40), type="TMD2"), SeqFeature(FeatureLocation(55, 60), type="TMD1"),
+                SeqFeature(CompoundLocation([FeatureLocation(5, 8), FeatureLocation(70, 75)]), type="splice"),
+                SeqFeature(FeatureLocation(90, 90), type="site")]
+    feature_index = br.FeatureIndex(features)
+    assert len(feature_index) == 6
+    assert feature_index.types() == OrderedDict([("TMD1", [0, 3]), ("CDS", [1]), ("TMD2", [2]),
+                                                 ("splice", [4]), ("site", [5])])
+    assert feature_index.match_type("TMD") == [0, 2, 3]
+    assert feature_index.match_type("TMD1|CDS") == [0, 1, 3]
+    assert feature_index.match_type("foo") == []
+    assert feature_index.span([0, 2]) == (10, 40)
+    assert feature_index.span([]) is None
+
+    assert feature_index.overlapping(0, 100) == [0, 1, 2, 3, 4, 5]
+    assert feature_index.overlapping(20, 30) == [1, 4]
+    assert feature_index.overlapping(19, 31) == [0, 1, 2, 4]
+    assert feature_index.overlapping(60, 70) == [1, 4]
+    assert feature_index.overlapping(100, 200) == []
+    assert br.FeatureIndex([]).overlapping(0, 10) == []
+
+    # Brute force check against every possible range
+    for start in range(0, 101, 3):
+        for end in range(start, 101, 7):
+            assert feature_index.overlapping(start, end) == \
+                [indx for indx, feat in enumerate(features) if feat.location.start < end and feat.location.end > start]
+
+
 def test_usage(monkeypatch):
     class FakeFTP:
         def __init__(self, *args, **kwargs):
@@ -687,6 +778,28 @@ def test_check_garbage_flags(capsys):
     assert br.check_garbage_flags(in_args, "AlignBuddy")
 
 
+def test_copy_record(sb_resources):
+    rec = sb_resources.get_one("d g").records[0]
+    rec.buddy_data = {"foo": ["bar"]}
+    tester = br.copy_record(rec)
+    assert tester is not rec
+    assert str(tester.seq) is str(rec.seq)
+    assert tester.seq is not rec.seq
+    assert tester.seq.alphabet is rec.seq.alphabet
+    assert tester.features is not rec.features
+    assert tester.features[0] is not rec.features[0]
+    assert tester.buddy_data == rec.buddy_data
+
+    tester.buddy_data["foo"].append("baz")
+    tester.features[0].location = None
+    tester.annotations["foo"] = "bar"
+    tester.seq.alphabet = None
+    assert rec.buddy_data == {"foo": ["bar"]}
+    assert rec.features[0].location is not None
+    assert "foo" not in rec.annotations
+    assert rec.seq.alphabet is not None
+
+
 def test_error_report(monkeypatch):
     class FakeFTP:
         def __init__(self, *args, **kwargs):
@@ -899,6 +1012,29 @@ def test_replacements():
     assert "There are more replacement match values specified than query parenthesized groups" in str(err)
 
 
+def test_unhasher():
+    unhasher = br.Unhasher(OrderedDict([("a1b2c", "Mle-Panxα1"), ("d3e4f", "Mle-Panxα2"), ("d3e4f5", "Long id")]))
+    assert unhasher.regex.pattern == "d3e4f5|a1b2c|d3e4f"
+    assert unhasher.sub("a1b2c") == "Mle-Panxα1"
+    assert unhasher.sub("d3e4f5") == "Long id"
+    assert unhasher.sub(">a1b2c\nATGC\n>d3e4f\tx_a1b2c_d3e4f5a1b2c") == ">Mle-Panxα1\nATGC\n>Mle-Panxα2\t" \
+                                                                     "x_Mle-Panxα1_Long idMle-Panxα1"
+    assert unhasher.sub("a1b2") == "a1b2"
+    assert unhasher.sub("") == ""
+    assert br.Unhasher({}).sub("a1b2c") == "a1b2c"
+    # Hashes are matched literally
+    assert br.Unhasher({"a.b": "dot", "(c)": "parens"}).sub("a.b axb (c) c") == "dot axb parens c"
+
+
+def test_rstrip_file():
+    tmp_file = br.TempFile()
+    for contents, expected in [("foo\n\n \t\n", "foo\n"), ("foo", "foo\n"), ("foo\n", "foo\n"), ("", "\n"),
+                               ("  \nα bar  \r\n", "  \nα bar\n")]:
+        tmp_file.write(contents, mode="w")
+        br.rstrip_file(tmp_file.path)
+        assert tmp_file.read() == expected
+
+
 def test_send_traceback(capsys, monkeypatch):
     monkeypatch.setattr(br, "error_report", lambda *_: False)
     version = br.Version("Foo", 1, 2, [])
@@ -973,6 +1109,32 @@ def test_shift_features(sb_resources, hf):
         br.shift_features(features, 10, len(buddy.records[0]))
 
 
+def test_sniff_format():
+    possible_formats = ["stockholm", "fasta", "gb", "phylipss", "phylipsr", "phylip", "phylip-relaxed",
+                        "fastq", "embl", "nexus", "seqxml", "clustal", "swiss"]
+    for _file, candidates in [("Mnemiopsis_cds.fa", ["fasta"]), ("Mnemiopsis_cds.gb", ["gb"]),
+                              ("Mnemiopsis_cds.embl", ["embl", "swiss"]), ("Mnemiopsis_cds.nex", ["nexus"]),
+                              ("Mnemiopsis_cds.seqxml", ["seqxml"]), ("Mnemiopsis_cds.stklm", ["stockholm"]),
+                              ("Mnemiopsis_cds.clus", ["clustal"]), ("gibberish.fa", []),
+                              ("Mnemiopsis_cds.physs", ["phylipss", "phylipsr", "phylip", "phylip-relaxed"])]:
+        with open("%s%s" % (RESOURCE_PATH, _file), "r", encoding="utf-8") as ifile:
+            assert br.sniff_format(ifile, possible_formats) == candidates
+            assert ifile.tell() == 0
+
+    tree_formats = ["nexml", "nexus", "newick"]
+    for _file, candidates in [("single_tree.xml", ["nexml"]), ("single_tree.nex", ["nexus"]),
+                              ("single_tree.newick", ["newick"]), ("Mnemiopsis_pep.newick", ["newick"])]:
+        with open("%s%s" % (RESOURCE_PATH, _file), "r", encoding="utf-8") as ifile:
+            assert br.sniff_format(ifile, tree_formats) == candidates
+
+    # Marker on the first line beats markers further down, and only the sample is looked at
+    assert br.sniff_format(io.StringIO("@read1\nACGT\n+\nIIII\n>foo\n"), possible_formats) == ["fastq", "fasta"]
+    assert br.sniff_format(io.StringIO("%s\n>foo\nACGT\n" % ("x" * 100)), ["fasta"], sample_size=50) == []
+    assert br.sniff_format(io.StringIO("ID   FOO_BAR   Reviewed;   100 AA.\n"), ["embl", "swiss"]) == \
+        ["swiss", "embl"]
+    assert br.sniff_format(io.StringIO("  \n\n"), possible_formats) == []
+
+
 def test_ungap_feature_ends_simple(alb_resources):
     rec = alb_resources.get_one("o d g").records()[0]
     feature = rec.features[1]
@@ -1021,6 +1183,32 @@ def test_ungap_feature_ends_error(alb_resources):
     assert "FeatureLocation or CompoundLocation object required." in str(err)
 
 
+def test_residue_columns():
+    assert br.residue_columns("--AT-G-").tolist() == [2, 3, 5]
+    assert br.residue_columns("A.T -α", ["-", ".", " "]).tolist() == [0, 2, 5]
+    assert br.residue_columns("---").tolist() == []
+    assert br.residue_columns("").tolist() == []
+
+
+def test_gap_index():
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    old_rec = SeqRecord(Seq("A-TG--CA"))
+    gap_index = br._GapIndex(old_rec, SeqRecord(Seq("--ATGC-A-")))
+    assert gap_index.first_mismatch == 5
+    assert gap_index.translate(0, 1) == (2, 3)
+    assert gap_index.translate(2, 7) == (3, 6)
+    assert gap_index.translate(1, 2) == (3, 9)  # No residues in the feature, so it runs to the end of the new record
+    assert gap_index.translate(7, 8) == (7, 8)
+
+    # Residues differ after the first two, so features starting past the mismatch can't be placed
+    gap_index = br._GapIndex(old_rec, SeqRecord(Seq("A-T-CCA")))
+    assert gap_index.first_mismatch == 2
+    assert gap_index.translate(0, 3) == (0, 3)
+    assert gap_index.translate(0, 6) == (0, 7)
+    assert gap_index.translate(6, 8) is None
+
+
 def test_old2new_simple(alb_resources, sb_resources):
     # Pulling out Mle-Panxα9 from both buddy objects
     align_rec = alb_resources.get_one("o d g").records()[0]
@@ -4,6 +4,12 @@ from collections import OrderedDict
 import datetime
 import random
 import re
+import os
+import dill
+import time
+import threading
+import _thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 import buddy_resources as br
 import DatabaseBuddy as Db
@@ -319,6 +325,45 @@ def test_record_search(sb_resources):
     assert not rec.search("ML07312abcd")
 
 
+
+def test_record_query(sb_resources, monkeypatch):
+    query = Db.compile_query("i?(organism) equus")
+    assert Db.compile_query("i?(organism) equus") is query
+    assert query.column == "organism"
+    assert query.regex == "equus"
+    assert query.pattern.flags & re.IGNORECASE
+
+    query = Db.compile_query("(length >= 451)")
+    assert query.length[1] == 451
+    assert query.pattern is None
+
+    # Invalid operators are only a problem once a record actually has a length
+    query = Db.compile_query("(length<>200)")
+    assert not query.match(Db.Record("F6SBJ1"))
+    with pytest.raises(ValueError) as err:
+        query.match(Db.Record("F6SBJ1", summary={"length": "451"}))
+    assert "Invalid operator: <>" in str(err)
+
+    # The embl text of full records is only generated once per SeqRecord
+    sb_obj = sb_resources.get_one("p g")
+    rec = Db.Record("Mle-Panxα8", _record=sb_obj.records[4])
+    calls = []
+    record_format = type(rec.record).format
+
+    def count_format(self, *args):
+        calls.append(args)
+        return record_format(self, *args)
+
+    monkeypatch.setattr(type(rec.record), "format", count_format)
+    assert rec.search("Innexin")
+    assert rec.search("i?innexin")
+    assert not rec.search("ML07312abcd")
+    assert len(calls) == 1
+
+    rec.record = sb_obj.records[3]
+    assert rec.search(sb_obj.records[3].id)
+    assert len(calls) == 2
+
 def test_record_update():
     rec = Db.Record("K9WMR5XBZ1")
     summary = OrderedDict([("ACCN", "F6SBJ1"), ("DB", "uniprot"), ("entry_name", "F6SBJ1_HORSE"), ("length", "451"),
@@ -349,6 +394,176 @@ def test_failure_class():
     assert str(failure) == "Q9JIJ4BYE\nBlahhh\n"
 
 
+def test_record_cache(sb_resources, monkeypatch, capsys):
+    tmp_dir = br.TempDir()
+    cache = Db.RecordCache(path="%s%scache.sqlite" % (tmp_dir.path, os.sep))
+    summary = OrderedDict([("gi_num", "703125407"), ("TaxId", "9544"), ("organism", "Macaca mulatta"),
+                           ("length", "1000"), ("comments", "Foo"), ("status", "live")])
+    seq_rec = sb_resources.get_one("d g").records[0]
+    nuc = Db.Record("XM_015147736.1", gi=703125407, summary=summary, _size=1000, _database="ncbi_nuc",
+                    _type="nucleotide")
+    prot = Db.Record("Q9JIJ4", summary=OrderedDict([("length", 300)]), _size=300, _database="uniprot",
+                     _type="protein")
+    cache.put_many([nuc, prot, Db.Record("123456", gi=123456, _database="ncbi_nuc", _type="gi_num")])
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["full_records"] == 0
+
+    # Versioned, unversioned, and GI lookups
+    lookups = [Db.Record("XM_015147736.1"), Db.Record("XM_015147736"), Db.Record("XM_015147736.2"),
+               Db.Record("703125407"), Db.Record("Q9JIJ4"), Db.Record("Q9JIJ5")]
+    for _rec in lookups:
+        _rec.guess_database()
+    found = cache.get_many(lookups)
+    assert [_rec.accession if _rec else None for _rec in found] == ["XM_015147736.1", "XM_015147736.1", None,
+                                                                     "XM_015147736.1", "Q9JIJ4", None]
+    assert found[0].summary == summary
+    assert type(found[0].summary) == OrderedDict
+    assert found[0].gi == 703125407
+    assert found[0].version == "1"
+    assert found[0].type == "nucleotide"
+    assert not found[0].record
+    assert cache.hits == 4
+    assert cache.misses == 2
+
+    # Sequences are added to the summaries already cached, and full lookups ignore summary-only entries
+    assert cache.get_many(lookups[:1], full=True) == [None]
+    cache.put_many([Db.Record("XM_015147736.1", _database="ncbi_nuc", _record=seq_rec)])
+    found = cache.get_many(lookups[:1], full=True)[0]
+    assert found.summary == summary
+    assert str(found.record.seq) == str(seq_rec.seq)
+    assert found.record.id == seq_rec.id
+    assert cache.stats()["full_records"] == 1
+
+    # Stale entries are ignored and then evicted
+    monkeypatch.setattr(Db, "time", lambda: 10 ** 12)
+    assert cache.get_many(lookups[:1]) == [None]
+    cache.evict()
+    assert cache.stats()["entries"] == 0
+    monkeypatch.undo()
+
+    # Least recently used entries go first once the size limit is passed
+    cache.put_many([nuc])
+    cache.put_many([prot])
+    cache.get_many([lookups[0]])
+    cache.max_size = cache.stats()["bytes"] - 1
+    cache.evict()
+    assert cache.get_many(lookups[:1])[0].accession == "XM_015147736.1"
+    assert cache.get_many([lookups[4]]) == [None]
+
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+    # A file that breaks after startup only switches the cache off
+    capsys.readouterr()
+    with open(cache.path, "wb") as ofile:
+        ofile.write(b"Not a database" * 1000)
+    assert cache.get_many(lookups) == [None] * 6
+    assert not cache.path
+    cache.put_many([nuc])
+    cache.evict()
+    assert cache.stats()["entries"] == 0
+    out, err = capsys.readouterr()
+    assert err.count("Caching is disabled") == 1
+    assert "file is not a database" in err
+
+    def locked():
+        raise Db.sqlite3.OperationalError("database is locked")
+
+    cache = Db.RecordCache(path="%s%scache2.sqlite" % (tmp_dir.path, os.sep))
+    monkeypatch.setattr(cache, "_connect", locked)
+    cache.put_many([nuc])
+    assert not cache.path
+    out, err = capsys.readouterr()
+    assert "(database is locked). Caching is disabled" in err
+
+    # Disabled when there is nowhere to put the file
+    monkeypatch.setitem(Db.CONFIG, "data_dir", False)
+    cache = Db.RecordCache()
+    assert not cache.path
+    cache.put_many([nuc])
+    assert cache.get_many([nuc]) == [None]
+    assert cache.stats()["entries"] == 0
+
+
+def test_session_journal(sb_resources):
+    tmp_dir = br.TempDir()
+    path = "%s%sjournal" % (tmp_dir.path, os.sep)
+    dbbuddy = Db.DbBuddy(",".join(ACCNS))
+    seq_rec = sb_resources.get_one("d g").records[0]
+    dbbuddy.records["XM_003978475"].record = seq_rec
+    dbbuddy.records["XM_003978475"].summary = OrderedDict([("organism", "Fugu")])
+    journal = Db.SessionJournal(path)
+    assert journal.record(dbbuddy) == 0
+    checkpoint_size = os.path.getsize(path)
+    assert checkpoint_size > len(dill.dumps(seq_rec))
+
+    # Moving records into the trash only logs the new order
+    dbbuddy.trash_bin["XM_003978475"] = dbbuddy.records.pop("XM_003978475")
+    assert journal.record(dbbuddy) == 1
+    assert os.path.getsize(path) - checkpoint_size < 1000
+    size = os.path.getsize(path)
+    assert journal.record(dbbuddy) is None
+    assert os.path.getsize(path) == size
+
+    dbbuddy.out_format = "fasta"
+    assert journal.record(dbbuddy) == 2
+    dbbuddy.trash_bin["XM_003978475"].summary["organism"] = "Takifugu"  # In-place changes are picked up too
+    assert journal.record(dbbuddy) == 3
+    assert os.path.getsize(path) - size > len(dill.dumps(seq_rec))
+
+    state = journal.replay()
+    assert list(state["records"]) == list(dbbuddy.records)
+    assert list(state["trash_bin"]) == ["XM_003978475"]
+    assert state["trash_bin"]["XM_003978475"].summary["organism"] == "Takifugu"
+    assert str(state["trash_bin"]["XM_003978475"].record.seq) == str(seq_rec.seq)
+    assert state["out_format"] == "fasta"
+
+    state = journal.replay(1)
+    assert state["out_format"] == "summary"
+    assert state["trash_bin"]["XM_003978475"].summary["organism"] == "Fugu"
+    state = journal.replay(0)
+    assert list(state["records"]) == ACCNS
+    assert not state["trash_bin"]
+
+    # Rewinding is logged without writing the records out again, so a crash right after ends up in the same place
+    size = os.path.getsize(path)
+    assert journal.restore(dbbuddy, 0) == 4
+    assert os.path.getsize(path) - size < 1000
+    assert list(dbbuddy.records) == ACCNS
+    assert dbbuddy.out_format == "summary"
+    assert dbbuddy.records["XM_003978475"].summary["organism"] == "Fugu"
+    assert journal.record(dbbuddy) is None
+    assert list(Db.SessionJournal.load(path).records) == ACCNS
+
+    # A partially written entry (e.g., from a crash) is ignored
+    dbbuddy.out_format = "genbank"
+    journal.record(dbbuddy)
+    with open(path, "rb") as ifile:
+        contents = ifile.read()
+    with open(path, "wb") as ofile:
+        ofile.write(contents[:-5])
+    recovered = Db.SessionJournal.load(path)
+    assert recovered.out_format == "summary"
+    assert list(recovered.records) == ACCNS
+
+    # Compaction
+    journal = Db.SessionJournal(path, compact_size=0)
+    journal.record(dbbuddy)
+    for indx in range(3):
+        dbbuddy.search_terms.append("Foo%s" % indx)
+        assert journal.record(dbbuddy) == indx + 1
+    assert journal.record(dbbuddy) is None
+    journal.checkpoint_size = 0
+    dbbuddy.search_terms.append("Bar")
+    assert journal.record(dbbuddy) == 0
+    assert journal.replay()["search_terms"] == ["Foo0", "Foo1", "Foo2", "Bar"]
+
+    # Plain pickled DbBuddy objects are still read
+    with open(path, "wb") as ofile:
+        dill.dump(Db.DbBuddy("Inx15"), ofile)
+    assert Db.SessionJournal.load(path).search_terms == ["Inx15"]
+
+
 # ##################################################### DB BUDDY ##################################################### #
 # Instantiation
 def test_instantiate_empty_dbbuddy_obj():
@@ -513,6 +728,40 @@ Failures:     0
 """
 
 
+
+def test_filter_records_column_index():
+    dbbuddy = Db.DbBuddy()
+    for indx, accn in enumerate(ACCNS):
+        summary = OrderedDict([("organism", "Danio rerio" if indx % 2 else "Homo sapiens"), ("length", indx * 100)])
+        dbbuddy.records[accn] = Db.Record(accn, summary=summary)
+
+    dbbuddy.filter_records("(organism) Danio", "remove")
+    index = Db._column_index(dbbuddy)
+    assert sorted(index.summary) == ["organism"]  # Columns are only built when a query needs them
+    assert list(dbbuddy.trash_bin) == ACCNS[1::2]
+    assert list(dbbuddy.records) == ACCNS[::2]
+
+    # Moving records between the records and trash bin doesn't invalidate the index
+    dbbuddy.filter_records("(length>=500)", "restore")
+    assert Db._column_index(dbbuddy) is index
+    assert list(dbbuddy.records) == ACCNS[::2] + ACCNS[5::2]
+    assert list(dbbuddy.trash_bin) == ACCNS[1:5:2]
+
+    # Changing a record forces a rebuild
+    dbbuddy.records[ACCNS[0]].summary = OrderedDict([("organism", "Danio rerio")])
+    dbbuddy.filter_records("i?danio", "keep")
+    assert Db._column_index(dbbuddy) is not index
+    assert list(dbbuddy.records) == [ACCNS[0]] + ACCNS[5::2]
+
+    # So do records that the index has never seen
+    index = Db._column_index(dbbuddy)
+    new_dbbuddy = Db.DbBuddy("XP_005165403.9")
+    dbbuddy.records.update(new_dbbuddy.records)
+    dbbuddy.filter_records("XP_", "remove")
+    assert Db._column_index(dbbuddy) is not index
+    assert "XP_005165403.9" in dbbuddy.trash_bin
+    assert "XP_005165403.2" in dbbuddy.trash_bin
+
 def test_record_breakdown():
     dbbuddy = Db.DbBuddy(", ".join(ACCNS))
     for accn, rec in dbbuddy.records.items():
@@ -857,3 +1106,211 @@ def test_retrieve_sequences(monkeypatch, capsys):
     assert "nucleotide" in out
     assert "protein" in out
     assert "ensembl" in out
+
+
+class DelayedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_servers():
+    """Stand-ins for UniProt, NCBI, and Ensembl that take a while to answer"""
+    servers = {}
+    for name in ["uniprot", "ncbi", "ensembl"]:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), DelayedHandler)
+        server.delay = 0.5
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[name] = server
+    Db.rate_limiter("127.0.0.1", 1000)
+    yield servers
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def test_retrieve_fan_out(monkeypatch, capsys, stub_servers):
+    def url(name):
+        return "http://127.0.0.1:%s/%s" % (stub_servers[name].server_address[1], name)
+
+    def search_proteins(self):
+        self.engine.request(url("uniprot"))
+        self.dbbuddy.records["A8XEF9"] = Db.Record("A8XEF9", summary=OrderedDict([("name", "inx-15")]),
+                                                   _database="uniprot", _type="protein")
+        self.dbbuddy.records["O61786"].summary = OrderedDict([("name", "inx-16")])
+
+    def search_ncbi(self, _type):
+        self.engine.request(url("ncbi"))
+        if _type == "nucleotide":
+            # Placeholders are swapped out for the versioned accession
+            rec = self.dbbuddy.records.pop("XM_003978475")
+            rec.accession = "XM_003978475.2"
+            self.dbbuddy.records[rec.accession] = rec
+        else:
+            self.write_error("NCBI request failed: casp9", "HTTP Error 500: Fake error")
+            self.parse_error_file()
+
+    def search_ensembl(self):
+        self.engine.request(url("ensembl"))
+        self.dbbuddy.records["ENSG00000001"] = Db.Record("ENSG00000001", _database="ensembl", _type="nucleotide")
+
+    monkeypatch.setattr(Db.UniProtRestClient, "search_proteins", search_proteins)
+    monkeypatch.setattr(Db.NCBIClient, "search_ncbi", search_ncbi)
+    monkeypatch.setattr(Db.NCBIClient, "fetch_summaries", lambda *_: True)
+    monkeypatch.setattr(Db.EnsemblRestClient, "search_ensembl", search_ensembl)
+    monkeypatch.setattr(Db.EnsemblRestClient, "fetch_summaries", lambda _: True)
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {"http://rest.ensembl.org/": (time.time(), {})})
+
+    dbbuddy = Db.DbBuddy("XM_003978475, O61786, ENSAMEG00000011912, NP_001287575.1")
+    dbbuddy.cache = Db.RecordCache(path=False)
+    start = time.monotonic()
+    Db.retrieve_summary(dbbuddy)
+    # The four requests (two to NCBI) would take 2 seconds one after the other
+    assert time.monotonic() - start < 1.5
+    # Same order as querying the servers one after the other
+    assert list(dbbuddy.records) == ["O61786", "ENSAMEG00000011912", "NP_001287575.1", "A8XEF9", "XM_003978475.2",
+                                     "ENSG00000001"]
+    assert dbbuddy.records["O61786"].summary["name"] == "inx-16"
+    assert len(dbbuddy.failures) == 1
+    for server in ["uniprot", "ncbi", "ensembl"]:
+        assert dbbuddy.server(server).dbbuddy is dbbuddy
+    out, err = capsys.readouterr()
+    assert "UniProt finished (2 records" in err
+    assert "NCBI finished (2 records" in err
+    assert "Ensembl finished (2 records" in err
+
+    # A slow server doesn't hold up the others
+    stub_servers["ensembl"].delay = 3
+    dbbuddy = Db.DbBuddy("XM_003978475, O61786, ENSAMEG00000011912")
+    dbbuddy.cache = Db.RecordCache(path=False)
+    slow_client = dbbuddy.server("ensembl")
+    start = time.monotonic()
+    assert Db._fan_out(dbbuddy, [("uniprot", ["uniprot"], search_proteins),
+                                 ("ensembl", ["ensembl"], search_ensembl)], timeout=1) == ["ensembl"]
+    assert time.monotonic() - start < 2
+    assert list(dbbuddy.records) == ["XM_003978475", "O61786", "ENSAMEG00000011912", "A8XEF9"]
+    out, err = capsys.readouterr()
+    assert "Ensembl did not respond within 1 sec; its results are not included" in err
+
+    # The abandoned client is cancelled, and a fresh one is used next time
+    assert slow_client.engine.cancelled
+    assert dbbuddy.server_clients["ensembl"] is False
+    assert dbbuddy.server("ensembl") is not slow_client
+
+    # Ctrl-C keeps whatever has already finished
+    def interrupt(_):
+        time.sleep(1.5)  # UniProt answers after 0.5 seconds, Ensembl after 3
+        _thread.interrupt_main()
+        time.sleep(1)
+
+    dbbuddy = Db.DbBuddy("XM_003978475, O61786, ENSAMEG00000011912")
+    dbbuddy.cache = Db.RecordCache(path=False)
+    slow_client = dbbuddy.server("ensembl")
+    assert Db._fan_out(dbbuddy, [("uniprot", ["uniprot"], search_proteins), ("ncbi", ["ncbi_nuc"], interrupt),
+                                 ("ensembl", ["ensembl"], search_ensembl)]) == ["ncbi", "ensembl"]
+    assert list(dbbuddy.records) == ["XM_003978475", "O61786", "ENSAMEG00000011912", "A8XEF9"]
+    assert slow_client.engine.cancelled
+    assert dbbuddy.server("ensembl") is not slow_client
+    out, err = capsys.readouterr()
+    assert "Query interrupted by user" in err
+    assert "NCBI was interrupted; its results are not included" in err
+    assert "Ensembl was interrupted; its results are not included" in err
+    with pytest.raises(Db.URLError):
+        slow_client.engine.request(url("uniprot"))
+
+    # Errors are passed on from the worker threads
+    def raise_error(_):
+        raise ValueError("Bad things")
+
+    with pytest.raises(ValueError) as err:
+        Db._fan_out(dbbuddy, [("uniprot", ["uniprot"], raise_error), ("ncbi", ["ncbi_nuc"], lambda _: True)])
+    assert "Bad things" in str(err)
+    assert dbbuddy.server("uniprot").dbbuddy is dbbuddy
+
+
+def test_retrieve_with_cache(monkeypatch, capsys, sb_resources):
+    requested = []
+
+    def fetch_summaries(self, database):
+        for accn, rec in self.dbbuddy.records.items():
+            if rec.database == database:
+                requested.append(accn)
+                rec.summary = OrderedDict([("length", 100)])
+
+    def fetch_sequences(self, database):
+        db = "ncbi_nuc" if database == "nucleotide" else "ncbi_prot"
+        for accn, rec in self.dbbuddy.records.items():
+            if rec.database == db:
+                requested.append(accn)
+                rec.record = sb_resources.get_one("d f").records[0]
+
+    for func in ["search_proteins", "fetch_proteins"]:
+        monkeypatch.setattr(Db.UniProtRestClient, func, lambda *_: True)
+    monkeypatch.setattr(Db.NCBIClient, "search_ncbi", lambda *_: True)
+    monkeypatch.setattr(Db.NCBIClient, "fetch_summaries", fetch_summaries)
+    monkeypatch.setattr(Db.NCBIClient, "fetch_sequences", fetch_sequences)
+    # Skip the species download, but keep the engine that _fan_out() uses to cancel slow clients
+    monkeypatch.setattr(Db.EnsemblRestClient, "__init__", lambda self, *_: setattr(self, "engine", Db.HTTPEngine()))
+    for func in ["search_ensembl", "fetch_summaries", "fetch_nucleotide"]:
+        monkeypatch.setattr(Db.EnsemblRestClient, func, lambda *_: True)
+
+    tmp_dir = br.TempDir()
+    cache = Db.RecordCache(path="%s%scache.sqlite" % (tmp_dir.path, os.sep))
+    cache.put_many([Db.Record("XM_015147736.1", gi=703125407, summary=OrderedDict([("length", 1000)]), _size=1000,
+                              _database="ncbi_nuc", _type="nucleotide")])
+
+    dbbuddy = Db.DbBuddy("NM_001017380.1, XM_015147736, AB000001")
+    dbbuddy.cache = cache
+    Db.retrieve_summary(dbbuddy)
+    assert requested == ["NM_001017380.1", "AB000001"]
+    assert list(dbbuddy.records) == ["NM_001017380.1", "XM_015147736.1", "AB000001"]
+    assert dbbuddy.records["XM_015147736.1"].summary["length"] == 1000
+    assert dbbuddy.records["XM_015147736.1"].gi == 703125407
+    assert "1 summaries retrieved from the local cache" in capsys.readouterr()[1]
+    assert cache.stats()["entries"] == 3
+
+    # Nothing is requested the second time around
+    requested = []
+    dbbuddy = Db.DbBuddy("NM_001017380.1, XM_015147736, AB000001")
+    dbbuddy.cache = cache
+    Db.retrieve_summary(dbbuddy)
+    assert not requested
+    assert list(dbbuddy.records) == ["NM_001017380.1", "XM_015147736.1", "AB000001"]
+    assert cache.hits == 4
+
+    # Sequences
+    Db.retrieve_sequences(dbbuddy)
+    assert requested == ["NM_001017380.1", "XM_015147736.1", "AB000001"]
+    assert cache.stats()["full_records"] == 3
+
+    requested = []
+    dbbuddy = Db.DbBuddy("NM_001017380.1, XM_015147736.1, AB000001")
+    dbbuddy.cache = cache
+    Db.retrieve_sequences(dbbuddy)
+    assert not requested
+    assert str(dbbuddy.records["AB000001"].record.seq) == str(sb_resources.get_one("d f").records[0].seq)
+    assert dbbuddy.records["AB000001"].summary["length"] == 100
+
+    # Offline mode never calls the clients
+    dbbuddy = Db.DbBuddy("NM_001017380.1, XM_015147737.1, casp9")
+    dbbuddy.cache = cache
+    dbbuddy.cache.offline = True
+    monkeypatch.setattr(Db.NCBIClient, "__init__", lambda *_: pytest.fail("Offline mode went online"))
+    capsys.readouterr()
+    Db.retrieve_summary(dbbuddy)
+    Db.retrieve_sequences(dbbuddy)
+    err = capsys.readouterr()[1]
+    assert "Offline mode: 1 records are not in the local cache" in err
+    assert "Offline mode: search terms were not sent to the servers" in err
+    assert dbbuddy.records["NM_001017380.1"].record
+    assert not dbbuddy.records["XM_015147737.1"].summary
@@ -6,9 +6,13 @@ import tempfile
 import re
 import json
 import os
+import time
+import threading
+import socket
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import buddy_resources as br
 import DatabaseBuddy as Db
-from io import StringIO
+from io import StringIO, BytesIO
 
 
 def patched_close(self):  # This suppresses an 'ignored' exception
@@ -118,13 +122,159 @@ def mock_raise_keyboardinterrupt(*args, **kwargs):
 
 
 # ################################################# Database Clients ################################################# #
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    hits = {}
+    client_ports = set()
+
+    def _respond(self, code, body=b"", headers=None):
+        self.send_response(code)
+        for key, value in (headers if headers else {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        StubHandler.client_ports.add(self.client_address[1])
+        StubHandler.hits[self.path] = StubHandler.hits.get(self.path, 0) + 1
+        if self.path.startswith("/ok"):
+            self._respond(200, self.path.encode())
+        elif self.path == "/busy" and StubHandler.hits[self.path] < 3:
+            self._respond(429, b"Slow down", {"Retry-After": "0.1"})
+        elif self.path == "/flaky" and StubHandler.hits[self.path] < 3:
+            self._respond(503, b"Service unavailable")
+        elif self.path in ["/busy", "/flaky"]:
+            self._respond(200, b"Finally")
+        elif self.path == "/redirect":
+            self._respond(302, headers={"Location": "/ok/redirected"})
+        else:
+            self._respond(404, b"Not found")
+
+    def do_POST(self):
+        self._respond(200, self.rfile.read(int(self.headers["Content-Length"])))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_server():
+    StubHandler.hits, StubHandler.client_ports = {}, set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Db.rate_limiter("127.0.0.1", 1000)
+    yield "http://127.0.0.1:%s" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_rate_limiter(monkeypatch):
+    limiter = Db.RateLimiter(20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert 0.15 < time.monotonic() - start < 1
+
+    limiter.pause(0.3)
+    assert limiter.acquire() > 0.2
+
+    limiter = Db.RateLimiter(20, burst=5)
+    time.sleep(0.1)
+    assert [limiter.acquire() for _ in range(5)] == [0] * 5
+
+    assert Db.rate_limiter("eutils.ncbi.nlm.nih.gov").rate == 3
+    assert Db.rate_limiter("eutils.ncbi.nlm.nih.gov") is Db.rate_limiter("eutils.ncbi.nlm.nih.gov")
+    assert Db.rate_limiter("eutils.ncbi.nlm.nih.gov", 10).rate == 10
+    assert Db.rate_limiter("www.example.com").rate == 10
+
+
+def test_http_engine(stub_server):
+    engine = Db.HTTPEngine(backoff=0.01, max_attempts=3)
+    assert engine.request("%s/ok" % stub_server) == b"/ok"
+    assert engine.request("%s/ok/again" % stub_server) == b"/ok/again"
+    assert len(StubHandler.client_ports) == 1  # Same connection was reused
+
+    assert engine.request("%s/redirect" % stub_server) == b"/ok/redirected"
+    assert engine.request("%s/echo" % stub_server, data=b'{"ids": ["Foo"]}') == b'{"ids": ["Foo"]}'
+
+    # Busy and flaky servers are retried until they come through
+    start = time.monotonic()
+    assert engine.request("%s/busy" % stub_server) == b"Finally"
+    assert time.monotonic() - start > 0.2
+    assert engine.request("%s/flaky" % stub_server) == b"Finally"
+    assert StubHandler.hits["/busy"] == StubHandler.hits["/flaky"] == 3
+
+    with pytest.raises(HTTPError) as err:
+        engine.request("%s/missing" % stub_server)
+    assert "HTTP Error 404: Not Found" in str(err.value)
+    assert StubHandler.hits["/missing"] == 1
+
+    StubHandler.hits = {}
+    with pytest.raises(HTTPError) as err:
+        Db.HTTPEngine(backoff=0.01, max_attempts=2).request("%s/flaky" % stub_server)
+    assert "HTTP Error 503" in str(err.value)
+
+    # The server hanging up on an idle connection is handled transparently
+    engine.close()
+    assert engine.request("%s/ok" % stub_server) == b"/ok"
+
+    with pytest.raises(URLError):
+        Db.HTTPEngine(backoff=0.01, max_attempts=2).request("http://127.0.0.1:1/ok")
+
+    # No point waiting around if the host name can't even be resolved
+    calls = []
+
+    def no_dns(*args):
+        calls.append(args)
+        raise URLError(socket.gaierror(-2, "Name or service not known"))
+
+    dns_engine = Db.HTTPEngine(backoff=10, max_attempts=5)
+    dns_engine._send = no_dns
+    with pytest.raises(URLError):
+        dns_engine.request("http://rest.ensembl.org/info/species")
+    assert len(calls) == 1
+
+    # Threads
+    results = engine.run(range(20), lambda indx: engine.request("%s/ok/%s" % (stub_server, indx)))
+    assert results == [("/ok/%s" % indx).encode() for indx in range(20)]
+    assert engine.run(["a", "b"], lambda next_iter, args: next_iter + args[0], ["c"]) == ["ac", "bc"]
+    assert engine.run([], print) == []
+
+
+def test_uniprotrestclient_stub_server(stub_server):
+    dbbuddy = Db.DbBuddy()
+    client = Db.UniProtRestClient(dbbuddy, server="%s/ok" % stub_server)
+    client.engine.run(["inx15", "inx16"], client.query_uniprot, [{"format": "list"}])
+    assert client.results_file.read().count("# Search: ") == 2
+    assert "/ok?query=inx15&format=list" in client.results_file.read()
+
+    client = Db.UniProtRestClient(dbbuddy, server="%s/missing" % stub_server)
+    client.query_uniprot("inx15", {"format": "list"})
+    assert "Uniprot search failed for 'inx15'\nHTTP Error 404: Not Found" in client.http_errors_file.read()
+
+
+def test_results_buffer():
+    results = Db.ResultsBuffer()
+    results.write("foo\n")
+    results.write("bar\n")
+    assert results.read() == "foo\nbar\n"
+    assert results.get_handle("r").read() == "foo\nbar\n"
+    results.write("baz", "w")
+    assert results.read() == "baz"
+    results.clear()
+    assert results.read() == ""
+
+
 # Generic
 def test_client_init():
     dbbuddy = Db.DbBuddy(", ".join(ACCNS[3:6]))
     client = Db.GenericClient(dbbuddy)
     assert hash(dbbuddy) == hash(client.dbbuddy)
-    assert type(client.http_errors_file) == br.TempFile
-    assert type(client.results_file) == br.TempFile
+    assert type(client.http_errors_file) == Db.ResultsBuffer
+    assert type(client.results_file) == Db.ResultsBuffer
+    assert type(client.engine) == Db.HTTPEngine
     assert client.max_url == 1000
     with client.lock:
         assert True
@@ -172,15 +322,16 @@ def test_uniprotrestclient_init():
     client = Db.UniProtRestClient(dbbuddy)
     assert hash(dbbuddy) == hash(client.dbbuddy)
     assert client.server == 'http://www.uniprot.org/uniprot'
-    assert type(client.http_errors_file) == br.TempFile
-    assert type(client.results_file) == br.TempFile
+    assert type(client.http_errors_file) == Db.ResultsBuffer
+    assert type(client.results_file) == Db.ResultsBuffer
+    assert type(client.engine) == Db.HTTPEngine
     assert client.max_url == 1000
 
 
 def test_uniprotrestclient_query_uniprot(capsys, monkeypatch):
     dbbuddy = Db.DbBuddy()
     client = Db.UniProtRestClient(dbbuddy)
-    monkeypatch.setattr(Db, 'urlopen', mock_urlopen_handle_uniprot_ids)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', lambda *args: mock_urlopen_handle_uniprot_ids(*args).read())
     client.query_uniprot("inx15", {"format": "list"})
 
     assert client.results_file.read() == '''# Search: inx15
@@ -190,24 +341,24 @@ A0A0H5SBJ0
 //
 '''
     # Also make sure request_params can come in as a list
-    monkeypatch.setattr(Db, 'urlopen', mock_urlopen_handle_uniprot_ids)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', lambda *args: mock_urlopen_handle_uniprot_ids(*args).read())
     client.query_uniprot("inx15", [{"format": "list"}])
 
     # Errors
-    monkeypatch.setattr(Db, 'urlopen', mock_raise_httperror)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', mock_raise_httperror)
     client.query_uniprot("inx15", [{"format": "list"}])
     assert client.http_errors_file.read() == "Uniprot search failed for 'inx15'\nHTTP Error 101: " \
                                              "Fake HTTPError from Mock\n//\n"
 
-    monkeypatch.setattr(Db, 'urlopen', mock_raise_urlerror_8)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', mock_raise_urlerror_8)
     client.query_uniprot("inx15", [{"format": "list"}])
     assert "Uniprot request failed, are you connected to the internet?" in client.http_errors_file.read()
 
-    monkeypatch.setattr(Db, 'urlopen', mock_raise_urlerror)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', mock_raise_urlerror)
     client.query_uniprot("inx15", [{"format": "list"}])
     assert "<urlopen error Fake URLError from Mock>" in client.http_errors_file.read()
 
-    monkeypatch.setattr(Db, 'urlopen', mock_raise_keyboardinterrupt)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', mock_raise_keyboardinterrupt)
     client.query_uniprot("inx15", [{"format": "list"}])
     out, err = capsys.readouterr()
     assert "\n\tUniProt query interrupted by user\n" in err
@@ -219,14 +370,14 @@ A0A0H5SBJ0
 def test_uniprotrestclient_count_hits(monkeypatch):
     dbbuddy = Db.DbBuddy("inx15,inx16")
     client = Db.UniProtRestClient(dbbuddy)
-    monkeypatch.setattr(Db, 'urlopen', mock_urlopen_uniprot_count_hits)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', lambda *args: mock_urlopen_uniprot_count_hits(*args).read())
     assert client.count_hits() == 10
 
     for indx in range(10):
         client.dbbuddy.search_terms.append("a" * 110)
     assert client.count_hits() == 20
 
-    monkeypatch.setattr(Db, 'urlopen', mock_raise_httperror)
+    monkeypatch.setattr(Db.HTTPEngine, 'request', mock_raise_httperror)
     assert client.count_hits() == 0
     assert "d3b8e6bb4b9094117b7555b01dc85f64" in client.dbbuddy.failures
 
@@ -283,7 +434,7 @@ E3MGD6	E3MGD6_CAERE	384	31234	Caenorhabditis remanei (Caenorhabditis vulgaris)	I
     assert "Uniprot returned no results\n\n" in err
 
     monkeypatch.setattr(Db.UniProtRestClient, "count_hits", lambda _: 9)
-    monkeypatch.setattr(br, "run_multicore_function", patch_query_uniprot_multi)
+    monkeypatch.setattr(Db.HTTPEngine, "run", patch_query_uniprot_multi)
     client1.search_proteins()
     out, err = capsys.readouterr()
     assert "Retrieving summary data for 9 records from UniProt\n" in err
@@ -326,18 +477,18 @@ similarities (1); Subcellular location (1)
 //''', "w")
         return
 
-    def patch_query_uniprot_fetch(*args, **kwargs):
-        print("patch_query_uniprot_fetch\nargs: %s\nkwargs: %s" % (args, kwargs))
+    def patch_request_fetch(*args, **kwargs):
+        print("patch_request_fetch\nargs: %s\nkwargs: %s" % (args, kwargs))
+        requests.append(args[1])
         with open("%s/mock_resources/test_databasebuddy_clients/uniprot_fetch.txt" % hf.resource_path, "r") \
                 as ifile:
-            client.results_file.write(ifile.read(), "w")
-        return
+            records = ifile.read().split("//\n")[:-1]
+        records = ["%s//\n" % re.sub("# Search.*?\n", "", rec) for rec in records]
+        # Only send back what was asked for
+        return "".join([rec for rec in records if re.search("AC   .*(%s);" % "|".join(accns(args[1])), rec)]).encode()
 
-    def patch_query_uniprot_fetch_nothing(*args, **kwargs):
-        print("patch_query_uniprot_fetch_nothing\nargs: %s\nkwargs: %s" % (args, kwargs))
-        client.results_file.write("# Search: A8XEF9,O61786,A0A0H5SBJ0,E3MGD6,O61787,A0A0V1AZ11,A8XEF8,A0A0B2VB60,"
-                                  "A0A0V0W5E2\n//\n//", "w")
-        return
+    def accns(url):
+        return re.search("query=(.*?)&", url).group(1).split(",")
 
     monkeypatch.setattr(Db.UniProtRestClient, "query_uniprot", lambda _: True)
     dbbuddy = Db.DbBuddy("inx15,inx16")
@@ -348,27 +499,46 @@ similarities (1); Subcellular location (1)
     assert client.results_file.read() == ""
     assert "full records from UniProt..." not in err
 
-    # Test a single call to query_uniprot
+    # Test a single request
+    requests = []
     monkeypatch.setattr(Db.UniProtRestClient, "query_uniprot", patch_query_uniprot_search)
     client.search_proteins()
-    monkeypatch.setattr(Db.UniProtRestClient, "query_uniprot", patch_query_uniprot_fetch)
+    monkeypatch.setattr(Db.HTTPEngine, "request", patch_request_fetch)
     client.fetch_proteins()
     out, err = capsys.readouterr()
     assert "Requesting 9 full records from UniProt..." in err
+    assert len(requests) == 1
+    assert "format=txt" in requests[0]
+    for accn, rec in client.dbbuddy.records.items():
+        assert rec.record.id == accn
+    # Nothing is buffered
+    assert client.results_file.read() == ""
 
-    # Test multicore call to query_uniprot
-    monkeypatch.setattr(br, "run_multicore_function", patch_query_uniprot_fetch)
+    # Several requests at once, with records attached as each response is parsed
+    requests = []
     for accn, rec in client.dbbuddy.records.items():
         rec.record = None
-    client.dbbuddy.records["a" * 999] = Db.Record("a" * 999, _database="uniprot")
+    client.max_url = 40
+    client.dbbuddy.records["a" * 30] = Db.Record("a" * 30, _database="uniprot")
     client.fetch_proteins()
     out, err = capsys.readouterr()
     assert "Requesting 10 full records from UniProt..." in err
+    assert len(requests) == 3
+    assert sorted([accn for url in requests for accn in accns(url)]) == sorted(client.dbbuddy.records)
     seq = str(client.dbbuddy.records["A8XEF9"].record.seq)
     assert hf.string2hash(seq) == "04f13629336cf6cdd5859c8913b742a5"
+    assert not client.dbbuddy.records["a" * 30].record
+
+    # Merged entries are matched through their secondary accessions
+    client.dbbuddy.records = OrderedDict([("Q9XTF6", Db.Record("Q9XTF6", _database="uniprot"))])
+    monkeypatch.setattr(Db.HTTPEngine, "request", lambda *args: patch_request_fetch(None, "?query=O61787&").replace(
+        b"AC   O61787;", b"AC   O61787; Q9XTF6;"))
+    client.fetch_proteins()
+    assert client.dbbuddy.records["Q9XTF6"].record.id == "O61787"
 
     # Some edge cases
-    monkeypatch.setattr(Db.UniProtRestClient, "query_uniprot", patch_query_uniprot_fetch_nothing)
+    client.max_url = 1000
+    monkeypatch.setattr(Db.HTTPEngine, "request", lambda *args: b"\n")
     client.http_errors_file.write("inx15\n%s\n//\n" % URLError("Fake URLError from Mock"))
 
     client.dbbuddy.records = OrderedDict([("a" * 999, Db.Record("a" * 999, _database="uniprot"))])
@@ -379,6 +549,12 @@ similarities (1); Subcellular location (1)
     assert "The following errors were encountered while querying UniProt with fetch_proteins():" in err
     assert hf.string2hash(str(client.dbbuddy.records["a" * 999])) == "670bf9c6ae5832b42841798d882a7276"
 
+    monkeypatch.setattr(Db.HTTPEngine, "request", mock_raise_httperror)
+    client.fetch_proteins()
+    out, err = capsys.readouterr()
+    assert "No sequences returned\n\n" in err
+    assert "Uniprot search failed for 'aaaa" in err
+
     with pytest.raises(ValueError) as err:
         client.dbbuddy.records["a" * 1001] = Db.Record("a" * 1001, _database="uniprot")
         client.fetch_proteins()
@@ -392,201 +568,309 @@ def test_ncbiclient_init():
     assert client.Entrez.email == br.config_values()['email']
     assert client.Entrez.tool == "buddysuite"
     assert hash(dbbuddy) == hash(client.dbbuddy)
-    assert type(client.http_errors_file) == br.TempFile
-    assert type(client.results_file) == br.TempFile
+    assert type(client.http_errors_file) == Db.ResultsBuffer
+    assert type(client.results_file) == Db.ResultsBuffer
+    assert type(client.engine) == Db.HTTPEngine
     assert client.max_url == 1000
     assert client.max_attempts == 5
-
-
-def test_ncbiclient_mc_query(hf, monkeypatch):
-    def patch_entrez_esummary_taxa(*args, **kwargs):
-        print("patch_entrez_esummary_taxa\nargs: %s\nkwargs: %s" % (args, kwargs))
-        test_file = "%s/mock_resources/test_databasebuddy_clients/Entrez_esummary_taxa.xml" % hf.resource_path
-        return open(test_file, "r")
-
-    def patch_entrez_efetch_gis(*args, **kwargs):
-        print("patch_entrez_efetch_gis\nargs: %s\nkwargs: %s" % (args, kwargs))
-        tmp_file = br.TempFile()
-        tmp_file.write("703125407\n703125412\n67586143\n")
-        return tmp_file.get_handle("r")
-
-    def patch_entrez_esummary_seq(*args, **kwargs):
-        print("patch_entrez_esummary_seq\nargs: %s\nkwargs: %s" % (args, kwargs))
-        test_file = "%s/mock_resources/test_databasebuddy_clients/Entrez_esummary_seq.xml" % hf.resource_path
-        return open(test_file, "r")
-
-    def patch_entrez_efetch_seq(*args, **kwargs):
-        print("patch_entrez_efetch_seq\nargs: %s\nkwargs: %s" % (args, kwargs))
-        test_file = "%s/mock_resources/test_databasebuddy_clients/Entrez_efetch_seq.gb" % hf.resource_path
-        return open(test_file, "r")
-
+    assert client.summary_page == 1000
+    assert client.sequence_page == 200
+    assert client.post_size == 10000
+    assert client.taxa == {}
+
+
+# Mock E-utilities server. Search hits and posted IDs are kept on a fake history server, and pages are sliced out of the
+# esummary/efetch resource files with retstart/retmax, the same way NCBI does it.
+def mock_history(query_key, count, tag="ePostResult"):
+    return BytesIO(('''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE %s PUBLIC "-//NLM//DTD ePostResult, 11 May 2002//EN" \
+"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20020511/ePost_020511.dtd">
+<%s>
+    <Count>%s</Count>
+    <QueryKey>%s</QueryKey>
+    <WebEnv>NCID_1_FAKE_WEBENV</WebEnv>
+</%s>
+''' % (tag, tag, count, query_key, tag)).encode("utf-8"))
+
+
+class MockEntrez(object):
+    def __init__(self, hf):
+        self.resources = "%s/mock_resources/test_databasebuddy_clients/" % hf.resource_path
+        self.history = {}
+        self.calls = []
+
+    def page(self, file_name, kwargs):
+        with open(self.resources + file_name, "r") as ifile:
+            contents = ifile.read()
+        if file_name.endswith(".xml"):
+            head, docsums = contents.split("<DocSum>", 1)
+            recs = ["<DocSum>%s" % x.replace("</eSummaryResult>", "") for x in docsums.split("<DocSum>")]
+            head, tail = head, "</eSummaryResult>\n"
+        else:
+            recs = ["%s\n//\n" % x.strip() for x in contents.split("//\n") if x.strip()]
+            head, tail = "", ""
+        ids = self.history.get(kwargs.get("query_key"))
+        if ids:  # Posted IDs only pull down the matching records
+            recs = [rec for rec in recs if [_id for _id in ids if re.search(r"\b%s\b" % re.escape(_id), rec)]]
+        start = int(kwargs.get("retstart", 0))
+        end = start + int(kwargs.get("retmax", len(recs)))
+        return BytesIO(("%s%s%s" % (head, "".join(recs[start:end]), tail)).encode("utf-8"))
+
+    def esearch(self, **kwargs):
+        self.calls.append(("esearch", kwargs))
+        assert kwargs["usehistory"] == "y"
+        self.history[str(len(self.history) + 1)] = None
+        return mock_history(len(self.history), 3, "eSearchResult")
+
+    def epost(self, **kwargs):
+        self.calls.append(("epost", kwargs))
+        self.history[str(len(self.history) + 1)] = kwargs["id"].split(",")
+        return mock_history(len(self.history), len(kwargs["id"].split(",")))
+
+    def esummary(self, **kwargs):
+        self.calls.append(("esummary", kwargs))
+        if kwargs["db"] == "taxonomy":
+            return self.page("Entrez_esummary_taxa.xml", {})
+        assert kwargs["WebEnv"] == "NCID_1_FAKE_WEBENV"
+        return self.page("Entrez_esummary_seq.xml", kwargs)
+
+    def efetch(self, **kwargs):
+        self.calls.append(("efetch", kwargs))
+        assert kwargs["WebEnv"] == "NCID_1_FAKE_WEBENV"
+        return self.page("Entrez_efetch_seq.gb", kwargs)
+
+
+def test_ncbiclient_entrez(hf, monkeypatch):
     monkeypatch.setattr(Db, "sleep", lambda _: True)  # No need to wait around for stuff...
+    mock_entrez = MockEntrez(hf)
+    monkeypatch.setattr(Db, "rate_limiter", lambda host, rate=None: Db.RateLimiter(1000))
     dbbuddy = Db.DbBuddy()
     client = Db.NCBIClient(dbbuddy)
 
-    monkeypatch.setattr(Db.Entrez, "esummary", patch_entrez_esummary_taxa)
-    client._mc_query("649,734,1009,2302", ["esummary_taxa"])
-    assert hf.string2hash(client.results_file.read()) == "acfb85bbdf7c2f8ea7e925c5bfcaaf06"
-    client.results_file.clear()
-
-    monkeypatch.setattr(Db.Entrez, "efetch", patch_entrez_efetch_gis)
-    client._mc_query("XP_010103297.1,XP_010103298.1,XP_010103299.1", ["efetch_gi"])
-    assert client.results_file.read() == "703125407\n703125412\n67586143\n### END ###\n"
-    client.results_file.clear()
+    monkeypatch.setattr(Db.Entrez, "esummary", mock_entrez.esummary)
+    result = client._entrez("esummary", db="taxonomy", id="649,734,1009,2302")
+    assert type(result) == bytes
+    assert "<Item Name=\"ScientificName\" Type=\"String\">Morus notabilis</Item>" in result.decode()
 
-    monkeypatch.setattr(Db.Entrez, "esummary", patch_entrez_esummary_seq)
-    client._mc_query("703125407,703125412,67586143", ["esummary_seq"])
-    assert hf.string2hash(client.results_file.read()) == "e6ba80b5fe2f35002ac2227ca7791c17"
-    client.results_file.clear()
+    monkeypatch.setattr(Db.Entrez, "epost", mock_entrez.epost)
+    result = client._entrez("epost", db="protein", id="703125407,703125412,67586143")
+    assert client._history(result) == ("NCID_1_FAKE_WEBENV", "1", 3)
+    assert client._history(b"<ERROR>Empty result - nothing to do</ERROR>") is None
+    assert client._history(None) is None
 
-    monkeypatch.setattr(Db.Entrez, "efetch", patch_entrez_efetch_seq)
-    client._mc_query("703125407,703125412,67586143", ["efetch_seq"])
-    assert hf.string2hash(client.results_file.read()) == "0154d7bd9d47ca6abac00f25428b9e7e"
-
-    monkeypatch.undo()
-    monkeypatch.setattr(Db, "sleep", lambda _: True)
-    with pytest.raises(ValueError) as err:
-        client._mc_query("703125407", ["foo"])
-    assert "'tool' argument must be in 'esummary_taxa', 'efetch_gi', 'esummary_seq', or 'efetch_seq'" in str(err)
+    # Plain text handles are converted to bytes
+    monkeypatch.setattr(Db.Entrez, "efetch", lambda **kwargs: StringIO("LOCUS Foo\n//\n"))
+    assert client._entrez("efetch", db="protein", id="703125407") == b"LOCUS Foo\n//\n"
 
     with pytest.raises(ValueError) as err:
-        client._mc_query("703125407", ["foo", "Bar"])
-    assert "Unknown type 'Bar', choose between 'nucleotide' and 'protein" in str(err)
+        client._entrez("foo", id="703125407")
+    assert "'tool' argument must be in 'esearch', 'epost', 'esummary', or 'efetch'" in str(err)
 
     monkeypatch.setattr(Db.Entrez, "efetch", mock_raise_httperror)
-    client._mc_query("703125407,703125412,67586143", ["efetch_seq"])
+    assert client._entrez("efetch", db="protein", id="703125407,703125412,67586143") is None
     assert "NCBI request failed: 703125407,703125412,67586143\nHTTP Error 101: Fake HTTPError from Mock\n//" \
            in client.http_errors_file.read()
 
     assert "Service unavailable" not in client.http_errors_file.read()
     monkeypatch.setattr(Db.Entrez, "efetch", mock_raise_503_httperror)
-    client._mc_query("703125407", ["efetch_seq"])
-    assert "Service unavailable" in client.http_errors_file.read()
+    client._entrez("efetch", db="protein", WebEnv="NCID_1_FAKE_WEBENV", query_key="1", retstart=200, retmax=200)
+    assert "NCBI request failed: protein 200-400\nHTTP Error 503: Service unavailable" in client.http_errors_file.read()
 
     monkeypatch.setattr(Db.Entrez, "efetch", mock_raise_connectionreseterror)
-    client._mc_query("703125407", ["efetch_seq"])
+    client._entrez("efetch", db="protein", id="703125407")
     assert "NCBI request failed: 703125407\nFake ConnectionResetError from Mock: [Errno 54] Connection reset by peer"\
            in client.http_errors_file.read()
 
     assert "are you connected to the internet?" not in client.http_errors_file.read()
     monkeypatch.setattr(Db.Entrez, "efetch", mock_raise_urlerror_8)
-    client._mc_query("703125407", ["efetch_seq"])
+    client._entrez("efetch", db="protein", id="703125407")
     assert "are you connected to the internet?" in client.http_errors_file.read()
 
     assert "<urlopen error Fake URLError from Mock>" not in client.http_errors_file.read()
     monkeypatch.setattr(Db.Entrez, "efetch", mock_raise_urlerror)
-    client._mc_query("703125407", ["efetch_seq"])
+    client._entrez("efetch", db="protein", id="703125407")
     assert "<urlopen error Fake URLError from Mock>" in client.http_errors_file.read()
 
 
-def test_ncbiclient_search_ncbi(hf, monkeypatch, capsys):
-    def patch_entrez_esearch(*args, **kwargs):
-        print("patch_entrez_esearch\nargs: %s\nkwargs: %s" % (args, kwargs))
-        if "rettype" in kwargs:
-            test_file = br.TempFile()
-            test_file.write("""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" \
-"http://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">
-<eSearchResult>
-    <Count>5</Count>
-</eSearchResult>
-""")
-            handle = test_file.get_handle(mode="r")
-        else:
-            handle = open("%s/mock_resources/test_databasebuddy_clients/Entrez_esearch.xml" % hf.resource_path,
-                          "r")
-        return handle
+def test_ncbiclient_post(hf, monkeypatch):
+    mock_entrez = MockEntrez(hf)
+    monkeypatch.setattr(Db, "rate_limiter", lambda host, rate=None: Db.RateLimiter(1000))
+    monkeypatch.setattr(Db.Entrez, "epost", mock_entrez.epost)
+    client = Db.NCBIClient(Db.DbBuddy())
+    client.post_size = 2
+    histories = client._post("protein", ["703125407", "703125412", "67586143", "XP_010103297.1", "AAY72386.1"])
+    assert histories == [("NCID_1_FAKE_WEBENV", "1", 2), ("NCID_1_FAKE_WEBENV", "2", 2),
+                         ("NCID_1_FAKE_WEBENV", "3", 1)]
+    assert [kwargs["id"] for tool, kwargs in mock_entrez.calls] == ["703125407,703125412",
+                                                                   "67586143,XP_010103297.1", "AAY72386.1"]
+    # Later batches are added to the same history server session
+    assert "WebEnv" not in mock_entrez.calls[0][1]
+    assert mock_entrez.calls[1][1]["WebEnv"] == "NCID_1_FAKE_WEBENV"
+
+
+def test_ncbiclient_stream_pages():
+    client = Db.NCBIClient(Db.DbBuddy())
+    processed = []
+
+    def fetch_page(retstart):
+        time.sleep(0.05 if retstart in [0, 20] else 0)  # Make the early pages come back last
+        return None if retstart == 30 else "page %s" % retstart
+
+    client._stream_pages([0, 10, 20, 30, 40, 50], fetch_page, processed.append)
+    assert processed == ["page 0", "page 10", "page 20", "page 40", "page 50"]
+
+
 
-    monkeypatch.setattr(Db.Entrez, "esearch", patch_entrez_esearch)
-    monkeypatch.setattr(Db.NCBIClient, "fetch_summaries", lambda _: True)
+def test_ncbiclient_page_summaries_errors(hf, monkeypatch):
+    mock_entrez = MockEntrez(hf)
+    mock_entrez.history["1"] = None
+    error_page = b'<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary ' \
+                 b'v1 20041029//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20041029/esummary-v1.dtd">\n' \
+                 b'<eSummaryResult><ERROR>Invalid uid</ERROR></eSummaryResult>\n'
+    dbbuddy = Db.DbBuddy()
+    client = Db.NCBIClient(dbbuddy)
+    client.summary_page = 2
+
+    def entrez(tool, **kwargs):
+        if kwargs["db"] == "taxonomy":  # Failed requests are reported by _entrez() itself
+            client.write_error("NCBI request failed: taxonomy", "HTTP Error 500: Fake error")
+            return None
+        if kwargs["retstart"] == 2:
+            return error_page
+        return getattr(mock_entrez, tool)(**kwargs).read()
+
+    monkeypatch.setattr(client, "_entrez", entrez)
+    # Errors are written from the worker threads, so they must not wait on the lock held while merging pages
+    worker = threading.Thread(target=lambda: client._page_summaries("protein", "ncbi_prot",
+                                                                    ("NCID_1_FAKE_WEBENV", "1", 4)), daemon=True)
+    worker.start()
+    worker.join(10)
+    assert not worker.is_alive()
+    assert list(dbbuddy.records) == ["XP_010103297.1", "XP_010103298.1"]
+    assert dbbuddy.records["XP_010103297.1"].summary["organism"] == "Unclassified"
+    errors = client.http_errors_file.read()
+    assert "NCBI esummary failed\nInvalid uid" in errors
+    assert "NCBI request failed: taxonomy" in errors
+
+def test_ncbiclient_search_ncbi(hf, monkeypatch, capsys):
+    mock_entrez = MockEntrez(hf)
+    monkeypatch.setattr(Db, "rate_limiter", lambda host, rate=None: Db.RateLimiter(1000))
+    monkeypatch.setattr(Db.Entrez, "esearch", mock_entrez.esearch)
+    monkeypatch.setattr(Db.Entrez, "esummary", mock_entrez.esummary)
     monkeypatch.setattr(Db, "sleep", lambda _: True)
     dbbuddy = Db.DbBuddy("909549231")
     client = Db.NCBIClient(dbbuddy)
     dbbuddy.search_terms = []
     client.search_ncbi("protein")
     assert len(dbbuddy.records) == 1
+    assert not mock_entrez.calls
+
+    # Summaries are paged straight off of the history server, without a separate fetch_summaries() call
+    dbbuddy.search_terms = ["'casp9'"]
+    with pytest.raises(ValueError) as err:
+        client.search_ncbi("foo")
+    assert "Unknown type 'foo', choose between 'nucleotide' and 'protein" in str(err)
 
-    dbbuddy.search_terms = ["casp9"]
+    client.summary_page = 2
     client.search_ncbi("protein")
-    for accn in ["909549231", "909549227", "909549224", "909546647", "306819620"]:
-        assert accn in dbbuddy.records
+    assert list(dbbuddy.records) == ["909549231", "XP_010103297.1", "XP_010103298.1", "AAY72386.1"]
+    assert dbbuddy.records["XP_010103297.1"].summary["organism"] == "Morus notabilis"
+    assert dbbuddy.records["XP_010103297.1"].database == "ncbi_prot"
+    assert mock_entrez.calls[0] == ("esearch", {"db": "protein", "term": "casp9", "usehistory": "y", "retmax": 0})
+    pages = [kwargs["retstart"] for tool, kwargs in mock_entrez.calls if tool == "esummary" and "WebEnv" in kwargs]
+    assert sorted(pages) == [0, 2]
+    # Taxa are only looked up once
+    assert len([tool for tool, kwargs in mock_entrez.calls if kwargs["db"] == "taxonomy"]) == 1
+    out, err = capsys.readouterr()
+    assert "Retrieving 3 protein record summaries from NCBI for ''casp9''..." in err
+    assert "3 records received." in err
 
     monkeypatch.setattr(Db.Entrez, "esearch", mock_raise_keyboardinterrupt)
     client.search_ncbi("protein")
     out, err = capsys.readouterr()
+    assert "NCBI query interrupted by user" in err
     assert 'NCBI returned no protein results' in err
 
 
 def test_ncbiclient_fetch_summaries(hf, monkeypatch):
-    def patch_entrez_fetch_summaries(*args, **kwargs):
-        print("patch_entrez_fetch_summaries\nargs: %s\nkwargs: %s" % (args, kwargs))
-        if kwargs["func_args"] == ["esummary_seq"]:
-            test_file = "%s/mock_resources/test_databasebuddy_clients/Entrez_esummary_seq.xml" % hf.resource_path
-            with open(test_file, "r") as ifile:
-                client.results_file.write(ifile.read().strip())
-                client.results_file.write('\n### END ###\n')
-        elif kwargs["func_args"] == ["esummary_taxa"]:
-            test_file = "%s/mock_resources/test_databasebuddy_clients/Entrez_esummary_taxa.xml" % hf.resource_path
-            with open(test_file, "r") as ifile:
-                client.results_file.write(ifile.read().strip())
-                client.results_file.write('\n### END ###\n')
-        elif kwargs["func_args"] == ["efetch_gi"]:
-            client.results_file.write("""703125407
-703125412
-67586143
-### END ###
-""")
-        return
+    mock_entrez = MockEntrez(hf)
+    monkeypatch.setattr(Db, "rate_limiter", lambda host, rate=None: Db.RateLimiter(1000))
+    monkeypatch.setattr(Db.Entrez, "epost", mock_entrez.epost)
+    monkeypatch.setattr(Db.Entrez, "esummary", mock_entrez.esummary)
 
     # No records to fetch
     dbbuddy = Db.DbBuddy()
     client = Db.NCBIClient(dbbuddy)
     client.fetch_summaries("ncbi_prot")
     assert not client.dbbuddy.records
+    assert not mock_entrez.calls
 
-    monkeypatch.setattr(Db.NCBIClient, "_mc_query", patch_entrez_fetch_summaries)
     dbbuddy = Db.DbBuddy("XP_010103297,XP_010103298.1,67586143,257467473")
     client = Db.NCBIClient(dbbuddy)
     client.fetch_summaries("ncbi_prot")
-    for accn, rec in dbbuddy.records.items():
-        assert rec.gi in [703125407, 703125412, 67586143, 257467473]
+    # Only records without summaries are posted, and un-versioned placeholders are replaced
+    assert mock_entrez.calls[0] == ("epost", {"db": "protein", "id": "XP_010103297,XP_010103298.1"})
+    assert list(dbbuddy.records) == ["XP_010103298.1", "67586143", "257467473", "XP_010103297.1"]
+    assert dbbuddy.records["XP_010103297.1"].gi == 703125407
+    assert dbbuddy.records["XP_010103298.1"].summary["organism"] == "Morus notabilis"
+    assert dbbuddy.records["XP_010103298.1"].summary["length"] == 632
+    assert dbbuddy.records["XP_010103298.1"].version == "1"
+
+    # GI numbers are posted as is, and GI-only placeholders are replaced
+    mock_entrez.calls = []
+    dbbuddy.records["257467473"].summary = OrderedDict([("organism", "Foo")])
+    client.fetch_summaries("ncbi_nuc")
+    assert mock_entrez.calls[0] == ("epost", {"db": "nucleotide", "id": "67586143"})
+    assert list(dbbuddy.records) == ["XP_010103298.1", "257467473", "XP_010103297.1", "AAY72386.1"]
+    assert dbbuddy.records["AAY72386.1"].gi == 67586143
     assert dbbuddy.records["AAY72386.1"].summary["organism"] == "Unclassified"
-    assert hf.string2hash(str(dbbuddy)) == "0cf7c9ccf058cf3b50d2aab7ecb1f953"
+    # TaxId 0 is never sent to NCBI
+    taxa_query = [kwargs for tool, kwargs in mock_entrez.calls if kwargs["db"] == "taxonomy"]
+    assert taxa_query == []  # Already looked up during the first fetch
 
 
 def test_ncbiclient_fetch_sequences(hf, monkeypatch, capsys):
-    def patch_entrez_fetch_seq(*args, **kwargs):
-        print("patch_entrez_fetch_seq\nargs: %s\nkwargs: %s" % (args, kwargs))
-        test_file = "{0}mock_resources{1}test_databasebuddy_clients" \
-                    "{1}Entrez_efetch_seq.gb".format(hf.resource_path, os.path.sep)
-        with open(test_file, "r") as ifile:
-            client.results_file.write(ifile.read())
+    mock_entrez = MockEntrez(hf)
+    monkeypatch.setattr(Db, "rate_limiter", lambda host, rate=None: Db.RateLimiter(1000))
+    monkeypatch.setattr(Db.Entrez, "epost", mock_entrez.epost)
+    monkeypatch.setattr(Db.Entrez, "efetch", mock_entrez.efetch)
 
     # Empty DbBuddy
     dbbuddy = Db.DbBuddy()
     client = Db.NCBIClient(dbbuddy)
-    client.fetch_sequences("ncbi_prot")
+    client.fetch_sequences("protein")
     assert hf.string2hash(str(dbbuddy)) == "016d020dd926f64ac1431f15c5683678"
+    assert not mock_entrez.calls
 
     # With records
-    monkeypatch.setattr(Db.NCBIClient, "_mc_query", patch_entrez_fetch_seq)
-    dbbuddy = Db.DbBuddy("XP_010103297.1,XP_010103298.1,XM_010104998.1")
+    dbbuddy = Db.DbBuddy("XP_010103297,XP_010103298.1,XM_010104998.1")
+    dbbuddy.records["XP_010103297"].gi = 703125407
     client = Db.NCBIClient(dbbuddy)
-    client.fetch_sequences("ncbi_prot")
+    client.sequence_page = 1
+    client.fetch_sequences("protein")
+    assert mock_entrez.calls[0] == ("epost", {"db": "protein", "id": "703125407,XP_010103298.1"})
+    assert sorted([kwargs["retstart"] for tool, kwargs in mock_entrez.calls if tool == "efetch"]) == [0, 1]
+    assert dbbuddy.records["XP_010103297"].record.id == "XP_010103297.1"
+    assert dbbuddy.records["XP_010103297"].version == "1"
+    assert dbbuddy.records["XP_010103298.1"].record.id == "XP_010103298.1"
+    assert not dbbuddy.records["XM_010104998.1"].record
+
     dbbuddy.out_format = "gb"
-    assert hf.string2hash(str(dbbuddy)) == "9bd8017da009696c1b6ebe5d4e3c0a89"
     capsys.readouterr()  # Clean up the buffer
-    dbbuddy.print()
+    client.fetch_sequences("nucleotide")
+    assert dbbuddy.records["XM_010104998.1"].record.id == "XM_010104998.1"
     out, err = capsys.readouterr()
-    out = re.sub(".*?sec.*?\n", "", out)
-    if os.name == "nt":
-        assert hf.string2hash(out) == "b431f4f8a05f5a0c14de2d0826859bca"
-    else:
-        assert hf.string2hash(out) == "40b60e455df6ba092dbf96dc028ca82f"
+    assert "Fetching full nucleotide sequence records from NCBI..." in err
+
+    # Records that already have sequences aren't fetched again
+    mock_entrez.calls = []
+    client.fetch_sequences("protein")
+    assert not mock_entrez.calls
 
     # Error
-    monkeypatch.setattr(Db.NCBIClient, "_mc_query", mock_raise_keyboardinterrupt)
-    client.fetch_sequences("ncbi_prot")
+    dbbuddy.records["XP_010103297"].record = None
+    monkeypatch.setattr(Db.Entrez, "epost", mock_raise_keyboardinterrupt)
+    client.fetch_sequences("protein")
     out, err = capsys.readouterr()
     assert "\n\tNCBI query interrupted by user\n" in err
 
@@ -604,43 +888,107 @@ def test_ensembl_init(monkeypatch, hf):
         print("patch_ensembl_perform_rest_action\nargs: %s\nkwargs: %s" % (args, kwargs))
         return {}
 
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
     monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action)
     dbbuddy = Db.DbBuddy(", ".join(ACCNS[7:]))
-    client = Db.EnsemblRestClient(dbbuddy)
+    client = Db.EnsemblRestClient(dbbuddy, species_file=False)
     assert hash(dbbuddy) == hash(client.dbbuddy)
-    assert type(client.http_errors_file) == br.TempFile
-    assert type(client.results_file) == br.TempFile
+    assert type(client.http_errors_file) == Db.ResultsBuffer
+    assert type(client.results_file) == Db.ResultsBuffer
+    assert type(client.engine) == Db.HTTPEngine
     assert client.max_url == 1000
     assert 'vicugnapacos' in client.species['Alpaca']['aliases']
 
+    # The species table is only downloaded once
     monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action_empty)
-    client = Db.EnsemblRestClient(dbbuddy)
+    client = Db.EnsemblRestClient(dbbuddy, species_file=False)
+    assert 'vicugnapacos' in client.species['Alpaca']['aliases']
+
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
+    client = Db.EnsemblRestClient(dbbuddy, species_file=False)
+    assert client.species == {}
+
+
+def test_ensembl_species_cache(monkeypatch, hf):
+    def patch_ensembl_perform_rest_action(*args, **kwargs):
+        print("patch_ensembl_perform_rest_action\nargs: %s\nkwargs: %s" % (args, kwargs))
+        downloads.append(args[1])
+        with open("%s/mock_resources/test_databasebuddy_clients/ensembl_species.json" % hf.resource_path) as ifile:
+            return json.load(ifile)
+
+    downloads = []
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
+    monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action)
+    tmp_dir = br.TempDir()
+    species_file = os.path.join(tmp_dir.path, "ensembl_species.json")
+    client = Db.EnsemblRestClient(Db.DbBuddy(), species_file=species_file)
+    assert len(client.species) == 69
+    assert downloads == ["info/species"]
+    with open(species_file, "r") as ifile:
+        assert "Alpaca" in json.load(ifile)["http://rest.ensembl.org/"]["species"]
+
+    # Read back from the file in a new session
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
+    client = Db.EnsemblRestClient(Db.DbBuddy(), species_file=species_file)
+    assert len(client.species) == 69
+    assert len(downloads) == 1
+
+    # Stale tables are downloaded again
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
+    monkeypatch.setattr(Db, "ENSEMBL_SPECIES_TTL", -1)
+    client = Db.EnsemblRestClient(Db.DbBuddy(), species_file=species_file)
+    assert len(client.species) == 69
+    assert len(downloads) == 2
+
+    # ... unless the server is down
+    monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", lambda *args, **kwargs: None)
+    client = Db.EnsemblRestClient(Db.DbBuddy(), species_file=species_file)
+    assert len(client.species) == 69
+
+    # Corrupt files are ignored
+    with open(species_file, "w") as ofile:
+        ofile.write("{Foo")
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
+    client = Db.EnsemblRestClient(Db.DbBuddy(), species_file=species_file)
     assert client.species == {}
 
 
-def test_ensembl_mc_search(monkeypatch, hf):
+def test_ensembl_bulk_search(monkeypatch, hf):
     def patch_ensembl_perform_rest_action(*args, **kwargs):
         print("patch_ensembl_perform_rest_action\nargs: %s\nkwargs: %s" % (args, kwargs))
         test_files = "%s/mock_resources/test_databasebuddy_clients/" % hf.resource_path
         if "info/species" in args:
             with open("%s/ensembl_species.json" % test_files, "r") as ifile:
                 return json.load(ifile)
-        elif "lookup/symbol/Mouse/Panx1" in args:
-            return json.loads('{"id": "ENSMUSG00000031934", "end": 15045478, "seq_region_name": "9", "description": '
-                              '"pannexin 1 [Source:MGI Symbol;Acc:MGI:1860055]", "logic_name": "ensembl_havana_gene", '
-                              '"species": "Mouse", "strand": -1, "start": 15005161, "db_type": "core", "assembly_name":'
-                              ' "GRCm38", "biotype": "protein_coding", "version": 13, "display_name": "Panx1", '
-                              '"source": "ensembl_havana", "object_type": "Gene"}')
-
+        elif "lookup/symbol/mus_musculus" in args:
+            if kwargs["data"] == {"symbols": ["Foo"]}:
+                return {}
+            assert kwargs["data"] == {"symbols": ["Panx1", "Foo"]}
+            return json.loads('{"Panx1": {"id": "ENSMUSG00000031934", "end": 15045478, "seq_region_name": "9", '
+                              '"description": "pannexin 1 [Source:MGI Symbol;Acc:MGI:1860055]", "logic_name": '
+                              '"ensembl_havana_gene", "species": "mus_musculus", "strand": -1, "start": 15005161, '
+                              '"db_type": "core", "assembly_name": "GRCm38", "biotype": "protein_coding", "version": '
+                              '13, "display_name": "Panx1", "source": "ensembl_havana", "object_type": "Gene"}}')
+
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
     monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action)
     dbbuddy = Db.DbBuddy(", ".join(ACCNS[7:]))
-    client = Db.EnsemblRestClient(dbbuddy)
-    client._mc_search('Mouse', ['Panx1'])
-    assert "'description': 'pannexin 1 [Source:MGI Symbol;Acc:MGI:1860055]'" in client.results_file.read()
+    client = Db.EnsemblRestClient(dbbuddy, species_file=False)
+    hits = client._bulk_search(('Mouse', ['Panx1', 'Foo']))
+    assert list(hits) == ["Panx1"]
+    rec = hits["Panx1"]
+    assert rec.accession == "ENSMUSG00000031934"
+    assert rec.version == 13
+    assert rec.database == "ensembl"
+    assert rec.summary["organism"] == "Mouse"
+    assert rec.summary["TaxId"] == "10090"
+    assert rec.summary["length"] == 40317
+    assert rec.summary["comments"] == "pannexin 1 [Source:MGI Symbol;Acc:MGI:1860055]"
+    assert client._bulk_search(('Mouse', ['Foo'])) == {}
 
     monkeypatch.undo()
-    monkeypatch.setattr(Db, "Request", mock_raise_httperror)
-    client._mc_search('Mouse', ['Panx1'])
+    monkeypatch.setattr(Db.HTTPEngine, "request", mock_raise_httperror)
+    assert client._bulk_search(('Mouse', ['Panx1'])) == {}
     assert "HTTP Error 101: Fake HTTPError from Mock" in client.http_errors_file.read()
 
 
@@ -651,40 +999,40 @@ def test_ensembl_perform_rest_action(monkeypatch, hf):
         with open("%s/ensembl_species.json" % test_files, "r") as ifile:
             return json.load(ifile)
 
-    def patch_ensembl_urlopen(*args, **kwargs):
-        print("patch_ensembl_urlopen\nargs: %s\nkwargs: %s" % (args, kwargs))
+    def patch_ensembl_request(*args, **kwargs):
+        print("patch_ensembl_request\nargs: %s\nkwargs: %s" % (args, kwargs))
         outfile.clear()
-        if "lookup/symbol/Mouse/Panx1" in args[0].full_url:
+        if "lookup/symbol/Mouse/Panx1" in args[1]:
             outfile.write('{"id": "ENSMUSG00000031934", "end": 15045478, "seq_region_name": "9", "description": '
                           '"pannexin 1 [Source:MGI Symbol;Acc:MGI:1860055]", "logic_name": "ensembl_havana_gene", '
                           '"species": "Mouse", "strand": -1, "start": 15005161, "db_type": "core", "assembly_name":'
                           ' "Foo", "biotype": "protein_coding", "version": 13, "display_name": "Panx1", '
                           '"source": "ensembl_havana", "object_type": "Gene"}'.encode())
-        elif "lookup/id" in args[0].full_url:
+        elif "lookup/id" in args[1]:
             outfile.write('{"ENSPTRG00000014529":{"source":"ensembl","object_type":"Gene","logic_name":"ensembl",'
                           '"version":5,"species":"pan_troglodytes",'
                           '"description":"pannexin 2 [Source:VGNC Symbol;Acc:VGNC:5291]",'
                           '"display_name":"PANX_tuba!","assembly_name":"CHIMP2.1.4","biotype":"protein_coding",'
                           '"end":49082954,"seq_region_name":"22","db_type":"core","strand":1,'
                           '"id":"ENSPTRG00000014529","start":49073399}}'.encode())
-        elif "sequence/id" in args[0].full_url:
+        elif "sequence/id" in args[1]:
             test_files = "%s/mock_resources/test_databasebuddy_clients/" % hf.resource_path
             with open("%s/ensembl_sequence.seqxml" % test_files, "r") as ifile:
                 outfile.write(ifile.read().encode())
-        elif "error400" in args[0].full_url:
+        elif "error400" in args[1]:
             raise HTTPError(url="http://fake.come", code=400, msg="Bad request",
                             hdrs="Foo", fp=StringIO("Bar"))
-        elif "error429" in args[0].full_url:
+        elif "error429" in args[1]:
             raise HTTPError(url="http://fake.come", code=429, msg="Server busy",
                             hdrs={'Retry-After': 0}, fp=StringIO("Bar"))
-        return outfile.get_handle("r")
+        return outfile.read()
 
     outfile = br.TempFile(byte_mode=True)
     monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action)
     dbbuddy = Db.DbBuddy(", ".join(ACCNS[7:]))
     client = Db.EnsemblRestClient(dbbuddy)
     monkeypatch.undo()  # Need to release perform_rest_action
-    monkeypatch.setattr(Db, "urlopen", patch_ensembl_urlopen)
+    monkeypatch.setattr(Db.HTTPEngine, "request", patch_ensembl_request)
     # Search for gene identifiers and return summaries
     data = client.perform_rest_action("lookup/symbol/Mouse/Panx1",
                                       headers={"Content-type": "application/json", "Accept": "application/json"})
@@ -705,25 +1053,25 @@ def test_ensembl_perform_rest_action(monkeypatch, hf):
         client.perform_rest_action("unknown/endpoint", headers={"Content-type": "Foo/Bar"})
     assert "Unknown request headers '{'Content-type': 'Foo/Bar'}'" in str(err)
 
-    # 400 error (with retry)
-    client.perform_rest_action("error400")
+    # 400 error
+    client.perform_rest_action("error400", headers={"Content-type": "application/json"})
     client.parse_error_file()
     assert not client.dbbuddy.failures
 
-    # 429 error (with retry)
-    client.perform_rest_action("error429")
+    # 429 error (still busy after the engine's retries)
+    client.perform_rest_action("error429", headers={"Content-type": "application/json"})
     client.parse_error_file()
     assert "39eaff4d057aa3d9d098be5cb50d2ce2" in client.dbbuddy.failures
 
     # URLError
-    monkeypatch.setattr(Db, "urlopen", mock_raise_urlerror)
-    client.perform_rest_action("URLError")
+    monkeypatch.setattr(Db.HTTPEngine, "request", mock_raise_urlerror)
+    client.perform_rest_action("URLError", headers={"Content-type": "application/json"})
     client.parse_error_file()
     assert 'eb498f0bcba3bfe69e4df6ee5bfbf6fb' in client.dbbuddy.failures
 
     # URLError 8 (no internet)
-    monkeypatch.setattr(Db, "urlopen", mock_raise_urlerror_8)
-    client.perform_rest_action("URLError")
+    monkeypatch.setattr(Db.HTTPEngine, "request", mock_raise_urlerror_8)
+    client.perform_rest_action("URLError", headers={"Content-type": "application/json"})
     client.parse_error_file()
     assert '57ad6fc317cf0d12ccb78d64d43682dc' in client.dbbuddy.failures
 
@@ -734,22 +1082,29 @@ def test_search_ensembl(monkeypatch, capsys, hf):
         with open("%s/ensembl_species.json" % test_files, "r") as ifile:
             return json.load(ifile)
 
-    def patch_search_ensembl_empty(*args, **kwargs):
-        print("patch_search_ensembl_empty\nargs: %s\nkwargs: %s" % (args, kwargs))
-        return
-
-    def patch_search_ensembl_results(*args, **kwargs):
-        print("patch_search_ensembl_empty\nargs: %s\nkwargs: %s" % (args, kwargs))
-        with open("%s/ensembl_search_results.txt" % test_files, "r") as ifile:
-            client.results_file.write(ifile.read())
-        return
+    def patch_ensembl_request(*args, **kwargs):
+        print("patch_ensembl_request\nargs: %s\nkwargs: %s" % (args, kwargs))
+        requests.append((args[1], json.loads(kwargs["data"].decode())))
+        species = names[args[1].split("/")[-1]]
+        return json.dumps({"Panx3": hits[species]} if species in hits else {}).encode()
 
     test_files = "%s/mock_resources/test_databasebuddy_clients/" % hf.resource_path
+    hits = {}
+    with open("%s/ensembl_search_results.txt" % test_files, "r") as ifile:
+        for rec in ifile.read().split("\n### END ###"):
+            rec = rec.strip()
+            if rec and rec != "None":
+                rec = json.loads(re.sub("'", '"', rec))
+                hits[rec["species"]] = rec
+
+    monkeypatch.setattr(Db, "_ENSEMBL_SPECIES", {})
     monkeypatch.setattr(Db.EnsemblRestClient, "perform_rest_action", patch_ensembl_perform_rest_action)
-    monkeypatch.setattr(br, "run_multicore_function", patch_search_ensembl_empty)
-
     dbbuddy = Db.DbBuddy(", ".join(ACCNS[7:]))
-    client = Db.EnsemblRestClient(dbbuddy)
+    client = Db.EnsemblRestClient(dbbuddy, species_file=False)
+    names = {info["name"]: display_name for display_name, info in client.species.items()}
+    monkeypatch.undo()
+    requests = []
+    monkeypatch.setattr(Db.HTTPEngine, "request", lambda *args, **kwargs: b"{}")
     client.dbbuddy.search_terms = ["Panx3"]
     client.dbbuddy.records["ENSLAFG00000006034"] = Db.Record("ENSLAFG00000006034")
     client.search_ensembl()
@@ -757,11 +1112,33 @@ def test_search_ensembl(monkeypatch, capsys, hf):
     assert err == "Searching Ensembl for Panx3...\nEnsembl returned no results\n"
     assert not client.dbbuddy.records["ENSLAFG00000006034"].record
 
-    monkeypatch.setattr(br, "run_multicore_function", patch_search_ensembl_results)
+    monkeypatch.setattr(Db.HTTPEngine, "request", patch_ensembl_request)
     client.search_ensembl()
+    # One POST request per species, no matter how many search terms there are
+    assert len(requests) == 69
+    assert requests[0] == ("http://rest.ensembl.org/lookup/symbol/saccharomyces_cerevisiae", {"symbols": ["Panx3"]})
+    out, err = capsys.readouterr()
+    assert err == "Searching Ensembl for Panx3...\n\t%s records received\n" % len(hits)
     assert hf.string2hash(str(client.dbbuddy)) == "95dc1ecce077bef84cdf2d85ce154eef"
     assert len(client.dbbuddy.records) == 44
     assert client.dbbuddy.records["ENSLAFG00000006034"].database == "ensembl"
+    assert client.dbbuddy.records["ENSDARG00000004627"].summary["organism"] == "Zebrafish"
+    assert client.dbbuddy.records["ENSDARG00000004627"].summary["TaxId"] == "7955"
+
+    requests = []
+    client.dbbuddy.search_terms = ["Panx3", "Panx1", "Panx3", "Panx2"]
+    monkeypatch.setattr(Db, "ENSEMBL_MAX_SYMBOLS", 2)
+    client.search_ensembl()
+    assert len(requests) == 138
+    assert sorted(set([str(data["symbols"]) for url, data in requests])) == ["['Panx2']", "['Panx3', 'Panx1']"]
+    out, err = capsys.readouterr()
+    assert "Searching Ensembl for Panx3, Panx1, Panx2...\n" in err
+
+    # Nothing to search for
+    requests = []
+    client.dbbuddy.search_terms = []
+    client.search_ensembl()
+    assert not requests
 
 
 def test_ensembl_fetch_summaries(monkeypatch, capsys, hf):
@@ -4,6 +4,7 @@ import re
 import sys
 import argparse
 from copy import deepcopy
+from collections import OrderedDict
 
 import buddy_resources as br
 import DatabaseBuddy as Db
@@ -317,6 +318,46 @@ def test_liveshell_do_bash(monkeypatch, capsys):
     os.chdir(cwd)
 
 
+def test_liveshell_do_cache(monkeypatch, capsys):
+    monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
+    monkeypatch.setattr(Db.LiveShell, "dump_session", lambda _: True)
+    dbbuddy = Db.DbBuddy()
+    crash_file = br.TempFile(byte_mode=True)
+    liveshell = Db.LiveShell(dbbuddy, crash_file)
+
+    dbbuddy.cache = Db.RecordCache(path=False)
+    liveshell.do_cache(None)
+    out, err = capsys.readouterr()
+    assert "The record cache is disabled" in out
+
+    tmp_dir = br.TempDir()
+    dbbuddy.cache = Db.RecordCache(path="%s%scache.sqlite" % (tmp_dir.path, os.sep))
+    dbbuddy.cache.put_many([Db.Record("Q9JIJ4", summary=OrderedDict([("length", 300)]), _database="uniprot",
+                                      _type="protein")])
+    liveshell.do_cache("offline")
+    assert dbbuddy.cache.offline
+    liveshell.do_cache(None)
+    out, err = capsys.readouterr()
+    assert "only be read from the local cache" in out
+    assert re.search("Mode: +.*offline", out)
+    assert re.search("Entries: +.*1.* \\(.*0.* with sequence", out)
+
+    liveshell.do_cache(" Online ")
+    assert not dbbuddy.cache.offline
+
+    liveshell.do_cache("foo")
+    out, err = capsys.readouterr()
+    assert "Unknown cache command 'foo'" in out
+
+    liveshell.do_cache("clear")
+    assert dbbuddy.cache.stats()["entries"] == 0
+
+    # Sessions saved before the cache was added
+    del dbbuddy.cache
+    liveshell.do_cache(None)
+    assert type(dbbuddy.cache) == Db.RecordCache
+
+
 def test_liveshell_do_database(monkeypatch, capsys):
     monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
     monkeypatch.setattr(Db.LiveShell, "dump_session", lambda _: True)
@@ -480,10 +521,11 @@ def test_liveshell_do_failures(monkeypatch, capsys):
 
 
 def test_liveshell_do_fetch(monkeypatch, capsys):
-    def mock_big_record_no_dl(_dbbuddy):
+    def mock_big_record_no_dl(_dbbuddy, timeout=None):
         _dbbuddy.records["NP_001287575.1"] = Db.Record("NP_001287575.1", _size=5000001)
 
-    def mock_big_record_fetch(_dbbuddy):
+    def mock_big_record_fetch(_dbbuddy, timeout=None):
+        assert timeout == 30
         _dbbuddy.records["NP_001287575.1"].record = True
 
     monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
@@ -504,6 +546,7 @@ def test_liveshell_do_fetch(monkeypatch, capsys):
 
     monkeypatch.setattr(Db, "retrieve_sequences", mock_big_record_fetch)
     monkeypatch.setattr(br, "ask", lambda _, **kwargs: True)
+    liveshell.timeout = 30
     liveshell.do_fetch(None)
     out, err = capsys.readouterr()
     print(out)
@@ -639,6 +682,7 @@ def test_liveshell_do_save(monkeypatch, capsys):
     crash_file = br.TempFile(byte_mode=True)
     liveshell = Db.LiveShell(dbbuddy, crash_file)
     dbbuddy.records["foo"] = "bar"
+    dbbuddy.cache = Db.RecordCache(path=False)
 
     # Standard, no problems
     tmp_dir = br.TempDir()
@@ -648,7 +692,7 @@ def test_liveshell_do_save(monkeypatch, capsys):
     assert "Live session saved\n\n" in out
     assert os.path.isfile("%s/save_dir/save_file1.db" % tmp_dir.path)
     with open("%s/save_dir/save_file1.db" % tmp_dir.path, "rb") as ifile:
-        assert len(ifile.read()) in [279, 281]  # Different versions of python give different file sizes
+        assert len(ifile.read()) in [392, 394]  # Different versions of python give different file sizes
 
     # File exists, abort
     monkeypatch.setattr(br, "ask", lambda _, **kwargs: False)
@@ -683,7 +727,7 @@ def test_liveshell_do_search(monkeypatch):
     dbbuddy.search_terms += ["Foo", "Bar"]
 
     monkeypatch.setattr("builtins.input", lambda _: "Panx1, Panx2")
-    monkeypatch.setattr(Db, "retrieve_summary", lambda _: True)
+    monkeypatch.setattr(Db, "retrieve_summary", lambda _, timeout=None: True)
 
     liveshell.do_search(None)
     assert dbbuddy.search_terms == ["Foo", "Bar", "Panx1", "Panx2"]
@@ -940,6 +984,39 @@ def test_liveshell_do_write(monkeypatch, capsys, hf):
     assert "written" not in out
 
 
+def test_liveshell_do_timeout(monkeypatch, capsys):
+    monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
+    monkeypatch.setattr(Db.LiveShell, "dump_session", lambda _: True)
+    dbbuddy = Db.DbBuddy()
+    crash_file = br.TempFile(byte_mode=True)
+    liveshell = Db.LiveShell(dbbuddy, crash_file)
+    capsys.readouterr()
+
+    liveshell.do_timeout(None)
+    out, err = capsys.readouterr()
+    assert liveshell.timeout is None
+    assert "wait for every server to finish" in out
+
+    liveshell.do_timeout(" 30 ")
+    out, err = capsys.readouterr()
+    assert liveshell.timeout == 30
+    assert "longer than \033[93m30 sec" in out
+
+    for bad in ["foo", "-5", "0"]:
+        liveshell.do_timeout(bad)
+        out, err = capsys.readouterr()
+        assert "Timeout must be a positive number of seconds" in out
+        assert liveshell.timeout == 30
+
+    timeouts = []
+    monkeypatch.setattr(Db, "retrieve_summary", lambda _, timeout=None: timeouts.append(timeout))
+    liveshell.do_search("Panx1")
+    assert timeouts == [30]
+
+    liveshell.do_timeout("Off")
+    assert liveshell.timeout is None
+
+
 def test_liveshell_do_undo(monkeypatch, capsys, hf):
     monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
     dbbuddy = Db.DbBuddy()
@@ -948,7 +1025,7 @@ def test_liveshell_do_undo(monkeypatch, capsys, hf):
 
     liveshell.do_undo(None)
     out, err = capsys.readouterr()
-    assert "There is currently no undo history (only a single undo is possible).\n\n" in out
+    assert "There is currently no undo history.\n\n" in out
 
     load_file = "%s/mock_resources/test_databasebuddy_clients/dbbuddy_save.db" % hf.resource_path
     liveshell.do_load(load_file)
@@ -958,12 +1035,51 @@ def test_liveshell_do_undo(monkeypatch, capsys, hf):
     assert dbbuddy.trash_bin
     liveshell.do_undo(None)
     assert not dbbuddy.trash_bin
+    assert dbbuddy.records
     out, err = capsys.readouterr()
     assert "Most recent state reloaded\n\n" in out
 
+    # Multiple levels of undo
+    liveshell.do_undo(None)
+    assert not dbbuddy.records
+
     liveshell.do_undo(None)
     out, err = capsys.readouterr()
-    assert "There is currently no undo history (only a single undo is possible).\n\n" in out
+    assert "There is currently no undo history.\n\n" in out
+
+
+def test_liveshell_do_undo_multiple(monkeypatch, capsys):
+    monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
+    monkeypatch.setattr(Db, "retrieve_summary", lambda _: True)
+    dbbuddy = Db.DbBuddy(",".join(ACCNS))
+    crash_file = br.TempFile(byte_mode=True)
+    liveshell = Db.LiveShell(dbbuddy, crash_file)
+    assert not liveshell.undo
+
+    liveshell.do_remove("XM_003978475")
+    liveshell.do_format("fasta")
+    liveshell.do_remove("ENS")
+    assert liveshell.undo == [1, 2, 3]
+    assert list(dbbuddy.trash_bin) == ["XM_003978475", "ENSAMEG00000011912", "ENSCJAG00000008732",
+                                       "ENSMEUG00000000523"]
+
+    liveshell.do_undo(None)
+    assert list(dbbuddy.trash_bin) == ["XM_003978475"]
+    assert dbbuddy.out_format == "fasta"
+    liveshell.do_undo(None)
+    assert dbbuddy.out_format == "summary"
+
+    # The crash file always holds the current state
+    assert list(Db.SessionJournal.load(crash_file.path).trash_bin) == ["XM_003978475"]
+    assert Db.SessionJournal.load(crash_file.path).out_format == "summary"
+
+    liveshell.do_undo(None)
+    assert not dbbuddy.trash_bin
+    assert list(dbbuddy.records) == ACCNS
+    capsys.readouterr()
+    liveshell.do_undo(None)
+    out, err = capsys.readouterr()
+    assert "There is currently no undo history.\n\n" in out
 
 
 def test_liveshell_complete_bash(monkeypatch):
@@ -979,6 +1095,14 @@ def test_liveshell_complete_bash(monkeypatch):
         assert program in programs
 
 
+def test_liveshell_complete_cache(monkeypatch):
+    monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
+    dbbuddy = Db.DbBuddy()
+    crash_file = br.TempFile(byte_mode=True)
+    liveshell = Db.LiveShell(dbbuddy, crash_file)
+    assert liveshell.complete_cache("o") == ["offline", "online"]
+
+
 def test_liveshell_complete_database(monkeypatch):
     monkeypatch.setattr(Db.LiveShell, "cmdloop", mock_cmdloop)
     dbbuddy = Db.DbBuddy()
@@ -1081,6 +1205,10 @@ def test_helps(monkeypatch, capsys):
     out, err = capsys.readouterr()
     assert "Run bash commands" in out
 
+    liveshell.help_cache()
+    out, err = capsys.readouterr()
+    assert "Show what is stored in the local record cache" in out
+
     liveshell.help_database()
     out, err = capsys.readouterr()
     assert "Reset the database" in out
@@ -1145,6 +1273,10 @@ def test_helps(monkeypatch, capsys):
     out, err = capsys.readouterr()
     assert "Display the current state of your Live" in out
 
+    liveshell.help_timeout()
+    out, err = capsys.readouterr()
+    assert "Stop waiting for slow servers" in out
+
     liveshell.help_undo()
     out, err = capsys.readouterr()
     assert "Revert the most recent change to your live session." in out
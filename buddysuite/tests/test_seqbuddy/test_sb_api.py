@@ -5,6 +5,7 @@
 import pytest
 from Bio.SeqFeature import FeatureLocation, CompoundLocation
 from Bio.Seq import Seq
+from Bio.Alphabet import IUPAC
 from unittest import mock
 import os
 import re
@@ -14,6 +15,7 @@ import shutil
 import time
 import subprocess
 from collections import OrderedDict
+import numpy as np
 
 import SeqBuddy as Sb
 import buddy_resources as br
@@ -202,9 +204,76 @@ def test_back_translate_bad_organism(sb_resources):
 
 
 # ######################  '-bl2s', '--bl2seq' ###################### #
-# ToDo: Mock output data
-def test_bl2seq():
-    pass
+def test_bl2seq(monkeypatch, sb_resources):
+    commands = []
+
+    class MockBl2seqPopen(object):
+        def __init__(self, command, shell, stdout=None, stderr=None):
+            self.command = command
+            self.returncode = 0
+            commands.append(command)
+
+        def communicate(self):
+            if self.command.startswith("blastp"):
+                tmp_path = re.search("-query (.*)all.fa", self.command).group(1)
+                with open("%sall.fa" % tmp_path, "r", encoding="utf-8") as ifile:
+                    ids = re.findall(">([^ \n]+)", ifile.read())
+                hit = "{0}\t{1}\t{2}\t300\t1\t0\t1\t300\t1\t300\t{3}\t{4}\n"
+                with open("%sout.txt" % tmp_path, "w", encoding="utf-8") as ofile:
+                    ofile.write(hit.format(ids[0], ids[0], "100.00", "0.0", "600"))  # Self hit
+                    ofile.write(hit.format(ids[1], ids[0], "90.00", "0.0", "500"))
+                    ofile.write(hit.format(ids[1], ids[0], "20.00", "1e-05", "50"))  # Second HSP
+                    ofile.write(hit.format(ids[0], ids[1], "91.00", "0.0", "501"))  # Reverse direction
+                    ofile.write(hit.format(ids[2], ids[1], "45.50", "2e-50", "200"))
+                    ofile.write(hit.format(ids[2], ids[0], "25.00", "25", "30"))  # Weak, but passes on its own
+                    ofile.write(hit.format(ids[1], ids[0], "25.00", "25", "30"))  # Already seen
+                return ["".encode(), "".encode()]
+            return ["".encode(), "".encode()]
+
+    monkeypatch.setattr(Sb, "_check_for_blast_bin", lambda _: True)
+    monkeypatch.setattr(Sb, "Popen", MockBl2seqPopen)
+    seqbuddy = Sb.pull_recs(sb_resources.get_one("p f"), "α[123]$")
+    lengths = {rec.id: len(rec.seq) for rec in seqbuddy.records}
+    db_size = sum(lengths.values())
+    result = Sb.bl2seq(seqbuddy)
+
+    assert len(commands) == 2
+    assert commands[0].startswith("makeblastdb -dbtype prot")
+    assert "-parse_seqids" in commands[0]
+    assert re.match("blastp -db .*all_db -query .*all.fa -out .*out.txt -outfmt 6 -num_threads [0-9]+ "
+                    "-max_target_seqs 5 -dbsize %s -evalue %s$" % (db_size, 10 * db_size / min(lengths.values())),
+                    commands[1])
+
+    # E-values are rescaled from the whole database to the length of the subject
+    evalue = 2e-50 * lengths["Mle-Panxα2"] / db_size
+    weak_evalue = 25 * lengths["Mle-Panxα1"] / db_size
+    assert list(result.keys()) == ["Mle-Panxα1", "Mle-Panxα2", "Mle-Panxα3"]
+    assert result["Mle-Panxα1"] == OrderedDict([("Mle-Panxα2", [90.0, 300, 1e-180, 500.0]),
+                                                 ("Mle-Panxα3", [25.0, 300, weak_evalue, 30.0])])
+    assert result["Mle-Panxα2"] == OrderedDict([("Mle-Panxα1", [90.0, 300, 1e-180, 500.0]),
+                                                 ("Mle-Panxα3", [45.5, 300, evalue, 200.0])])
+    assert result["Mle-Panxα3"]["Mle-Panxα2"] == [45.5, 300, evalue, 200.0]
+
+    class MockMakeblastdbErrorPopen(MockBl2seqPopen):
+        def communicate(self):
+            if self.command.startswith("makeblastdb"):
+                self.returncode = 1
+                return ["".encode(), "BLAST options error: File all.fa does not exist".encode()]
+            return MockBl2seqPopen.communicate(self)
+
+    monkeypatch.setattr(Sb, "Popen", MockMakeblastdbErrorPopen)
+    with pytest.raises(RuntimeError) as err:
+        Sb.bl2seq(seqbuddy)
+    assert "makeblastdb failed: BLAST options error: File all.fa does not exist" in str(err)
+
+    class MockErrorPopen(MockBl2seqPopen):
+        def communicate(self):
+            return ["".encode(), "BLAST Database Error: Bad".encode()]
+
+    monkeypatch.setattr(Sb, "Popen", MockErrorPopen)
+    with pytest.raises(RuntimeError) as err:
+        Sb.bl2seq(seqbuddy)
+    assert "BLAST Database Error" in str(err)
 
 
 def test_bl2_no_binary(sb_resources):
@@ -458,6 +527,61 @@ def test_blast_errors(monkeypatch, capsys, sb_resources, hf):
     assert "blastn not found in system path." in str(err)
 
 
+# ######################  cd_hit  ###################### #
+def test_cd_hit(sb_resources):
+    tester = Sb.cd_hit(sb_resources.get_one("p f"), 0.5)
+    assert [rec.id for rec in tester.records] == ['Mle-Panxα7A', 'Mle-Panxα8', 'Mle-Panxα1', 'Mle-Panxα2',
+                                                  'Mle-Panxα5', 'Mle-Panxα4', 'Mle-Panxα3', 'Mle-Panxα6',
+                                                  'Mle-Panxα11', 'Mle-Panxα10A']
+    assert tester.records[-1].buddy_data["cluster"] == ['Mle-Panxα12', 'Mle-Panxα9', 'Mle-Panxα10B']
+    assert tester.records[0].buddy_data["cluster"] == []
+
+    # Percentages work too
+    tester = Sb.cd_hit(sb_resources.get_one("p f"), 90)
+    assert len(tester) == 12
+    assert tester.records[-1].buddy_data["cluster"] == ['Mle-Panxα9']
+
+    tester = Sb.cd_hit(sb_resources.get_one("d f"), 0.8)
+    assert len(tester) == 11
+    assert tester.records[-1].buddy_data["cluster"] == ['Mle-Panxα9', 'Mle-Panxα10B']
+
+    # Sequence fragments, gaps, and case are all handled
+    tester = Sb.SeqBuddy(">full\nMAVLDRPWQSTYKLNMEFGHACDE\n>fragment\nldrp-wqstykln\n>mutant\nMAVLDRPWQSTYKLNMEFGHAKKK",
+                         alpha=IUPAC.protein)
+    tester = Sb.cd_hit(tester, 0.85, word_size=3)
+    assert [rec.id for rec in tester.records] == ["full"]
+    assert tester.records[0].buddy_data["cluster"] == ["mutant", "fragment"]
+
+    tester = Sb.cd_hit(Sb.SeqBuddy(">full\nMAVLDRPWQSTYKLNMEFGHACDE\n>mutant\nMAVLDRPWQSTYKLNMEFGHAKKK",
+                                   alpha=IUPAC.protein), 0.9)
+    assert [rec.id for rec in tester.records] == ["full", "mutant"]
+
+    # Sequences shorter than word_size are aligned against all of every representative
+    tester = Sb.SeqBuddy(">full\n%sPWQSTY\n>short\nPWQS\n>unrelated\nWWWW\n>duplicate\nWWWW" % ("MAVLDRGHACDE" * 5),
+                         alpha=IUPAC.protein)
+    tester = Sb.cd_hit(tester, 0.9)
+    assert [rec.id for rec in tester.records] == ["full", "unrelated"]
+    assert tester.records[0].buddy_data["cluster"] == ["short"]
+    assert tester.records[1].buddy_data["cluster"] == ["duplicate"]
+
+    with pytest.raises(ValueError) as err:
+        Sb.cd_hit(sb_resources.get_one("p f"), 0)
+    assert "The cd_hit threshold must be between 0 and 1" in str(err)
+
+    with pytest.raises(ValueError) as err:
+        Sb.cd_hit(sb_resources.get_one("p f"), 0.9, word_size=9)
+    assert "The cd_hit word_size must be between 1 and 8" in str(err)
+
+
+def test_banded_identities():
+    query = np.frombuffer(b"ACGTACGTAA", dtype=np.uint8)
+    subjects = [np.frombuffer(b"TTACGTACGTAATT", dtype=np.uint8), np.frombuffer(b"ACGTCGTAA", dtype=np.uint8),
+                np.frombuffer(b"GGGGGGGGGG", dtype=np.uint8)]
+    assert list(Sb._banded_identities(query, subjects, [2, 0, 0], 3)) == [10, 9, 2]
+    # Band that doesn't reach the right diagonal
+    assert list(Sb._banded_identities(query, subjects[:1], [-5], 1)) == [0]
+
+
 # ######################  '-cs', '--clean_seq'  ###################### #
 def test_clean_seq_prot(sb_resources, hf):
     # Protein
@@ -566,6 +690,23 @@ def test_count_codons_pep_exception(sb_resources):
         Sb.count_codons(tester)
 
 
+def test_count_codons_aggregate(sb_resources):
+    tester = sb_resources.get_one("d f")
+    per_record = Sb.count_codons(tester)[1]
+    tester, aggregate = Sb.count_codons(sb_resources.get_one("d f"), aggregate=True)
+    assert "Codon_frequency" not in getattr(tester.records[0], "buddy_data", {})
+    assert list(aggregate) == sorted(aggregate)
+    for codon, (amino_acid, count, percent) in aggregate.items():
+        assert count == sum([table[codon][1] for table in per_record.values() if codon in table])
+    assert aggregate["ATG"][0] == "M"
+    assert aggregate["TGA"][0] == "*"
+    assert round(sum([data[2] for data in aggregate.values()])) == 100
+
+    tester = Sb.SeqBuddy(">seq1\nATGat-gTAAC\n>seq2\nATGNNN\n", in_format="fasta")
+    assert Sb.count_codons(tester, aggregate=True)[1] == OrderedDict([("ATG", ["M", 3, 60.0]), ("NNN", ["X", 1, 20.0]),
+                                                                       ("TAA", ["*", 1, 20.0])])
+
+
 # ######################  '-cr', '--count_residues' ###################### #
 def test_count_residues_unambig_dna(sb_resources):
     tester = Sb.SeqBuddy(">seq1\nACGCGAAGCGAACGCGCAGACGACGCGACGACGACGACGCA", in_format="fasta")
@@ -622,6 +763,20 @@ def test_count_residues_prot(sb_resources):
     assert res_count["% Hydrophobic"] == 55.4
 
 
+def test_count_residues_aggregate(sb_resources):
+    tester = sb_resources.get_one("p f")
+    res_count = Sb.count_residues(tester, aggregate=True)
+    seq = "".join([str(rec.seq).upper() for rec in tester.records])
+    assert res_count["P"] == [seq.count("P"), seq.count("P") / len(seq)]
+    assert res_count["% Positive"] == round(100 * len(re.findall("[HKR]", seq)) / len(seq), 2)
+    assert not hasattr(tester.records[0], "buddy_data") or "res_count" not in tester.records[0].buddy_data
+
+    tester = Sb.SeqBuddy(">seq1\nACGU\n>seq2\nacgn\n", in_format="fasta")
+    assert Sb.count_residues(tester, aggregate=True) == OrderedDict([("% Ambiguous", 12.5), ("A", [2, 0.25]),
+                                                                      ("C", [2, 0.25]), ("G", [2, 0.25]),
+                                                                      ("N", [1, 0.125]), ("U", [1, 0.125])])
+
+
 # ######################  '-dgn' '--degenerate_sequence'################### #
 def test_degenerate_sequence_without_arguments(sb_resources, hf):
     tester = sb_resources.get_one("f d")
@@ -883,10 +1038,35 @@ def test_extract_regions_edges(sb_resources):
 
 
 # #####################  '-fcpg', '--find_CpG' ###################### ##
-def test_find_cpg(sb_resources, hf):
+def test_find_cpg(sb_resources):
     tester = sb_resources.get_one("d g")
     tester = Sb.find_cpg(tester)
-    assert hf.buddy2hash(tester) == "9499f524da0c35a60502031e94864928"
+    assert tester.to_dict()["Mle-Panxα11"].buddy_data["cpgs"] == [(182, 419), (640, 700), (895, 898), (987, 1197)]
+    assert str(tester.to_dict()["Mle-Panxα11"].seq)[180:184] == "taCG"
+    islands = [(rec.id, int(feat.location.start), int(feat.location.end)) for rec in tester.records
+               for feat in rec.features if feat.type == "CpG_island"]
+    assert islands == [("Mle-Panxα9", 934, 1203), ("Mle-Panxα1", 674, 738), ("Mle-Panxα3", 238, 356),
+                       ("Mle-Panxα12", 206, 263), ("Mle-Panxα12", 428, 447), ("Mle-Panxα12", 689, 920),
+                       ("Mle-Panxα11", 182, 419), ("Mle-Panxα11", 640, 700), ("Mle-Panxα11", 895, 898),
+                       ("Mle-Panxα11", 987, 1197), ("Mle-Panxα4", 161, 236), ("Mle-Panxα8", 950, 1251),
+                       ("Mle-Panxα10B", 822, 1077), ("Mle-Panxα10A", 215, 490), ("Mle-Panxα10A", 1035, 1290)]
+
+    tester = Sb.find_cpg(sb_resources.get_one("d g"), window_size=100, min_gc=0.6, min_oe=0.8)
+    assert tester.to_dict()["Mle-Panxα11"].buddy_data["cpgs"] == [(1165, 1195)]
+
+    with pytest.raises(ValueError) as err:
+        Sb.find_cpg(sb_resources.get_one("d g"), window_size=0)
+    assert "The CpG window size must be a positive integer, not 0" in str(err)
+
+
+def test_cpg_islands():
+    seq = "ATATATATAT" * 30 + "CGCGGCGCTA" * 25 + "ATATATATAT" * 30 + "GCGACGCGCC" * 20
+    islands = list(Sb._cpg_islands(seq, window_size=50))
+    assert islands == list(Sb._cpg_islands(seq, window_size=50, block_size=37))
+    assert islands == list(Sb._cpg_islands(seq.lower(), window_size=50, block_size=250))
+    assert islands == [(306, 542), (853, 1050)]
+    assert list(Sb._cpg_islands("ATATATATAT", window_size=50)) == []
+    assert list(Sb._cpg_islands("")) == []
 
 
 # #####################  '-orf', '--find_orf' ###################### ##
@@ -903,6 +1083,10 @@ def test_find_orf(sb_resources, hf):
 
     tester = Sb.find_orfs(sb_resources.get_one("d g"), include_feature=False)
     assert hf.buddy2hash(tester) == "908744b00d9f3392a64b4b18f0db9fee"
+    assert not [feature for rec in tester.records for feature in rec.features if feature.type == "orf"]
+    assert [rec.buddy_data["find_orfs"] for rec in tester.records] == \
+        [rec.buddy_data["find_orfs"] for rec in Sb.find_orfs(sb_resources.get_one("d g")).records]
+    assert tester.records[0].buddy_data["find_orfs"]["-"][0] == (1001, 1139)
 
     tester = Sb.find_orfs(sb_resources.get_one("r f"))
     assert hf.buddy2hash(tester) == "d2db9b02485e80323c487c1dd6f1425b"
@@ -940,6 +1124,25 @@ def test_find_pattern(sb_resources, hf):
     assert hf.buddy2hash(tester) == "b7abcb4334232e38dfbac9f46234501a"
 
 
+def test_find_pattern_reverse(sb_resources):
+    # Reverse strand matches are opt-in, and reported in forward strand coordinates
+    tester = Sb.find_pattern(Sb.SeqBuddy(">seq1\naaATGGTcccACCATtttacca"), "ATGGT", reverse=True)
+    rec = tester.records[0]
+    assert str(rec.seq) == "aaATGGTcccACCATtttacca"
+    assert rec.buddy_data["find_patterns"]["ATGGT"] == [2]
+    assert rec.buddy_data["find_patterns_reverse"]["ATGGT"] == [10]
+    assert [(int(feat.location.start), int(feat.location.end), feat.strand) for feat in rec.features] == \
+        [(2, 7, 1), (10, 15, -1)]
+
+    tester = Sb.find_pattern(Sb.SeqBuddy(">seq1\naaATGGTcccACCATtttacca"), "ATGGT")
+    assert "find_patterns_reverse" not in tester.records[0].buddy_data
+    assert str(tester.records[0].seq) == "aaATGGTcccaccattttacca"
+
+    with pytest.raises(TypeError) as err:
+        Sb.find_pattern(sb_resources.get_one("p g"), "MTV", reverse=True)
+    assert "Nucleic acid sequences required." in str(err)
+
+
 # #####################  '-frp', '--find_repeats' ###################### ##
 def test_find_repeats(sb_odd_resources):
     tester = Sb.SeqBuddy(sb_odd_resources["duplicate"])
@@ -1008,6 +1211,8 @@ def test_hash_seq_ids(sb_resources):
     assert tester_copy.records[0].id == tester.records[0].id
 
     tester_copy.reverse_hashmap()
+    assert [rec.id for rec in tester_copy.records] == list(tester.hash_map.values())
+    assert [rec.name for rec in tester_copy.records] == list(tester.hash_map.values())
     tester_copy.records[0].id = tester_copy.records[0].id[:-1]
     tester_copy = Sb.hash_ids(tester_copy, 25)
     assert tester_copy.records[0].id != tester.records[0].id
@@ -1029,6 +1234,43 @@ def test_hash_seq_ids_errors(sb_resources):
     assert "Insufficient number of hashes available to cover all sequences." in str(e.value)
 
 
+# ##################### '-idx', 'index_file' ###################### ##
+def test_index_file(sb_resources, hf):
+    tmp_dir = br.TempDir()
+    fasta = shutil.copy(sb_resources.get_one("d f", "paths"), tmp_dir.path)
+    seq_index = Sb.index_file(fasta)
+    with open("%s.fai" % fasta, "r", encoding="utf-8") as ifile:
+        fai = ifile.read().splitlines()
+    assert len(fai) == 13
+    assert fai[0] == "Mle-Panxα9\t1203\t30\t60\t61"
+    assert fai[1] == "Mle-Panxα7A\t1875\t1288\t60\t61"
+    assert seq_index.in_format == "fasta"
+    seq_index.close()
+
+    genbank = shutil.copy(sb_resources.get_one("d g", "paths"), tmp_dir.path)
+    with Sb.index_file(genbank, "genbank") as seq_index:
+        assert seq_index.in_format == "gb"
+        assert seq_index.ids() == [rec.id for rec in Sb.SeqBuddy(genbank).records]
+    with open("%s.gbi" % genbank, "r", encoding="utf-8") as ifile:
+        assert ifile.readline() == "Mle-Panxα9\tMle-Panxα9\t0\t2220\t1203\n"
+
+    # Irregular line lengths can't be used to calculate offsets
+    irregular = os.path.join(tmp_dir.path, "irregular.fa")
+    with open(irregular, "w", encoding="utf-8") as ofile:
+        ofile.write(">seq1 desc\nACGTA\nCGTAC\nGG\n>seq2\nACG\nACGTA\n>seq3\nACGTA\n\nACGTA\n>seq4\n")
+    Sb.index_file(irregular).close()
+    with open("%s.fai" % irregular, "r", encoding="utf-8") as ifile:
+        assert ifile.read() == "seq1\t12\t11\t5\t6\nseq2\t8\t32\t0\t0\nseq3\t10\t48\t0\t0\nseq4\t0\t67\t0\t0\n"
+
+    with pytest.raises(FileNotFoundError) as err:
+        Sb.index_file(os.path.join(tmp_dir.path, "foo.fa"))
+    assert "Only files can be indexed" in str(err)
+
+    with pytest.raises(ValueError) as err:
+        Sb.index_file(sb_resources.get_one("d n", "paths"))
+    assert "Only FASTA and GenBank files can be indexed, not 'nexus'." in str(err)
+
+
 # ##################### '-is', 'insert_seq' ###################### ##
 def test_insert_seqs_start(sb_resources, hf):
     insert = 'AACAGGTCGAGCA'
@@ -1444,25 +1686,19 @@ def test_prosite_scan_mc_run_prosite(sb_resources, hf, monkeypatch):
 
     monkeypatch.setattr(Sb.PrositeScan, "_rest_request", mock_rest_request)
     monkeypatch.setattr(Sb.time, "sleep", lambda _: True)
-    out_file = br.TempFile()
     seqbuddy = sb_resources.get_one("d f")
     Sb.pull_recs(seqbuddy, "Mle-Panxα10B")
     ps_scan = Sb.PrositeScan(seqbuddy)
-    ps_scan._mc_run_prosite(seqbuddy.records[0], [out_file.path, Sb.Lock()])
-    with open(out_file.path, "r", encoding="utf-8") as ifile:
-        output = ifile.read()
-    assert hf.string2hash(output) == "e2991bfa6bccafdbf75055d697d9c980"
+    output = ps_scan._mc_run_prosite(seqbuddy.records[0])
+    assert hf.string2hash("%s\n" % output) == "e2991bfa6bccafdbf75055d697d9c980"
 
 
 def test_prosite_scan_run(sb_resources, hf, monkeypatch):
-    def mock_mc_run_prosite(self, _rec, args):
+    def mock_mc_run_prosite(self, _rec):
         print(self)
-        out_file_path, lock = args
         temp_seq = Sb.SeqBuddy([_rec], out_format="gb")
         Sb.annotate(temp_seq, "Foo", "1-100")
-        with lock:
-            with open(out_file_path, "a") as out_file:
-                out_file.write("%s\n" % str(temp_seq))
+        return str(temp_seq)
 
     monkeypatch.setattr(Sb.PrositeScan, "_mc_run_prosite", mock_mc_run_prosite)
     seqbuddy = sb_resources.get_one("d g")
@@ -1543,6 +1779,15 @@ def test_purge(sb_resources, hf, monkeypatch):
     Sb.purge(tester, 200)
     assert hf.buddy2hash(tester) == '256681ed87c67f8f3a8c5771572767f1'
 
+    tester = Sb.purge(sb_resources.get_one("p f"), 50, method="cd_hit")
+    assert len(tester) == 10
+    assert tester.records[-1].buddy_data["purge_set"] == ['Mle-Panxα12', 'Mle-Panxα9', 'Mle-Panxα10B']
+    assert tester.records[0].buddy_data["purge_set"] is None
+
+    with pytest.raises(ValueError) as err:
+        Sb.purge(sb_resources.get_one("p f"), 50, method="foo")
+    assert "Unknown purge method 'foo'" in str(err)
+
 
 # ######################  '-ri', '--rename_ids' ###################### #
 hashes = [('d f', '8b4a9e3d3bb58cf8530ee18b9df67ff1'), ('d g', '78c73f97117bd937fd5cf52f4bd6c26e'),
@@ -2,6 +2,10 @@
 # coding=utf-8
 """ tests basic functionality of SeqBuddy class """
 import pytest
+import re
+import shutil
+import time
+import numpy as np
 from Bio.Alphabet import IUPAC
 from collections import OrderedDict
 import os
@@ -71,6 +75,14 @@ def test_to_dict(sb_resources, hf):
         tester.to_dict()
 
 
+def test_records_dict(sb_resources):
+    tester = Sb.SeqBuddy(">duplicate_id\nATGCTCGTA\n>unique_id\nATGCTC\n>duplicate_id\nATGCTCGTCGATGCT\n")
+    records_dict = tester.records_dict()
+    assert list(records_dict) == ["duplicate_id", "unique_id"]
+    assert [str(rec.seq) for rec in records_dict["duplicate_id"]] == ["ATGCTCGTA", "ATGCTCGTCGATGCT"]
+    assert records_dict["unique_id"][0] is tester.records[1]
+
+
 def test_to_string(sb_resources, hf, capsys):
     tester = sb_resources.get_one("d f")
     assert hf.string2hash(str(tester)) == "b831e901d8b6b1ba52bad797bad92d14"
@@ -117,7 +129,7 @@ def test_to_string(sb_resources, hf, capsys):
     assert "Warning: Genbank format returned an 'ID too long' error. Format changed to EMBL." in err
 
 
-def test_write(sb_resources, hf):
+def test_write(sb_resources, hf, monkeypatch):
     temp_dir = br.TempDir()
     tester = sb_resources.get_one("d g")
     tester.write("%s/sequences.gb" % temp_dir.path)
@@ -127,6 +139,34 @@ def test_write(sb_resources, hf):
     tester.write("%s/sequences.fa" % temp_dir.path, out_format="fasta")
     with open("%s/sequences.fa" % temp_dir.path, encoding="utf-8") as ifile:
         assert hf.string2hash(ifile.read()) == "25073539df4a982b7f99c72dd280bb8f"
+    assert tester.out_format == "gb"
+
+    tester.out_format = "raw"
+    tester.write("%s/sequences.txt" % temp_dir.path)
+    with open("%s/sequences.txt" % temp_dir.path, encoding="utf-8") as ifile:
+        assert ifile.read() == str(tester)
+
+    # Fall back to EMBL partway through a GenBank write, without leaving partial GenBank output behind
+    seqio_write = Sb.SeqIO.write
+
+    def mock_write(records, handle, _format):
+        if _format == "gb":
+            handle.write("LOCUS       bar\n")
+            raise ValueError("Locus identifier 'fooooooooooooooobaaaaaaaaaaaaaaaaaar' is too long")
+        return seqio_write(records, handle, _format)
+
+    monkeypatch.setattr(Sb.SeqIO, "write", mock_write)
+    tester = Sb.SeqBuddy(">bar\nATGATGATGTAGT\n>fooooooooooooooobaaaaaaaaaaaaaaaaaar\nATGATGATGTAGT\n", out_format="gb")
+    tester.write("%s/sequences.gb" % temp_dir.path)
+    with open("%s/sequences.gb" % temp_dir.path, encoding="utf-8") as ifile:
+        output = ifile.read()
+    assert output == str(tester)
+    assert "LOCUS" not in output
+
+    tester.records = []
+    tester.write("%s/sequences.gb" % temp_dir.path)
+    with open("%s/sequences.gb" % temp_dir.path, encoding="utf-8") as ifile:
+        assert ifile.read() == "Error: No sequences in object.\n"
 
 
 def test_print_hashmap(sb_resources, hf):
@@ -149,7 +189,36 @@ def test_reverse_hashmap(sb_resources):
 
 
 # ################################################# HELPER FUNCTIONS ################################################# #
-# ToDo: Missing tests for --> _add_buddy_data, FeatureReMapper
+# ToDo: Missing tests for --> _add_buddy_data
+# ######################  'FeatureReMapper' ###################### #
+def test_feature_remapper(sb_resources):
+    for exists in [[False, False, True, False, True, True, False], [True, False, True], [False, False]]:
+        rec = Sb.SeqBuddy(">seq1\n%s" % ("A" * len(exists)), in_format="fasta").records[0]
+        for split in range(len(exists) + 1):
+            tester, control = Sb.FeatureReMapper(rec), Sb.FeatureReMapper(rec)
+            tester.extend_many(exists[:split])
+            tester.extend_many(np.array(exists[split:], dtype=bool))
+            for next_pos in exists:
+                control.extend(next_pos)
+            assert tester.position_map == control.position_map
+            assert tester.starting_position_filled == control.starting_position_filled
+        with pytest.raises(AttributeError) as err:
+            tester.extend_many([True])
+        assert "The position map has already been fully populated." in str(err)
+
+    rec = sb_resources.get_one("d g").records[0]
+    remapper = Sb.FeatureReMapper(rec)
+    remapper.extend_many([indx % 2 == 0 or 200 < indx < 300 for indx in range(len(rec.seq))])
+    new_rec = remapper.remap_features(Sb.SeqRecord(rec.seq, id=rec.id))
+    assert len(new_rec.features) == 6
+    assert [(feat.type, int(feat.location.start), int(feat.location.end)) for feat in new_rec.features][:4] == \
+        [('CDS', 0, 652), ('splice_donor', 18, 23), ('TMD1', 39, 71), ('TMD2', 244, 275)]
+
+    remapper = Sb.FeatureReMapper(rec)
+    remapper.extend_many([False] * len(rec.seq))
+    assert remapper.remap_features(Sb.SeqRecord(rec.seq, id=rec.id)).features == []
+
+
 # ######################  '_check_for_blast_bin' ###################### #
 def test_check_blast_bin(monkeypatch, capsys):
     monkeypatch.setattr(Sb, "which", lambda *_: True)
@@ -285,8 +354,158 @@ def test_no__input():
         Sb.SeqBuddy()
 
 
+def test_pattern_hits(sb_resources):
+    records = sb_resources.get_one("d g").records
+    patterns = ["α1", "^Mle-Panxα1$", "^Mle\\-Panxα1$", "Panx.1[02]", "*", "Mle-Panxα1$", "(?i)ml47742", "foo"]
+    for fields in [lambda rec: [rec.id, rec.name], lambda rec: [rec.id, rec.description, str(rec.annotations)]]:
+        hits = Sb._pattern_hits(records, patterns, fields)
+        for pattern, pat_hits in zip(patterns, hits):
+            pattern = ".*" if pattern == "*" else pattern
+            assert pat_hits == [indx for indx, rec in enumerate(records)
+                                if any(re.search(pattern, text) for text in fields(rec))]
+
+    hits = Sb._pattern_hits(records, patterns, lambda rec: [rec.id])
+    assert [len(pat_hits) for pat_hits in hits] == [5, 1, 1, 3, 13, 1, 0, 0]
+    assert [records[indx].id for indx in hits[0]] == ["Mle-Panxα1", "Mle-Panxα12", "Mle-Panxα11", "Mle-Panxα10B",
+                                                      "Mle-Panxα10A"]
+
+
+# ######################  'SeqIndex' ###################### #
+def test_seq_index(sb_resources, hf):
+    tmp_dir = br.TempDir()
+    for code in ["d f", "d g"]:
+        seq_file = shutil.copy(sb_resources.get_one(code, "paths"), tmp_dir.path)
+        with pytest.raises(FileNotFoundError) as err:
+            Sb.SeqIndex(seq_file)
+        assert "No index found for" in str(err)
+        assert Sb._load_index(seq_file) is None
+
+        Sb.index_file(seq_file).close()
+        seqbuddy = Sb.SeqBuddy(seq_file)
+        with Sb.SeqIndex(seq_file) as seq_index:
+            assert len(seq_index) == 13
+            assert [str(rec.seq) for rec in seq_index.records([2, 0])] == [str(seqbuddy.records[2].seq),
+                                                                           str(seqbuddy.records[0].seq)]
+            for patterns in [["α1"], ["^Mle-Panxα1$", "α2"], ["full"], ["*"]]:
+                tester = seq_index.pull_recs(list(patterns))
+                assert hf.buddy2hash(tester) == hf.buddy2hash(Sb.pull_recs(Sb.make_copy(seqbuddy), list(patterns)))
+
+            sequence = str(seqbuddy.records[1].seq)
+            for start, end in [(0, None), (5, 100), (59, 61), (60, 120), (-20, None), (100, 50)]:
+                assert seq_index.subsequence("Mle-Panxα7A", start, end) == sequence[start:end]
+            with pytest.raises(KeyError) as err:
+                seq_index.subsequence("foo")
+            assert "'foo' is not in the index" in str(err)
+
+        # Modifying the file makes the index stale
+        os.utime(seq_file, (time.time() + 10, time.time() + 10))
+        with pytest.raises(RuntimeError) as err:
+            Sb.SeqIndex(seq_file)
+        assert "is older than its sequence file" in str(err)
+        assert Sb._load_index(seq_file) is None
+
+    irregular = os.path.join(tmp_dir.path, "irregular.fa")
+    with open(irregular, "w", encoding="utf-8") as ofile:
+        ofile.write(">seq1 desc\nACGTA\nCGTAC\nGG\n>seq2\nACG\nACGTA\n>seq3\n")
+    with Sb.index_file(irregular) as seq_index:
+        assert seq_index.subsequence("seq1", 3, 11) == "TACGTACG"
+        assert seq_index.subsequence("seq2", 2) == "GACGTA"
+        assert seq_index.subsequence("seq3") == ""
+        assert [rec.description for rec in seq_index.records()] == ["seq1 desc", "seq2", "seq3"]
+
+
+# ######################  'PatternScanner' ###################### #
+def test_pattern_scanner_compile():
+    scanner = Sb.PatternScanner(["ATGgt", "[AC]N{2}.", "[^t]\\*-", "a[tu]g(?:...)*?[tu]aa", "AT+", "A{2,3}", "x"])
+    assert scanner.patterns[0] == "ATGgt"
+    assert list(scanner.tables) == [0, 1, 2, 6]
+    assert list(scanner.regexes) == [3, 4, 5]
+    assert scanner.tables[1].shape == (4, 256)
+    assert scanner.tables[0][3][ord("G")] and not scanner.tables[0][3][ord("g")]
+    assert scanner.tables[1][0][[ord("A"), ord("C")]].all() and scanner.tables[1][0].sum() == 2
+    assert scanner.tables[1][3].sum() == 255
+    assert scanner.tables[2][0].sum() == 255 and not scanner.tables[2][0][ord("T")]
+
+    scanner = Sb.PatternScanner(["ATGGN{6}", "RY"], IUPAC.ambiguous_dna, ambig=True)
+    assert scanner.tables[0].shape == (10, 256)
+    assert scanner.tables[0][9][[ord(x) for x in "ACGT"]].all() and not scanner.tables[0][9][ord("N")]
+    assert scanner.tables[1][1][[ord(x) for x in "CT"]].all() and scanner.tables[1][1].sum() == 2
+
+
+def test_pattern_scanner_scan():
+    seq = "aaAcgTTacgaccgAAAAtacgNacg-*acg"
+    patterns = ["acg", "A{2}", "[ct]g", "ac[^g]", "a(cg|aa)", "\\*", "x", "a-"]
+    scanner = Sb.PatternScanner(patterns)
+    assert scanner.scan(seq) == scanner.scan(Sb.Seq(seq))
+    for pattern, matches in zip(patterns, scanner.scan(seq)):
+        assert matches == [(match.start(), match.end()) for match in re.finditer(pattern, seq, flags=re.IGNORECASE)]
+
+    # Force every table pattern through the prefix index, and then through a full scan
+    scanner.max_prefixes = 0
+    assert scanner.scan(seq) == Sb.PatternScanner(patterns).scan(seq)
+    assert scanner.scan("") == [[] for _ in patterns]
+    assert scanner.scan("ac") == [[], [], [], [], [], [], [], []]
+    assert Sb.PatternScanner(["AA"]).scan("AAAAA") == [[(0, 2), (2, 4)]]
+
 # ######################  'make_copy' ###################### #
 def test_make_copy(sb_resources, hf):
     tester = Sb.SeqBuddy(sb_resources.get_one("d f", mode="paths"))
     tester_copy = Sb.make_copy(tester)
     assert hf.buddy2hash(tester) == hf.buddy2hash(tester_copy)
+
+    # Sequence strings are shared, everything else is independent
+    tester = Sb.SeqBuddy(sb_resources.get_one("d g", mode="paths"))
+    before = hf.buddy2hash(tester)
+    tester_copy = Sb.make_copy(tester)
+    assert tester_copy.alpha is tester.alpha
+    assert str(tester_copy.records[0].seq) is str(tester.records[0].seq)
+    assert tester_copy.records[0].seq.alphabet is tester.records[0].seq.alphabet
+    Sb.lowercase(tester_copy)
+    Sb.rename(tester_copy, "Mle", "Foo")
+    tester_copy.records[1].features = []
+    tester_copy.records[2].annotations["foo"] = "bar"
+    tester_copy.hash_map["foo"] = "bar"
+    assert hf.buddy2hash(tester) == before
+    assert "foo" not in tester.records[2].annotations
+    assert not tester.hash_map
+
+
+# ######################  'stream' ###################### #
+def test_stream(sb_resources, hf):
+    for key in ["d f", "d g", "p f", "p g"]:
+        _path = sb_resources.get_one(key, mode="paths")
+        chunks = list(Sb.stream(_path, chunk_size=5))
+        assert [len(chunk) for chunk in chunks] == [5, 5, 3]
+        full_buddy = Sb.SeqBuddy(_path)
+        assert "".join([str(chunk) for chunk in chunks]) == str(full_buddy)
+        assert chunks[-1].alpha == full_buddy.alpha
+
+    with open(sb_resources.get_one("d f", mode="paths"), "r", encoding="utf-8") as ifile:
+        tester = [Sb.uppercase(chunk) for chunk in Sb.stream(ifile, out_format="genbank", chunk_size=4)]
+    full_buddy = Sb.SeqBuddy(sb_resources.get_one("d f", mode="paths"), out_format="genbank")
+    assert "".join([str(chunk) for chunk in tester]) == str(Sb.uppercase(full_buddy))
+
+    tester = list(Sb.stream("ATGCTAGC", in_format="raw"))
+    assert str(tester[0]) == ">raw_input\nATGCTAGC\n"
+
+
+def test_stream_errors(sb_resources, sb_odd_resources):
+    with pytest.raises(ValueError) as err:
+        Sb.stream(sb_resources.get_one("d n", mode="paths"))
+    assert "Format 'nexus' can not be streamed" in str(err)
+
+    with pytest.raises(ValueError) as err:
+        Sb.stream(sb_resources.get_one("d f", mode="paths"), out_format="phylip")
+    assert "Format 'phylip' can not be streamed" in str(err)
+
+    with pytest.raises(ValueError) as err:
+        Sb.stream(sb_resources.get_one("d f", mode="paths"), chunk_size=0)
+    assert "chunk_size must be a positive integer" in str(err)
+
+    with pytest.raises(br.GuessError) as err:
+        Sb.stream(sb_odd_resources["gibberish"])
+    assert "Could not determine format from sb_input file" in str(err)
+
+    with pytest.raises(br.GuessError) as err:
+        Sb.stream(["foo"])
+    assert "Unable to stream input type" in str(err)
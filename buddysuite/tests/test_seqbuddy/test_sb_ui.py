@@ -25,6 +25,7 @@ Description: Collection of PyTest unit tests for the AlignBuddy.py program
 
 import pytest
 import os
+import shutil
 import argparse
 from copy import deepcopy
 from unittest import mock
@@ -306,7 +307,7 @@ def test_count_codons_ui(capsys, sb_resources, hf):
     test_in_args.count_codons = ["conc"]
     Sb.command_line_ui(test_in_args, sb_resources.get_one("d g"), True)
     out, err = capsys.readouterr()
-    assert hf.string2hash(out) == "3e76bd510de4a61efb17ffc186ef9e68"
+    assert hf.string2hash(out) == "5fa9b843dd2cb3a3c28aa7d93795629d"
 
     with pytest.raises(TypeError) as err:
         Sb.command_line_ui(test_in_args, sb_resources.get_one("p g"), pass_through=True)
@@ -324,7 +325,7 @@ def test_count_residues_ui(capsys, sb_resources, hf):
     test_in_args.count_residues = ["conc"]
     Sb.command_line_ui(test_in_args, sb_resources.get_one('p f'), True)
     out, err = capsys.readouterr()
-    assert hf.string2hash(out) == "051d98f6e2ba6159f5f282562d3627b4"
+    assert hf.string2hash(out) == "108c26db4641e675978c852ca296eee2"
 
 
 # ######################  '-dgn' '--degenerate_sequence'################### #
@@ -486,11 +487,24 @@ def test_extract_regions_ui(sb_resources, hf, capsys):
 # ######################  '-fcpg', '--find_cpg' ###################### #
 def test_find_cpg_ui(capsys, sb_resources, hf):
     test_in_args = deepcopy(in_args)
-    test_in_args.find_CpG = True
+    test_in_args.find_CpG = [[]]
     Sb.command_line_ui(test_in_args, sb_resources.get_one('d g'), True)
     out, err = capsys.readouterr()
-    assert hf.string2hash(out) == "9499f524da0c35a60502031e94864928"
-    assert hf.string2hash(err) == "1fc07e5884a2a4c1344865f385b1dc79"
+    assert hf.string2hash(err) == "599ca23b95aff4bee0afba6f8b4f946c"
+    islands = [line.split()[1] for line in out.split("\n") if line.strip().startswith("CpG_island")]
+    assert islands == ["935..1203", "675..738", "239..356", "207..263", "429..447", "690..920", "183..419", "641..700",
+                       "896..898", "988..1197", "162..236", "951..1251", "823..1077", "216..490", "1036..1290"]
+
+    test_in_args.find_CpG = [["100", "0.6", "0.8"]]
+    Sb.command_line_ui(test_in_args, sb_resources.get_one('d g'), True)
+    out, err = capsys.readouterr()
+    assert "Mle-Panxα11: 1165-1195\n" in err
+
+    test_in_args.find_CpG = [["foo"]]
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, sb_resources.get_one('d g'), pass_through=True)
+    assert "invalid literal for int()" in str(err)
+    test_in_args.find_CpG = [[]]
 
     Sb.command_line_ui(test_in_args, Sb.SeqBuddy(">seq1\nATGCCTAGCTAGCT", in_format="fasta"), True)
     out, err = capsys.readouterr()
@@ -539,6 +553,21 @@ def test_find_pattern_ui(capsys, sb_resources, hf):
     assert hf.string2hash(err) == "f54ddf323e0d8fecb2ef52084d048531"
 
 
+def test_find_pattern_reverse_ui(capsys, sb_resources):
+    test_in_args = deepcopy(in_args)
+    test_in_args.find_pattern = ["ATGGT", "rc"]
+    Sb.command_line_ui(test_in_args, Sb.SeqBuddy(">seq1\naaATGGTcccACCATttt"), True)
+    out, err = capsys.readouterr()
+    assert out == ">seq1\naaATGGTcccACCATttt\n"
+    assert err == "#### 1 matches found across 1 sequences for pattern 'ATGGT' ####\nseq1: 2\n\n" \
+                  "#### 1 reverse strand matches found across 1 sequences for pattern 'ATGGT' ####\nseq1: 10\n\n"
+
+    test_in_args.find_pattern = ["MTV", "rc"]
+    Sb.command_line_ui(test_in_args, sb_resources.get_one("p g"), True)
+    out, err = capsys.readouterr()
+    assert "Nucleic acid sequences required." in err
+
+
 # ######################  '-frp', '--find_repeats' ###################### #
 def test_find_repeats_ui(capsys, sb_resources, sb_odd_resources, hf):
     test_in_args = deepcopy(in_args)
@@ -728,6 +757,37 @@ def test_hash_seq_ids_ui(capsys, sb_resources):
     assert "cover all sequences, so it has been increased to 2" in err
 
 
+# ######################  '-idx', '--index_file' ###################### #
+def test_index_file_ui(capsys, monkeypatch, sb_resources, hf):
+    tmp_dir = br.TempDir()
+    seq_file = shutil.copy(sb_resources.get_one("d f", "paths"), tmp_dir.path)
+    test_in_args = deepcopy(in_args)
+    test_in_args.index_file = True
+    test_in_args.sequence = [seq_file]
+    Sb.command_line_ui(test_in_args, Sb.SeqBuddy(seq_file), True)
+    out, err = capsys.readouterr()
+    assert err == "Indexed 13 records in %s.fai\n" % seq_file
+    assert os.path.isfile("%s.fai" % seq_file)
+
+    # Pull records straight from the index
+    monkeypatch.setattr(sys, "argv", ['SeqBuddy.py', seq_file, "-pr", "α1", "α2"])
+    temp_in_args, seq_index = Sb.argparse_init()
+    assert type(seq_index) == Sb.SeqIndex
+    Sb.command_line_ui(temp_in_args, seq_index, True)
+    out, err = capsys.readouterr()
+    assert hf.string2hash(out) == "cd8d7284f039233e090c16e8aa6b5035"
+
+    for argv in [[seq_file, "-pr", "full", "α1"], [seq_file, "-pr", "α1", "-f", "gb"], [seq_file, "-li"]]:
+        monkeypatch.setattr(sys, "argv", ['SeqBuddy.py'] + argv)
+        temp_in_args, seqbuddy = Sb.argparse_init()
+        assert type(seqbuddy) == Sb.SeqBuddy
+
+    test_in_args.sequence = ["ATGCATGCATGC"]
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, Sb.SeqBuddy("ATGCATGCATGC", "raw"), pass_through=True)
+    assert "The index_file tool requires the path to a single sequence file." in str(err)
+
+
 # ######################  '-is', '--insert_seq' ###################### #
 def test_insert_seqs_ui(capsys, sb_resources, hf):
     test_in_args = deepcopy(in_args)
@@ -1128,13 +1188,32 @@ def test_pull_records_with_feature_ui(capsys, sb_resources, hf):
 # ######################  '-prg', '--purge' ###################### #
 def test_purge_ui(capsys, sb_resources, hf):
     test_in_args = deepcopy(in_args)
-    test_in_args.purge = 200
+    test_in_args.purge = [["200"]]
     Sb.command_line_ui(test_in_args, sb_resources.get_one('p f'), True)
     out, err = capsys.readouterr()
     assert hf.string2hash(out) == "b21b2e2f0ca1fcd7b25efbbe9c08858c", print(out)
     assert hf.string2hash(err) == "fbfde496ae179f83e3d096da15d90920", print(err)
 
 
+def test_purge_cd_hit_ui(capsys, sb_resources):
+    test_in_args = deepcopy(in_args)
+    test_in_args.purge = [["50", "cd_hit"]]
+    Sb.command_line_ui(test_in_args, sb_resources.get_one('p f'), True)
+    out, err = capsys.readouterr()
+    assert str(Sb.purge(sb_resources.get_one('p f'), 50, method="cd_hit")) == out
+    assert "Mle-Panxα10A\nMle-Panxα12, Mle-Panxα9, Mle-Panxα10B\n" in err
+
+    test_in_args.purge = [["50", "foo"]]
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, sb_resources.get_one('p f'), pass_through=True)
+    assert "Unknown purge method 'foo'" in str(err)
+
+    test_in_args.purge = [["bar", "cd_hit"]]
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, sb_resources.get_one('p f'), pass_through=True)
+    assert "could not convert string to float: 'bar'" in str(err)
+
+
 # ######################  '-ri', '--rename_ids' ###################### #
 def test_rename_ids_ui(capsys, sb_resources, hf):
     test_in_args = deepcopy(in_args)
@@ -1297,6 +1376,41 @@ def test_shuffle_seqs_ui(capsys, sb_resources, hf):
     assert hf.string2hash(out) != "b831e901d8b6b1ba52bad797bad92d14"
 
 
+# ######################  '-s', '--stream' ###################### #
+def test_stream_ui(capsys, sb_resources, hf):
+    test_in_args = deepcopy(in_args)
+    test_in_args.stream = True
+    test_in_args.uppercase = True
+    Sb.command_line_ui(test_in_args, Sb.stream(sb_resources.get_one("d g", mode="paths"), chunk_size=4), True)
+    out, err = capsys.readouterr()
+    assert out == str(Sb.uppercase(sb_resources.get_one("d g")))
+
+    test_in_args.uppercase = False
+    test_in_args.pull_records = ["full", "ML25993a"]
+    Sb.command_line_ui(test_in_args, Sb.stream(sb_resources.get_one("d f", mode="paths"), chunk_size=4), True)
+    out, err = capsys.readouterr()
+    assert out == str(Sb.pull_recs(sb_resources.get_one("d f"), "ML25993a", description=True))
+
+    test_in_args.pull_records = False
+    test_in_args.translate = True
+    with pytest.raises(TypeError) as err:
+        Sb.command_line_ui(test_in_args, Sb.stream(sb_resources.get_one("p f", mode="paths")), pass_through=True)
+    assert "Nucleic acid sequence required, not protein." in str(err)
+
+    test_in_args.translate = False
+    test_in_args.num_seqs = True
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, Sb.stream(sb_resources.get_one("d f", mode="paths")), pass_through=True)
+    assert "The --stream flag can only be used with the following tools" in str(err)
+
+    test_in_args.num_seqs = False
+    test_in_args.uppercase = True
+    test_in_args.in_place = True
+    with pytest.raises(ValueError) as err:
+        Sb.command_line_ui(test_in_args, Sb.stream(sb_resources.get_one("d f", mode="paths")), pass_through=True)
+    assert "The --stream flag can not be combined with --in_place" in str(err)
+
+
 # ######################  '-d2r', '--transcribe' ###################### #
 def test_transcribe_ui(capsys, sb_resources, hf):
     test_in_args = deepcopy(in_args)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Compare the time and memory cost of copying SeqBuddy/AlignBuddy objects with make_copy() against a plain
+deepcopy() of the same object (the way make_copy() used to work).
+
+$: python make_copy_benchmark.py All_pannexins_nuc.gb -i 20
+"""
+import sys
+import os
+import argparse
+import timeit
+import tracemalloc
+from copy import deepcopy
+import buddysuite.SeqBuddy as Sb
+import buddysuite.AlignBuddy as Alb
+
+
+def deepcopy_buddy(buddy):
+    alphabet_list = [rec.seq.alphabet for rec in (buddy.records() if hasattr(buddy, "alignments") else buddy.records)]
+    _copy = deepcopy(buddy)
+    _copy.alpha = buddy.alpha
+    for indx, rec in enumerate(_copy.records() if hasattr(_copy, "alignments") else _copy.records):
+        rec.seq.alphabet = alphabet_list[indx]
+    return _copy
+
+
+def peak_memory(func, buddy):
+    tracemalloc.start()
+    _copy = func(buddy)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del _copy
+    return peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="make_copy_benchmark", description="Benchmark make_copy() against deepcopy()",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("reference", help="Sequence or alignment file")
+    parser.add_argument("-a", "--alignment", action='store_true', help="Load the reference as an AlignBuddy object")
+    parser.add_argument("-i", "--iterations", action='store', default=10, type=int,
+                        help="Specify number of timeit replicates")
+    in_args = parser.parse_args()
+
+    if not os.path.isfile(in_args.reference):
+        sys.stderr.write("Error: Reference file does not exist\n")
+        sys.exit()
+
+    if in_args.alignment:
+        buddy = Alb.AlignBuddy(in_args.reference)
+        make_copy = Alb.make_copy
+    else:
+        buddy = Sb.SeqBuddy(in_args.reference)
+        make_copy = Sb.make_copy
+
+    print("%-12s %12s %12s" % ("method", "sec/copy", "peak KiB"))
+    for name, func in [("deepcopy", deepcopy_buddy), ("make_copy", make_copy)]:
+        seconds = timeit.timeit(lambda: func(buddy), number=in_args.iterations) / in_args.iterations
+        print("%-12s %12.5f %12.1f" % (name, seconds, peak_memory(func, buddy) / 1024))